@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Accounting Events
+A trigger on radacct publishes every accounting start, interim update and stop
+on the radius_acct channel, so services that keep state in memory (IP pools,
+session counters, usage) follow sessions without polling radacct.
+"""
+
+import json
+
+CHANNEL = 'radius_acct'
+
+ACCT_EVENTS_SCHEMA = f"""
+CREATE OR REPLACE FUNCTION radacct_notify() RETURNS trigger AS $$
+DECLARE
+    event TEXT;
+BEGIN
+    IF NEW.acctstoptime IS NOT NULL THEN
+        IF TG_OP = 'UPDATE' AND OLD.acctstoptime IS NOT NULL THEN
+            RETURN NULL;
+        END IF;
+        event := 'stop';
+    ELSIF TG_OP = 'INSERT' THEN
+        event := 'start';
+    ELSE
+        event := 'interim';
+    END IF;
+    PERFORM pg_notify('{CHANNEL}', json_build_object(
+        'event', event,
+        'username', NEW.username,
+        'sessionid', NEW.acctsessionid,
+        'nasip', host(NEW.nasipaddress),
+        'framedip', host(NEW.framedipaddress),
+        'callingstationid', NEW.callingstationid,
+        'input_octets', NEW.acctinputoctets,
+        'output_octets', NEW.acctoutputoctets,
+        'interval', NEW.acctinterval,
+        'ts', EXTRACT(EPOCH FROM COALESCE(NEW.acctstoptime, NEW.acctupdatetime, NEW.acctstarttime, now()))
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS radacct_notify_trg ON radacct;
+CREATE TRIGGER radacct_notify_trg AFTER INSERT OR UPDATE ON radacct
+    FOR EACH ROW EXECUTE FUNCTION radacct_notify();
+"""
+
+
+def parse_events(batch):
+    """[(channel, payload), ...] from pg_listen -> accounting event dicts; other channels are skipped"""
+    events = []
+    for channel, payload in batch:
+        if channel != CHANNEL:
+            continue
+        try:
+            events.append(json.loads(payload))
+        except ValueError:
+            print(f"Ignoring malformed accounting event: {payload[:100]}")
+    return events
@@ -0,0 +1,719 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Accounting Shards
+radacct can be split over several PostgreSQL servers, keyed by NAS IP. The
+routing map (acct_shard_routes on the primary) assigns networks, a single
+NAS (/32) or a region's range, to a named shard; the longest matching
+network wins and unmatched NAS stay on the default shard. Accounting writes
+and per-NAS session lookups go to one shard; cross-shard reads (online
+users, the online count, usage reports) run on every shard in parallel and
+the results are merged. Rebalancing moves a NAS's history to another shard
+in batches, switches its route, then moves what was left.
+
+Shards are listed in DB_CONFIG['acct_shards'] ({name: dict or DSN}, dicts
+inherit unset keys from the primary) or ACCT_SHARD_DSNS (name=DSN,...).
+The primary itself is the shard 'main'; with no shards configured
+everything stays on it, as before.
+
+Usage:
+    python acct_shards.py --status
+    python acct_shards.py --init                  # radacct schema on every shard
+    python acct_shards.py --route 10.20.0.0/16 north
+    python acct_shards.py --move-nas 10.20.0.1 north
+"""
+
+import argparse
+import contextvars
+import hashlib
+import heapq
+import ipaddress
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+
+import reports
+import session_reaper
+import tracing
+from db_routing import connection_params
+
+PRIMARY_SHARD = 'main'
+DEFAULT_SHARD = os.environ.get('ACCT_DEFAULT_SHARD', PRIMARY_SHARD)
+ROUTES_TTL = float(os.environ.get('ACCT_ROUTES_TTL', '30'))        # seconds a process keeps the routing map
+SCATTER_TIMEOUT = float(os.environ.get('ACCT_SCATTER_TIMEOUT', '10'))
+SCATTER_WORKERS = int(os.environ.get('ACCT_SCATTER_WORKERS', '16'))
+WRITER_POOL_SIZE = int(os.environ.get('ACCT_WRITER_POOL_SIZE', '8'))  # connections per shard
+MOVE_BATCH = 5000
+REBALANCE_LOCK_ID = 0x53484152   # one rebalance at a time
+
+# Parts of db_schema applied to every shard (the primary already has them all)
+SHARD_SCHEMA_PARTS = ['base', 'reports', 'acct_events', 'reaper', 'acct_shards', 'archive']
+
+ACCT_SHARDS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS acct_shard_routes (
+    network CIDR PRIMARY KEY,
+    shard VARCHAR(32) NOT NULL,
+    updated_at TIMESTAMP with time zone NOT NULL DEFAULT now()
+);
+
+-- One row per Acct-Unique-Session-Id, so a retransmitted Start, Interim-Update or Stop
+-- cannot add a second row for a session. Rows written twice before the index existed
+-- carry the same octets, so one is kept (a closed one, else the last updated).
+DELETE FROM radacct r USING (
+    SELECT radacctid, row_number() OVER (
+        PARTITION BY acctuniqueid
+        ORDER BY acctstoptime IS NULL, acctupdatetime DESC NULLS LAST, radacctid) AS n
+    FROM radacct
+    WHERE acctuniqueid IN (SELECT acctuniqueid FROM radacct WHERE acctuniqueid <> ''
+                           GROUP BY acctuniqueid HAVING COUNT(*) > 1)
+) d
+WHERE r.radacctid = d.radacctid AND d.n > 1;
+CREATE UNIQUE INDEX IF NOT EXISTS radacct_uniqueid_key ON radacct (acctuniqueid) WHERE acctuniqueid <> '';
+DROP INDEX IF EXISTS radacct_uniqueid_idx;
+"""
+
+# ON CONFLICT target matching radacct_uniqueid_key
+UNIQUE_SESSION = "(acctuniqueid) WHERE acctuniqueid <> ''"
+
+# radacct columns copied when a NAS moves (radacctid is assigned by the target)
+RADACCT_COLUMNS = [
+    'acctsessionid', 'acctuniqueid', 'username', 'groupname', 'realm', 'nasipaddress', 'nasportid',
+    'nasporttype', 'acctstarttime', 'acctupdatetime', 'acctstoptime', 'acctinterval', 'acctsessiontime',
+    'acctauthentic', 'connectinfo_start', 'connectinfo_stop', 'acctinputoctets', 'acctoutputoctets',
+    'calledstationid', 'callingstationid', 'acctterminatecause', 'servicetype', 'framedprotocol',
+    'framedipaddress',
+]
+
+_executor = ThreadPoolExecutor(max_workers=SCATTER_WORKERS, thread_name_prefix='acct-shard')
+_default_router = None
+
+
+def shard_params(config):
+    """{name: connection settings} of every shard, the primary included"""
+    primary = connection_params(config)
+    shards = dict(config.get('acct_shards') or {})
+    env = os.environ.get('ACCT_SHARD_DSNS')
+    if env:
+        for item in env.split(','):
+            name, _, dsn = item.strip().partition('=')
+            if name and dsn:
+                shards[name.strip()] = dsn.strip()
+    params = {PRIMARY_SHARD: primary}
+    for name, shard in shards.items():
+        params[name] = dict(primary, **shard) if isinstance(shard, dict) else shard
+    return params
+
+
+def _connect(params):
+    if isinstance(params, str):
+        return psycopg2.connect(params, connection_factory=tracing.connection_factory())
+    return psycopg2.connect(**params, connection_factory=tracing.connection_factory())
+
+
+class ShardRouter:
+    """Maps NAS IPs to accounting shards and runs queries on one or all of them"""
+
+    def __init__(self, config, routes_ttl=ROUTES_TTL):
+        self.shards = shard_params(config)
+        self.default = DEFAULT_SHARD if DEFAULT_SHARD in self.shards else PRIMARY_SHARD
+        self.routes_ttl = routes_ttl
+        self._routes = []           # [(network, shard)], longest prefix first
+        self._by_nas = {}           # nas ip -> shard, cleared on every reload
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    @property
+    def sharded(self):
+        return len(self.shards) > 1
+
+    def connect(self, shard=PRIMARY_SHARD):
+        return _connect(self.shards[shard])
+
+    # Routing
+
+    def load_routes(self, conn=None):
+        """Read the routing map from the primary"""
+        own = conn is None
+        conn = conn or self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT network::text, shard FROM acct_shard_routes")
+            rows = cur.fetchall()
+            conn.rollback()
+        finally:
+            if own:
+                conn.close()
+        routes = []
+        for network, shard in rows:
+            if shard not in self.shards:
+                print(f"Accounting route {network} -> {shard}: no such shard configured, ignored")
+                continue
+            routes.append((ipaddress.ip_network(network), shard))
+        routes.sort(key=lambda route: route[0].prefixlen, reverse=True)
+        with self._lock:
+            self._routes = routes
+            self._by_nas = {}
+            self._loaded_at = time.monotonic()
+        return routes
+
+    def shard_for(self, nas_ip):
+        """Shard holding the accounting of this NAS"""
+        if not self.sharded:
+            return PRIMARY_SHARD
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.routes_ttl:
+            try:
+                self.load_routes()
+            except psycopg2.Error as e:
+                # Keep routing with the map we have
+                print(f"Accounting routes reload failed: {e}")
+                self._loaded_at = time.monotonic()
+        shard = self._by_nas.get(nas_ip)
+        if shard is None:
+            address = ipaddress.ip_address(nas_ip)
+            shard = next((name for network, name in self._routes
+                          if network.version == address.version and address in network), self.default)
+            self._by_nas[nas_ip] = shard
+        return shard
+
+    @contextmanager
+    def nas_connection(self, nas_ip, primary_conn=None):
+        """Connection to the shard of a NAS; `primary_conn` is used when that is the primary"""
+        shard = self.shard_for(nas_ip)
+        if shard == PRIMARY_SHARD and primary_conn is not None:
+            yield primary_conn
+            return
+        conn = self.connect(shard)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def routes(self):
+        with self._lock:
+            return [(str(network), shard) for network, shard in self._routes]
+
+    # Scatter-gather
+
+    @staticmethod
+    def _run(conn, sql, params):
+        cur = conn.cursor()
+        cur.execute("SET LOCAL statement_timeout = %s", (int(SCATTER_TIMEOUT * 1000),))
+        cur.execute(sql, params)
+        columns = [column.name for column in cur.description]
+        rows = cur.fetchall()
+        conn.rollback()
+        return columns, rows
+
+    def _query(self, shard, sql, params):
+        conn = self.connect(shard)
+        try:
+            return self._run(conn, sql, params)
+        finally:
+            conn.close()
+
+    def scatter(self, sql, params=None, conn=None):
+        """Run a read query on every shard in parallel
+
+        `params` may be a function of the shard name. `conn`, a connection to
+        the primary, answers for the main shard in the calling thread.
+        Returns (columns, {shard: rows}, {shard: error}).
+        """
+        params_for = params if callable(params) else (lambda name: params)
+        # Each query runs in a copy of the caller's context, so its spans join the caller's trace
+        futures = {
+            name: _executor.submit(contextvars.copy_context().run, self._query, name, sql, params_for(name))
+            for name in self.shards if conn is None or name != PRIMARY_SHARD
+        }
+        results, errors, columns = {}, {}, None
+        if conn is not None:
+            columns, results[PRIMARY_SHARD] = self._run(conn, sql, params_for(PRIMARY_SHARD))
+        for name, future in futures.items():
+            try:
+                columns, results[name] = future.result(timeout=SCATTER_TIMEOUT + 5)
+            except Exception as e:
+                print(f"Accounting shard {name} query failed: {e}")
+                errors[name] = str(e)
+        return columns, results, errors
+
+    # Writes
+
+    def _pool(self, shard):
+        with self._lock:
+            pool = self._pools.get(shard)
+            if pool is None:
+                params = self.shards[shard]
+                factory = tracing.connection_factory()
+                if isinstance(params, str):
+                    pool = psycopg2.pool.ThreadedConnectionPool(1, WRITER_POOL_SIZE, params,
+                                                                connection_factory=factory)
+                else:
+                    pool = psycopg2.pool.ThreadedConnectionPool(1, WRITER_POOL_SIZE, **params,
+                                                                connection_factory=factory)
+                self._pools[shard] = pool
+        return pool
+
+    def write(self, nas_ip, func):
+        """func(conn) in a transaction on the NAS's shard; retried once on a dropped connection"""
+        pool = self._pool(self.shard_for(nas_ip))
+        for attempt in (1, 2):
+            conn = pool.getconn()
+            try:
+                result = func(conn)
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                pool.putconn(conn, close=True)
+                if attempt == 2:
+                    raise
+                continue
+            except Exception:
+                conn.rollback()
+                pool.putconn(conn)
+                raise
+            pool.putconn(conn)
+            return result
+
+    # Cross-shard reads for the admin app
+
+    def online_count(self, conn=None):
+        """(open sessions on all reachable shards, unavailable shards)"""
+        _, results, errors = self.scatter("SELECT COUNT(*) FROM radacct WHERE acctstoptime IS NULL", None, conn)
+        return sum(rows[0][0] for rows in results.values()), sorted(errors)
+
+    def online_users(self, conn, limit):
+        """Open sessions of every shard, newest first: (columns, rows, unavailable shards)
+
+        radacctid is only unique within a shard, so every row also names its shard.
+        """
+        columns, results, errors = self.scatter("""
+            SELECT radacctid, username, host(nasipaddress) AS nasipaddress, acctsessionid, acctstarttime,
+                   host(framedipaddress) AS framedipaddress, callingstationid,
+                   acctinputoctets, acctoutputoctets, %s AS shard
+            FROM radacct
+            WHERE acctstoptime IS NULL
+            ORDER BY acctstarttime DESC
+            LIMIT %s
+        """, lambda name: (name, limit), conn)
+        if columns is None:
+            return ['shard'], [], sorted(errors)
+        return columns, merge_newest(results.values(), columns.index('acctstarttime'), limit), sorted(errors)
+
+    def gather_report(self, report_type, params):
+        """reports.get_report hook: (rows, data as of, approximate) of the sharded reports, None for the others
+
+        Each shard's usage snapshot holds only its top reports.USAGE_MAX_ROWS
+        users, so a subscriber whose NAS are on several shards may be missing
+        from a shard where their share fell below that shard's cut. The merged
+        totals are exact when every listed user is on every shard's list (or
+        the shard's list is not cut) and no other user could reach the last
+        row even with the largest share the cuts could hide; otherwise the
+        result is marked approximate.
+        """
+        if report_type != 'usage':
+            return None
+        params = dict(params)
+        _, results, errors = self.scatter("""
+            SELECT u.username, u.total_bytes, u.session_count, u.last_session, s.refreshed_at
+            FROM report_usage_top u, report_snapshots s
+            WHERE u.window_days = %s AND s.name = 'report_usage_top'
+        """, (params['days'],))
+        if errors:
+            raise psycopg2.OperationalError(f"Accounting shards unavailable: {', '.join(sorted(errors))}")
+        # A subscriber whose NAS are on several shards has a partial total on each
+        totals, shards_of, as_of = {}, {}, None
+        cuts = {}               # shard -> smallest total on its list, for the shards whose list is cut
+        for shard, rows in results.items():
+            if len(rows) >= reports.USAGE_MAX_ROWS:
+                cuts[shard] = min(int(row[1]) for row in rows)
+            for username, total_bytes, sessions, last_session, refreshed_at in rows:
+                shards_of.setdefault(username, set()).add(shard)
+                entry = totals.get(username)
+                if entry is None:
+                    totals[username] = [int(total_bytes), sessions, last_session]
+                else:
+                    entry[0] += int(total_bytes)
+                    entry[1] += sessions
+                    entry[2] = max(entry[2], last_session) if entry[2] and last_session else entry[2] or last_session
+                as_of = refreshed_at if as_of is None else min(as_of, refreshed_at)
+        top = heapq.nlargest(params['limit'], totals.items(), key=lambda item: item[1][0])
+
+        def hidden(username):
+            # Most bytes the cut lists could hide for this user
+            return sum(cut for shard, cut in cuts.items() if shard not in shards_of.get(username, ()))
+
+        approximate = False
+        if cuts:
+            listed = {username for username, _ in top}
+            last = top[-1][1][0] if len(top) == params['limit'] else 0
+            approximate = any(hidden(username) for username in listed) or sum(cuts.values()) > last or any(
+                total + hidden(username) > last
+                for username, (total, _, _) in totals.items() if username not in listed)
+        return [{'username': username, 'total_bytes': total_bytes, 'session_count': sessions,
+                 'last_session': last_session}
+                for username, (total_bytes, sessions, last_session) in top], as_of, approximate
+
+    def refresh_reports(self):
+        """Refresh the usage snapshot on every shard but the primary (reports.start_refresher hook)"""
+        for name in self.shards:
+            if name == PRIMARY_SHARD:
+                continue
+            try:
+                conn = self.connect(name)
+            except psycopg2.Error as e:
+                print(f"Accounting shard {name} report refresh failed: {e}")
+                continue
+            try:
+                reports.refresh_snapshots(conn, ['report_usage_top'])
+            except psycopg2.Error as e:
+                print(f"Accounting shard {name} report refresh failed: {e}")
+            finally:
+                conn.close()
+
+    def reaper_log(self, conn, limit=100):
+        """session_reaper_log of every shard, newest first"""
+        columns, results, _ = self.scatter("""
+            SELECT closed_at, host(nasipaddress) AS nasipaddress, cause, scope, sessions,
+                   oldest_seen, newest_seen
+            FROM session_reaper_log ORDER BY closed_at DESC LIMIT %s
+        """, (limit,), conn)
+        rows = merge_newest(results.values(), 0, limit)
+        return [dict(zip(columns, row)) for row in rows]
+
+    def status(self):
+        """Sessions per shard and the routing map, for the admin app"""
+        self.load_routes()
+        _, results, errors = self.scatter("""
+            SELECT COUNT(*), COUNT(DISTINCT nasipaddress),
+                   (SELECT reltuples::bigint FROM pg_class WHERE oid = 'radacct'::regclass)
+            FROM radacct WHERE acctstoptime IS NULL
+        """)
+        shards = []
+        for name in self.shards:
+            entry = {'shard': name, 'available': name in results, 'default': name == self.default}
+            if name in results:
+                online, nas, estimated_rows = results[name][0]
+                entry.update(online_sessions=online, online_nas=nas, estimated_rows=max(estimated_rows, 0))
+            else:
+                entry['error'] = errors.get(name)
+            shards.append(entry)
+        return {'shards': shards, 'routes': [{'network': network, 'shard': shard}
+                                             for network, shard in self.routes()]}
+
+
+def merge_newest(results, column, limit):
+    """Row lists sorted by `column` DESC (NULLs first, as PostgreSQL does), merged into the first `limit`"""
+    def key(row):
+        value = row[column]
+        return (value is None, value.timestamp() if value is not None else 0)
+    return list(islice(heapq.merge(*results, key=key, reverse=True), limit))
+
+
+def default_router():
+    """Router for the app's DB_CONFIG, for job handlers and command line tools"""
+    global _default_router
+    if _default_router is None:
+        from app import DB_CONFIG
+        _default_router = ShardRouter(DB_CONFIG)
+    return _default_router
+
+
+# Accounting writes (the RADIUS REST backend's /accounting)
+
+def _octets(attrs, name):
+    """Acct-*-Octets with its Gigawords (wraps at 4 GB), None when the NAS did not send it"""
+    if f'Acct-{name}-Octets' not in attrs:
+        return None
+    low = int(attrs[f'Acct-{name}-Octets'] or 0)
+    high = int(attrs.get(f'Acct-{name}-Gigawords') or 0)
+    return (high << 32) | low
+
+
+def unique_session_id(attrs):
+    """Acct-Unique-Session-Id, or the same hash as FreeRADIUS's acct_unique policy"""
+    if attrs.get('Acct-Unique-Session-Id'):
+        return attrs['Acct-Unique-Session-Id'][:32]
+    key = ','.join(attrs.get(name, '') for name in
+                   ('User-Name', 'Acct-Session-Id', 'NAS-IP-Address', 'NAS-Identifier', 'NAS-Port-Id', 'NAS-Port'))
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def _session_row(attrs):
+    return {
+        'uniqueid': unique_session_id(attrs),
+        'sessionid': attrs.get('Acct-Session-Id', '')[:64],
+        'username': attrs.get('User-Name', '')[:64],
+        'realm': attrs.get('Realm', '')[:64],
+        'nasip': attrs['NAS-IP-Address'],
+        'nasportid': (attrs.get('NAS-Port-Id') or attrs.get('NAS-Port') or '')[:15] or None,
+        'nasporttype': attrs.get('NAS-Port-Type'),
+        'authentic': attrs.get('Acct-Authentic'),
+        'connectinfo': attrs.get('Connect-Info', '')[:50] or None,
+        'calledstationid': attrs.get('Called-Station-Id', '')[:50] or None,
+        'callingstationid': attrs.get('Calling-Station-Id', '')[:50] or None,
+        'servicetype': attrs.get('Service-Type'),
+        'framedprotocol': attrs.get('Framed-Protocol'),
+        'framedip': attrs.get('Framed-IP-Address') or None,
+        'sessiontime': int(attrs['Acct-Session-Time']) if attrs.get('Acct-Session-Time') else None,
+        'input': _octets(attrs, 'Input'),
+        'output': _octets(attrs, 'Output'),
+        'delay': int(attrs.get('Acct-Delay-Time') or 0),
+        'cause': attrs.get('Acct-Terminate-Cause'),
+    }
+
+
+# Event time of the packet: now, less the delay the NAS reports
+EVENT_TIME = "(now() - make_interval(secs => %(delay)s))"
+
+INSERT_SESSION = f"""
+    INSERT INTO radacct (acctsessionid, acctuniqueid, username, realm, nasipaddress, nasportid, nasporttype,
+                         acctstarttime, acctupdatetime, acctstoptime, acctsessiontime, acctauthentic,
+                         connectinfo_start, acctinputoctets, acctoutputoctets, calledstationid,
+                         callingstationid, acctterminatecause, servicetype, framedprotocol, framedipaddress)
+    VALUES (%(sessionid)s, %(uniqueid)s, %(username)s, %(realm)s, %(nasip)s, %(nasportid)s, %(nasporttype)s,
+            {EVENT_TIME} - make_interval(secs => COALESCE(%(sessiontime)s, 0)), {EVENT_TIME},
+            CASE WHEN %(stop)s THEN {EVENT_TIME} END,
+            %(sessiontime)s, %(authentic)s, %(connectinfo)s, %(input)s, %(output)s, %(calledstationid)s,
+            %(callingstationid)s, %(cause)s, %(servicetype)s, %(framedprotocol)s, %(framedip)s)
+"""
+
+
+# A retransmitted Start leaves the session alone, a Start that arrives after its
+# Interim-Update only moves the start time back
+START_SESSION = f"""
+    {INSERT_SESSION}
+    ON CONFLICT {UNIQUE_SESSION} DO UPDATE SET acctstarttime = EXCLUDED.acctstarttime
+    WHERE EXCLUDED.acctstarttime < radacct.acctstarttime
+    RETURNING (xmax = 0) AS inserted
+"""
+
+# Interim-Update and Stop update the open session. A session that is already
+# closed (a retransmitted Stop, an Interim-Update that arrived after the Stop)
+# is left as it is; only when there is no row at all (the Start was lost, or
+# went to the shard the NAS was on before a move) is one inserted.
+UPDATE_SESSION = f"""
+    {INSERT_SESSION}
+    ON CONFLICT {UNIQUE_SESSION} DO UPDATE SET
+        acctupdatetime = {EVENT_TIME},
+        acctinterval = EXTRACT(EPOCH FROM {EVENT_TIME} - COALESCE(radacct.acctupdatetime,
+                                                                 radacct.acctstarttime))::bigint,
+        acctstoptime = CASE WHEN %(stop)s THEN {EVENT_TIME} END,
+        acctsessiontime = COALESCE(%(sessiontime)s, radacct.acctsessiontime),
+        acctinputoctets = COALESCE(%(input)s, radacct.acctinputoctets),
+        acctoutputoctets = COALESCE(%(output)s, radacct.acctoutputoctets),
+        framedipaddress = COALESCE(%(framedip)s::inet, radacct.framedipaddress),
+        acctterminatecause = CASE WHEN %(stop)s THEN %(cause)s END,
+        connectinfo_stop = CASE WHEN %(stop)s THEN %(connectinfo)s END
+    WHERE radacct.acctstoptime IS NULL
+    RETURNING (xmax = 0) AS inserted
+"""
+
+
+def record_accounting(router, attrs):
+    """Apply one Accounting-Request to the NAS's shard; returns what was done
+
+    Safe to repeat: a NAS that did not get its Accounting-Response sends the
+    same packet again, and that must not count the session twice.
+    """
+    status = attrs.get('Acct-Status-Type')
+    nas_ip = attrs.get('NAS-IP-Address')
+    if not nas_ip:
+        raise ValueError('NAS-IP-Address is required')
+    ipaddress.ip_address(nas_ip)
+    if status in ('Accounting-On', 'Accounting-Off'):
+        return router.write(nas_ip, lambda conn: session_reaper.reset_nas(conn, nas_ip))
+    if status not in ('Start', 'Interim-Update', 'Alive', 'Stop'):
+        raise ValueError(f'Unsupported Acct-Status-Type: {status}')
+    row = _session_row(attrs)
+
+    def apply(conn):
+        cur = conn.cursor()
+        stop = status == 'Stop'
+        cur.execute(START_SESSION if status == 'Start' else UPDATE_SESSION, dict(row, stop=stop))
+        result = cur.fetchone()
+        if result is None:
+            return 'duplicate'
+        if status == 'Start':
+            return 'started' if result[0] else 'updated'
+        if result[0]:
+            return 'inserted'
+        return 'stopped' if stop else 'updated'
+
+    return router.write(nas_ip, apply)
+
+
+# Rebalancing
+
+def set_route(conn, network, shard):
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO acct_shard_routes (network, shard) VALUES (%s, %s)
+        ON CONFLICT (network) DO UPDATE SET shard = EXCLUDED.shard, updated_at = now()
+    """, (network, shard))
+    conn.commit()
+
+
+def delete_route(conn, network):
+    cur = conn.cursor()
+    cur.execute("DELETE FROM acct_shard_routes WHERE network = %s", (network,))
+    conn.commit()
+    return cur.rowcount
+
+
+def _session_key(row):
+    # row: RADACCT_COLUMNS order
+    return row[1] if row[1] else (row[0], row[8])
+
+
+def move_batch(source, target, nas_ip, after_id, closed_only, batch_size=MOVE_BATCH):
+    """Copy one batch of a NAS's sessions to the target shard, then delete them from the source
+
+    Sessions already on the target (written there after the route switch) are
+    kept and only take the original start time. Returns (last radacctid, moved).
+    """
+    src = source.cursor()
+    src.execute(f"""
+        SELECT radacctid, {', '.join(RADACCT_COLUMNS)} FROM radacct
+        WHERE nasipaddress = %s::inet AND radacctid > %s {'AND acctstoptime IS NOT NULL' if closed_only else ''}
+        ORDER BY radacctid LIMIT %s
+    """, (nas_ip, after_id, batch_size))
+    rows = src.fetchall()
+    if not rows:
+        source.rollback()
+        return after_id, 0
+    ids = [row[0] for row in rows]
+    sessions = [row[1:] for row in rows]
+    dst = target.cursor()
+    dst.execute(f"""
+        SELECT radacctid, {', '.join(RADACCT_COLUMNS)} FROM radacct
+        WHERE nasipaddress = %s::inet AND acctsessionid = ANY(%s)
+    """, (nas_ip, list({row[0] for row in sessions})))
+    existing = {_session_key(row[1:]): row[0] for row in dst.fetchall()}
+    fresh = [row for row in sessions if _session_key(row) not in existing]
+    # A session written to the target between the check and the insert keeps that row
+    psycopg2.extras.execute_values(dst, f"""
+        INSERT INTO radacct ({', '.join(RADACCT_COLUMNS)}) VALUES %s
+        ON CONFLICT {UNIQUE_SESSION} DO NOTHING
+    """, fresh, page_size=1000)
+    duplicates = [(existing[_session_key(row)], row[8]) for row in sessions if _session_key(row) in existing]
+    if duplicates:
+        psycopg2.extras.execute_values(dst, """
+            UPDATE radacct r SET acctstarttime = LEAST(r.acctstarttime, d.started)
+            FROM (VALUES %s) AS d(radacctid, started) WHERE r.radacctid = d.radacctid
+        """, duplicates, template='(%s, %s::timestamptz)')
+    target.commit()
+    src.execute("DELETE FROM radacct WHERE radacctid = ANY(%s)", (ids,))
+    source.commit()
+    return ids[-1], len(rows)
+
+
+def move_nas(router, nas_ip, target_shard, batch_size=MOVE_BATCH, drain=None, progress=print):
+    """Move a NAS's accounting to another shard and route it there; returns sessions moved"""
+    if target_shard not in router.shards:
+        raise ValueError(f"Unknown shard: {target_shard}")
+    primary = router.connect()
+    cur = primary.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(%s)", (REBALANCE_LOCK_ID,))
+    if not cur.fetchone()[0]:
+        primary.close()
+        raise RuntimeError('Another rebalance is running')
+    moved = 0
+    try:
+        router.load_routes(primary)
+        source_shard = router.shard_for(nas_ip)
+        if source_shard == target_shard:
+            return 0
+        source, target = router.connect(source_shard), router.connect(target_shard)
+        try:
+            # 1. History while the NAS keeps writing to the source
+            last_id = 0
+            while True:
+                last_id, count = move_batch(source, target, nas_ip, last_id, True, batch_size)
+                if not count:
+                    break
+                moved += count
+                progress(f"{nas_ip}: {moved} closed sessions copied to {target_shard}")
+            # 2. Route the NAS to the target and wait until every process has reloaded the map
+            set_route(primary, str(ipaddress.ip_network(nas_ip)), target_shard)
+            wait = router.routes_ttl + 5 if drain is None else drain
+            progress(f"{nas_ip}: routed to {target_shard}, waiting {wait:.0f}s for writers to follow")
+            time.sleep(wait)
+            # 3. Open sessions and whatever arrived meanwhile
+            last_id = 0
+            while True:
+                last_id, count = move_batch(source, target, nas_ip, last_id, False, batch_size)
+                if not count:
+                    break
+                moved += count
+            progress(f"{nas_ip}: {moved} sessions moved from {source_shard} to {target_shard}")
+        finally:
+            source.close()
+            target.close()
+    finally:
+        primary.rollback()
+        cur.execute("SELECT pg_advisory_unlock(%s)", (REBALANCE_LOCK_ID,))
+        primary.commit()
+        primary.close()
+    return moved
+
+
+def apply_shard_schema(router):
+    """Create radacct and its indexes, triggers and usage snapshot on every shard"""
+    import db_schema
+    for name in router.shards:
+        if name == PRIMARY_SHARD:
+            continue
+        conn = router.connect(name)
+        try:
+            db_schema.apply_schema(conn, SHARD_SCHEMA_PARTS)
+        finally:
+            conn.close()
+        print(f"Schema applied to shard {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the accounting shards')
+    parser.add_argument('--status', action='store_true', help='Sessions per shard and the routing map')
+    parser.add_argument('--init', action='store_true', help='Apply the radacct schema to every shard')
+    parser.add_argument('--route', nargs=2, metavar=('NETWORK', 'SHARD'), help='Route a network to a shard')
+    parser.add_argument('--unroute', metavar='NETWORK', help='Remove a route (its NAS use the default shard)')
+    parser.add_argument('--move-nas', nargs=2, metavar=('IP', 'SHARD'),
+                        help="Move a NAS's accounting to a shard and route it there")
+    parser.add_argument('--batch', type=int, default=MOVE_BATCH, help='Sessions per batch when moving')
+    args = parser.parse_args()
+
+    router = default_router()
+    if args.init:
+        apply_shard_schema(router)
+    if args.route or args.unroute:
+        conn = router.connect()
+        if args.route:
+            if args.route[1] not in router.shards:
+                parser.error(f"unknown shard {args.route[1]} (configured: {', '.join(router.shards)})")
+            set_route(conn, args.route[0], args.route[1])
+            print(f"{args.route[0]} -> {args.route[1]}")
+        else:
+            print(f"Removed {delete_route(conn, args.unroute)} route")
+        conn.close()
+    if args.move_nas:
+        move_nas(router, args.move_nas[0], args.move_nas[1], args.batch)
+    if args.status or not (args.init or args.route or args.unroute or args.move_nas):
+        status = router.status()
+        for shard in status['shards']:
+            if shard['available']:
+                print(f"{shard['shard']}{' (default)' if shard['default'] else ''}: "
+                      f"{shard['online_sessions']} online on {shard['online_nas']} NAS, "
+                      f"~{shard['estimated_rows']} sessions")
+            else:
+                print(f"{shard['shard']}: unavailable ({shard['error']})")
+        for route in status['routes']:
+            print(f"  {route['network']} -> {route['shard']}")
+
+
+if __name__ == '__main__':
+    main()
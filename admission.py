@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Admission Control
+Limits how many API requests run at once in each gunicorn worker, so a slow
+database does not collect a pile of dashboard polls that make it slower.
+Requests over the limit wait in a bounded priority queue (writes first, bulk
+reads last) for at most their class deadline, and are otherwise refused at
+once with 503 and Retry-After. Needs threaded workers (gunicorn
+--worker-class gthread); the limits below apply per worker process.
+"""
+
+import heapq
+import itertools
+import json
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify
+
+from db_routing import READ_ONLY_ACTIONS
+
+# Requests running at once in one worker, and per action for the heavy reads
+MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT', '8'))
+ACTION_LIMITS = {
+    'get_users': 2,
+    'get_online_users': 2,
+    'get_billing': 2,
+    'get_reports': 2,
+    'get_usage_history': 2,
+    'get_stats': 3,
+}
+MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', '32'))
+
+# Priority classes: lower runs first; seconds a request may wait in the queue
+WRITE, READ, BULK = 0, 1, 2
+CLASS_NAMES = {WRITE: 'write', READ: 'read', BULK: 'bulk'}
+QUEUE_DEADLINE = {WRITE: 10.0, READ: 3.0, BULK: 1.0}
+BULK_ACTIONS = set(ACTION_LIMITS)
+
+# Each worker writes its counters here so any worker can report all of them
+STATS_DIR = os.environ.get('ADMISSION_STATS_DIR', '/tmp/isp-admission')
+STATS_WRITE_INTERVAL = 1.0
+
+
+def priority_class(action):
+    if action not in READ_ONLY_ACTIONS:
+        return WRITE
+    return BULK if action in BULK_ACTIONS else READ
+
+
+class Ticket:
+    __slots__ = ('action', 'priority', 'seq', 'event', 'state')
+
+    def __init__(self, action, priority, seq):
+        self.action = action
+        self.priority = priority
+        self.seq = seq
+        self.event = threading.Event()
+        self.state = 'waiting'          # -> granted | shed | expired
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController:
+    """Concurrency limits with a bounded priority queue for one worker process"""
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT, action_limits=ACTION_LIMITS, max_queue=MAX_QUEUE):
+        self.max_concurrent = max_concurrent
+        self.action_limits = action_limits
+        self.max_queue = max_queue
+        self.running = 0
+        self.running_by_action = {}
+        self._queue = []                # heap of waiting tickets (expired ones removed lazily)
+        self._waiting = 0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._service_time = {}         # action -> EWMA of seconds per request
+        self.counters = {'admitted': 0, 'queued': 0, 'shed_queue_full': 0, 'shed_deadline': 0,
+                         'evicted': 0, 'max_queue_depth': 0}
+        self.shed_by_action = {}
+        self._stats_written = 0
+
+    def _fits(self, action):
+        if self.running >= self.max_concurrent:
+            return False
+        limit = self.action_limits.get(action)
+        return limit is None or self.running_by_action.get(action, 0) < limit
+
+    def _start(self, action):
+        self.running += 1
+        self.running_by_action[action] = self.running_by_action.get(action, 0) + 1
+        self.counters['admitted'] += 1
+
+    def _grant_waiting(self):
+        """Start queued requests in priority order while they fit"""
+        if not self._queue or self.running >= self.max_concurrent:
+            return
+        skipped = []
+        while self._queue and self.running < self.max_concurrent:
+            ticket = heapq.heappop(self._queue)
+            if ticket.state != 'waiting':
+                continue
+            if self._fits(ticket.action):
+                ticket.state = 'granted'
+                self._waiting -= 1
+                self._start(ticket.action)
+                ticket.event.set()
+            else:
+                # Its action is at its own limit; let lower-priority actions go ahead
+                skipped.append(ticket)
+        for ticket in skipped:
+            heapq.heappush(self._queue, ticket)
+
+    def _shed(self, action, reason):
+        self.counters[reason] += 1
+        self.shed_by_action[action] = self.shed_by_action.get(action, 0) + 1
+
+    def acquire(self, action):
+        """True once the request may run, False if it was shed"""
+        priority = priority_class(action)
+        with self._lock:
+            # Queued requests that fit were already started on the last release
+            if self._fits(action):
+                self._start(action)
+                return True
+            if self._waiting >= self.max_queue:
+                victim = max((t for t in self._queue if t.state == 'waiting'), default=None)
+                if victim is None or victim.priority <= priority:
+                    self._shed(action, 'shed_queue_full')
+                    return False
+                # A full queue makes room for more important work by dropping the least important
+                victim.state = 'shed'
+                self._waiting -= 1
+                self._shed(victim.action, 'evicted')
+                victim.event.set()
+            ticket = Ticket(action, priority, next(self._seq))
+            heapq.heappush(self._queue, ticket)
+            self._waiting += 1
+            self.counters['queued'] += 1
+            self.counters['max_queue_depth'] = max(self.counters['max_queue_depth'], self._waiting)
+        ticket.event.wait(QUEUE_DEADLINE[priority])
+        with self._lock:
+            if ticket.state == 'granted':
+                return True
+            if ticket.state == 'waiting':
+                ticket.state = 'expired'
+                self._waiting -= 1
+                self._shed(action, 'shed_deadline')
+            return False
+
+    def release(self, action, seconds):
+        with self._lock:
+            self.running -= 1
+            self.running_by_action[action] -= 1
+            previous = self._service_time.get(action)
+            self._service_time[action] = seconds if previous is None else previous * 0.8 + seconds * 0.2
+            self._grant_waiting()
+
+    def retry_after(self, action):
+        """Seconds a refused client should wait: the time to drain the current queue, at least 1"""
+        with self._lock:
+            service = self._service_time.get(action, 1.0)
+            waiting = self._waiting
+        return max(1, min(60, math.ceil(service * (waiting + 1) / self.max_concurrent)))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'updated_at': time.time(),
+                'running': self.running,
+                'running_by_action': {a: n for a, n in self.running_by_action.items() if n},
+                'queue_depth': self._waiting,
+                'queued_by_class': {
+                    CLASS_NAMES[p]: sum(1 for t in self._queue if t.state == 'waiting' and t.priority == p)
+                    for p in CLASS_NAMES
+                },
+                'counters': dict(self.counters),
+                'shed_by_action': dict(self.shed_by_action),
+                'service_ms': {a: round(s * 1000, 1) for a, s in self._service_time.items()},
+                'limits': {'max_concurrent': self.max_concurrent, 'max_queue': self.max_queue,
+                           'actions': self.action_limits},
+            }
+
+    def write_stats(self, force=False):
+        """Publish this worker's snapshot for all_stats (at most once a second)"""
+        now = time.monotonic()
+        if not force and now - self._stats_written < STATS_WRITE_INTERVAL:
+            return
+        self._stats_written = now
+        try:
+            os.makedirs(STATS_DIR, exist_ok=True)
+            path = os.path.join(STATS_DIR, f'{os.getpid()}.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"Admission stats write failed: {e}")
+
+    def admit(self, view):
+        """Decorator for a Flask view taking `action`: 503 + Retry-After when over budget"""
+        @wraps(view)
+        def wrapper(action, *args, **kwargs):
+            if not self.acquire(action):
+                self.write_stats()
+                response = jsonify({'success': False, 'message': 'Server busy, please retry shortly'})
+                response.status_code = 503
+                response.headers['Retry-After'] = str(self.retry_after(action))
+                return response
+            started = time.monotonic()
+            try:
+                return view(action, *args, **kwargs)
+            finally:
+                self.release(action, time.monotonic() - started)
+                self.write_stats()
+        return wrapper
+
+
+def all_stats(controller):
+    """Snapshots of every live worker, plus totals"""
+    controller.write_stats(force=True)
+    workers = []
+    try:
+        names = os.listdir(STATS_DIR)
+    except OSError:
+        names = []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(STATS_DIR, name)
+        try:
+            os.kill(int(name[:-5]), 0)
+        except (ValueError, ProcessLookupError):
+            # Worker has exited
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        except PermissionError:
+            pass
+        try:
+            with open(path) as f:
+                workers.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    totals = {'running': sum(w['running'] for w in workers),
+              'queue_depth': sum(w['queue_depth'] for w in workers)}
+    for key in controller.counters:
+        values = [w['counters'].get(key, 0) for w in workers]
+        totals[key] = max(values, default=0) if key == 'max_queue_depth' else sum(values)
+    return {'totals': totals, 'workers': sorted(workers, key=lambda w: w['pid'])}
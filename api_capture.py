@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - API Traffic Capture
+Opt-in recording of the admin API calls operators actually make, for
+replaying against a test instance (benchmarks/replay.py). With API_CAPTURE_FILE
+set, every /api/<action> call (or an API_CAPTURE_RATE share of them) is logged
+with its start time, form fields, status, server-side duration, response size
+and the shape of the JSON response (keys and value types, not the values).
+Passwords, shared secrets and similar fields are replaced by REDACTED before
+anything is written.
+
+Records are buffered in memory and appended once a second as one gzip member
+per batch, so the log stays compact and several gunicorn workers can share a
+file; a gzip reader sees the members as one stream of JSON lines.
+
+Usage:
+    API_CAPTURE_FILE=/var/log/isp-radius/api-capture.jsonl.gz gunicorn ... app:app
+    python api_capture.py /var/log/isp-radius/api-capture.jsonl.gz     # summary
+"""
+
+import argparse
+import gzip
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+CAPTURE_FILE = os.environ.get('API_CAPTURE_FILE')
+CAPTURE_RATE = float(os.environ.get('API_CAPTURE_RATE', '1'))
+FLUSH_INTERVAL = 1.0
+MAX_BUFFERED = 50000         # records waiting to be written; more are dropped
+SHAPE_MAX_BYTES = 4 * 1024 * 1024    # larger responses are not parsed for their shape
+
+REDACTED = 'REDACTED'
+SECRET_FIELDS = re.compile(r'pass|secret|token|key|card|cvv|iban', re.IGNORECASE)
+
+
+def enabled():
+    return bool(CAPTURE_FILE)
+
+
+def redact(form):
+    return {name: REDACTED if SECRET_FIELDS.search(name) else value for name, value in form.items()}
+
+
+def shape(value):
+    """Structure of a JSON value: dicts by key, lists by their first element, scalars by type"""
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [shape(value[0])] if value else []
+    if value is None:
+        return 'null'
+    return type(value).__name__
+
+
+def shape_differences(expected, actual, path='$'):
+    """Paths where two shapes disagree; null and empty lists match anything"""
+    if expected == 'null' or actual == 'null' or expected == [] or actual == []:
+        return []
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        differences = [f"{path}.{key} missing" for key in expected if key not in actual]
+        differences += [f"{path}.{key} added" for key in actual if key not in expected]
+        for key in expected.keys() & actual.keys():
+            differences += shape_differences(expected[key], actual[key], f"{path}.{key}")
+        return differences
+    if isinstance(expected, list) and isinstance(actual, list):
+        return shape_differences(expected[0], actual[0], f"{path}[]")
+    if isinstance(expected, str) and isinstance(actual, str):
+        if expected != actual and {expected, actual} != {'int', 'float'}:
+            return [f"{path}: {expected} -> {actual}"]
+        return []
+    if expected != actual:
+        return [f"{path}: {shape_kind(expected)} -> {shape_kind(actual)}"]
+    return []
+
+
+def shape_kind(value):
+    """'object', 'array' or the scalar type name of a shape"""
+    if isinstance(value, dict):
+        return 'object'
+    if isinstance(value, list):
+        return 'array'
+    return value
+
+
+class CaptureLog:
+    """Buffers records and appends them to the capture file from a background thread"""
+
+    def __init__(self, path=CAPTURE_FILE, rate=CAPTURE_RATE):
+        self.path = path
+        self.rate = rate
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=MAX_BUFFERED)
+        threading.Thread(target=self._run, name='api-capture', daemon=True).start()
+
+    def wanted(self):
+        return self.rate >= 1 or random.random() < self.rate
+
+    def record(self, entry):
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            batch = []
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                continue
+            for entry in batch:
+                _add_shape(entry)
+            data = gzip.compress(''.join(json.dumps(entry, separators=(',', ':'), default=str) + '\n'
+                                         for entry in batch).encode())
+            try:
+                # One write per member; O_APPEND keeps members from several workers whole
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                print(f"API capture write failed: {e}")
+
+
+def build_entry(action, form, files, read_only, started_at, seconds, response):
+    """The record for one request; the response body is kept for the writer thread to take its shape"""
+    body = None
+    if (response.mimetype == 'application/json' and not response.direct_passthrough
+            and (response.content_length or 0) <= SHAPE_MAX_BYTES):
+        body = response.get_data()
+    return {
+        't': round(started_at, 6),
+        'action': action,
+        'form': redact(form),
+        'files': sorted(files),
+        'write': not read_only,
+        'status': response.status_code,
+        'ms': round(seconds * 1000, 3),
+        'bytes': response.content_length,
+        '_body': body,
+        '_gzip': response.headers.get('Content-Encoding') == 'gzip',
+    }
+
+
+def _add_shape(entry):
+    """Replace the raw response body with its success flag and shape (off the request thread)"""
+    body, compressed = entry.pop('_body'), entry.pop('_gzip')
+    try:
+        value = json.loads(gzip.decompress(body) if compressed else body) if body is not None else None
+    except (ValueError, OSError):
+        value = None
+    entry['success'] = value.get('success') if isinstance(value, dict) else None
+    entry['shape'] = shape(value) if value is not None else None
+
+
+def read_log(path):
+    """All records of a capture file, in start-time order"""
+    with gzip.open(path, 'rt') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries.sort(key=lambda entry: entry['t'])
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise an API capture file')
+    parser.add_argument('file')
+    args = parser.parse_args()
+
+    entries = read_log(args.file)
+    if not entries:
+        print('No requests captured')
+        return
+    span = entries[-1]['t'] - entries[0]['t']
+    print(f"{len(entries)} requests over {span:.0f}s "
+          f"({sum(1 for e in entries if e['write'])} writes)")
+    for action, count in Counter(entry['action'] for entry in entries).most_common():
+        times = sorted(entry['ms'] for entry in entries if entry['action'] == action)
+        print(f"  {action:28} {count:7}  p50 {times[len(times) // 2]:8.1f} ms  max {times[-1]:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
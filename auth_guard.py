@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Post-Auth Logging and Brute-Force Detection
+Replaces FreeRADIUS's synchronous INSERT into radpostauth per attempt: the
+RADIUS REST backend records every Accept and Reject here, the attempts are
+written to radpostauth in batches, and failures are counted in memory over a
+sliding window per username, per calling-station MAC and per NAS. Offenders
+are flagged or blocked for a while (blocked users and devices are rejected
+by /authorize) and saved to auth_blocks in one statement per flush.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extras
+
+from pg_listen import start_listener
+
+GUARD_CHANNEL = 'radius_authguard'
+FLUSH_INTERVAL = float(os.environ.get('AUTHGUARD_FLUSH_INTERVAL', '1'))   # seconds between batch writes
+BUCKET_SECONDS = 10
+# Attempts kept in memory when the database is unreachable (oldest dropped first)
+MAX_BUFFERED = 500000
+
+# kind -> (failures, window seconds, action, seconds the flag/block lasts)
+RULES = {
+    'username': (int(os.environ.get('AUTHGUARD_USER_FAILURES', '10')), 300, 'block', 900),
+    'mac': (int(os.environ.get('AUTHGUARD_MAC_FAILURES', '20')), 300, 'block', 900),
+    'nas': (int(os.environ.get('AUTHGUARD_NAS_FAILURES', '500')), 60, 'flag', 600),
+}
+
+AUTHGUARD_SCHEMA = f"""
+ALTER TABLE radpostauth ADD COLUMN IF NOT EXISTS callingstationid VARCHAR(50);
+ALTER TABLE radpostauth ADD COLUMN IF NOT EXISTS nasipaddress INET;
+CREATE INDEX IF NOT EXISTS radpostauth_authdate_brin ON radpostauth USING BRIN (authdate);
+
+-- Current offenders; rows are kept after they expire for the record
+CREATE TABLE IF NOT EXISTS auth_blocks (
+    kind VARCHAR(16) NOT NULL CHECK (kind IN ('username', 'mac', 'nas')),
+    value VARCHAR(64) NOT NULL,
+    action VARCHAR(8) NOT NULL CHECK (action IN ('flag', 'block')),
+    failures INTEGER NOT NULL,
+    first_detected TIMESTAMP with time zone NOT NULL DEFAULT now(),
+    detected_at TIMESTAMP with time zone NOT NULL,
+    expires_at TIMESTAMP with time zone NOT NULL,
+    PRIMARY KEY (kind, value)
+);
+CREATE INDEX IF NOT EXISTS auth_blocks_expires_idx ON auth_blocks (expires_at);
+
+-- Deleting a row lifts the block in the running RADIUS REST backend and clears its failure count
+CREATE OR REPLACE FUNCTION auth_blocks_notify() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('{GUARD_CHANNEL}', 'unblock:' || OLD.kind || ':' || OLD.value);
+    ELSE
+        PERFORM pg_notify('{GUARD_CHANNEL}', 'reload');
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS auth_blocks_notify_trg ON auth_blocks;
+CREATE TRIGGER auth_blocks_notify_trg AFTER DELETE ON auth_blocks
+    FOR EACH ROW EXECUTE FUNCTION auth_blocks_notify();
+DROP TRIGGER IF EXISTS auth_blocks_truncate_trg ON auth_blocks;
+CREATE TRIGGER auth_blocks_truncate_trg AFTER TRUNCATE ON auth_blocks
+    FOR EACH STATEMENT EXECUTE FUNCTION auth_blocks_notify();
+"""
+
+
+def normalize_mac(value):
+    """Calling-Station-Id in one form (aabbccddeeff) whatever separators the NAS uses"""
+    if not value:
+        return None
+    mac = value.lower().replace(':', '').replace('-', '').replace('.', '')
+    return mac if len(mac) == 12 else value.lower()
+
+
+class SlidingCounter:
+    """Events per key over the last `window` seconds, counted in BUCKET_SECONDS buckets"""
+
+    def __init__(self, window):
+        self.span = max(1, window // BUCKET_SECONDS)
+        self.keys = {}      # key -> [total, deque([[bucket, count], ...])]
+
+    def add(self, key, now):
+        bucket = int(now // BUCKET_SECONDS)
+        entry = self.keys.get(key)
+        if entry is None:
+            self.keys[key] = [1, deque([[bucket, 1]])]
+            return 1
+        buckets = entry[1]
+        oldest = bucket - self.span
+        while buckets and buckets[0][0] <= oldest:
+            entry[0] -= buckets.popleft()[1]
+        if buckets and buckets[-1][0] == bucket:
+            buckets[-1][1] += 1
+        else:
+            buckets.append([bucket, 1])
+        entry[0] += 1
+        return entry[0]
+
+    def reset(self, key):
+        self.keys.pop(key, None)
+
+    def prune(self, now):
+        """Forget keys with no events inside the window"""
+        oldest = int(now // BUCKET_SECONDS) - self.span
+        stale = [key for key, entry in self.keys.items() if entry[1][-1][0] <= oldest]
+        for key in stale:
+            del self.keys[key]
+        return len(stale)
+
+
+class AuthGuard:
+    """Buffers post-auth attempts and tracks failures per username, MAC and NAS"""
+
+    def __init__(self, rules=RULES):
+        self.rules = rules
+        self.counters = {kind: SlidingCounter(rule[1]) for kind, rule in rules.items()}
+        self.blocks = {}            # (kind, value) -> (action, expires epoch)
+        self._attempts = []         # rows for radpostauth
+        self._offenders = {}        # (kind, value) -> row for auth_blocks
+        self._lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stats = {'accepts': 0, 'rejects': 0, 'written': 0, 'dropped': 0, 'detected': 0,
+                      'blocked_requests': 0}
+
+    def load(self, conn):
+        """Restore the flags and blocks that have not expired yet"""
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT kind, value, action, EXTRACT(EPOCH FROM expires_at)
+            FROM auth_blocks WHERE expires_at > now()
+        """)
+        blocks = {(kind, value): (action, float(expires)) for kind, value, action, expires in cur.fetchall()}
+        conn.commit()
+        with self._lock:
+            # Offenders detected since the last flush are not in the table yet
+            for key, row in self._offenders.items():
+                blocks[key] = (row[2], row[5])
+            self.blocks = blocks
+        self.ready.set()
+
+    def apply_notifications(self, conn, batch):
+        """Follow manual unblocks: forget the failures that led to them, then reload the blocks
+
+        Without this the next failure after an unblock would block again at once.
+        """
+        unblocked, everything = [], False
+        for _, payload in batch:
+            kind, _, rest = payload.partition(':')
+            if kind == 'unblock':
+                kind, _, value = rest.partition(':')
+                unblocked.append((kind, value))
+            elif kind == 'reload':
+                everything = True
+        with self._lock:
+            if everything:
+                # TRUNCATE auth_blocks lifts every block
+                self.counters = {kind: SlidingCounter(rule[1]) for kind, rule in self.rules.items()}
+                self._offenders = {}
+            for key in unblocked:
+                if key[0] in self.counters:
+                    self.counters[key[0]].reset(key[1])
+                self._offenders.pop(key, None)
+        self.load(conn)
+
+    def record(self, username, callingstationid, nasip, accepted, now=None, counted=True):
+        """Log one authentication result; returns the offenders it newly detected
+
+        counted=False logs a reject without counting it as a failure (the login was
+        refused by an active block or Simultaneous-Use, not by a wrong password).
+        """
+        now = now or time.time()
+        mac = normalize_mac(callingstationid)
+        if mac:
+            mac = mac[:64]
+        detected = []
+        with self._lock:
+            if len(self._attempts) >= MAX_BUFFERED:
+                del self._attempts[:len(self._attempts) // 10]
+                self.stats['dropped'] += MAX_BUFFERED // 10
+            self._attempts.append(((username or '')[:64], 'Access-Accept' if accepted else 'Access-Reject',
+                                   now, (callingstationid or '')[:50] or None, nasip))
+            if accepted:
+                self.stats['accepts'] += 1
+                # A successful login clears the user's failures (not the device's or the NAS's)
+                self.counters['username'].reset(username)
+                return detected
+            self.stats['rejects'] += 1
+            if not counted:
+                return detected
+            for kind, value in (('username', username), ('mac', mac), ('nas', nasip)):
+                if not value or kind not in self.rules:
+                    continue
+                failures = self.counters[kind].add(value, now)
+                limit, _, action, duration = self.rules[kind]
+                if failures < limit:
+                    continue
+                key = (kind, value)
+                current = self.blocks.get(key)
+                if current is not None and current[1] > now and not (action == 'block' and current[0] == 'flag'):
+                    # Already flagged or blocked: it runs out at its original time
+                    continue
+                self.stats['detected'] += 1
+                detected.append(key)
+                self.blocks[key] = (action, now + duration)
+                self._offenders[key] = (kind, value, action, failures, now, now + duration)
+        return detected
+
+    def blocked(self, username, callingstationid, now=None):
+        """The (kind, value) of an active block on this user or device, else None"""
+        now = now or time.time()
+        for key in (('username', username), ('mac', normalize_mac(callingstationid))):
+            entry = self.blocks.get(key)
+            if entry is not None and entry[0] == 'block' and entry[1] > now:
+                self.stats['blocked_requests'] += 1
+                return key
+        return None
+
+    def flush(self, conn):
+        """Write buffered attempts and new offenders; returns the number of attempts written"""
+        with self._lock:
+            attempts, self._attempts = self._attempts, []
+            offenders, self._offenders = self._offenders, {}
+        try:
+            self._write(conn, attempts, offenders)
+        except psycopg2.DataError:
+            # A malformed value would fail every retry of this batch
+            self.stats['dropped'] += len(attempts)
+            raise
+        except psycopg2.Error:
+            with self._lock:
+                self._attempts[:0] = attempts
+                for key, row in offenders.items():
+                    self._offenders.setdefault(key, row)
+            raise
+        return len(attempts)
+
+    def _write(self, conn, attempts, offenders):
+        if not (attempts or offenders):
+            return
+        try:
+            cur = conn.cursor()
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO radpostauth (username, reply, authdate, callingstationid, nasipaddress)
+                VALUES %s
+            """, attempts, template='(%s, %s, to_timestamp(%s), %s, %s::inet)', page_size=5000)
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO auth_blocks AS b (kind, value, action, failures, detected_at, expires_at)
+                VALUES %s
+                ON CONFLICT (kind, value) DO UPDATE SET
+                    action = EXCLUDED.action,
+                    failures = EXCLUDED.failures,
+                    detected_at = EXCLUDED.detected_at,
+                    expires_at = EXCLUDED.expires_at,
+                    first_detected = CASE WHEN b.expires_at < EXCLUDED.detected_at
+                                          THEN EXCLUDED.detected_at ELSE b.first_detected END
+            """, list(offenders.values()),
+                template='(%s, %s, %s, %s, to_timestamp(%s), to_timestamp(%s))', page_size=1000)
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        self.stats['written'] += len(attempts)
+
+    def prune(self, now=None):
+        now = now or time.time()
+        with self._lock:
+            for counter in self.counters.values():
+                counter.prune(now)
+            for key in [key for key, (_, expires) in self.blocks.items() if expires <= now]:
+                del self.blocks[key]
+
+    # Service
+
+    def start(self, connect):
+        """Load active blocks, follow manual unblocks and write batches every FLUSH_INTERVAL"""
+        start_listener(connect, [GUARD_CHANNEL], self.apply_notifications,
+                       on_connect=self.load, name='auth-guard-events')
+
+        def writer():
+            conn = None
+            last_prune = time.monotonic()
+            while True:
+                time.sleep(FLUSH_INTERVAL)
+                try:
+                    if conn is None or conn.closed:
+                        conn = connect()
+                    self.flush(conn)
+                    if time.monotonic() - last_prune >= 60:
+                        self.prune()
+                        last_prune = time.monotonic()
+                except psycopg2.Error as e:
+                    print(f"Post-auth log write error: {e}")
+                    if conn is not None:
+                        conn.close()
+                    conn = None
+
+        threading.Thread(target=writer, name='auth-guard-writer', daemon=True).start()
+
+    def summary(self):
+        now = time.time()
+        with self._lock:
+            active = [(kind, action) for (kind, _), (action, expires) in self.blocks.items() if expires > now]
+            return dict(
+                self.stats,
+                pending_writes=len(self._attempts),
+                tracked={kind: len(counter.keys) for kind, counter in self.counters.items()},
+                active={f'{kind}_{action}': active.count((kind, action)) for kind, action in set(active)},
+                ready=self.ready.is_set(),
+            )
+
+
+def list_blocks(cur, include_expired=False):
+    """Flags and blocks for the admin app, newest first"""
+    cur.execute(f"""
+        SELECT kind, value, action, failures, first_detected, detected_at, expires_at,
+               expires_at > now() AS active
+        FROM auth_blocks
+        {'' if include_expired else 'WHERE expires_at > now()'}
+        ORDER BY detected_at DESC
+        LIMIT 1000
+    """)
+    return [dict(row) for row in cur.fetchall()]
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Authorize Cache
+In-memory copy of the FreeRADIUS SQL authorization tables (radcheck, radreply,
+radusergroup, radgroupcheck, radgroupreply) so Access-Requests are answered
+without any per-request SQL. The cache is warmed in bulk at startup and kept
+current through LISTEN/NOTIFY: triggers on those tables announce which users
+or groups changed, and only those are reloaded.
+"""
+
+import re
+import sys
+import threading
+import time
+
+from pg_listen import start_listener
+
+CHANNEL = 'radius_authz'
+FETCH_SIZE = 50000
+
+# Check items with these operators are copied to the control list; the others
+# are compared against the request, as rlm_sql does
+ASSIGN_OPS = {':=', '=', '+='}
+
+AUTHZ_SCHEMA = f"""
+CREATE OR REPLACE FUNCTION radius_authz_notify() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('{CHANNEL}', 'reload');
+    ELSIF TG_TABLE_NAME IN ('radgroupcheck', 'radgroupreply') THEN
+        IF TG_OP <> 'INSERT' THEN PERFORM pg_notify('{CHANNEL}', 'group:' || OLD.groupname); END IF;
+        IF TG_OP <> 'DELETE' THEN PERFORM pg_notify('{CHANNEL}', 'group:' || NEW.groupname); END IF;
+    ELSE
+        IF TG_OP <> 'INSERT' THEN PERFORM pg_notify('{CHANNEL}', 'user:' || OLD.username); END IF;
+        IF TG_OP <> 'DELETE' THEN PERFORM pg_notify('{CHANNEL}', 'user:' || NEW.username); END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+""" + ''.join(f"""
+DROP TRIGGER IF EXISTS {table}_authz_notify_trg ON {table};
+CREATE TRIGGER {table}_authz_notify_trg AFTER INSERT OR UPDATE OR DELETE ON {table}
+    FOR EACH ROW EXECUTE FUNCTION radius_authz_notify();
+DROP TRIGGER IF EXISTS {table}_authz_truncate_trg ON {table};
+CREATE TRIGGER {table}_authz_truncate_trg AFTER TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE FUNCTION radius_authz_notify();
+""" for table in ('radcheck', 'radreply', 'radusergroup', 'radgroupcheck', 'radgroupreply'))
+
+
+def _regex_match(value, pattern):
+    try:
+        return re.search(pattern, value) is not None
+    except re.error:
+        return False
+
+
+def _numeric(compare):
+    def check(value, expected):
+        try:
+            return compare(float(value), float(expected))
+        except ValueError:
+            return False
+    return check
+
+
+COMPARATORS = {
+    '==': lambda value, expected: value == expected,
+    '!=': lambda value, expected: value != expected,
+    '=~': _regex_match,
+    '!~': lambda value, expected: not _regex_match(value, expected),
+    '>': _numeric(lambda a, b: a > b),
+    '>=': _numeric(lambda a, b: a >= b),
+    '<': _numeric(lambda a, b: a < b),
+    '<=': _numeric(lambda a, b: a <= b),
+}
+
+
+def _flatten(items):
+    """[(attr, op, value), ...] -> (attr, op, value, attr, op, value, ...) with shared strings"""
+    flat = []
+    for attribute, op, value in items:
+        flat.extend((sys.intern(attribute), sys.intern(op.strip()), value))
+    return tuple(flat)
+
+
+def _triples(flat):
+    return zip(flat[0::3], flat[1::3], flat[2::3])
+
+
+class AuthorizeCache:
+    """username -> (check items, reply items, groups) and groupname -> (check items, reply items)"""
+
+    def __init__(self):
+        self.users = {}
+        self.groups = {}
+        self._group_lists = {}
+        self._lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stats = {'hits': 0, 'misses': 0, 'rejects': 0, 'reloads': 0, 'invalidations': 0,
+                      'warm_seconds': None, 'warmed_at': None}
+
+    # Loading
+
+    def _stream(self, conn, sql, params=None):
+        with conn.cursor(name="authz_load") as cur:
+            cur.itersize = FETCH_SIZE
+            cur.execute(sql, params)
+            yield from cur
+
+    def _group_list(self, names):
+        key = tuple(names)
+        return self._group_lists.setdefault(key, key)
+
+    def _load_users(self, conn, usernames=None):
+        where = "WHERE username = ANY(%(names)s)" if usernames is not None else ""
+        params = {'names': list(usernames)} if usernames is not None else None
+        checks, replies, memberships = {}, {}, {}
+        for username, attribute, op, value in self._stream(
+                conn, f"SELECT username, attribute, op, value FROM radcheck {where} ORDER BY username, id", params):
+            checks.setdefault(username, []).append((attribute, op, value))
+        for username, attribute, op, value in self._stream(
+                conn, f"SELECT username, attribute, op, value FROM radreply {where} ORDER BY username, id", params):
+            replies.setdefault(username, []).append((attribute, op, value))
+        for username, groupname in self._stream(
+                conn, f"SELECT username, groupname FROM radusergroup {where} ORDER BY username, priority", params):
+            memberships.setdefault(username, []).append(sys.intern(groupname))
+        users = {}
+        for username in set(checks) | set(replies) | set(memberships):
+            users[username] = (
+                _flatten(checks.get(username, ())),
+                _flatten(replies.get(username, ())),
+                self._group_list(memberships.get(username, ())),
+            )
+        return users
+
+    def _load_groups(self, conn, groupnames=None):
+        where = "WHERE groupname = ANY(%(names)s)" if groupnames is not None else ""
+        params = {'names': list(groupnames)} if groupnames is not None else None
+        checks, replies = {}, {}
+        for groupname, attribute, op, value in self._stream(
+                conn, f"SELECT groupname, attribute, op, value FROM radgroupcheck {where} ORDER BY groupname, id",
+                params):
+            checks.setdefault(groupname, []).append((attribute, op, value))
+        for groupname, attribute, op, value in self._stream(
+                conn, f"SELECT groupname, attribute, op, value FROM radgroupreply {where} ORDER BY groupname, id",
+                params):
+            replies.setdefault(groupname, []).append((attribute, op, value))
+        return {sys.intern(name): (_flatten(checks.get(name, ())), _flatten(replies.get(name, ())))
+                for name in set(checks) | set(replies)}
+
+    def warm(self, connect):
+        """Load every user and group in bulk and swap them in"""
+        started = time.time()
+        conn = connect()
+        try:
+            users = self._load_users(conn)
+            groups = self._load_groups(conn)
+        finally:
+            conn.close()
+        with self._lock:
+            self.users, self.groups = users, groups
+        self.stats['warm_seconds'] = round(time.time() - started, 3)
+        self.stats['warmed_at'] = time.time()
+        self.stats['reloads'] += 1
+        self.ready.set()
+        print(f"Authorize cache warmed: {len(users)} users, {len(groups)} groups "
+              f"in {self.stats['warm_seconds']}s")
+
+    def apply_notifications(self, connect, batch):
+        """Reload the users and groups named in a batch of NOTIFY payloads"""
+        usernames, groupnames = set(), set()
+        for _, payload in batch:
+            kind, _, name = payload.partition(':')
+            if kind == 'user':
+                usernames.add(name)
+            elif kind == 'group':
+                groupnames.add(name)
+            elif kind == 'reload':
+                self.warm(connect)
+                return
+        conn = connect()
+        try:
+            users = self._load_users(conn, usernames) if usernames else {}
+            groups = self._load_groups(conn, groupnames) if groupnames else {}
+            conn.rollback()
+        finally:
+            conn.close()
+        with self._lock:
+            for username in usernames:
+                if username in users:
+                    self.users[username] = users[username]
+                else:
+                    self.users.pop(username, None)
+            for groupname in groupnames:
+                if groupname in groups:
+                    self.groups[groupname] = groups[groupname]
+                else:
+                    self.groups.pop(groupname, None)
+        self.stats['invalidations'] += len(usernames) + len(groupnames)
+
+    def start(self, connect):
+        """Warm the cache and keep it current from NOTIFY in a background thread"""
+        start_listener(
+            connect, [CHANNEL],
+            on_notify=lambda conn, batch: self.apply_notifications(connect, batch),
+            # Runs after every (re)connect, so changes missed while disconnected are picked up
+            on_connect=lambda conn: self.warm(connect),
+            name='authz-cache',
+        )
+
+    # Authorization
+
+    def authorize(self, username, request_attrs):
+        """Return (result, control, reply) where result is 'ok', 'notfound' or 'reject'"""
+        entry = self.users.get(username)
+        if entry is None:
+            self.stats['misses'] += 1
+            return 'notfound', [], []
+        self.stats['hits'] += 1
+        check, reply_items, groups = entry
+        control, reply = [], []
+        if not self._apply_checks(check, request_attrs, control):
+            self.stats['rejects'] += 1
+            return 'reject', [], []
+        reply.extend(_triples(reply_items))
+        for groupname in groups:
+            group = self.groups.get(groupname)
+            if group is None:
+                continue
+            group_control = []
+            # A group whose check items do not match contributes nothing
+            if self._apply_checks(group[0], request_attrs, group_control):
+                control.extend(group_control)
+                reply.extend(_triples(group[1]))
+        return 'ok', control, reply
+
+    @staticmethod
+    def _apply_checks(flat, request_attrs, control):
+        for attribute, op, value in _triples(flat):
+            if op in ASSIGN_OPS:
+                control.append((attribute, op, value))
+                continue
+            compare = COMPARATORS.get(op)
+            if compare is None:
+                continue
+            actual = request_attrs.get(attribute)
+            if actual is None or not compare(actual, value):
+                return False
+        return True
+
+    def summary(self):
+        return dict(self.stats, users=len(self.users), groups=len(self.groups), ready=self.ready.is_set())
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Time-of-Day Bandwidth Policies
+Service profiles can run at other speeds at certain hours and days (a faster
+night plan, a slower business-hours one). Schedules are kept in
+bandwidth_schedules; their start and end boundaries are placed on a timing
+wheel with one slot per minute of the week, so each tick only looks at the
+profiles with a boundary in that minute, however many schedules there are.
+At a boundary the profile's WISPr-Bandwidth-Max-Down/Up in radgroupreply is
+set to the rate now in effect (new logins get it at once) and every online
+session of the profile is sent a CoA-Request with the new rate, paced to
+spread the batch over COA_SPREAD seconds. Times are the server's local time.
+
+Usage:
+    python bandwidth_scheduler.py              # run the scheduler
+    python bandwidth_scheduler.py --show       # schedules and upcoming boundaries
+    python bandwidth_scheduler.py --apply-now  # bring every profile to its current rate
+"""
+
+import argparse
+import asyncio
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+
+import psycopg2
+import psycopg2.extras
+
+import acct_shards
+import radius_client
+from pg_listen import start_listener
+
+CHANNEL = 'bandwidth_schedules'
+MINUTES_PER_WEEK = 7 * 24 * 60
+TICK_INTERVAL = 1.0
+COA_SPREAD = float(os.environ.get('BANDWIDTH_COA_SPREAD', '60'))     # seconds a boundary's CoAs are spread over
+COA_MAX_RATE = int(os.environ.get('BANDWIDTH_COA_MAX_RATE', '2000'))  # CoA-Requests per second, at most
+COA_MIN_RATE = 50
+COA_TIMEOUT = 3.0
+SCHEDULER_LOCK_ID = 0x42574454   # one scheduler at a time
+RATE_ATTRIBUTES = ('WISPr-Bandwidth-Max-Down', 'WISPr-Bandwidth-Max-Up')
+DAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+BANDWIDTH_SCHEMA = f"""
+-- days: 0 = Monday .. 6 = Sunday; a window whose end is not after its start runs past midnight
+CREATE TABLE IF NOT EXISTS bandwidth_schedules (
+    id SERIAL PRIMARY KEY,
+    service_profile VARCHAR(50) NOT NULL REFERENCES service_profiles(name) ON DELETE CASCADE,
+    days SMALLINT[] NOT NULL DEFAULT '{{0,1,2,3,4,5,6}}',
+    start_time TIME NOT NULL,
+    end_time TIME NOT NULL,
+    download_speed INTEGER NOT NULL,
+    upload_speed INTEGER NOT NULL,
+    enabled BOOLEAN NOT NULL DEFAULT true,
+    created_at TIMESTAMP with time zone NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS bandwidth_policy_runs (
+    id SERIAL PRIMARY KEY,
+    applied_at TIMESTAMP with time zone NOT NULL DEFAULT now(),
+    profiles TEXT[] NOT NULL,
+    sessions INTEGER NOT NULL DEFAULT 0,
+    acknowledged INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    -- sessions on NAS that nas_monitor reports unreachable; they get the rate at their next login
+    skipped INTEGER NOT NULL DEFAULT 0,
+    seconds REAL
+);
+
+CREATE OR REPLACE FUNCTION bandwidth_schedules_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{CHANNEL}', 'reload');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS bandwidth_schedules_notify_trg ON bandwidth_schedules;
+CREATE TRIGGER bandwidth_schedules_notify_trg AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON bandwidth_schedules
+    FOR EACH STATEMENT EXECUTE FUNCTION bandwidth_schedules_notify();
+"""
+
+
+def minute_of_week(moment):
+    return moment.weekday() * 1440 + moment.hour * 60 + moment.minute
+
+
+class TimingWheel:
+    """One slot per minute of the week, each holding the keys with a boundary in that minute"""
+
+    def __init__(self):
+        self.slots = [None] * MINUTES_PER_WEEK
+        self.size = 0
+
+    def add(self, minute, key):
+        slot = self.slots[minute]
+        if slot is None:
+            slot = self.slots[minute] = set()
+        if key not in slot:
+            slot.add(key)
+            self.size += 1
+
+    def due(self, after, until):
+        """Keys in the slots after minute `after` up to and including `until` (wrapping at week end)"""
+        keys = set()
+        steps = (until - after) % MINUTES_PER_WEEK
+        for step in range(1, steps + 1):
+            slot = self.slots[(after + step) % MINUTES_PER_WEEK]
+            if slot:
+                keys |= slot
+        return keys
+
+    def upcoming(self, after, count=10):
+        """[(minutes ahead, keys)] of the next `count` non-empty slots"""
+        found = []
+        for step in range(1, MINUTES_PER_WEEK + 1):
+            slot = self.slots[(after + step) % MINUTES_PER_WEEK]
+            if slot:
+                found.append((step, sorted(slot)))
+                if len(found) == count:
+                    break
+        return found
+
+
+class Window:
+    """One schedule row: a weekly window with its own speeds"""
+    __slots__ = ('id', 'days', 'start', 'end', 'download', 'upload')
+
+    def __init__(self, id, days, start, end, download, upload):
+        self.id = id
+        self.days = frozenset(days)
+        self.start = start.hour * 60 + start.minute
+        self.end = end.hour * 60 + end.minute
+        self.download = download
+        self.upload = upload
+
+    def boundaries(self):
+        """Minutes of the week at which this window starts or ends"""
+        for day in self.days:
+            start = day * 1440 + self.start
+            # Ending at or before its start means the next day
+            end = (day + (1 if self.end <= self.start else 0)) * 1440 + self.end
+            yield start % MINUTES_PER_WEEK
+            yield end % MINUTES_PER_WEEK
+
+    def active(self, minute):
+        day, minute_of_day = divmod(minute, 1440)
+        if self.end > self.start:
+            return day in self.days and self.start <= minute_of_day < self.end
+        return ((day in self.days and minute_of_day >= self.start)
+                or ((day - 1) % 7 in self.days and minute_of_day < self.end))
+
+
+class BandwidthScheduler:
+    """Keeps each service profile's group rate in line with its schedules"""
+
+    def __init__(self, connect, router=None, spread=COA_SPREAD, max_rate=COA_MAX_RATE):
+        self.connect = connect
+        self.router = router
+        self.spread = spread
+        self.max_rate = max_rate
+        self.wheel = TimingWheel()
+        self.windows = {}           # profile -> [Window], in id order (the last active one wins)
+        self.base = {}              # profile -> (download, upload) Mbps from service_profiles
+        self._lock = threading.Lock()
+        self._reload = threading.Event()
+        self.history = deque(maxlen=50)
+
+    def load(self, conn):
+        """Read the schedules and rebuild the wheel"""
+        cur = conn.cursor()
+        cur.execute("SELECT name, download_speed, upload_speed FROM service_profiles")
+        base = {name: (download, upload) for name, download, upload in cur.fetchall()}
+        cur.execute("""
+            SELECT id, service_profile, days, start_time, end_time, download_speed, upload_speed
+            FROM bandwidth_schedules WHERE enabled ORDER BY id
+        """)
+        windows = defaultdict(list)
+        wheel = TimingWheel()
+        for id, profile, days, start, end, download, upload in cur.fetchall():
+            window = Window(id, [day for day in days if 0 <= day <= 6], start, end, download, upload)
+            windows[profile].append(window)
+            for minute in window.boundaries():
+                wheel.add(minute, profile)
+        if not conn.autocommit:
+            conn.rollback()
+        with self._lock:
+            self.base, self.windows, self.wheel = base, dict(windows), wheel
+        return wheel.size
+
+    def rate(self, profile, minute):
+        """(download, upload) Mbps in effect for a profile at a minute of the week"""
+        rate = self.base.get(profile)
+        for window in self.windows.get(profile, ()):
+            if window.active(minute):
+                rate = (window.download, window.upload)
+        return rate
+
+    # Applying
+
+    def _changed_profiles(self, cur, rates):
+        """Profiles whose radgroupreply rate differs from `rates`; updates radgroupreply for them"""
+        cur.execute("""
+            SELECT groupname, attribute, value FROM radgroupreply
+            WHERE groupname = ANY(%s) AND attribute = ANY(%s)
+        """, (list(rates), list(RATE_ATTRIBUTES)))
+        current = defaultdict(dict)
+        for group, attribute, value in cur.fetchall():
+            current[group][attribute] = value
+        changed = {}
+        for profile, (download, upload) in rates.items():
+            wanted = {'WISPr-Bandwidth-Max-Down': str(download * 1000000),
+                      'WISPr-Bandwidth-Max-Up': str(upload * 1000000)}
+            if current.get(profile) != wanted:
+                changed[profile] = wanted
+        if changed:
+            rows = [(profile, attribute, value) for profile, wanted in changed.items()
+                    for attribute, value in wanted.items()]
+            psycopg2.extras.execute_values(cur, """
+                DELETE FROM radgroupreply g USING (VALUES %s) AS v(groupname, attribute)
+                WHERE g.groupname = v.groupname AND g.attribute = v.attribute
+            """, [(profile, attribute) for profile, attribute, _ in rows])
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO radgroupreply (groupname, attribute, op, value) VALUES %s
+            """, rows, template="(%s, %s, ':=', %s)")
+        return changed
+
+    def coa_requests(self, cur, changed):
+        """(CoA-Requests for the online sessions of the changed profiles interleaved across NAS, sessions skipped)"""
+        cur.execute("""
+            SELECT username, groupname FROM radusergroup WHERE groupname = ANY(%s)
+        """, (list(changed),))
+        members = dict(cur.fetchall())
+        if not members:
+            return [], 0
+        sql = """
+            SELECT username, acctsessionid, host(framedipaddress), host(nasipaddress)
+            FROM radacct WHERE acctstoptime IS NULL AND username = ANY(%s)
+        """
+        if self.router is not None and self.router.sharded:
+            _, results, errors = self.router.scatter(sql, (list(members),))
+            for shard, error in errors.items():
+                print(f"Bandwidth policy: sessions on shard {shard} skipped: {error}")
+            sessions = [row for rows in results.values() for row in rows]
+        else:
+            cur.execute(sql, (list(members),))
+            sessions = cur.fetchall()
+        # A dead NAS would hold the batch up with timeouts
+        cur.execute("""
+            SELECT n.nas_ip, n.shared_secret FROM nas_devices n
+            LEFT JOIN nas_health h ON h.nas_id = n.id
+            WHERE n.nas_ip = ANY(%s) AND COALESCE(h.reachable, true)
+        """, (list({row[3] for row in sessions}),))
+        secrets = dict(cur.fetchall())
+        by_nas = defaultdict(list)
+        skipped = 0
+        for username, sessionid, framedip, nasip in sessions:
+            if nasip not in secrets:
+                skipped += 1
+                continue
+            rates = changed[members[username]]
+            attributes = [('User-Name', username), ('Acct-Session-Id', sessionid), ('NAS-IP-Address', nasip)]
+            if framedip:
+                attributes.append(('Framed-IP-Address', framedip))
+            attributes.extend((name, int(rates[name])) for name in RATE_ATTRIBUTES)
+            by_nas[nasip].append((nasip, radius_client.COA_PORT, secrets[nasip] or '',
+                                  radius_client.COA_REQUEST, attributes))
+        # Round-robin over the NAS, so no single NAS gets a burst of the batch
+        queues = list(by_nas.values())
+        requests = [queue[i] for i in range(max(map(len, queues), default=0)) for queue in queues if i < len(queue)]
+        return requests, skipped
+
+    def pace(self, count):
+        """CoA-Requests per second for a batch, spreading it over self.spread seconds"""
+        return max(COA_MIN_RATE, min(self.max_rate, count / self.spread if self.spread else self.max_rate))
+
+    def apply(self, profiles, moment=None, send=True):
+        """Bring the profiles to the rate in effect now; returns a summary (None if nothing changed)"""
+        started = time.monotonic()
+        minute = minute_of_week(moment or datetime.now())
+        with self._lock:
+            rates = {profile: self.rate(profile, minute) for profile in profiles}
+        rates = {profile: rate for profile, rate in rates.items() if rate}
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            changed = self._changed_profiles(cur, rates)
+            if not changed:
+                conn.rollback()
+                return None
+            conn.commit()
+            requests, skipped = self.coa_requests(cur, changed)
+            conn.rollback()
+            summary = {'profiles': sorted(changed), 'sessions': len(requests) + skipped, 'acknowledged': 0,
+                       'failed': 0, 'skipped': skipped}
+            if send and requests:
+                summary['acknowledged'], summary['failed'] = self.send(requests)
+            summary['seconds'] = round(time.monotonic() - started, 2)
+            cur.execute("""
+                INSERT INTO bandwidth_policy_runs (profiles, sessions, acknowledged, failed, skipped, seconds)
+                VALUES (%(profiles)s, %(sessions)s, %(acknowledged)s, %(failed)s, %(skipped)s, %(seconds)s)
+            """, summary)
+            conn.commit()
+        finally:
+            conn.close()
+        self.history.append(summary)
+        return summary
+
+    def send(self, requests):
+        """Paced CoA-Requests; returns (acknowledged, failed)"""
+        async def push():
+            client = await radius_client.RadiusClient.open()
+            try:
+                return await radius_client.send_paced(client, requests, rate=self.pace(len(requests)),
+                                                      max_in_flight=1000, timeout=COA_TIMEOUT)
+            finally:
+                client.close()
+
+        results = asyncio.run(push())
+        acknowledged = sum(1 for result in results if result == radius_client.COA_ACK)
+        return acknowledged, len(results) - acknowledged
+
+    # Service
+
+    def run(self, stop_event=None):
+        """Tick every second and apply the profiles whose boundary has passed"""
+        stop_event = stop_event or threading.Event()
+
+        def reload(conn, batch=None):
+            self.load(conn)
+            self._reload.set()
+
+        start_listener(self.connect, [CHANNEL], reload, on_connect=reload, name='bandwidth-schedules')
+        self._reload.wait()
+        last = None
+        while not stop_event.is_set():
+            now = datetime.now()
+            minute = minute_of_week(now)
+            if self._reload.is_set():
+                # Schedules changed (or first start): every profile to its current rate
+                self._reload.clear()
+                with self._lock:
+                    profiles = set(self.base)
+                last = minute
+            elif minute != last:
+                with self._lock:
+                    profiles = self.wheel.due(last, minute)
+                last = minute
+            else:
+                profiles = ()
+            if profiles:
+                try:
+                    summary = self.apply(profiles, now)
+                    if summary:
+                        print(f"{now.isoformat()} {', '.join(summary['profiles'])}: {summary['sessions']} "
+                              f"sessions, {summary['acknowledged']} acknowledged, {summary['failed']} failed, "
+                              f"{summary['skipped']} skipped in {summary['seconds']}s")
+                except psycopg2.Error as e:
+                    print(f"Bandwidth policy error: {e}")
+                    # Retry these profiles on the next tick
+                    self._reload.set()
+            stop_event.wait(TICK_INTERVAL)
+
+
+def list_schedules(cur):
+    cur.execute("""
+        SELECT id, service_profile, days, start_time, end_time, download_speed, upload_speed, enabled
+        FROM bandwidth_schedules ORDER BY service_profile, start_time
+    """)
+    return [dict(row) for row in cur.fetchall()]
+
+
+def add_schedule(cur, profile, days, start_time, end_time, download, upload):
+    """Validate and insert a schedule; returns its id"""
+    days = sorted({int(day) for day in days})
+    if not days or any(day < 0 or day > 6 for day in days):
+        raise ValueError('days must be between 0 (Monday) and 6 (Sunday)')
+    if int(download) <= 0 or int(upload) <= 0:
+        raise ValueError('speeds must be positive')
+    cur.execute("""
+        INSERT INTO bandwidth_schedules (service_profile, days, start_time, end_time, download_speed, upload_speed)
+        VALUES (%s, %s, %s, %s, %s, %s) RETURNING id
+    """, (profile, days, start_time, end_time, int(download), int(upload)))
+    row = cur.fetchone()
+    return row['id'] if isinstance(row, dict) else row[0]
+
+
+def recent_runs(cur, limit=50):
+    cur.execute("""
+        SELECT applied_at, profiles, sessions, acknowledged, failed, skipped, seconds
+        FROM bandwidth_policy_runs ORDER BY applied_at DESC LIMIT %s
+    """, (limit,))
+    return [dict(row) for row in cur.fetchall()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply time-of-day bandwidth schedules to online sessions')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    parser.add_argument('--show', action='store_true', help='Print the schedules and the next boundaries')
+    parser.add_argument('--apply-now', action='store_true', help='Apply the current rates once and exit')
+    parser.add_argument('--no-coa', action='store_true', help='With --apply-now, only update radgroupreply')
+    args = parser.parse_args()
+
+    if args.dsn:
+        connect, router = (lambda: psycopg2.connect(args.dsn)), None
+    else:
+        router = acct_shards.default_router()
+        connect = router.connect
+    scheduler = BandwidthScheduler(connect, router)
+    conn = connect()
+    scheduler.load(conn)
+
+    if args.show:
+        for profile, windows in sorted(scheduler.windows.items()):
+            print(f"{profile} (base {scheduler.base.get(profile)} Mbps)")
+            for w in windows:
+                print(f"  #{w.id} {','.join(DAY_NAMES[d] for d in sorted(w.days))} "
+                      f"{w.start // 60:02d}:{w.start % 60:02d}-{w.end // 60:02d}:{w.end % 60:02d} "
+                      f"{w.download}/{w.upload} Mbps")
+        now = datetime.now()
+        for ahead, profiles in scheduler.wheel.upcoming(minute_of_week(now)):
+            at = (now + timedelta(minutes=ahead)).strftime('%a %H:%M')
+            print(f"{at}: {', '.join(profiles)}")
+        conn.close()
+        return
+    if args.apply_now:
+        conn.close()
+        print(scheduler.apply(set(scheduler.base), send=not args.no_coa) or 'Every profile is at its current rate')
+        return
+
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(%s)", (SCHEDULER_LOCK_ID,))
+    if not cur.fetchone()[0]:
+        print('Another bandwidth scheduler is running')
+        return
+    conn.commit()
+    print(f"Bandwidth scheduler: {scheduler.wheel.size} boundaries for {len(scheduler.windows)} profiles")
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Benchmark Comparison
+Compares two result files from run_benchmarks.py and exits non-zero when the
+candidate regresses beyond the threshold, so it can gate CI or release checks.
+
+Usage:
+    python -m benchmarks.compare baseline.json candidate.json --threshold 0.10
+"""
+
+import argparse
+import json
+import sys
+
+# metric -> True when a higher value is better
+METRICS = {
+    'throughput_rps': True,
+    'p50': False,
+    'p99': False,
+}
+
+
+def metric_value(run, metric):
+    if metric in run.get('latency_ms', {}):
+        return run['latency_ms'][metric]
+    return run.get(metric)
+
+
+def compare(baseline, candidate, threshold):
+    """Return (rows, regressions) for every scenario/concurrency present in both files"""
+    rows = []
+    regressions = []
+    for name, base_runs in baseline['results'].items():
+        cand_runs = {run['concurrency']: run for run in candidate['results'].get(name, [])}
+        for base in base_runs:
+            cand = cand_runs.get(base['concurrency'])
+            if not cand:
+                continue
+            for metric, higher_is_better in METRICS.items():
+                old = metric_value(base, metric)
+                new = metric_value(cand, metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                regressed = change < -threshold if higher_is_better else change > threshold
+                row = (name, base['concurrency'], metric, old, new, change, regressed)
+                rows.append(row)
+                if regressed:
+                    regressions.append(row)
+            if cand.get('errors', 0) > base.get('errors', 0):
+                row = (name, base['concurrency'], 'errors', base.get('errors', 0), cand['errors'], None, True)
+                rows.append(row)
+                regressions.append(row)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('baseline', help='Results of the reference version')
+    parser.add_argument('candidate', help='Results of the version under test')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Allowed relative change (0.10 = 10%%)')
+    parser.add_argument('--json', action='store_true', help='Print the comparison as JSON')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    rows, regressions = compare(baseline, candidate, args.threshold)
+    if args.json:
+        keys = ('scenario', 'concurrency', 'metric', 'baseline', 'candidate', 'change', 'regressed')
+        print(json.dumps({
+            'baseline': baseline['meta'], 'candidate': candidate['meta'],
+            'rows': [dict(zip(keys, row)) for row in rows],
+            'regressions': len(regressions),
+        }, indent=2))
+    else:
+        print(f"{'scenario':<20} {'conc':>5} {'metric':<15} {'baseline':>12} {'candidate':>12} {'change':>8}")
+        for name, conc, metric, old, new, change, regressed in rows:
+            change_text = f"{change * 100:+.1f}%" if change is not None else ''
+            flag = '  REGRESSION' if regressed else ''
+            print(f"{name:<20} {conc:>5} {metric:<15} {old:>12} {new:>12} {change_text:>8}{flag}")
+        print(f"\n{len(regressions)} regression(s) beyond {args.threshold * 100:.0f}%")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
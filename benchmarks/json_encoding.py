@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - JSON Encoding Benchmark
+Compares the old list encoding (RealDictCursor rows -> dicts -> jsonify) with
+json_response (tuple cursor encoded in batches, objects/columnar, gzip) for
+get_users and get_online_users on a seeded database. Seed with about 300k
+customers for 100k online sessions at the default online ratio.
+
+Usage:
+    python -m benchmarks.json_encoding --dsn postgresql:///radius_bench --rows 100000
+"""
+
+import argparse
+import gzip
+import statistics
+import time
+
+import psycopg2
+import psycopg2.extras
+from flask import jsonify
+
+import json_response
+from app import app
+
+QUERIES = {
+    'get_users': """
+        SELECT c.customer_id, c.first_name, c.last_name, c.email, c.phone, c.address,
+               c.service_profile, c.status, c.created_at, c.updated_at, sp.price
+        FROM customers c
+        LEFT JOIN service_profiles sp ON c.service_profile = sp.name
+        ORDER BY c.created_at DESC
+        LIMIT %s
+    """,
+    'get_online_users': """
+        SELECT radacctid, username, host(nasipaddress) AS nasipaddress, acctsessionid, acctstarttime,
+               host(framedipaddress) AS framedipaddress, callingstationid,
+               acctinputoctets, acctoutputoctets
+        FROM radacct
+        WHERE acctstoptime IS NULL
+        ORDER BY acctstarttime DESC
+        LIMIT %s
+    """,
+}
+
+
+def old_path(conn, sql, rows):
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute(sql, (rows,))
+    result = cur.fetchall()
+    return jsonify({'success': True, 'rows': [dict(row) for row in result]}).get_data()
+
+
+def new_path(conn, sql, rows, columnar=False):
+    cur = json_response.tuple_cursor(conn)
+    cur.execute(sql, (rows,))
+    return json_response.rows_response(cur, 'rows', columnar).get_data()
+
+
+def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), len(body), body
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare list response encodings')
+    parser.add_argument('--dsn', required=True, help='PostgreSQL DSN of a seeded database')
+    parser.add_argument('--rows', type=int, default=100000, help='Rows per response')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per variant (median reported)')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    library = 'orjson' if json_response.orjson else 'json'
+    print(f"Encoder: {library}, rows requested: {args.rows}")
+    # name, encoder (None = old path), columnar, accept gzip
+    variants = [
+        ('jsonify (old)', None, False, False),
+        ('objects', new_path, False, False),
+        ('columnar', new_path, True, False),
+        ('columnar+gzip', new_path, True, True),
+    ]
+    for action, sql in QUERIES.items():
+        print(f"\n{action}")
+        baseline = None
+        for name, encoder, columnar, accept_gzip in variants:
+            headers = {'Accept-Encoding': 'gzip'} if accept_gzip else {}
+            with app.test_request_context('/', headers=headers):
+                if encoder is None:
+                    seconds, size, body = measure(lambda: old_path(conn, sql, args.rows), args.repeat)
+                else:
+                    seconds, size, body = measure(lambda: encoder(conn, sql, args.rows, columnar), args.repeat)
+            if accept_gzip:
+                gzip.decompress(body)
+            baseline = baseline or seconds
+            print(f"  {name:<15} {seconds * 1000:9.1f} ms  {size / 1024:9.0f} KiB  {baseline / seconds:5.2f}x")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Captured Traffic Replay
+Re-issues API calls recorded by api_capture.py against a test instance, each
+at its original offset from the start of the capture (divided by --speed), so
+the mix of actions and how they overlapped is the one operators produced.
+Latency, status and the shape of every JSON response are compared with the
+capture, and the results are saved in the run_benchmarks.py format, so two
+replays of the same capture can be compared with compare.py.
+
+Writes are skipped unless --writes is given (they mutate the test database,
+so restore it between runs). Redacted fields are sent as --redacted-value,
+and calls that uploaded files are skipped.
+
+Usage:
+    python -m benchmarks.replay capture.jsonl.gz --base-url http://127.0.0.1:5000 --speed 2
+    python -m benchmarks.compare results/replay-before.json results/replay-after.json
+"""
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api_capture import REDACTED, read_log, shape, shape_differences  # noqa: E402
+from benchmarks.run_benchmarks import git_revision, percentile  # noqa: E402
+
+LATE_AFTER = 0.05            # seconds behind schedule before a request counts as late
+
+
+def replay_request(base_url, entry, redacted_value, timeout, headers):
+    """Send one captured call; returns (latency seconds, status, success, shape, response bytes)"""
+    form = {name: redacted_value if value == REDACTED else value for name, value in entry['form'].items()}
+    req = urllib.request.Request(f"{base_url}/api/{entry['action']}", data=urllib.parse.urlencode(form).encode(),
+                                 method='POST', headers=headers or {})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            body = resp.read()
+            status = resp.status
+            encoding = resp.headers.get('Content-Encoding')
+    except urllib.error.HTTPError as e:
+        body, status, encoding = e.read(), e.code, e.headers.get('Content-Encoding')
+    except (urllib.error.URLError, OSError):
+        return time.perf_counter() - started, None, None, None, 0
+    latency = time.perf_counter() - started
+    try:
+        value = json.loads(gzip.decompress(body) if encoding == 'gzip' else body)
+    except (ValueError, OSError):
+        value = None
+    success = value.get('success') if isinstance(value, dict) else None
+    return latency, status, success, shape(value) if value is not None else None, len(body)
+
+
+def replay(entries, base_url, speed=1.0, max_concurrency=64, redacted_value='replay-redacted', timeout=120.0,
+           headers=None):
+    """Replay the entries on their original schedule; returns one outcome dict per entry"""
+    outcomes = [None] * len(entries)
+    in_flight = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def run(index, entry):
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        started = time.perf_counter()
+        try:
+            latency, status, success, response_shape, size = replay_request(
+                base_url, entry, redacted_value, timeout, headers)
+            differences = []
+            if entry.get('shape') is not None and response_shape is not None and status == entry['status']:
+                differences = shape_differences(entry['shape'], response_shape)
+            outcomes[index] = {
+                'latency': latency, 'status': status, 'success': success, 'bytes': size,
+                'error': status is None or status != entry['status'] or (entry.get('success') and not success),
+                'differences': differences,
+            }
+        except Exception as e:
+            # e.g. http.client.IncompleteRead; counted as an error instead of leaving the outcome empty
+            print(f"Replaying {entry['action']} failed: {e!r}", file=sys.stderr)
+            outcomes[index] = {'latency': time.perf_counter() - started, 'status': None, 'success': None,
+                               'bytes': 0, 'error': True, 'differences': []}
+        finally:
+            with lock:
+                in_flight -= 1
+
+    first = entries[0]['t'] if entries else 0
+    late = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        for index, entry in enumerate(entries):
+            due = started + (entry['t'] - first) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif -delay > LATE_AFTER:
+                late += 1
+            pool.submit(run, index, entry)
+    elapsed = time.perf_counter() - started
+    return outcomes, {'elapsed_s': round(elapsed, 3), 'peak_concurrency': peak, 'late': late}
+
+
+def latency_summary(values):
+    values = sorted(values)
+    if not values:
+        return {'mean': None, 'p50': None, 'p90': None, 'p99': None, 'max': None}
+    return {
+        'mean': round(sum(values) / len(values), 3),
+        'p50': round(percentile(values, 0.50), 3),
+        'p90': round(percentile(values, 0.90), 3),
+        'p99': round(percentile(values, 0.99), 3),
+        'max': round(values[-1], 3),
+    }
+
+
+def summarise(entries, outcomes, elapsed):
+    """Per action results in the run_benchmarks.py layout, plus the captured latencies and shape checks"""
+    by_action = defaultdict(list)
+    for entry, outcome in zip(entries, outcomes):
+        by_action[entry['action']].append((entry, outcome))
+    results = {}
+    for action, pairs in sorted(by_action.items()):
+        differences = defaultdict(int)
+        for _, outcome in pairs:
+            for difference in outcome['differences']:
+                differences[difference] += 1
+        count = len(pairs)
+        results[action] = [{
+            'concurrency': 'replay',
+            'requests': count,
+            'errors': sum(1 for _, outcome in pairs if outcome['error']),
+            'elapsed_s': elapsed,
+            'throughput_rps': round(count / elapsed, 2) if elapsed else 0,
+            'mean_bytes': int(sum(outcome['bytes'] for _, outcome in pairs) / count),
+            'latency_ms': latency_summary([outcome['latency'] * 1000 for _, outcome in pairs]),
+            'captured_latency_ms': latency_summary([entry['ms'] for entry, _ in pairs]),
+            'shape_mismatches': sum(1 for _, outcome in pairs if outcome['differences']),
+            'shape_differences': dict(sorted(differences.items(), key=lambda item: -item[1])[:10]),
+        }]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured admin API traffic against a test instance')
+    parser.add_argument('capture', help='File written by api_capture.py')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000', help='Test instance')
+    parser.add_argument('--speed', type=float, default=1.0, help='Time scale: 2 replays twice as fast')
+    parser.add_argument('--max-concurrency', type=int, default=64, help='Most requests in flight at once')
+    parser.add_argument('--writes', action='store_true', help='Also replay writes (mutates the database)')
+    parser.add_argument('--only', action='append', help='Only replay this action (repeatable)')
+    parser.add_argument('--limit', type=int, help='Replay only the first N calls')
+    parser.add_argument('--redacted-value', default='replay-redacted', help='Sent in place of redacted fields')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Per request timeout in seconds')
+    parser.add_argument('--gzip', action='store_true', help='Send Accept-Encoding: gzip')
+    parser.add_argument('--label', help='Free-form label stored with the results (e.g. version)')
+    parser.add_argument('--output', help='Results file (default benchmarks/results/replay-<timestamp>.json)')
+    args = parser.parse_args()
+
+    entries = [entry for entry in read_log(args.capture)
+               if not entry['files'] and (args.writes or not entry['write'])
+               and (not args.only or entry['action'] in args.only)]
+    entries = entries[:args.limit] if args.limit else entries
+    if not entries:
+        print('Nothing to replay')
+        return
+    span = (entries[-1]['t'] - entries[0]['t']) / args.speed
+    print(f"Replaying {len(entries)} calls over {span:.0f}s against {args.base_url}...")
+    headers = {'Accept-Encoding': 'gzip'} if args.gzip else None
+    outcomes, run = replay(entries, args.base_url, args.speed, args.max_concurrency, args.redacted_value,
+                           args.timeout, headers)
+    results = summarise(entries, outcomes, run['elapsed_s'])
+
+    print(f"{'action':28} {'calls':>7} {'errors':>7} {'captured p50':>13} {'p50':>9} {'p99':>9} {'shape':>6}")
+    for action, (result,) in results.items():
+        print(f"{action:28} {result['requests']:7} {result['errors']:7} "
+              f"{result['captured_latency_ms']['p50']:11.1f}ms {result['latency_ms']['p50']:7.1f}ms "
+              f"{result['latency_ms']['p99']:7.1f}ms {result['shape_mismatches']:6}")
+        for difference, count in result['shape_differences'].items():
+            print(f"    {count} x {difference}")
+    print(f"Peak concurrency {run['peak_concurrency']}, {run['late']} calls started late")
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'label': args.label,
+            'git_revision': git_revision(),
+            'base_url': args.base_url,
+            'python': platform.python_version(),
+            'host': platform.node(),
+            'capture': os.path.abspath(args.capture),
+            'speed': args.speed,
+            'writes': args.writes,
+            **run,
+        },
+        'results': results,
+    }
+    output = args.output
+    if not output:
+        results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+        os.makedirs(results_dir, exist_ok=True)
+        output = os.path.join(results_dir, datetime.now().strftime('replay-%Y%m%d-%H%M%S') + '.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Endpoint Benchmarks
+Measures latency and throughput of the admin API under concurrency against a
+running instance (usually one backed by a database from seed_dataset.py) and
+saves the results as JSON for compare.py.
+
+Usage:
+    python -m benchmarks.run_benchmarks --base-url http://127.0.0.1:5000 --concurrency 1,8,32
+"""
+
+import argparse
+import gzip
+import itertools
+import json
+import os
+import platform
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+_counter = itertools.count(1)
+
+SEARCH_TERMS = ['smith', 'john', 'haddad1', 'CUST00012', 'example.net', '100.64.', 'jonhson', 'maya.k']
+
+
+def search_form():
+    return {'q': SEARCH_TERMS[next(_counter) % len(SEARCH_TERMS)]}
+
+
+def add_user_form():
+    n = next(_counter)
+    return {
+        'first_name': 'Bench', 'last_name': f"User{os.getpid()}x{n}",
+        'email': f"bench.{os.getpid()}.{n}@example.org", 'phone': '555-0100',
+        'address': '1 Benchmark Way', 'service_profile': 'Standard', 'password': 'benchpass',
+    }
+
+
+def add_nas_form():
+    n = next(_counter)
+    return {
+        'nas_name': f"bench-nas-{n}", 'nas_ip': f"192.0.{n // 250 % 250}.{n % 250 + 1}",
+        'nas_type': 'MikroTik', 'shared_secret': 'benchsecret', 'location': 'Benchmark',
+    }
+
+
+class DeleteTargets:
+    """Hands out seeded customer IDs (CUST0000001...) so each delete_user hits a real row once"""
+
+    def __init__(self, start):
+        self._ids = itertools.count(start)
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            return {'customer_id': f"CUST{next(self._ids):07d}"}
+
+
+# name -> (method, path, form fields or a callable returning them, mutates data)
+SCENARIOS = {
+    'get_stats': ('POST', '/api/get_stats', None, False),
+    'get_users': ('POST', '/api/get_users', None, False),
+    'get_users_columnar': ('POST', '/api/get_users', {'format': 'columnar'}, False),
+    'get_online_users': ('POST', '/api/get_online_users', None, False),
+    'get_online_users_columnar': ('POST', '/api/get_online_users', {'format': 'columnar'}, False),
+    'search_users': ('POST', '/api/search_users', search_form, False),
+    'get_nas': ('POST', '/api/get_nas', None, False),
+    'get_billing': ('POST', '/api/get_billing', None, False),
+    'service_profiles': ('GET', '/service_profiles', None, False),
+    'report_revenue': ('POST', '/api/get_reports', {'report_type': 'revenue'}, False),
+    'report_customers': ('POST', '/api/get_reports', {'report_type': 'customers'}, False),
+    'report_usage': ('POST', '/api/get_reports', {'report_type': 'usage'}, False),
+}
+
+WRITE_SCENARIOS = {
+    'add_user': ('POST', '/api/add_user', add_user_form, True),
+    'add_nas': ('POST', '/api/add_nas', add_nas_form, True),
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def issue_request(base_url, method, path, form, timeout, headers=None):
+    """Send one request and return (latency seconds, ok, response bytes on the wire)"""
+    data = urllib.parse.urlencode(form).encode() if form else None
+    if method == 'POST' and data is None:
+        data = b''
+    req = urllib.request.Request(base_url + path, data=data, method=method, headers=headers or {})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            body = resp.read()
+            ok = resp.status == 200
+            if ok and path.startswith('/api/'):
+                content = gzip.decompress(body) if resp.headers.get('Content-Encoding') == 'gzip' else body
+                ok = json.loads(content).get('success', False)
+    except (urllib.error.URLError, OSError, ValueError):
+        return time.perf_counter() - started, False, 0
+    return time.perf_counter() - started, ok, len(body)
+
+
+def run_scenario(base_url, scenario, concurrency, requests_per_worker, duration, timeout, headers=None):
+    """Run one scenario with N concurrent clients; stop on request count or duration"""
+    method, path, form, _ = scenario
+    latencies = []
+    errors = 0
+    total_bytes = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration if duration else None
+
+    def worker():
+        nonlocal errors, total_bytes
+        local = []
+        local_errors = 0
+        local_bytes = 0
+        for _ in range(requests_per_worker):
+            if deadline and time.perf_counter() >= deadline:
+                break
+            latency, ok, size = issue_request(base_url, method, path, form() if callable(form) else form, timeout,
+                                              headers)
+            local.append(latency)
+            local_bytes += size
+            if not ok:
+                local_errors += 1
+        with lock:
+            latencies.extend(local)
+            errors += local_errors
+            total_bytes += local_bytes
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    count = len(latencies)
+    return {
+        'concurrency': concurrency,
+        'requests': count,
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(count / elapsed, 2) if elapsed else 0,
+        'mean_bytes': int(total_bytes / count) if count else 0,
+        'latency_ms': {
+            'mean': round(sum(latencies) / count * 1000, 3) if count else None,
+            'p50': round(percentile(latencies, 0.50) * 1000, 3) if count else None,
+            'p90': round(percentile(latencies, 0.90) * 1000, 3) if count else None,
+            'p99': round(percentile(latencies, 0.99) * 1000, 3) if count else None,
+            'max': round(latencies[-1] * 1000, 3) if count else None,
+        },
+    }
+
+
+def dataset_summary(dsn):
+    """Row counts of the benchmark database so results can be compared like for like"""
+    import psycopg2
+    conn = psycopg2.connect(dsn)
+    try:
+        cur = conn.cursor()
+        summary = {}
+        for table in ('customers', 'radcheck', 'radusergroup', 'billing', 'nas_devices', 'radacct'):
+            cur.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", (table,))
+            row = cur.fetchone()
+            summary[table] = row[0] if row else None
+        return summary
+    finally:
+        conn.close()
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ISP admin API endpoints')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000', help='Running app to benchmark')
+    parser.add_argument('--concurrency', default='1,8,32', help='Comma separated client counts')
+    parser.add_argument('--requests', type=int, default=50, help='Requests per client per scenario')
+    parser.add_argument('--duration', type=float, default=30.0, help='Max seconds per scenario run')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Per request timeout in seconds')
+    parser.add_argument('--only', action='append', help='Run only the named scenario (repeatable)')
+    parser.add_argument('--writes', action='store_true',
+                        help='Also benchmark add_user, add_nas and delete_user (mutates the database)')
+    parser.add_argument('--delete-start', type=int, default=1,
+                        help='First seeded customer number used by the delete_user scenario')
+    parser.add_argument('--gzip', action='store_true', help='Send Accept-Encoding: gzip')
+    parser.add_argument('--dsn', help='Benchmark database DSN, recorded in the results')
+    parser.add_argument('--label', help='Free-form label stored with the results (e.g. version)')
+    parser.add_argument('--output', help='Results file (default benchmarks/results/<timestamp>.json)')
+    args = parser.parse_args()
+
+    scenarios = dict(SCENARIOS)
+    if args.writes:
+        scenarios.update(WRITE_SCENARIOS)
+        scenarios['delete_user'] = ('POST', '/api/delete_user', DeleteTargets(args.delete_start), True)
+    if args.only:
+        scenarios = {name: s for name, s in scenarios.items() if name in args.only}
+
+    levels = [int(level) for level in args.concurrency.split(',') if level]
+    headers = {'Accept-Encoding': 'gzip'} if args.gzip else None
+    results = {}
+    for name, scenario in scenarios.items():
+        results[name] = []
+        for level in levels:
+            print(f"{name} @ {level} clients...", end=' ', flush=True)
+            run = run_scenario(args.base_url, scenario, level, args.requests, args.duration, args.timeout, headers)
+            results[name].append(run)
+            print(f"{run['throughput_rps']} req/s, p50 {run['latency_ms']['p50']} ms, "
+                  f"p99 {run['latency_ms']['p99']} ms, errors {run['errors']}")
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'label': args.label,
+            'git_revision': git_revision(),
+            'base_url': args.base_url,
+            'python': platform.python_version(),
+            'host': platform.node(),
+            'requests_per_client': args.requests,
+            'gzip': args.gzip,
+            'dataset': dataset_summary(args.dsn) if args.dsn else None,
+        },
+        'results': results,
+    }
+    output = args.output
+    if not output:
+        results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+        os.makedirs(results_dir, exist_ok=True)
+        output = os.path.join(results_dir, datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Synthetic Dataset Seeder
+Loads a realistic synthetic ISP into a local PostgreSQL database with COPY:
+customers with matching radcheck/radusergroup/billing rows, NAS devices and
+radacct sessions with diurnal start times and plan-dependent traffic.
+
+Usage:
+    python -m benchmarks.seed_dataset --dsn postgresql:///radiusdb --customers 1000000
+"""
+
+import argparse
+import io
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_schema import apply_schema  # noqa: E402
+
+FIRST_NAMES = [
+    'james', 'mary', 'john', 'patricia', 'robert', 'jennifer', 'michael', 'linda', 'william',
+    'elizabeth', 'david', 'barbara', 'richard', 'susan', 'joseph', 'jessica', 'thomas', 'sarah',
+    'charles', 'karen', 'ahmad', 'fatima', 'omar', 'layla', 'hassan', 'nour', 'ali', 'maya',
+    'karim', 'rania', 'george', 'lina', 'elie', 'rita', 'tony', 'nadine', 'sami', 'hala',
+]
+LAST_NAMES = [
+    'smith', 'johnson', 'williams', 'brown', 'jones', 'garcia', 'miller', 'davis', 'rodriguez',
+    'martinez', 'haddad', 'khoury', 'nasser', 'saad', 'hajj', 'karam', 'aoun', 'frem', 'salem',
+    'mansour', 'harb', 'daher', 'chami', 'fares', 'rizk', 'youssef', 'hanna', 'sleiman',
+]
+STREETS = ['Main St', 'Oak Ave', 'Hamra St', 'Cedar Rd', 'Harbor Blvd', 'Mountain View', 'Station Rd']
+
+# (name, share of customers, download Mbps, mean GB per month)
+PROFILES = [
+    ('Student', 0.15, 15, 60),
+    ('Basic', 0.30, 10, 40),
+    ('Standard', 0.30, 25, 120),
+    ('Premium', 0.18, 50, 250),
+    ('Business', 0.07, 100, 500),
+]
+PROFILE_PRICES = {'Student': 19.99, 'Basic': 29.99, 'Standard': 49.99, 'Premium': 79.99, 'Business': 149.99}
+
+# Relative share of session starts for each hour of the day (evening peak)
+HOURLY_WEIGHTS = [
+    2, 1, 1, 1, 1, 2, 4, 6, 7, 7, 6, 6,
+    6, 6, 6, 6, 7, 8, 10, 12, 13, 12, 9, 5,
+]
+NAS_TYPES = ['MikroTik', 'Cisco', 'Ubiquiti', 'Other']
+
+
+class CopyStream(io.RawIOBase):
+    """File-like object that feeds generated COPY lines to psycopg2 without buffering them all"""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = 1 << 16
+        parts = [self._pending]
+        length = len(self._pending)
+        for line in self._lines:
+            encoded = line.encode('utf-8')
+            parts.append(encoded)
+            length += len(encoded)
+            if length >= size:
+                break
+        data = b''.join(parts)
+        self._pending = data[size:]
+        return data[:size]
+
+
+def copy_rows(conn, table, columns, lines):
+    """COPY a generator of tab separated lines into a table"""
+    started = time.time()
+    cur = conn.cursor()
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", CopyStream(lines), size=1 << 16)
+    conn.commit()
+    cur.execute(f"SELECT COUNT(*) FROM {table}")
+    print(f"  {table}: {cur.fetchone()[0]} rows ({time.time() - started:.1f}s)")
+    conn.rollback()
+
+
+def copy_value(value):
+    """Format a value for COPY text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def copy_line(*values):
+    return '\t'.join(copy_value(v) for v in values) + '\n'
+
+
+def customer_record(index, rng, now):
+    """Deterministic customer fields for a synthetic subscriber number"""
+    first = FIRST_NAMES[index % len(FIRST_NAMES)]
+    last = f"{LAST_NAMES[(index // len(FIRST_NAMES)) % len(LAST_NAMES)]}{index}"
+    pick = rng.random()
+    cumulative = 0
+    for name, share, _, _ in PROFILES:
+        cumulative += share
+        if pick <= cumulative:
+            profile = name
+            break
+    else:
+        profile = PROFILES[-1][0]
+    created = now - timedelta(days=rng.randint(1, 3 * 365), seconds=rng.randint(0, 86399))
+    status = 'active' if rng.random() < 0.95 else rng.choice(['inactive', 'suspended'])
+    return {
+        'index': index,
+        'customer_id': f"CUST{index:07d}",
+        'first_name': first.capitalize(),
+        'last_name': last.capitalize(),
+        'username': f"{first}.{last}",
+        'email': f"{first}.{last}@example.net",
+        'phone': f"+961-{rng.randint(1, 9)}-{rng.randint(100000, 999999)}",
+        'address': f"{rng.randint(1, 999)} {rng.choice(STREETS)}",
+        'profile': profile,
+        'status': status,
+        'created_at': created,
+    }
+
+
+def iter_customers(count, seed, now):
+    rng = random.Random(seed)
+    for index in range(1, count + 1):
+        yield customer_record(index, rng, now)
+
+
+def seed_nas(conn, nas_count):
+    lines = (
+        copy_line(f"nas-{i:04d}", f"10.{i // 250}.{i % 250}.1", NAS_TYPES[i % len(NAS_TYPES)],
+                  f"secret{i:04d}", f"POP {i // 10 + 1}", 'active')
+        for i in range(1, nas_count + 1)
+    )
+    copy_rows(conn, 'nas_devices', ['nas_name', 'nas_ip', 'nas_type', 'shared_secret', 'location', 'status'], lines)
+    return [f"10.{i // 250}.{i % 250}.1" for i in range(1, nas_count + 1)]
+
+
+def seed_customers(conn, args, now):
+    columns = ['customer_id', 'first_name', 'last_name', 'email', 'phone', 'address',
+               'service_profile', 'status', 'created_at', 'updated_at']
+    copy_rows(conn, 'customers', columns, (
+        copy_line(c['customer_id'], c['first_name'], c['last_name'], c['email'], c['phone'],
+                  c['address'], c['profile'], c['status'], c['created_at'], c['created_at'])
+        for c in iter_customers(args.customers, args.seed, now)
+    ))
+    copy_rows(conn, 'radcheck', ['username', 'attribute', 'op', 'value'], (
+        copy_line(c['username'], 'Cleartext-Password', ':=', f"pw{c['customer_id'][4:]}")
+        for c in iter_customers(args.customers, args.seed, now)
+    ))
+    copy_rows(conn, 'radusergroup', ['username', 'groupname', 'priority'], (
+        copy_line(c['username'], c['profile'], 1)
+        for c in iter_customers(args.customers, args.seed, now)
+    ))
+    copy_rows(conn, 'billing', ['customer_id', 'invoice_number', 'amount', 'billing_date', 'due_date',
+                                'status', 'created_at'], iter_billing(args, now))
+
+
+def iter_billing(args, now):
+    """Monthly invoices since signup (capped): older ones paid, the latest pending, a few overdue"""
+    rng = random.Random(args.seed + 1)
+    today = now.date()
+    for c in iter_customers(args.customers, args.seed, now):
+        months = min(args.billing_months, max(1, (today - c['created_at'].date()).days // 30))
+        price = PROFILE_PRICES[c['profile']]
+        for m in range(months):
+            billing_date = today - timedelta(days=30 * (months - 1 - m) + rng.randint(0, 3))
+            due_date = billing_date + timedelta(days=30)
+            if m < months - 1:
+                status = 'paid' if rng.random() < 0.97 else 'overdue'
+            else:
+                status = 'pending'
+            yield copy_line(c['customer_id'], f"INV-{c['customer_id'][4:]}-{m:03d}", price,
+                            billing_date, due_date, status, billing_date)
+
+
+def iter_sessions(args, nas_ips, now):
+    """radacct rows: diurnal start times, lognormal durations and plan-scaled octets"""
+    rng = random.Random(args.seed + 2)
+    speeds = {name: (mbps, gb) for name, _, mbps, gb in PROFILES}
+    hours = list(range(24))
+    window_start = now - timedelta(days=args.days)
+    radacctid = 0
+    for c in iter_customers(args.customers, args.seed, now):
+        if c['status'] != 'active':
+            continue
+        mbps, monthly_gb = speeds[c['profile']]
+        nas_ip = nas_ips[c['index'] % len(nas_ips)]
+        mac = ':'.join(f"{rng.randint(0, 255):02x}" for _ in range(6))
+        framed_ip = f"100.{64 + rng.randint(0, 63)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+        # Poisson-ish session count around the configured mean
+        n_sessions = max(0, int(rng.gauss(args.sessions_per_customer, args.sessions_per_customer ** 0.5)))
+        bytes_per_second = monthly_gb * 1e9 / (30 * 86400) * 4
+        for s in range(n_sessions):
+            day = window_start + timedelta(days=rng.randint(0, args.days - 1))
+            start = day.replace(hour=rng.choices(hours, HOURLY_WEIGHTS)[0], minute=rng.randint(0, 59),
+                                second=rng.randint(0, 59))
+            duration = int(min(7 * 86400, rng.lognormvariate(math.log(7200), 1.1)))
+            stop = start + timedelta(seconds=duration)
+            if stop >= now:
+                continue
+            traffic = int(duration * bytes_per_second * rng.lognormvariate(0, 0.8))
+            download = traffic * 8 // 9
+            radacctid += 1
+            yield session_line(radacctid, c, nas_ip, mac, framed_ip, start, stop, duration, traffic - download,
+                               download, 'User-Request' if rng.random() < 0.8 else 'Lost-Carrier')
+        # A share of active subscribers currently online
+        if rng.random() < args.online_ratio:
+            start = now - timedelta(seconds=int(rng.lognormvariate(math.log(10800), 1.0)) % (3 * 86400))
+            duration = int((now - start).total_seconds())
+            traffic = int(duration * bytes_per_second * rng.lognormvariate(0, 0.8))
+            radacctid += 1
+            yield session_line(radacctid, c, nas_ip, mac, framed_ip, start, None, duration, traffic // 9,
+                               traffic - traffic // 9, None, update=now - timedelta(seconds=rng.randint(0, 299)))
+
+
+def session_line(radacctid, c, nas_ip, mac, framed_ip, start, stop, duration, input_octets, output_octets,
+                 cause, update=None):
+    session_id = f"{radacctid:08X}"
+    return copy_line(
+        session_id, f"{radacctid:032x}", c['username'], c['profile'], nas_ip, f"ether{radacctid % 48}",
+        'Ethernet', start, update or stop, stop, 300, duration, input_octets, output_octets,
+        'pppoe-server', mac, cause or '', 'Framed-User', 'PPP', framed_ip,
+    )
+
+
+def seed_sessions(conn, args, nas_ips, now):
+    columns = ['acctsessionid', 'acctuniqueid', 'username', 'groupname', 'nasipaddress', 'nasportid',
+               'nasporttype', 'acctstarttime', 'acctupdatetime', 'acctstoptime', 'acctinterval',
+               'acctsessiontime', 'acctinputoctets', 'acctoutputoctets', 'calledstationid',
+               'callingstationid', 'acctterminatecause', 'servicetype', 'framedprotocol', 'framedipaddress']
+    copy_rows(conn, 'radacct', columns, iter_sessions(args, nas_ips, now))
+
+
+def truncate(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        TRUNCATE radacct, billing, radusergroup, radcheck, customers, nas_devices RESTART IDENTITY CASCADE
+    """)
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a synthetic ISP dataset for benchmarking')
+    parser.add_argument('--dsn', required=True, help='PostgreSQL DSN of the benchmark database')
+    parser.add_argument('--customers', type=int, default=10000, help='Number of subscribers (up to 1M)')
+    parser.add_argument('--nas', type=int, default=50, help='Number of NAS devices')
+    parser.add_argument('--sessions-per-customer', type=float, default=30.0,
+                        help='Mean closed radacct sessions per active subscriber')
+    parser.add_argument('--days', type=int, default=90, help='Accounting history window in days')
+    parser.add_argument('--billing-months', type=int, default=6, help='Invoices per subscriber (max)')
+    parser.add_argument('--online-ratio', type=float, default=0.35, help='Share of subscribers online now')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed for reproducible datasets')
+    parser.add_argument('--keep', action='store_true', help='Do not truncate existing data first')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    started = time.time()
+    try:
+        print("Applying schema...")
+        apply_schema(conn, ['base', 'seed'])
+        if not args.keep:
+            truncate(conn)
+        print(f"Seeding {args.customers} customers...")
+        nas_ips = seed_nas(conn, args.nas)
+        seed_customers(conn, args, now)
+        print("Seeding accounting sessions...")
+        seed_sessions(conn, args, nas_ips, now)
+        print("Building indexes and derived tables...")
+        apply_schema(conn)
+        print("Analyzing...")
+        conn.autocommit = True
+        conn.cursor().execute("ANALYZE")
+        print(f"Done in {time.time() - started:.1f}s")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
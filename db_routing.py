@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Read/Write Routing
+Sends read-only API actions to streaming replicas and everything else to the
+primary. A replica is skipped when its replay lag exceeds a threshold or when
+it has not yet replayed the client's own last write (read-your-writes, tracked
+with a WAL LSN cookie set after every mutation).
+"""
+
+import itertools
+import os
+import threading
+import time
+
+import psycopg2
+
+import tracing
+
+# Actions that never write and may be answered by a replica
+READ_ONLY_ACTIONS = {
+    'get_users', 'get_online_users', 'search_users', 'get_nas', 'get_stats', 'get_billing', 'get_reports',
+    'get_job', 'list_jobs', 'get_nas_health', 'get_ip_pools',
+    'get_usage_history', 'get_auth_blocks', 'get_reaper_log',
+    'get_payment_batch', 'list_payment_batches', 'get_dunning_runs', 'get_acct_shards',
+    'get_bandwidth_schedules', 'lookup_ip', 'get_usage_ratings',
+}
+
+MAX_REPLICA_LAG = float(os.environ.get('DB_MAX_REPLICA_LAG', '5'))    # seconds
+STATUS_TTL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', '2'))  # seconds between lag checks
+LSN_COOKIE = 'db_lsn'
+LSN_COOKIE_MAX_AGE = 60
+
+REPLICA_STATUS_SQL = """
+    SELECT pg_is_in_recovery(),
+           pg_last_wal_replay_lsn()::text,
+           CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+           END
+"""
+
+
+def parse_lsn(text):
+    """'16/B374D848' -> integer position, None for missing or malformed values"""
+    try:
+        high, low = text.split('/')
+        return (int(high, 16) << 32) | int(low, 16)
+    except (AttributeError, ValueError):
+        return None
+
+
+def connection_params(config):
+    """psycopg2.connect() keyword arguments of the primary from DB_CONFIG"""
+    return {key: value for key, value in config.items() if key not in ('replicas', 'acct_shards')}
+
+
+def replica_params(config):
+    """Replica connection settings; dict entries inherit unset keys from the primary"""
+    primary = connection_params(config)
+    replicas = list(config.get('replicas') or [])
+    env = os.environ.get('DB_REPLICA_DSNS')
+    if env:
+        replicas.extend(dsn.strip() for dsn in env.split(',') if dsn.strip())
+    return [dict(primary, **replica) if isinstance(replica, dict) else replica for replica in replicas]
+
+
+def _connect(params):
+    with tracing.span('connect', 'client'):
+        if isinstance(params, str):
+            return psycopg2.connect(params, connection_factory=tracing.connection_factory())
+        return psycopg2.connect(**params, connection_factory=tracing.connection_factory())
+
+
+class ReplicaState:
+    def __init__(self, params):
+        self.params = params
+        self.checked_at = 0.0
+        self.healthy = False
+        self.lag = None
+        self.replay_lsn = None
+
+
+class DatabaseRouter:
+    """Picks the server for each connection and tracks replica lag"""
+
+    def __init__(self, config, max_lag=MAX_REPLICA_LAG, status_ttl=STATUS_TTL):
+        self.primary = connection_params(config)
+        self.replicas = [ReplicaState(params) for params in replica_params(config)]
+        self.max_lag = max_lag
+        self.status_ttl = status_ttl
+        self._next = itertools.cycle(range(len(self.replicas))) if self.replicas else None
+        self._lock = threading.Lock()
+
+    @property
+    def has_replicas(self):
+        return bool(self.replicas)
+
+    def connect_primary(self):
+        return _connect(self.primary)
+
+    def connect_for_read(self, min_lsn=None):
+        """Return (connection, 'replica'|'primary') for a read-only request"""
+        wanted = parse_lsn(min_lsn) if min_lsn else None
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = self.replicas[next(self._next)]
+            conn = self._try_replica(replica, wanted)
+            if conn:
+                return conn, 'replica'
+        return self.connect_primary(), 'primary'
+
+    def _try_replica(self, replica, wanted):
+        now = time.monotonic()
+        fresh = now - replica.checked_at < self.status_ttl
+        # A cached status can only understate how far the replica has replayed
+        if fresh and not self._usable(replica, wanted):
+            return None
+        try:
+            conn = _connect(replica.params)
+        except psycopg2.Error as e:
+            print(f"Replica connection error: {e}")
+            replica.healthy, replica.checked_at = False, now
+            return None
+        if not fresh:
+            try:
+                cur = conn.cursor()
+                cur.execute(REPLICA_STATUS_SQL)
+                in_recovery, replay_lsn, lag = cur.fetchone()
+                conn.rollback()
+                replica.healthy = bool(in_recovery)
+                replica.replay_lsn = parse_lsn(replay_lsn)
+                replica.lag = float(lag)
+            except psycopg2.Error as e:
+                print(f"Replica status check failed: {e}")
+                replica.healthy = False
+            replica.checked_at = now
+            if not self._usable(replica, wanted):
+                conn.close()
+                return None
+        return conn
+
+    def _usable(self, replica, wanted):
+        if not replica.healthy or replica.lag is None or replica.lag > self.max_lag:
+            return False
+        if wanted is not None and (replica.replay_lsn is None or replica.replay_lsn < wanted):
+            return False
+        return True
+
+    @staticmethod
+    def current_lsn(conn):
+        """WAL position on the primary after a write, handed to the client as the LSN cookie"""
+        cur = conn.cursor()
+        cur.execute("SELECT pg_current_wal_lsn()::text")
+        lsn = cur.fetchone()[0]
+        conn.rollback()
+        return lsn
+
+    def status(self):
+        return [{
+            'replica': index,
+            'healthy': replica.healthy,
+            'lag_seconds': replica.lag,
+            'checked_seconds_ago': round(time.monotonic() - replica.checked_at, 1) if replica.checked_at else None,
+        } for index, replica in enumerate(self.replicas)]
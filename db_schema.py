@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Database Schema
+Tables used by the admin app and FreeRADIUS. Every statement is idempotent,
+so the schema can be applied to a fresh database or re-applied after upgrades.
+"""
+
+import argparse
+import psycopg2
+
+from acct_events import ACCT_EVENTS_SCHEMA
+from acct_shards import ACCT_SHARDS_SCHEMA
+from auth_guard import AUTHGUARD_SCHEMA
+from bandwidth_scheduler import BANDWIDTH_SCHEMA
+from authz_cache import AUTHZ_SCHEMA
+from db_routing import connection_params
+from deprovision import DEPROVISION_SCHEMA
+from dunning import DUNNING_SCHEMA
+from invoice_documents import INVOICE_DOCUMENTS_SCHEMA
+from ip_pool import IPPOOL_SCHEMA
+from jobs import JOBS_SCHEMA
+from nas_clients import NAS_CLIENTS_SCHEMA
+from nas_monitor import NAS_HEALTH_SCHEMA
+from payments import PAYMENTS_SCHEMA
+from rating import RATING_SCHEMA
+from reports import REPORTS_SCHEMA
+from search import SEARCH_SCHEMA
+from session_archive import ARCHIVE_SCHEMA
+from session_limits import SESSION_LIMITS_SCHEMA
+from session_reaper import REAPER_SCHEMA
+from usage_store import USAGE_SCHEMA
+
+# Core ISP and FreeRADIUS tables (same layout as the installer scripts)
+BASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS service_profiles (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(50) UNIQUE NOT NULL,
+    download_speed INTEGER NOT NULL,
+    upload_speed INTEGER NOT NULL,
+    data_limit INTEGER,
+    price DECIMAL(10,2) NOT NULL,
+    description TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS customers (
+    customer_id VARCHAR(20) PRIMARY KEY,
+    first_name VARCHAR(50) NOT NULL,
+    last_name VARCHAR(50) NOT NULL,
+    email VARCHAR(100) UNIQUE NOT NULL,
+    phone VARCHAR(20),
+    address TEXT,
+    service_profile VARCHAR(50),
+    status VARCHAR(20) DEFAULT 'active',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS nas_devices (
+    id SERIAL PRIMARY KEY,
+    nas_name VARCHAR(100) NOT NULL,
+    nas_ip VARCHAR(15) NOT NULL,
+    nas_type VARCHAR(50),
+    shared_secret VARCHAR(100),
+    location VARCHAR(200),
+    status VARCHAR(20) DEFAULT 'active',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS billing (
+    id SERIAL PRIMARY KEY,
+    customer_id VARCHAR(20) REFERENCES customers(customer_id),
+    invoice_number VARCHAR(50) UNIQUE NOT NULL,
+    amount DECIMAL(10,2) NOT NULL,
+    billing_date DATE DEFAULT CURRENT_DATE,
+    due_date DATE NOT NULL,
+    status VARCHAR(20) DEFAULT 'pending',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS radcheck (
+    id SERIAL PRIMARY KEY,
+    username VARCHAR(64) NOT NULL DEFAULT '',
+    attribute VARCHAR(64) NOT NULL DEFAULT '',
+    op CHAR(2) NOT NULL DEFAULT '==',
+    value VARCHAR(253) NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS radreply (
+    id SERIAL PRIMARY KEY,
+    username VARCHAR(64) NOT NULL DEFAULT '',
+    attribute VARCHAR(64) NOT NULL DEFAULT '',
+    op CHAR(2) NOT NULL DEFAULT '=',
+    value VARCHAR(253) NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS radgroupcheck (
+    id SERIAL PRIMARY KEY,
+    groupname VARCHAR(64) NOT NULL DEFAULT '',
+    attribute VARCHAR(64) NOT NULL DEFAULT '',
+    op CHAR(2) NOT NULL DEFAULT '==',
+    value VARCHAR(253) NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS radgroupreply (
+    id SERIAL PRIMARY KEY,
+    groupname VARCHAR(64) NOT NULL DEFAULT '',
+    attribute VARCHAR(64) NOT NULL DEFAULT '',
+    op CHAR(2) NOT NULL DEFAULT '=',
+    value VARCHAR(253) NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS radusergroup (
+    username VARCHAR(64) NOT NULL DEFAULT '',
+    groupname VARCHAR(64) NOT NULL DEFAULT '',
+    priority INTEGER NOT NULL DEFAULT 1
+);
+
+CREATE TABLE IF NOT EXISTS radacct (
+    radacctid BIGSERIAL PRIMARY KEY,
+    acctsessionid VARCHAR(64) NOT NULL DEFAULT '',
+    acctuniqueid VARCHAR(32) NOT NULL DEFAULT '',
+    username VARCHAR(64) NOT NULL DEFAULT '',
+    groupname VARCHAR(64) NOT NULL DEFAULT '',
+    realm VARCHAR(64) DEFAULT '',
+    nasipaddress INET NOT NULL,
+    nasportid VARCHAR(15),
+    nasporttype VARCHAR(32),
+    acctstarttime TIMESTAMP with time zone,
+    acctupdatetime TIMESTAMP with time zone,
+    acctstoptime TIMESTAMP with time zone,
+    acctinterval BIGINT,
+    acctsessiontime BIGINT,
+    acctauthentic VARCHAR(32),
+    connectinfo_start VARCHAR(50),
+    connectinfo_stop VARCHAR(50),
+    acctinputoctets BIGINT,
+    acctoutputoctets BIGINT,
+    calledstationid VARCHAR(50),
+    callingstationid VARCHAR(50),
+    acctterminatecause VARCHAR(32),
+    servicetype VARCHAR(32),
+    framedprotocol VARCHAR(32),
+    framedipaddress INET
+);
+
+CREATE TABLE IF NOT EXISTS radpostauth (
+    id BIGSERIAL PRIMARY KEY,
+    username VARCHAR(64) NOT NULL DEFAULT '',
+    pass VARCHAR(64) NOT NULL DEFAULT '',
+    reply VARCHAR(32) NOT NULL DEFAULT '',
+    authdate TIMESTAMP with time zone NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS nas (
+    id SERIAL PRIMARY KEY,
+    nasname VARCHAR(128) NOT NULL,
+    shortname VARCHAR(32),
+    type VARCHAR(30) DEFAULT 'other',
+    ports INTEGER,
+    secret VARCHAR(60) NOT NULL DEFAULT 'secret',
+    server VARCHAR(64),
+    community VARCHAR(50),
+    description VARCHAR(200) DEFAULT 'RADIUS Client'
+);
+
+CREATE INDEX IF NOT EXISTS radacct_username_idx ON radacct (username);
+CREATE INDEX IF NOT EXISTS radacct_session_idx ON radacct (acctsessionid);
+CREATE INDEX IF NOT EXISTS radacct_start_time_idx ON radacct (acctstarttime);
+CREATE INDEX IF NOT EXISTS radacct_open_start_idx ON radacct (acctstarttime DESC) WHERE acctstoptime IS NULL;
+CREATE INDEX IF NOT EXISTS radcheck_username_idx ON radcheck (username);
+CREATE INDEX IF NOT EXISTS radreply_username_idx ON radreply (username);
+CREATE INDEX IF NOT EXISTS radgroupcheck_groupname_idx ON radgroupcheck (groupname);
+CREATE INDEX IF NOT EXISTS radgroupreply_groupname_idx ON radgroupreply (groupname);
+CREATE INDEX IF NOT EXISTS radusergroup_username_idx ON radusergroup (username);
+"""
+
+# Default service plans and their bandwidth groups
+SEED_DATA = """
+INSERT INTO service_profiles (name, download_speed, upload_speed, data_limit, price, description) VALUES
+('Student', 15, 3, 75, 19.99, 'Perfect for students - basic internet access with good speed'),
+('Basic', 10, 2, 50, 29.99, 'Basic home internet package for light usage'),
+('Standard', 25, 5, 150, 49.99, 'Standard home internet with good speed for families'),
+('Premium', 50, 10, 300, 79.99, 'Premium package for heavy users and streaming'),
+('Business', 100, 20, NULL, 149.99, 'Business package with unlimited data and priority support')
+ON CONFLICT (name) DO NOTHING;
+
+INSERT INTO radgroupreply (groupname, attribute, op, value)
+SELECT sp.name, a.attribute, ':=', (CASE a.attribute
+        WHEN 'WISPr-Bandwidth-Max-Down' THEN sp.download_speed
+        ELSE sp.upload_speed END * 1000000)::text
+FROM service_profiles sp
+CROSS JOIN (VALUES ('WISPr-Bandwidth-Max-Down'), ('WISPr-Bandwidth-Max-Up')) AS a(attribute)
+WHERE NOT EXISTS (
+    SELECT 1 FROM radgroupreply r WHERE r.groupname = sp.name AND r.attribute = a.attribute
+);
+"""
+
+# Applied in order by apply_schema(); subsystems add their own parts here
+SCHEMA_PARTS = [
+    ('base', BASE_SCHEMA),
+    ('seed', SEED_DATA),
+    ('search', SEARCH_SCHEMA),
+    ('reports', REPORTS_SCHEMA),
+    ('jobs', JOBS_SCHEMA),
+    ('authz', AUTHZ_SCHEMA),
+    ('nas_health', NAS_HEALTH_SCHEMA),
+    ('acct_events', ACCT_EVENTS_SCHEMA),
+    ('ip_pools', IPPOOL_SCHEMA),
+    ('usage', USAGE_SCHEMA),
+    ('auth_guard', AUTHGUARD_SCHEMA),
+    ('reaper', REAPER_SCHEMA),
+    ('payments', PAYMENTS_SCHEMA),
+    ('dunning', DUNNING_SCHEMA),
+    ('acct_shards', ACCT_SHARDS_SCHEMA),
+    ('bandwidth', BANDWIDTH_SCHEMA),
+    ('archive', ARCHIVE_SCHEMA),
+    ('rating', RATING_SCHEMA),
+    ('session_limits', SESSION_LIMITS_SCHEMA),
+    ('invoice_documents', INVOICE_DOCUMENTS_SCHEMA),
+    ('nas_clients', NAS_CLIENTS_SCHEMA),
+    ('deprovision', DEPROVISION_SCHEMA),
+]
+
+
+def apply_schema(conn, parts=None):
+    """Create all tables and indexes, skipping anything that already exists"""
+    cur = conn.cursor()
+    for name, sql in SCHEMA_PARTS:
+        if parts and name not in parts:
+            continue
+        cur.execute(sql)
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create or upgrade the ISP RADIUS database schema')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    parser.add_argument('--part', action='append', help='Only apply the named part (repeatable)')
+    args = parser.parse_args()
+
+    if args.dsn:
+        conn = psycopg2.connect(args.dsn)
+    else:
+        from app import DB_CONFIG
+        conn = psycopg2.connect(**connection_params(DB_CONFIG))
+    try:
+        apply_schema(conn, args.part)
+        print("Schema applied successfully")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Deprovisioning
+Removes customers in bulk in two steps. Deprovisioning is one statement for
+any number of customers: they are marked deleted (status 'deleted',
+deleted_at) and their RADIUS usernames get an Auth-Type := Reject check item,
+so the next Access-Request is rejected (the authorize cache reloads those
+users from NOTIFY) and their live sessions are disconnected by a job right
+after. Their radcheck, radreply, radusergroup and billing rows and the
+customer rows themselves are purged later by a background job, PURGE_BATCH
+customers per transaction with a pause in between, so a large churn batch
+never holds many row locks or a long transaction.
+
+A username shared with a customer who is not deleted (namesakes before the
+username was stored per customer) is neither rejected nor purged.
+
+Usage:
+    python deprovision.py CUST0001 CUST0002 ...   # deprovision, purge in the background
+    python deprovision.py --file churned.txt      # one customer ID per line
+    python deprovision.py --purge                 # purge now, in the foreground
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import psycopg2
+
+import acct_shards
+import dunning
+import jobs
+from db_routing import connection_params
+
+PURGE_DELAY = int(os.environ.get('DEPROVISION_PURGE_DELAY', '0'))    # seconds a deleted customer is kept
+PURGE_BATCH = 1000
+BATCH_PAUSE = 0.05             # seconds between purge batches, lets other writes through
+PURGE_LOCK_ID = 0x50555247     # one purge at a time
+
+DEPROVISION_SCHEMA = """
+ALTER TABLE customers ADD COLUMN IF NOT EXISTS radius_username VARCHAR(64);
+ALTER TABLE customers ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP with time zone;
+-- Customers created before the column existed got the username add_user derived from their name
+UPDATE customers SET radius_username = lower(first_name) || '.' || lower(last_name)
+WHERE radius_username IS NULL;
+CREATE INDEX IF NOT EXISTS customers_radius_username_idx ON customers (radius_username);
+CREATE INDEX IF NOT EXISTS customers_deleted_idx ON customers (deleted_at) WHERE deleted_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS billing_customer_idx ON billing (customer_id);
+"""
+
+# Deleted customers due for purging
+DUE = "deleted_at IS NOT NULL AND deleted_at <= now() - make_interval(secs => %s)"
+
+
+def deprovision(cur, customer_ids):
+    """Soft-delete the customers and reject their logins, in the caller's transaction
+
+    Returns (customers deleted, usernames cut off). Unknown or already
+    deleted IDs are ignored.
+    """
+    cur.execute("""
+        WITH gone AS (
+            UPDATE customers SET status = 'deleted', deleted_at = now(), updated_at = now()
+            WHERE customer_id = ANY(%(ids)s) AND deleted_at IS NULL
+            RETURNING customer_id, radius_username
+        ), unsuspended AS (
+            -- Dunning must not give their groups back
+            DELETE FROM dunning_suspensions s USING gone g WHERE s.customer_id = g.customer_id
+        ), cut AS (
+            INSERT INTO radcheck (username, attribute, op, value)
+            SELECT DISTINCT g.radius_username, 'Auth-Type', ':=', 'Reject'
+            FROM gone g
+            -- The statement sees customers as they were before the UPDATE
+            WHERE g.radius_username IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM customers live
+                WHERE live.radius_username = g.radius_username AND live.deleted_at IS NULL
+                  AND live.customer_id <> ALL(%(ids)s)
+            )
+            RETURNING username
+        )
+        SELECT (SELECT COUNT(*) FROM gone), ARRAY(SELECT username FROM cut)
+    """, {'ids': list(customer_ids)})
+    deleted, usernames = cur.fetchone()
+    return deleted, usernames
+
+
+def deprovision_customers(conn, customer_ids):
+    """Deprovision, then queue the disconnects and the purge; returns a summary"""
+    cur = conn.cursor()
+    deleted, usernames = deprovision(cur, customer_ids)
+    disconnect_job = jobs.enqueue(cur, 'deprovision_disconnect', {'usernames': usernames}) if usernames else None
+    purge_job = jobs.enqueue(cur, 'purge_customers', delay=PURGE_DELAY) if deleted else None
+    conn.commit()
+    return {'deleted': deleted, 'rejected_usernames': len(usernames),
+            'disconnect_job_id': disconnect_job, 'purge_job_id': purge_job}
+
+
+def purge(conn, batch_size=PURGE_BATCH, older_than=PURGE_DELAY, progress=None):
+    """Remove deleted customers and their RADIUS and billing rows, one batch per transaction
+
+    Returns the counts, or None if another purge holds the lock.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(%s)", (PURGE_LOCK_ID,))
+    if not cur.fetchone()[0]:
+        conn.rollback()
+        return None
+    conn.commit()
+    started = time.monotonic()
+    counts = {'customers': 0, 'radcheck': 0, 'radreply': 0, 'radusergroup': 0, 'billing': 0}
+    try:
+        cur.execute(f"SELECT COUNT(*) FROM customers WHERE {DUE}", (older_than,))
+        total = cur.fetchone()[0]
+        conn.rollback()
+        while True:
+            cur.execute(f"""
+                CREATE TEMP TABLE purge_batch ON COMMIT DROP AS
+                SELECT customer_id, radius_username AS username
+                FROM customers
+                WHERE {DUE}
+                ORDER BY deleted_at
+                LIMIT %s
+            """, (older_than, batch_size))
+            if cur.rowcount == 0:
+                conn.rollback()
+                break
+            batch = cur.rowcount
+            for table in ('radcheck', 'radreply', 'radusergroup'):
+                cur.execute(f"""
+                    DELETE FROM {table} r
+                    USING (SELECT DISTINCT username FROM purge_batch WHERE username IS NOT NULL) p
+                    WHERE r.username = p.username AND NOT EXISTS (
+                        -- A username is kept while a customer who is not deleted holds it
+                        SELECT 1 FROM customers live
+                        WHERE live.radius_username = p.username AND live.deleted_at IS NULL
+                    )
+                """)
+                counts[table] += cur.rowcount
+            # billing references customers without ON DELETE CASCADE, so it goes first
+            cur.execute("DELETE FROM billing b USING purge_batch p WHERE b.customer_id = p.customer_id")
+            counts['billing'] += cur.rowcount
+            cur.execute("DELETE FROM customers c USING purge_batch p WHERE c.customer_id = p.customer_id")
+            counts['customers'] += cur.rowcount
+            conn.commit()
+            if progress:
+                progress(counts['customers'] / max(total, 1), f"{counts['customers']} customers purged")
+            if batch < batch_size:
+                break
+            time.sleep(BATCH_PAUSE)
+    finally:
+        conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(%s)", (PURGE_LOCK_ID,))
+        conn.commit()
+    counts['seconds'] = round(time.monotonic() - started, 2)
+    return counts
+
+
+@jobs.job_handler('deprovision_disconnect')
+def disconnect_job(ctx, payload):
+    """Background job: disconnect the live sessions of deprovisioned users (payload: usernames)"""
+    conn = ctx.connect()
+    try:
+        requests = dunning.open_sessions(conn.cursor(), payload['usernames'], acct_shards.default_router())
+        conn.rollback()
+    finally:
+        conn.close()
+    disconnected, failed = dunning.disconnect(requests)
+    return {'sessions': len(requests), 'disconnected': disconnected, 'disconnect_failed': failed}
+
+
+@jobs.job_handler('purge_customers')
+def purge_job(ctx, payload):
+    """Background job: purge deleted customers in batches"""
+    conn = ctx.connect()
+    try:
+        counts = purge(conn, progress=ctx.progress)
+    finally:
+        conn.close()
+    return {'skipped': True} if counts is None else counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Deprovision customers and purge deleted ones')
+    parser.add_argument('customer_ids', nargs='*')
+    parser.add_argument('--file', help='File with one customer ID per line')
+    parser.add_argument('--purge', action='store_true', help='Purge deleted customers now instead of by a job')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    args = parser.parse_args()
+
+    customer_ids = list(args.customer_ids)
+    if args.file:
+        with open(args.file) as f:
+            customer_ids += [line.strip() for line in f if line.strip()]
+    if not customer_ids and not args.purge:
+        parser.error('give customer IDs, --file or --purge')
+    if args.dsn:
+        config = {'dsn': args.dsn}
+    else:
+        from app import DB_CONFIG
+        config = DB_CONFIG
+    conn = psycopg2.connect(**connection_params(config))
+    try:
+        if customer_ids:
+            summary = deprovision_customers(conn, customer_ids)
+            print(f"{summary['deleted']} customers deprovisioned, {summary['rejected_usernames']} usernames rejected")
+        if args.purge:
+            counts = purge(conn, older_than=0)
+            if counts is None:
+                sys.exit('Another purge is running')
+            print(f"Purged {counts['customers']} customers: {counts['radcheck']} radcheck, "
+                  f"{counts['radreply']} radreply, {counts['radusergroup']} radusergroup, "
+                  f"{counts['billing']} billing rows in {counts['seconds']}s")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Dunning
+Suspends customers with invoices overdue past the grace period and restores
+them once they have paid, a whole run at a time: pending invoices past their
+due date are marked overdue, and the customers to suspend or restore are
+selected into temporary tables, so every change (radusergroup moved to or
+from the walled-garden group, customers.status) is one statement however
+many accounts are affected. Live sessions of the affected users are then
+disconnected (RFC 5176 Disconnect-Request) at a limited rate, so they log in
+again under their new group.
+
+Usage:
+    python dunning.py                  # suspend, restore and disconnect
+    python dunning.py --dry-run        # report the counts, change nothing
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+import psycopg2
+
+import acct_shards
+import jobs
+import radius_client
+from db_routing import connection_params
+
+GRACE_DAYS = int(os.environ.get('DUNNING_GRACE_DAYS', '7'))
+WALLED_GARDEN_GROUP = os.environ.get('DUNNING_GROUP', 'walled-garden')
+DISCONNECT_RATE = int(os.environ.get('DUNNING_DISCONNECT_RATE', '500'))    # Disconnect-Requests per second
+DISCONNECT_TIMEOUT = 3.0
+DUNNING_LOCK_ID = 0x44554e4e   # only one run at a time
+
+# RADIUS username of a customer, stored by add_user (see deprovision.py)
+USERNAME_SQL = "c.radius_username"
+
+DUNNING_SCHEMA = f"""
+CREATE INDEX IF NOT EXISTS billing_open_due_idx ON billing (due_date) WHERE status IN ('pending', 'overdue');
+
+-- Customers suspended by dunning, with the groups to give back on restore
+CREATE TABLE IF NOT EXISTS dunning_suspensions (
+    customer_id VARCHAR(20) PRIMARY KEY REFERENCES customers(customer_id) ON DELETE CASCADE,
+    username VARCHAR(64) NOT NULL,
+    groups TEXT[] NOT NULL,
+    priorities INTEGER[] NOT NULL,
+    suspended_at TIMESTAMP with time zone NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS dunning_runs (
+    id SERIAL PRIMARY KEY,
+    started_at TIMESTAMP with time zone NOT NULL DEFAULT now(),
+    marked_overdue INTEGER NOT NULL DEFAULT 0,
+    suspended INTEGER NOT NULL DEFAULT 0,
+    restored INTEGER NOT NULL DEFAULT 0,
+    sessions INTEGER NOT NULL DEFAULT 0,
+    disconnected INTEGER NOT NULL DEFAULT 0,
+    disconnect_failed INTEGER NOT NULL DEFAULT 0,
+    seconds REAL
+);
+
+-- Suspended users keep connecting, but only to the payment portal
+INSERT INTO radgroupreply (groupname, attribute, op, value)
+SELECT '{WALLED_GARDEN_GROUP}', 'Mikrotik-Address-List', ':=', 'walled-garden'
+WHERE NOT EXISTS (SELECT 1 FROM radgroupreply WHERE groupname = '{WALLED_GARDEN_GROUP}');
+"""
+
+
+def apply_dunning(cur, grace_days=GRACE_DAYS, group=WALLED_GARDEN_GROUP):
+    """Mark overdue invoices, suspend and restore customers in the caller's transaction
+
+    Returns (counts, usernames whose sessions must be disconnected).
+    """
+    params = {'grace': grace_days, 'group': group}
+    cur.execute("""
+        UPDATE billing SET status = 'overdue'
+        WHERE status = 'pending' AND due_date < CURRENT_DATE
+    """)
+    marked_overdue = cur.rowcount
+
+    cur.execute(f"""
+        CREATE TEMP TABLE dunning_suspend ON COMMIT DROP AS
+        SELECT c.customer_id, {USERNAME_SQL} AS username
+        FROM customers c
+        WHERE c.status = 'active'
+          AND c.customer_id IN (
+              SELECT customer_id FROM billing
+              WHERE status IN ('pending', 'overdue') AND due_date < CURRENT_DATE - %(grace)s
+          )
+          AND NOT EXISTS (SELECT 1 FROM dunning_suspensions s WHERE s.customer_id = c.customer_id)
+    """, params)
+    cur.execute("""
+        INSERT INTO dunning_suspensions (customer_id, username, groups, priorities)
+        SELECT t.customer_id, t.username,
+               COALESCE(array_agg(g.groupname ORDER BY g.priority) FILTER (WHERE g.groupname IS NOT NULL), '{}'),
+               COALESCE(array_agg(g.priority ORDER BY g.priority) FILTER (WHERE g.groupname IS NOT NULL), '{}')
+        FROM dunning_suspend t
+        LEFT JOIN radusergroup g ON g.username = t.username
+        GROUP BY t.customer_id, t.username
+    """)
+    suspended = cur.rowcount
+    cur.execute("DELETE FROM radusergroup g USING dunning_suspend t WHERE g.username = t.username")
+    cur.execute("""
+        INSERT INTO radusergroup (username, groupname, priority)
+        SELECT username, %(group)s, 0 FROM dunning_suspend
+    """, params)
+    cur.execute("""
+        UPDATE customers c SET status = 'suspended', updated_at = now()
+        FROM dunning_suspend t WHERE c.customer_id = t.customer_id
+    """)
+
+    # Paid up (nothing overdue past the grace period any more), and not re-activated by hand meanwhile
+    cur.execute("""
+        CREATE TEMP TABLE dunning_restore ON COMMIT DROP AS
+        SELECT s.customer_id, s.username, s.groups, s.priorities
+        FROM dunning_suspensions s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM billing b
+            WHERE b.customer_id = s.customer_id AND b.status IN ('pending', 'overdue')
+              AND b.due_date < CURRENT_DATE - %(grace)s
+        )
+    """, params)
+    cur.execute("""
+        DELETE FROM radusergroup g USING dunning_restore r
+        WHERE g.username = r.username AND g.groupname = %(group)s
+    """, params)
+    cur.execute("""
+        INSERT INTO radusergroup (username, groupname, priority)
+        SELECT r.username, x.groupname, x.priority
+        FROM dunning_restore r, unnest(r.groups, r.priorities) AS x(groupname, priority)
+    """)
+    cur.execute("""
+        UPDATE customers c SET status = 'active', updated_at = now()
+        FROM dunning_restore r WHERE c.customer_id = r.customer_id AND c.status = 'suspended'
+    """)
+    cur.execute("DELETE FROM dunning_suspensions s USING dunning_restore r WHERE s.customer_id = r.customer_id")
+    restored = cur.rowcount
+
+    cur.execute("SELECT username FROM dunning_suspend UNION SELECT username FROM dunning_restore")
+    usernames = [row[0] for row in cur.fetchall()]
+    return {'marked_overdue': marked_overdue, 'suspended': suspended, 'restored': restored}, usernames
+
+
+def open_sessions(cur, usernames, router=None):
+    """Disconnect-Request targets: [(host, port, secret, code, attributes), ...]"""
+    if not usernames:
+        return []
+    if router is not None and router.sharded:
+        # Sessions from every accounting shard, secrets from the primary
+        _, results, _ = router.scatter("""
+            SELECT username, acctsessionid, host(framedipaddress), host(nasipaddress)
+            FROM radacct WHERE acctstoptime IS NULL AND username = ANY(%s)
+        """, (usernames,))
+        sessions = [row for rows in results.values() for row in rows]
+        cur.execute("SELECT nas_ip, shared_secret FROM nas_devices WHERE nas_ip = ANY(%s)",
+                    (list({row[3] for row in sessions}),))
+        secrets = dict(cur.fetchall())
+        rows = [row + (secrets[row[3]],) for row in sessions if row[3] in secrets]
+    else:
+        cur.execute("""
+            SELECT a.username, a.acctsessionid, host(a.framedipaddress), host(a.nasipaddress), n.shared_secret
+            FROM radacct a
+            JOIN nas_devices n ON n.nas_ip = host(a.nasipaddress)
+            WHERE a.acctstoptime IS NULL AND a.username = ANY(%s)
+        """, (usernames,))
+        rows = cur.fetchall()
+    requests = []
+    for username, sessionid, framedip, nasip, secret in rows:
+        attributes = [('User-Name', username), ('Acct-Session-Id', sessionid), ('NAS-IP-Address', nasip)]
+        if framedip:
+            attributes.append(('Framed-IP-Address', framedip))
+        requests.append((nasip, radius_client.COA_PORT, secret or '', radius_client.DISCONNECT_REQUEST,
+                         attributes))
+    return requests
+
+
+async def _disconnect(requests, rate):
+    client = await radius_client.RadiusClient.open()
+    try:
+        return await radius_client.send_paced(client, requests, rate=rate, timeout=DISCONNECT_TIMEOUT)
+    finally:
+        client.close()
+
+
+def disconnect(requests, rate=DISCONNECT_RATE):
+    """Send the Disconnect-Requests; returns (acknowledged, failed)"""
+    if not requests:
+        return 0, 0
+    results = asyncio.run(_disconnect(requests, rate))
+    acknowledged = sum(1 for result in results if result == radius_client.DISCONNECT_ACK)
+    return acknowledged, len(results) - acknowledged
+
+
+def run(conn, dry_run=False, send_disconnects=True, rate=DISCONNECT_RATE, router=None):
+    """One dunning run; returns a summary or None if another run holds the lock
+
+    `router` (acct_shards.ShardRouter) finds the sessions when radacct is sharded.
+    """
+    started = time.monotonic()
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (DUNNING_LOCK_ID,))
+    if not cur.fetchone()[0]:
+        conn.rollback()
+        return None
+    counts, usernames = apply_dunning(cur)
+    requests = open_sessions(cur, usernames, router)
+    summary = dict(counts, sessions=len(requests), disconnected=0, disconnect_failed=0)
+    if dry_run:
+        conn.rollback()
+        summary['seconds'] = round(time.monotonic() - started, 2)
+        return summary
+    conn.commit()
+    if send_disconnects:
+        summary['disconnected'], summary['disconnect_failed'] = disconnect(requests, rate)
+    summary['seconds'] = round(time.monotonic() - started, 2)
+    cur.execute("""
+        INSERT INTO dunning_runs (marked_overdue, suspended, restored, sessions, disconnected,
+                                  disconnect_failed, seconds)
+        VALUES (%(marked_overdue)s, %(suspended)s, %(restored)s, %(sessions)s, %(disconnected)s,
+                %(disconnect_failed)s, %(seconds)s)
+    """, summary)
+    conn.commit()
+    return summary
+
+
+@jobs.job_handler('dunning_run')
+def dunning_job(ctx, payload):
+    """Background job: one dunning run"""
+    conn = ctx.connect()
+    try:
+        summary = run(conn, dry_run=payload.get('dry_run', False), router=acct_shards.default_router())
+    finally:
+        conn.close()
+    return {'skipped': True} if summary is None else summary
+
+
+def recent_runs(cur, limit=30):
+    cur.execute("""
+        SELECT id, started_at, marked_overdue, suspended, restored, sessions, disconnected,
+               disconnect_failed, seconds
+        FROM dunning_runs ORDER BY started_at DESC LIMIT %s
+    """, (limit,))
+    return [dict(row) for row in cur.fetchall()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Suspend customers with overdue invoices and restore paid ones')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    parser.add_argument('--dry-run', action='store_true', help='Report what would change, then roll back')
+    parser.add_argument('--no-disconnect', action='store_true', help='Do not disconnect live sessions')
+    parser.add_argument('--rate', type=int, default=DISCONNECT_RATE, help='Disconnect-Requests per second')
+    args = parser.parse_args()
+
+    if args.dsn:
+        conn, router = psycopg2.connect(args.dsn), None
+    else:
+        from app import DB_CONFIG
+        conn, router = psycopg2.connect(**connection_params(DB_CONFIG)), acct_shards.default_router()
+    summary = run(conn, args.dry_run, not args.no_disconnect, args.rate, router)
+    conn.close()
+    print('Another dunning run is in progress' if summary is None else summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Invoice Documents
+Renders billing invoices (with the customer, the service profile and any
+usage line items from rating.py) as PDF and HTML documents. A document is
+stored under the SHA-256 of everything it shows plus TEMPLATE_VERSION, so an
+invoice is rendered again only when its content changes (a payment, a new
+address) and asking for it twice costs a file read. A whole billing cycle is
+rendered by a background job in a process pool; the admin app streams single
+documents and whole cycles as a zip from the cache.
+
+The PDF writer is built in (one font, text only), so no PDF library is needed.
+
+Usage:
+    python invoice_documents.py --period 2025-03            # render a billing cycle
+    python invoice_documents.py --invoice INV-202503-123 --format html > invoice.html
+"""
+
+import argparse
+import hashlib
+import html
+import json
+import multiprocessing
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from decimal import Decimal
+
+import psycopg2
+import psycopg2.extras
+
+import jobs
+from db_routing import connection_params
+from rating import last_month, month_period
+
+CACHE_DIR = os.environ.get('INVOICE_CACHE_DIR', '/var/lib/isp-radius/invoices')
+RENDER_WORKERS = int(os.environ.get('INVOICE_RENDER_WORKERS', str(os.cpu_count() or 2)))
+RENDER_CHUNK = 500              # invoices per task handed to a render process
+FETCH_SIZE = 5000
+INLINE_RENDER_LIMIT = 200       # a cycle download renders at most this many missing documents itself
+COMPANY_NAME = os.environ.get('INVOICE_COMPANY_NAME', 'ISP RADIUS')
+CURRENCY = os.environ.get('INVOICE_CURRENCY', '$')
+TEMPLATE_VERSION = 1            # bump when the layout changes, so every document is rendered again
+
+FORMATS = {'pdf': 'application/pdf', 'html': 'text/html; charset=utf-8'}
+
+INVOICE_DOCUMENTS_SCHEMA = """
+CREATE INDEX IF NOT EXISTS billing_date_idx ON billing (billing_date);
+"""
+
+INVOICE_SQL = """
+    SELECT b.invoice_number, b.customer_id, b.amount, b.billing_date, b.due_date, b.status,
+           c.first_name, c.last_name, c.email, c.phone, c.address, c.service_profile,
+           sp.download_speed, sp.upload_speed, sp.description AS profile_description,
+           COALESCE(items.line_items, '[]') AS line_items
+    FROM billing b
+    JOIN customers c ON c.customer_id = b.customer_id
+    LEFT JOIN service_profiles sp ON sp.name = c.service_profile
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_object('description', li.description, 'quantity_gb', li.quantity_gb,
+                                          'unit_price', li.unit_price, 'amount', li.amount)
+                        ORDER BY li.quantity_gb DESC) AS line_items
+        FROM usage_ratings ur
+        JOIN usage_line_items li ON li.customer_id = ur.customer_id AND li.period_start = ur.period_start
+        WHERE ur.invoice_number = b.invoice_number
+    ) items ON true
+"""
+
+
+def fetch_invoices(conn, period_start=None, period_end=None, invoice_numbers=None):
+    """Invoice dicts of a billing cycle (billing_date in [start, end)) or of the given numbers"""
+    if invoice_numbers is not None:
+        where, params = "WHERE b.invoice_number = ANY(%s)", (list(invoice_numbers),)
+    else:
+        where, params = "WHERE b.billing_date >= %s AND b.billing_date < %s", (period_start, period_end)
+    with conn.cursor(name='invoice_documents', cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.itersize = FETCH_SIZE
+        cur.execute(f"{INVOICE_SQL} {where} ORDER BY b.invoice_number", params)
+        for row in cur:
+            yield dict(row)
+
+
+# Content addressing
+
+def content_hash(invoice):
+    """SHA-256 of the invoice's content and the template version, the same in every process"""
+    data = json.dumps([TEMPLATE_VERSION, invoice], sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def document_path(invoice, digest, fmt, cache_dir=None):
+    """Cache file of a document: <month>/<first two hex digits>/<hash>.<format>"""
+    month = str(invoice['billing_date'])[:7]
+    return os.path.join(cache_dir or CACHE_DIR, month, digest[:2], f"{digest}.{fmt}")
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+# Rendering
+
+def _money(value):
+    return f"{CURRENCY}{Decimal(str(value)):,.2f}"
+
+
+def invoice_lines(invoice):
+    """The invoice's items as (description, quantity, unit price, amount) rows"""
+    items = invoice['line_items']
+    if isinstance(items, str):
+        items = json.loads(items)
+    if items:
+        return [(item['description'], f"{Decimal(str(item['quantity_gb'])):,.3f} GB",
+                 _money(item['unit_price']), _money(item['amount'])) for item in items]
+    profile = invoice['service_profile'] or 'Service'
+    if invoice['download_speed']:
+        profile += f" ({invoice['download_speed']}/{invoice['upload_speed']} Mbps)"
+    return [(f"{profile} - monthly service", '1', _money(invoice['amount']), _money(invoice['amount']))]
+
+
+def render_html(invoice):
+    e = lambda value: html.escape(str(value)) if value is not None else ''
+    rows = ''.join(f"<tr><td>{e(description)}</td><td class=\"n\">{e(quantity)}</td>"
+                   f"<td class=\"n\">{e(price)}</td><td class=\"n\">{e(amount)}</td></tr>"
+                   for description, quantity, price, amount in invoice_lines(invoice))
+    address = '<br>'.join(e(line) for line in (invoice['address'] or '').splitlines())
+    return f"""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="UTF-8">
+<title>Invoice {e(invoice['invoice_number'])}</title>
+<style>
+body {{ font-family: Helvetica, Arial, sans-serif; margin: 40px; color: #222; }}
+table {{ border-collapse: collapse; width: 100%; margin-top: 24px; }}
+th, td {{ border-bottom: 1px solid #ddd; padding: 6px 8px; text-align: left; }}
+.n {{ text-align: right; }}
+.status {{ text-transform: uppercase; font-weight: bold; }}
+</style>
+</head>
+<body>
+<h1>{e(COMPANY_NAME)}</h1>
+<h2>Invoice {e(invoice['invoice_number'])}</h2>
+<p>Date: {e(invoice['billing_date'])}<br>Due: {e(invoice['due_date'])}<br>
+Status: <span class="status">{e(invoice['status'])}</span></p>
+<p><strong>Bill to</strong><br>{e(invoice['first_name'])} {e(invoice['last_name'])} ({e(invoice['customer_id'])})<br>
+{address}{'<br>' if address else ''}{e(invoice['email'])}</p>
+<table>
+<thead><tr><th>Description</th><th class="n">Quantity</th><th class="n">Unit price</th><th class="n">Amount</th></tr></thead>
+<tbody>{rows}</tbody>
+<tfoot><tr><th colspan="3" class="n">Total</th><th class="n">{e(_money(invoice['amount']))}</th></tr></tfoot>
+</table>
+</body>
+</html>
+""".encode()
+
+
+def _pdf_text(value):
+    return str(value).replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def _pdf(pages):
+    """A PDF of A4 pages, each a list of (x, y, size, text) in points from the bottom left"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    page_ids = []
+    for page in pages:
+        stream = ''.join(f"BT /F1 {size} Tf {x} {y} Td ({_pdf_text(text)}) Tj ET\n"
+                         for x, y, size, text in page).encode('cp1252', 'replace')   # WinAnsiEncoding
+        objects.append(b"<< /Length %d >>\nstream\n%sendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        page_ids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        ' '.join(f"{page_id} 0 R" for page_id in page_ids).encode(), len(page_ids))
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b''.join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def render_pdf(invoice):
+    header = [
+        (50, 790, 18, COMPANY_NAME),
+        (50, 760, 14, f"Invoice {invoice['invoice_number']}"),
+        (50, 740, 10, f"Date: {invoice['billing_date']}    Due: {invoice['due_date']}    "
+                      f"Status: {str(invoice['status']).upper()}"),
+        (50, 712, 10, 'Bill to'),
+        (50, 698, 10, f"{invoice['first_name']} {invoice['last_name']} ({invoice['customer_id']})"),
+    ]
+    y = 684
+    for line in (invoice['address'] or '').splitlines() + [invoice['email']]:
+        header.append((50, y, 10, line))
+        y -= 14
+    pages, page = [], header
+    y -= 20
+    columns = (50, 330, 420, 500)
+    for row in [('Description', 'Quantity', 'Unit price', 'Amount')] + invoice_lines(invoice):
+        if y < 60:
+            pages.append(page)
+            page, y = [], 790
+        page.extend((x, y, 10, text) for x, text in zip(columns, row))
+        y -= 16
+    page.append((420, y - 8, 11, 'Total'))
+    page.append((500, y - 8, 11, _money(invoice['amount'])))
+    pages.append(page)
+    return _pdf(pages)
+
+
+RENDERERS = {'pdf': render_pdf, 'html': render_html}
+
+
+def render_to_cache(invoices, formats, cache_dir=None):
+    """Render and store [(invoice, digest)]; runs in the render processes. Returns (documents, bytes)"""
+    documents = size = 0
+    for invoice, digest in invoices:
+        for fmt in formats:
+            data = RENDERERS[fmt](invoice)
+            _write_atomic(document_path(invoice, digest, fmt, cache_dir), data)
+            documents += 1
+            size += len(data)
+    return documents, size
+
+
+def ensure_document(invoice, fmt, cache_dir=None):
+    """(path, digest) of an invoice's document, rendered now if it is not cached"""
+    digest = content_hash(invoice)
+    path = document_path(invoice, digest, fmt, cache_dir)
+    if not os.path.exists(path):
+        render_to_cache([(invoice, digest)], [fmt], cache_dir)
+    return path, digest
+
+
+# Billing cycles
+
+def previous_month():
+    return last_month()[0].strftime('%Y-%m')
+
+
+def render_cycle(conn, month, formats=('pdf', 'html'), workers=RENDER_WORKERS, cache_dir=None, progress=None):
+    """Render every invoice of a billing month ('YYYY-MM') whose documents are not cached
+
+    Rendering runs in a process pool while the invoices are still being
+    read. Documents of the month that no longer match any invoice (the
+    invoice changed since) are removed afterwards.
+    """
+    started = time.time()
+    period_start, period_end = month_period(month)
+    cache_dir = cache_dir or CACHE_DIR
+    total = cached = rendered = size = 0
+    current = set()
+    futures = []
+    chunk = []
+    # Spawned, not forked: the caller may hold connections and threads (a job worker's heartbeat)
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context('spawn')) as pool:
+        for invoice in fetch_invoices(conn, period_start, period_end):
+            total += 1
+            digest = content_hash(invoice)
+            paths = [document_path(invoice, digest, fmt, cache_dir) for fmt in formats]
+            current.update(paths)
+            if all(os.path.exists(path) for path in paths):
+                cached += 1
+                continue
+            chunk.append((invoice, digest))
+            if len(chunk) >= RENDER_CHUNK:
+                futures.append(pool.submit(render_to_cache, chunk, formats, cache_dir))
+                chunk = []
+        if chunk:
+            futures.append(pool.submit(render_to_cache, chunk, formats, cache_dir))
+        conn.rollback()
+        for done, future in enumerate(as_completed(futures), 1):
+            documents, written = future.result()
+            rendered += documents
+            size += written
+            if progress:
+                progress(done / len(futures), f"{rendered} documents rendered")
+    removed = 0
+    suffixes = tuple(f".{fmt}" for fmt in formats)
+    for directory, _, names in os.walk(os.path.join(cache_dir, month)):
+        for name in names:
+            path = os.path.join(directory, name)
+            # Files written after the run started may belong to a newer version of an invoice
+            if path not in current and name.endswith(suffixes) and os.stat(path).st_mtime < started:
+                os.unlink(path)
+                removed += 1
+    return {'invoices': total, 'cached': cached, 'rendered': rendered, 'bytes': size, 'removed': removed,
+            'seconds': round(time.time() - started, 2)}
+
+
+@jobs.job_handler('render_invoices')
+def render_invoices_job(ctx, payload):
+    """Background job: render a billing cycle (payload: period 'YYYY-MM', formats)"""
+    formats = [fmt for fmt in payload.get('formats') or FORMATS if fmt in FORMATS]
+    conn = ctx.connect()
+    try:
+        return render_cycle(conn, payload.get('period') or previous_month(), formats, progress=ctx.progress)
+    finally:
+        conn.close()
+
+
+def cycle_documents(conn, month, fmt, cache_dir=None):
+    """([(file name, path)], rendered here) of a cycle's documents; (None, missing) when too many need rendering"""
+    documents, missing = [], []
+    for invoice in fetch_invoices(conn, *month_period(month)):
+        digest = content_hash(invoice)
+        path = document_path(invoice, digest, fmt, cache_dir)
+        documents.append((f"{invoice['invoice_number']}.{fmt}", path))
+        if not os.path.exists(path):
+            missing.append((invoice, digest))
+    conn.rollback()
+    if len(missing) > INLINE_RENDER_LIMIT:
+        return None, len(missing)
+    render_to_cache(missing, [fmt], cache_dir)
+    return documents, len(missing)
+
+
+class _ZipSink:
+    """Write-only file object collecting what ZipFile writes, for streaming it out"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data, self._chunks = b''.join(self._chunks), []
+        return data
+
+
+def zip_stream(documents):
+    """Yield a zip of [(name, path)] piece by piece, without building it in memory or on disk"""
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        for name, path in documents:
+            with open(path, 'rb') as source, archive.open(name, 'w') as target:
+                while True:
+                    block = source.read(64 * 1024)
+                    if not block:
+                        break
+                    target.write(block)
+            data = sink.take()
+            if data:
+                yield data
+    yield sink.take()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render invoice documents into the content-addressed cache')
+    parser.add_argument('--period', help="Billing cycle 'YYYY-MM' (default: last month)")
+    parser.add_argument('--invoice', help='Write one invoice document to stdout instead')
+    parser.add_argument('--format', choices=sorted(FORMATS), action='append', help='Formats (default: all)')
+    parser.add_argument('--workers', type=int, default=RENDER_WORKERS)
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    args = parser.parse_args()
+
+    if args.dsn:
+        config = {'dsn': args.dsn}
+    else:
+        from app import DB_CONFIG
+        config = DB_CONFIG
+    conn = psycopg2.connect(**connection_params(config))
+    try:
+        if args.invoice:
+            invoices = list(fetch_invoices(conn, invoice_numbers=[args.invoice]))
+            if not invoices:
+                sys.exit(f"No invoice {args.invoice}")
+            path, _ = ensure_document(invoices[0], (args.format or ['pdf'])[0])
+            with open(path, 'rb') as f:
+                sys.stdout.buffer.write(f.read())
+            return
+        month = args.period or previous_month()
+        print(f"Rendering invoices of {month} with {args.workers} processes...")
+        summary = render_cycle(conn, month, args.format or list(FORMATS), args.workers,
+                               progress=lambda fraction, message: print(f"  {fraction:5.0%} {message}"))
+    finally:
+        conn.close()
+    print(f"{summary['invoices']} invoices: {summary['rendered']} documents rendered "
+          f"({summary['bytes'] / 1e6:.1f} MB), {summary['cached']} invoices cached, "
+          f"{summary['removed']} outdated documents removed in {summary['seconds']}s")
+
+
+if __name__ == '__main__':
+    main()
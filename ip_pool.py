@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - IP Address Pools
+Assigns Framed-IP-Address centrally instead of relying on each NAS's local
+pools. Every pool is held in memory as a byte-per-address state array, so an
+allocation is a memchr over the array under one lock (no row locking per
+Access-Request). Lease changes are written to ip_leases in batches; leases are
+renewed by accounting interim updates, released by accounting stops and
+reconciled against the open sessions in radacct (radacct.framedipaddress is
+the source of truth after a restart or a missed notification).
+"""
+
+import bisect
+import ipaddress
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.extras
+
+import acct_events
+import acct_shards
+from pg_listen import start_listener
+
+POOL_CHANNEL = 'radius_ippool'
+FLUSH_INTERVAL = float(os.environ.get('IPPOOL_FLUSH_INTERVAL', '1'))         # seconds between lease writes
+EXPIRY_INTERVAL = 30
+RECONCILE_INTERVAL = int(os.environ.get('IPPOOL_RECONCILE_INTERVAL', '600'))
+
+# Largest pool: the state array holds a byte per address
+MAX_POOL_PREFIX = 16
+
+# Address states in a pool's state array
+FREE, LEASED, RESERVED = 0, 1, 2
+
+# The addresses a pool hands out, as an inetrange (the network clipped to first/last_address)
+POOL_RANGE = ("inetrange(GREATEST(host({network})::inet, host({first})::inet), "
+              "LEAST(host(broadcast({network}))::inet, host({last})::inet), '[]')")
+
+# Open sessions holding an address, the newest per address
+OPEN_ADDRESSES_SQL = """
+    SELECT DISTINCT ON (framedipaddress)
+           host(framedipaddress), username, callingstationid, host(nasipaddress), acctsessionid,
+           EXTRACT(EPOCH FROM acctstarttime)::float8
+    FROM radacct
+    WHERE acctstoptime IS NULL AND framedipaddress IS NOT NULL
+    ORDER BY framedipaddress, acctstarttime DESC
+"""
+
+IPPOOL_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS ip_pools (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(64) UNIQUE NOT NULL,
+    network CIDR NOT NULL,
+    -- Optional sub-range of the network; defaults to all host addresses
+    first_address INET,
+    last_address INET,
+    -- A pool applies to users of this profile and/or sessions on this NAS
+    service_profile VARCHAR(50) REFERENCES service_profiles(name) ON UPDATE CASCADE,
+    nas_ip INET,
+    -- Must be longer than the NAS interim-update interval
+    lease_time INTEGER NOT NULL DEFAULT 3600,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CHECK (service_profile IS NOT NULL OR nas_ip IS NOT NULL)
+);
+
+-- One row per address ever handed out; expired rows remember the last holder
+-- so a reconnecting subscriber gets the same address back
+CREATE TABLE IF NOT EXISTS ip_leases (
+    pool_id INTEGER NOT NULL REFERENCES ip_pools(id) ON DELETE CASCADE,
+    address INET NOT NULL,
+    username VARCHAR(64) NOT NULL,
+    callingstationid VARCHAR(50),
+    nasipaddress INET,
+    acctsessionid VARCHAR(64),
+    expires_at TIMESTAMP with time zone NOT NULL,
+    updated_at TIMESTAMP with time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (pool_id, address)
+);
+CREATE INDEX IF NOT EXISTS ip_leases_username_idx ON ip_leases (username);
+
+-- An address belongs to one pool at most, so leases and releases find their pool by address
+DO $$
+BEGIN
+    IF to_regtype('inetrange') IS NULL THEN
+        CREATE TYPE inetrange AS RANGE (subtype = inet);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'ip_pools_no_overlap') THEN
+        ALTER TABLE ip_pools ADD CONSTRAINT ip_pools_no_overlap
+            EXCLUDE USING gist (({POOL_RANGE.format(network='network', first='first_address', last='last_address')}) WITH &&);
+    END IF;
+    -- NOT VALID keeps existing rows; the backend skips those when it loads the pools
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'ip_pools_network_check') THEN
+        ALTER TABLE ip_pools ADD CONSTRAINT ip_pools_network_check
+            CHECK (family(network) = 4 AND masklen(network) >= {MAX_POOL_PREFIX}) NOT VALID;
+    END IF;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS radacct_open_framedip_idx ON radacct (framedipaddress)
+    WHERE acctstoptime IS NULL AND framedipaddress IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION ip_pools_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{POOL_CHANNEL}', 'reload');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS ip_pools_notify_trg ON ip_pools;
+CREATE TRIGGER ip_pools_notify_trg AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON ip_pools
+    FOR EACH STATEMENT EXECUTE FUNCTION ip_pools_notify();
+"""
+
+
+class Lease:
+    __slots__ = ('username', 'callingstationid', 'nasip', 'sessionid', 'expires')
+
+    def __init__(self, username, callingstationid, nasip, sessionid, expires):
+        self.username = username
+        self.callingstationid = callingstationid or ''
+        self.nasip = nasip
+        self.sessionid = sessionid
+        self.expires = expires
+
+
+class Pool:
+    def __init__(self, row):
+        network = ipaddress.ip_network(row['network'])
+        if network.num_addresses > 2:
+            first, last = network.network_address + 1, network.broadcast_address - 1
+        else:
+            first, last = network.network_address, network.broadcast_address
+        if row['first_address']:
+            first = max(first, ipaddress.ip_address(row['first_address']))
+        if row['last_address']:
+            last = min(last, ipaddress.ip_address(row['last_address']))
+        self.id = row['id']
+        self.name = row['name']
+        self.service_profile = row['service_profile']
+        self.nas_ip = row['nas_ip']
+        self.lease_time = row['lease_time']
+        self.base = int(first)
+        self.size = max(0, int(last) - int(first) + 1)
+        self.state = bytearray(self.size)
+        self.leases = {}
+        self.cursor = 0
+        # More specific pools are tried first
+        self.rank = (self.nas_ip is not None) + (self.service_profile is not None)
+
+    def index_of(self, address):
+        index = int(ipaddress.ip_address(address)) - self.base
+        return index if 0 <= index < self.size else None
+
+    def address(self, index):
+        return str(ipaddress.IPv4Address(self.base + index))
+
+    def take_free(self):
+        # Round-robin from the last allocation, so a released address is reused last
+        index = self.state.find(FREE, self.cursor)
+        if index < 0:
+            index = self.state.find(FREE, 0, self.cursor)
+            if index < 0:
+                return None
+        self.cursor = index + 1
+        return index
+
+
+class IPPoolManager:
+    """In-memory pools and leases, persisted in batches to ip_leases"""
+
+    def __init__(self):
+        self.pools = []
+        self._bases = []
+        self.by_client = {}      # (username, callingstationid) -> (pool, index) of the active lease
+        self.last_address = {}   # (username, callingstationid) -> integer address of the previous lease
+        self._dirty = {}
+        self.router = None          # acct_shards.ShardRouter when radacct is sharded
+        self._resync = threading.Event()
+        self._lock = threading.RLock()
+        self.ready = threading.Event()
+        self.stats = {'allocations': 0, 'renewals': 0, 'releases': 0, 'expired': 0, 'exhausted': 0,
+                      'adopted': 0, 'conflicts': 0, 'flushed': 0, 'loaded_at': None}
+
+    # Loading and reconciliation
+
+    def load(self, conn):
+        """(Re)build every pool from ip_pools/ip_leases, then reconcile with radacct"""
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        with self._lock:
+            # Pending writes go first, the reload below reads them back
+            self._write(conn, self._dirty)
+            self._dirty = {}
+            cur.execute("""
+                SELECT id, name, network::text, host(first_address) AS first_address,
+                       host(last_address) AS last_address, service_profile,
+                       host(nas_ip) AS nas_ip, lease_time
+                FROM ip_pools ORDER BY id
+            """)
+            pools = []
+            for row in cur.fetchall():
+                problem = network_problem(row['network'])
+                if problem:
+                    print(f"IP pool {row['name']}: {problem}, not used")
+                    continue
+                pools.append(Pool(row))
+            pools_by_id = {pool.id: pool for pool in pools}
+            by_client, last_address = {}, {}
+            now = time.time()
+            cur.execute("""
+                SELECT pool_id, host(address) AS address, username, callingstationid,
+                       host(nasipaddress) AS nasip, acctsessionid, EXTRACT(EPOCH FROM expires_at) AS expires
+                FROM ip_leases ORDER BY expires_at
+            """)
+            for row in cur:
+                pool = pools_by_id.get(row['pool_id'])
+                index = pool.index_of(row['address']) if pool else None
+                if index is None:
+                    continue
+                client = (row['username'], row['callingstationid'] or '')
+                if row['expires'] > now:
+                    pool.state[index] = LEASED
+                    pool.leases[index] = Lease(row['username'], row['callingstationid'], row['nasip'],
+                                               row['acctsessionid'], float(row['expires']))
+                    by_client[client] = (pool, index)
+                else:
+                    last_address[client] = pool.base + index
+            self.pools = []
+            for pool in sorted(pools, key=lambda pool: pool.base):
+                # ip_pools_no_overlap prevents this; _locate needs disjoint pools
+                if self.pools and pool.base < self.pools[-1].base + self.pools[-1].size:
+                    print(f"IP pool {pool.name} overlaps {self.pools[-1].name}, not used")
+                    continue
+                self.pools.append(pool)
+            self._bases = [pool.base for pool in self.pools]
+            # Static addresses from radreply are never handed out dynamically
+            cur.execute("SELECT value FROM radreply WHERE attribute = 'Framed-IP-Address'")
+            for row in cur.fetchall():
+                found = self._locate(row['value'])
+                if found and found[0].state[found[1]] == FREE:
+                    found[0].state[found[1]] = RESERVED
+            self.by_client, self.last_address = by_client, last_address
+            conn.commit()
+            self.reconcile(conn)
+            self.stats['loaded_at'] = time.time()
+        self.ready.set()
+        print(f"IP pools loaded: {len(pools)} pools, {len(by_client)} active leases")
+
+    def reconcile(self, conn):
+        """Align leases with the open sessions in radacct (on every accounting shard); returns what was corrected"""
+        checked_at = time.time()
+        if self.router is not None and self.router.sharded:
+            _, results, errors = self.router.scatter(OPEN_ADDRESSES_SQL, None, conn)
+            # An address seen on two shards (a NAS that moved) belongs to the newest session
+            newest = {}
+            for rows in results.values():
+                for row in rows:
+                    if row[0] not in newest or (row[5] or 0) > (newest[row[0]][5] or 0):
+                        newest[row[0]] = row
+            sessions = list(newest.values())
+        else:
+            cur = conn.cursor()
+            cur.execute(OPEN_ADDRESSES_SQL)
+            sessions, errors = cur.fetchall(), {}
+            conn.rollback()
+        now = time.time()
+        adopted = conflicts = released = 0
+        with self._lock:
+            live = set()
+            for address, username, callingstationid, nasip, sessionid, _ in sessions:
+                found = self._locate(address)
+                if not found:
+                    continue
+                pool, index = found
+                live.add((pool.id, index))
+                lease = pool.leases.get(index)
+                if lease is None:
+                    adopted += 1
+                elif lease.username != username:
+                    conflicts += 1
+                    print(f"IP pool conflict: {address} leased to {lease.username} but in use by {username}")
+                else:
+                    lease.sessionid = lease.sessionid or sessionid
+                    continue
+                self._assign(pool, index, username, callingstationid, nasip, sessionid, now + pool.lease_time)
+            # Leases confirmed by accounting whose session has since closed; leases
+            # touched after the query started may belong to sessions it did not see,
+            # and a shard that did not answer may hold the session
+            for pool in self.pools if not errors else ():
+                for index, lease in list(pool.leases.items()):
+                    if lease.sessionid and (pool.id, index) not in live \
+                            and lease.expires - pool.lease_time < checked_at:
+                        self._release(pool, index, now)
+                        released += 1
+        self.stats['adopted'] += adopted
+        self.stats['conflicts'] += conflicts
+        return {'sessions': len(sessions), 'adopted': adopted, 'conflicts': conflicts, 'released': released,
+                'unavailable': sorted(errors)}
+
+    # Allocation
+
+    def candidates(self, nas_ip, groups):
+        """Pools that apply to a request, most specific first"""
+        matching = [pool for pool in self.pools
+                    if (pool.nas_ip is None or pool.nas_ip == nas_ip)
+                    and (pool.service_profile is None or pool.service_profile in groups)]
+        return sorted(matching, key=lambda pool: (-pool.rank, pool.id))
+
+    def allocate(self, username, nas_ip, groups=(), callingstationid=''):
+        """Return an address for the session, or None when no pool applies or all are full"""
+        client = (username, callingstationid or '')
+        now = time.time()
+        with self._lock:
+            pools = self.candidates(nas_ip, groups)
+            if not pools:
+                return None
+            current = self.by_client.get(client)
+            if current and current[0] in pools:
+                pool, index = current
+                lease = pool.leases[index]
+                lease.expires = now + pool.lease_time
+                lease.nasip = nas_ip
+                self._mark(pool, index)
+                self.stats['renewals'] += 1
+                return pool.address(index)
+            previous = self.last_address.get(client)
+            for pool in pools:
+                index = None
+                if previous is not None and 0 <= previous - pool.base < pool.size \
+                        and pool.state[previous - pool.base] == FREE:
+                    index = previous - pool.base
+                if index is None:
+                    index = pool.take_free()
+                if index is not None:
+                    self._assign(pool, index, username, callingstationid, nas_ip, None, now + pool.lease_time)
+                    self.stats['allocations'] += 1
+                    return pool.address(index)
+            self.stats['exhausted'] += 1
+            return None
+
+    def apply_accounting(self, events):
+        """Renew, adopt or release leases from accounting start/interim/stop events"""
+        now = time.time()
+        with self._lock:
+            for event in events:
+                found = self._locate(event.get('framedip'))
+                if not found:
+                    continue
+                pool, index = found
+                lease = pool.leases.get(index)
+                if event['event'] == 'stop':
+                    if lease is not None and lease.username == event['username']:
+                        self._release(pool, index, now)
+                    continue
+                if lease is None or lease.username != event['username']:
+                    # The NAS is using an address we did not hand out (or handed to someone else)
+                    if lease is not None:
+                        self.stats['conflicts'] += 1
+                    else:
+                        self.stats['adopted'] += 1
+                    self._assign(pool, index, event['username'], event.get('callingstationid'),
+                                 event.get('nasip'), event.get('sessionid'), now + pool.lease_time)
+                else:
+                    lease.sessionid = event.get('sessionid')
+                    lease.nasip = event.get('nasip')
+                    lease.expires = now + pool.lease_time
+                    self._mark(pool, index)
+
+    def expire(self):
+        """Release leases that were neither renewed nor stopped in time"""
+        now = time.time()
+        expired = 0
+        with self._lock:
+            for pool in self.pools:
+                for index in [index for index, lease in pool.leases.items() if lease.expires <= now]:
+                    self._release(pool, index, now)
+                    expired += 1
+        self.stats['expired'] += expired
+        return expired
+
+    # Internal state changes (caller holds the lock)
+
+    def _locate(self, address):
+        if not address:
+            return None
+        try:
+            value = int(ipaddress.ip_address(address))
+        except ValueError:
+            return None
+        position = bisect.bisect_right(self._bases, value) - 1
+        if position < 0:
+            return None
+        pool = self.pools[position]
+        index = value - pool.base
+        return (pool, index) if index < pool.size else None
+
+    def _assign(self, pool, index, username, callingstationid, nasip, sessionid, expires):
+        old = pool.leases.get(index)
+        if old is not None:
+            self.by_client.pop((old.username, old.callingstationid), None)
+        lease = Lease(username, callingstationid, nasip, sessionid, expires)
+        client = (username, lease.callingstationid)
+        previous = self.by_client.get(client)
+        if previous is not None and previous != (pool, index):
+            self._release(*previous, time.time())
+        pool.state[index] = LEASED
+        pool.leases[index] = lease
+        self.by_client[client] = (pool, index)
+        self._mark(pool, index)
+
+    def _release(self, pool, index, now):
+        lease = pool.leases.pop(index, None)
+        pool.state[index] = FREE
+        if lease is None:
+            return
+        client = (lease.username, lease.callingstationid)
+        if self.by_client.get(client) == (pool, index):
+            del self.by_client[client]
+        self.last_address[client] = pool.base + index
+        lease.expires = now
+        lease.sessionid = None
+        self._dirty[(pool.id, index)] = (pool.id, pool.address(index), lease.username, lease.callingstationid,
+                                         lease.nasip, None, now)
+        self.stats['releases'] += 1
+
+    def _mark(self, pool, index):
+        lease = pool.leases[index]
+        self._dirty[(pool.id, index)] = (pool.id, pool.address(index), lease.username, lease.callingstationid,
+                                         lease.nasip, lease.sessionid, lease.expires)
+
+    # Persistence
+
+    def flush(self, conn):
+        """Write pending lease changes in one statement; returns the number of rows"""
+        with self._lock:
+            pending, self._dirty = self._dirty, {}
+        try:
+            self._write(conn, pending)
+        except (psycopg2.Error, ValueError):
+            with self._lock:
+                # Keep the rows for the next attempt unless they were superseded meanwhile
+                for key, row in pending.items():
+                    self._dirty.setdefault(key, row)
+            raise
+        return len(pending)
+
+    def _write(self, conn, pending):
+        if not pending:
+            return
+        try:
+            cur = conn.cursor()
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO ip_leases (pool_id, address, username, callingstationid, nasipaddress,
+                                       acctsessionid, expires_at)
+                VALUES %s
+                ON CONFLICT (pool_id, address) DO UPDATE SET
+                    username = EXCLUDED.username,
+                    callingstationid = EXCLUDED.callingstationid,
+                    nasipaddress = EXCLUDED.nasipaddress,
+                    acctsessionid = EXCLUDED.acctsessionid,
+                    expires_at = EXCLUDED.expires_at,
+                    updated_at = now()
+            """, list(pending.values()), template='(%s, %s::inet, %s, %s, %s::inet, %s, to_timestamp(%s))',
+                page_size=1000)
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        self.stats['flushed'] += len(pending)
+
+    # Service
+
+    def start(self, connect, router=None):
+        """Load the pools and keep them current from accounting (on every shard) and pool changes"""
+        self.router = router
+        def on_notify(conn, batch):
+            if any(channel == POOL_CHANNEL for channel, _ in batch):
+                self.load(conn)
+            events = acct_events.parse_events(batch)
+            if events:
+                self.apply_accounting(events)
+
+        # Runs after every (re)connect, so sessions missed while disconnected are reconciled
+        start_listener(connect, [acct_events.CHANNEL, POOL_CHANNEL], on_notify,
+                       on_connect=self.load, name='ip-pool-events')
+        # Other accounting shards only publish their sessions; a reconnect there asks for a reconcile
+        if router is not None and router.sharded:
+            for shard in router.shards:
+                if shard == acct_shards.PRIMARY_SHARD:
+                    continue
+                start_listener(lambda shard=shard: router.connect(shard), [acct_events.CHANNEL],
+                               lambda conn, batch: self.apply_accounting(acct_events.parse_events(batch)),
+                               on_connect=lambda conn: self._resync.set(), name=f'ip-pool-events-{shard}')
+
+        def maintain():
+            conn = None
+            last_expiry = last_reconcile = time.monotonic()
+            while True:
+                time.sleep(FLUSH_INTERVAL)
+                try:
+                    if conn is None or conn.closed:
+                        conn = connect()
+                    now = time.monotonic()
+                    if now - last_expiry >= EXPIRY_INTERVAL:
+                        self.expire()
+                        last_expiry = now
+                    if (self._resync.is_set() or now - last_reconcile >= RECONCILE_INTERVAL) \
+                            and self.ready.is_set():
+                        self._resync.clear()
+                        result = self.reconcile(conn)
+                        if result['adopted'] or result['conflicts'] or result['released']:
+                            print(f"IP pool reconciliation: {result}")
+                        last_reconcile = now
+                    self.flush(conn)
+                except psycopg2.Error as e:
+                    print(f"IP pool persistence error: {e}")
+                    if conn is not None:
+                        conn.close()
+                    conn = None
+
+        threading.Thread(target=maintain, name='ip-pool-writer', daemon=True).start()
+
+    def summary(self):
+        with self._lock:
+            pools = [{
+                'name': pool.name,
+                'size': pool.size,
+                'leased': len(pool.leases),
+                'free': pool.state.count(FREE),
+            } for pool in self.pools]
+        return dict(self.stats, pools=pools, pending_writes=len(self._dirty), ready=self.ready.is_set())
+
+
+def network_problem(network, first_address=None, last_address=None):
+    """Why a pool cannot use this network/range, or None if it can"""
+    try:
+        network = ipaddress.ip_network(network)
+        addresses = [ipaddress.ip_address(value) for value in (first_address, last_address) if value]
+    except ValueError as e:
+        return str(e)
+    if network.version != 4 or any(address.version != 4 for address in addresses):
+        return 'IP pools must be IPv4'
+    if network.prefixlen < MAX_POOL_PREFIX:
+        return f'IP pools must be /{MAX_POOL_PREFIX} or smaller'
+    return None
+
+
+def overlapping_pools(cur, network, first_address=None, last_address=None):
+    """Names of the pools sharing an address with a pool of this network and range (for the admin app)"""
+    cur.execute(f"""
+        SELECT name FROM ip_pools
+        WHERE {POOL_RANGE.format(network='network', first='first_address', last='last_address')}
+              && {POOL_RANGE.format(network='%(network)s::cidr', first='%(first)s::inet', last='%(last)s::inet')}
+        ORDER BY name
+    """, {'network': network, 'first': first_address, 'last': last_address})
+    return [row['name'] for row in cur.fetchall()]
+
+
+def pool_usage(cur):
+    """Pools with their lease counts as stored in ip_leases (for the admin app)"""
+    cur.execute("""
+        SELECT p.id, p.name, p.network::text AS network, host(p.first_address) AS first_address,
+               host(p.last_address) AS last_address, p.service_profile, host(p.nas_ip) AS nas_ip,
+               p.lease_time, COUNT(l.address) FILTER (WHERE l.expires_at > now()) AS active_leases
+        FROM ip_pools p
+        LEFT JOIN ip_leases l ON l.pool_id = p.id
+        GROUP BY p.id
+        ORDER BY p.name
+    """)
+    return [dict(row) for row in cur.fetchall()]
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Background Jobs
+A PostgreSQL-backed job queue for work that is too slow for a request thread
+(billing runs, mass operations, exports, report refreshes). The app enqueues a
+job and returns its id right away; a pool of worker processes claims jobs with
+FOR UPDATE SKIP LOCKED, reports progress, retries failures with exponential
+backoff and honours cancellation requests.
+
+Usage:
+    python jobs.py --concurrency 4
+"""
+
+import argparse
+import importlib
+import multiprocessing
+import os
+import random
+import select
+import signal
+import socket
+import threading
+import time
+import traceback
+
+import psycopg2
+import psycopg2.extras
+
+import tracing
+from db_routing import connection_params
+
+CONCURRENCY = int(os.environ.get('JOB_CONCURRENCY', '2'))
+POLL_INTERVAL = 5            # seconds a worker waits for a NOTIFY before polling again
+HEARTBEAT_INTERVAL = 15      # seconds between heartbeats of a running job
+STALE_AFTER = 120            # running jobs without a heartbeat for this long are requeued
+RETRY_BASE_DELAY = 10        # seconds; doubled on every attempt
+RETRY_MAX_DELAY = 3600
+
+# Modules that register job handlers, imported by every worker process
+HANDLER_MODULES = ['reports', 'payments', 'dunning', 'rating', 'invoice_documents', 'deprovision']
+
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id BIGSERIAL PRIMARY KEY,
+    kind VARCHAR(64) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    priority INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    run_at TIMESTAMP with time zone NOT NULL DEFAULT now(),
+    progress REAL NOT NULL DEFAULT 0,
+    progress_message TEXT,
+    result JSONB,
+    error TEXT,
+    cancel_requested BOOLEAN NOT NULL DEFAULT false,
+    locked_by VARCHAR(100),
+    heartbeat_at TIMESTAMP with time zone,
+    created_at TIMESTAMP with time zone NOT NULL DEFAULT now(),
+    started_at TIMESTAMP with time zone,
+    finished_at TIMESTAMP with time zone
+);
+
+-- Trace of the request that queued the job (tracing.py), continued by the worker
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS traceparent VARCHAR(55);
+
+CREATE INDEX IF NOT EXISTS jobs_ready_idx ON jobs (priority DESC, run_at) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS jobs_running_idx ON jobs (heartbeat_at) WHERE status = 'running';
+CREATE INDEX IF NOT EXISTS jobs_created_idx ON jobs (created_at DESC);
+"""
+
+JOB_COLUMNS = """
+    id, kind, payload, status, priority, attempts, max_attempts, run_at, progress, progress_message,
+    result, error, cancel_requested, created_at, started_at, finished_at, traceparent
+"""
+
+HANDLERS = {}
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler when its job has been cancelled"""
+
+
+def job_handler(kind):
+    """Register a function(ctx, payload) as the handler for a job kind"""
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def enqueue(cur, kind, payload=None, priority=0, max_attempts=3, delay=0):
+    """Queue a job in the caller's transaction and return its id (workers wake on commit)"""
+    cur.execute("""
+        INSERT INTO jobs (kind, payload, priority, max_attempts, run_at, traceparent)
+        VALUES (%s, %s, %s, %s, now() + %s * INTERVAL '1 second', %s)
+        RETURNING id
+    """, (kind, psycopg2.extras.Json(payload or {}), priority, max_attempts, delay,
+          tracing.current_traceparent()))
+    row = cur.fetchone()
+    job_id = row['id'] if isinstance(row, dict) else row[0]
+    cur.execute("SELECT pg_notify('jobs', %s)", (str(job_id),))
+    return job_id
+
+
+def get_job(cur, job_id):
+    cur.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = %s", (job_id,))
+    row = cur.fetchone()
+    return dict(row) if row else None
+
+
+def list_jobs(cur, status=None, kind=None, limit=50):
+    cur.execute(f"""
+        SELECT {JOB_COLUMNS} FROM jobs
+        WHERE (%(status)s IS NULL OR status = %(status)s) AND (%(kind)s IS NULL OR kind = %(kind)s)
+        ORDER BY created_at DESC
+        LIMIT %(limit)s
+    """, {'status': status, 'kind': kind, 'limit': limit})
+    return [dict(row) for row in cur.fetchall()]
+
+
+def cancel_job(cur, job_id):
+    """Cancel a queued job immediately, or ask a running one to stop; returns the new status"""
+    cur.execute("""
+        UPDATE jobs SET
+            status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+            finished_at = CASE WHEN status = 'queued' THEN now() ELSE finished_at END,
+            cancel_requested = true
+        WHERE id = %s AND status IN ('queued', 'running')
+        RETURNING status
+    """, (job_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return row['status'] if isinstance(row, dict) else row[0]
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter for the given number of failed attempts"""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class JobContext:
+    """Handed to job handlers: progress reporting, cancellation checks and DB connections"""
+
+    def __init__(self, job, control, control_lock, connect):
+        self.job = job
+        self.id = job['id']
+        self.attempt = job['attempts']
+        self._control = control
+        self._lock = control_lock
+        self._connect = connect
+
+    def connect(self):
+        """A new connection for the handler's own transactions"""
+        return self._connect()
+
+    def progress(self, fraction, message=None):
+        """Record progress (0..1) and raise JobCancelled if cancellation was requested"""
+        with self._lock:
+            cur = self._control.cursor()
+            cur.execute("""
+                UPDATE jobs SET progress = %s, progress_message = COALESCE(%s, progress_message),
+                                heartbeat_at = now()
+                WHERE id = %s
+                RETURNING cancel_requested
+            """, (max(0.0, min(1.0, fraction)), message, self.id))
+            row = cur.fetchone()
+        if row and row[0]:
+            raise JobCancelled()
+
+    def check_cancelled(self):
+        with self._lock:
+            cur = self._control.cursor()
+            cur.execute("SELECT cancel_requested FROM jobs WHERE id = %s", (self.id,))
+            row = cur.fetchone()
+        if row and row[0]:
+            raise JobCancelled()
+
+
+def claim_job(conn, worker_name, kinds):
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute(f"""
+        UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_by = %(worker)s,
+                        started_at = now(), heartbeat_at = now(), error = NULL
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE status = 'queued' AND run_at <= now() AND kind = ANY(%(kinds)s)
+            ORDER BY priority DESC, run_at
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING {JOB_COLUMNS}
+    """, {'worker': worker_name, 'kinds': list(kinds)})
+    return cur.fetchone()
+
+
+def finish_job(conn, job, status, result=None, error=None):
+    cur = conn.cursor()
+    if status == 'failed' and job['attempts'] < job['max_attempts']:
+        # cancel_requested is read here, not from the claimed row: a cancel may arrive while the job runs
+        cur.execute("""
+            UPDATE jobs SET status = CASE WHEN cancel_requested THEN 'cancelled' ELSE 'queued' END,
+                            locked_by = NULL, error = %s,
+                            run_at = CASE WHEN cancel_requested THEN run_at
+                                          ELSE now() + %s * INTERVAL '1 second' END,
+                            finished_at = CASE WHEN cancel_requested THEN now() END
+            WHERE id = %s
+            RETURNING status
+        """, (error, retry_delay(job['attempts']), job['id']))
+        row = cur.fetchone()
+        return 'cancelled' if row and row[0] == 'cancelled' else 'retrying'
+    cur.execute("""
+        UPDATE jobs SET status = CASE WHEN %(status)s = 'failed' AND cancel_requested THEN 'cancelled'
+                                      ELSE %(status)s END,
+                        result = %(result)s, error = %(error)s, locked_by = NULL, finished_at = now(),
+                        progress = CASE WHEN %(status)s = 'succeeded' THEN 1 ELSE progress END
+        WHERE id = %(id)s
+        RETURNING status
+    """, {'status': status, 'result': psycopg2.extras.Json(result) if result is not None else None,
+          'error': error, 'id': job['id']})
+    row = cur.fetchone()
+    return row[0] if row else status
+
+
+def requeue_stale_jobs(conn):
+    """Return jobs whose worker died (no heartbeat) to the queue, or fail them when out of attempts"""
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE jobs SET
+            status = CASE WHEN attempts < max_attempts AND NOT cancel_requested THEN 'queued'
+                          WHEN cancel_requested THEN 'cancelled' ELSE 'failed' END,
+            finished_at = CASE WHEN attempts < max_attempts AND NOT cancel_requested THEN NULL ELSE now() END,
+            error = 'Worker stopped responding',
+            locked_by = NULL
+        WHERE status = 'running' AND heartbeat_at < now() - %s * INTERVAL '1 second'
+    """, (STALE_AFTER,))
+    return cur.rowcount
+
+
+def run_worker(connect, worker_name, stop_event, kinds=None):
+    """Claim and run jobs until stop_event is set"""
+    for module in HANDLER_MODULES:
+        importlib.import_module(module)
+    kinds = kinds or list(HANDLERS)
+
+    control = connect()
+    control.autocommit = True
+    control.cursor().execute("LISTEN jobs")
+    control_lock = threading.Lock()
+    current = {'id': None}
+
+    def heartbeat():
+        while not stop_event.wait(HEARTBEAT_INTERVAL):
+            if current['id'] is None:
+                continue
+            try:
+                with control_lock:
+                    control.cursor().execute("UPDATE jobs SET heartbeat_at = now() WHERE id = %s",
+                                             (current['id'],))
+            except psycopg2.Error as e:
+                print(f"[{worker_name}] heartbeat error: {e}")
+
+    threading.Thread(target=heartbeat, name='job-heartbeat', daemon=True).start()
+
+    while not stop_event.is_set():
+        with control_lock:
+            job = claim_job(control, worker_name, kinds)
+        if not job:
+            # Sleep until a job is enqueued (NOTIFY) or the poll interval passes
+            if select.select([control], [], [], POLL_INTERVAL) != ([], [], []):
+                with control_lock:
+                    control.poll()
+                    control.notifies.clear()
+            continue
+
+        current['id'] = job['id']
+        ctx = JobContext(job, control, control_lock, connect)
+        started = time.time()
+        try:
+            with tracing.trace(f"job {job['kind']}", job['traceparent'], 'consumer',
+                               **{'job.id': job['id'], 'job.attempt': job['attempts']}):
+                result = HANDLERS[job['kind']](ctx, job['payload'])
+            status, error = 'succeeded', None
+        except JobCancelled:
+            result, status, error = None, 'cancelled', 'Cancelled'
+        except Exception as e:
+            result, status, error = None, 'failed', f"{e}\n{traceback.format_exc(limit=5)}"
+        current['id'] = None
+        with control_lock:
+            outcome = finish_job(control, job, status, result, error)
+        print(f"[{worker_name}] job {job['id']} ({job['kind']}) {outcome} in {time.time() - started:.1f}s")
+
+    control.close()
+
+
+def _worker_process(db_config, worker_name, stop_event):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    run_worker(lambda: psycopg2.connect(**db_config, connection_factory=tracing.connection_factory()),
+               worker_name, stop_event)
+
+
+def run_pool(db_config, concurrency=CONCURRENCY):
+    """Supervise `concurrency` worker processes, restarting any that exit, and requeue stale jobs"""
+    stop_event = multiprocessing.Event()
+    stopping = []
+    host = socket.gethostname()
+    workers = {}
+
+    # Only flag here: setting the shared Event from a signal handler can deadlock
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+    maintenance = psycopg2.connect(**db_config)
+    maintenance.autocommit = True
+    print(f"Starting {concurrency} job workers")
+    next_check = 0
+    while not stopping:
+        for slot in range(concurrency):
+            process = workers.get(slot)
+            if process is None or not process.is_alive():
+                name = f"{host}:{os.getpid()}:{slot}"
+                # Not daemonic, so handlers can start process pools of their own (invoice rendering)
+                process = multiprocessing.Process(target=_worker_process, args=(db_config, name, stop_event),
+                                                  name=f"job-worker-{slot}")
+                process.start()
+                workers[slot] = process
+        if time.time() >= next_check:
+            next_check = time.time() + HEARTBEAT_INTERVAL
+            try:
+                requeued = requeue_stale_jobs(maintenance)
+                if requeued:
+                    print(f"Requeued {requeued} stale job(s)")
+            except psycopg2.Error as e:
+                print(f"Stale job check failed: {e}")
+        time.sleep(1)
+
+    print("Stopping job workers...")
+    stop_event.set()
+    for process in workers.values():
+        process.join(timeout=30)
+        if process.is_alive():
+            process.terminate()
+    maintenance.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the background job workers')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='Number of worker processes')
+    args = parser.parse_args()
+
+    from app import DB_CONFIG
+    run_pool(connection_params(DB_CONFIG), args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
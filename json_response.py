@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Fast JSON Responses
+Encodes large query results for the API without RealDictCursor rows, per-row
+dict copies and jsonify. Rows come from a plain tuple cursor and are encoded
+in batches as they are fetched (orjson when installed, the json module
+otherwise), optionally in a columnar layout (column names once, then value
+arrays), and gzip-compressed on the fly for clients that accept it.
+"""
+
+import json
+import os
+import zlib
+from datetime import date, datetime, time
+from decimal import Decimal
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
+
+import psycopg2.extensions
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BATCH_ROWS = 2000
+# Responses with fewer rows are sent uncompressed
+GZIP_MIN_ROWS = int(os.environ.get('JSON_GZIP_MIN_ROWS', '200'))
+GZIP_LEVEL = int(os.environ.get('JSON_GZIP_LEVEL', '1'))
+
+# NUMERIC columns as their text (what jsonify sends for Decimal), without building Decimal objects
+NUMERIC_AS_TEXT = psycopg2.extensions.new_type((1700,), 'NUMERIC_AS_TEXT', lambda value, cur: value)
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, (IPv4Address, IPv6Address, IPv4Network, IPv6Network)):
+        return str(value)
+    if isinstance(value, memoryview):
+        return value.tobytes().decode(errors='replace')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    def dumps(value):
+        return orjson.dumps(value, default=_default)
+else:
+    _encoder = json.JSONEncoder(default=_default, separators=(',', ':'), ensure_ascii=False)
+
+    def dumps(value):
+        return _encoder.encode(value).encode()
+
+
+def tuple_cursor(conn):
+    """Cursor for rows_response: plain tuples, NUMERIC left as text"""
+    cur = conn.cursor()
+    psycopg2.extensions.register_type(NUMERIC_AS_TEXT, cur)
+    return cur
+
+
+def _encode_rows(columns, batches, key, columnar, extra):
+    """Yield the response body in pieces, one per batch of rows"""
+    head = {'success': True, **(extra or {})}
+    if columnar:
+        head['columns'] = columns
+    yield dumps(head)[:-1] + b',"' + key.encode() + b'":['
+    first = True
+    for rows in batches:
+        if not columnar:
+            rows = [dict(zip(columns, row)) for row in rows]
+        body = dumps(rows)[1:-1]
+        yield body if first else b',' + body
+        first = False
+    yield b']}'
+
+
+def _response(chunks, row_count):
+    headers = {'Vary': 'Accept-Encoding'}
+    if row_count >= GZIP_MIN_ROWS and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        body = b''.join(compressor.compress(chunk) for chunk in chunks) + compressor.flush()
+        headers['Content-Encoding'] = 'gzip'
+    else:
+        body = b''.join(chunks)
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+def rows_response(cur, key, columnar=False, extra=None):
+    """JSON response {"success": true, <extra>, key: [rows]} for an executed tuple cursor
+
+    Columnar responses also carry "columns" and each row is an array of values.
+    """
+    columns = [column.name for column in cur.description]
+    batches = iter(lambda: cur.fetchmany(BATCH_ROWS), [])
+    return _response(_encode_rows(columns, batches, key, columnar, extra), cur.rowcount)
+
+
+def list_response(columns, rows, key, columnar=False, extra=None):
+    """rows_response for rows already in memory (e.g. merged from several databases)"""
+    batches = (rows[start:start + BATCH_ROWS] for start in range(0, len(rows), BATCH_ROWS))
+    return _response(_encode_rows(columns, batches, key, columnar, extra), len(rows))
+
+
+def wants_columnar():
+    return request.form.get('format', request.args.get('format')) == 'columnar'
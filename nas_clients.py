@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - NAS Clients
+Serves FreeRADIUS its clients (NAS IP -> shared secret) from nas_devices, so
+adding a NAS or changing its secret needs no FreeRADIUS restart. FreeRADIUS
+asks for an unknown source address through a dynamic_clients virtual server
+that calls /client on the RADIUS REST backend; the answer comes from an
+in-memory index kept current through LISTEN/NOTIFY (a trigger on nas_devices
+names the addresses that changed and only those are reloaded). FreeRADIUS
+keeps a client for its configured lifetime, after which it asks again, so a
+new NAS works with its first packet and a changed secret or a removal takes
+effect within that lifetime. NAS with status 'disabled' are not served.
+
+Usage:
+    python db_schema.py --part nas_clients
+    python nas_clients.py                    # list the clients as FreeRADIUS would get them
+"""
+
+import argparse
+import ipaddress
+import threading
+import time
+
+import psycopg2
+
+from db_routing import connection_params
+from pg_listen import start_listener
+
+CHANNEL = 'radius_nas'
+DISABLED_STATUS = 'disabled'
+RECENT_UNKNOWN = 100            # unknown source addresses remembered for /status
+
+NAS_CLIENTS_SCHEMA = f"""
+CREATE INDEX IF NOT EXISTS nas_devices_ip_idx ON nas_devices (nas_ip);
+
+CREATE OR REPLACE FUNCTION nas_clients_notify() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('{CHANNEL}', 'reload');
+        RETURN NULL;
+    END IF;
+    IF TG_OP <> 'INSERT' THEN PERFORM pg_notify('{CHANNEL}', 'nas:' || OLD.nas_ip); END IF;
+    IF TG_OP <> 'DELETE' THEN PERFORM pg_notify('{CHANNEL}', 'nas:' || NEW.nas_ip); END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS nas_devices_clients_notify_trg ON nas_devices;
+CREATE TRIGGER nas_devices_clients_notify_trg
+    AFTER INSERT OR DELETE OR UPDATE OF nas_name, nas_ip, nas_type, shared_secret, status ON nas_devices
+    FOR EACH ROW EXECUTE FUNCTION nas_clients_notify();
+DROP TRIGGER IF EXISTS nas_devices_clients_truncate_trg ON nas_devices;
+CREATE TRIGGER nas_devices_clients_truncate_trg AFTER TRUNCATE ON nas_devices
+    FOR EACH STATEMENT EXECUTE FUNCTION nas_clients_notify();
+"""
+
+# With several rows for one address, an enabled one wins, then the newest
+CLIENTS_SQL = f"""
+    SELECT DISTINCT ON (nas_ip) nas_ip, nas_name, nas_type, shared_secret
+    FROM nas_devices
+    WHERE status IS DISTINCT FROM '{DISABLED_STATUS}' AND shared_secret IS NOT NULL AND shared_secret <> ''
+"""
+
+
+def normalize(address):
+    """Canonical text of an IP address, or None when it is not one"""
+    try:
+        return str(ipaddress.ip_address(address.strip()))
+    except (AttributeError, ValueError):
+        return None
+
+
+class NASClientIndex:
+    """NAS IP -> (shortname, secret, nas type) for every NAS FreeRADIUS should accept"""
+
+    def __init__(self):
+        self.clients = {}
+        self.unknown = {}           # recent source addresses with no client -> last asked
+        self._lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stats = {'hits': 0, 'misses': 0, 'invalid': 0, 'reloads': 0, 'invalidations': 0,
+                      'loaded_at': None}
+
+    def _load(self, conn, addresses=None):
+        cur = conn.cursor()
+        if addresses is None:
+            cur.execute(CLIENTS_SQL + " ORDER BY nas_ip, id DESC")
+        else:
+            cur.execute(CLIENTS_SQL + " AND nas_ip = ANY(%s) ORDER BY nas_ip, id DESC", (list(addresses),))
+        clients = {}
+        for nas_ip, nas_name, nas_type, secret in cur.fetchall():
+            address = normalize(nas_ip)
+            if address is None:
+                print(f"NAS {nas_name}: {nas_ip!r} is not an IP address, not served as a client")
+                continue
+            clients[address] = (nas_name or address, secret, nas_type or 'other')
+        conn.rollback()
+        return clients
+
+    def load(self, conn):
+        """Replace the whole index"""
+        clients = self._load(conn)
+        with self._lock:
+            self.clients = clients
+        self.stats['reloads'] += 1
+        self.stats['loaded_at'] = time.time()
+        self.ready.set()
+        print(f"NAS clients loaded: {len(clients)}")
+
+    def apply_notifications(self, conn, batch):
+        """Reload the addresses named in a batch of NOTIFY payloads"""
+        addresses = set()
+        for _, payload in batch:
+            kind, _, value = payload.partition(':')
+            if kind == 'reload':
+                self.load(conn)
+                return
+            if kind == 'nas':
+                addresses.add(value)
+        if not addresses:
+            return
+        clients = self._load(conn, addresses)
+        with self._lock:
+            for value in addresses:
+                address = normalize(value)
+                if address is None:
+                    continue
+                if address in clients:
+                    self.clients[address] = clients[address]
+                    self.unknown.pop(address, None)
+                else:
+                    self.clients.pop(address, None)
+        self.stats['invalidations'] += len(addresses)
+
+    def start(self, connect):
+        """Load the index and keep it current from NOTIFY in a background thread"""
+        # Runs after every (re)connect, so changes missed while disconnected are picked up
+        start_listener(connect, [CHANNEL], self.apply_notifications, on_connect=self.load, name='nas-clients')
+
+    def lookup(self, address):
+        """(shortname, secret, nas type) of the NAS at this address, or None"""
+        client = self.clients.get(address)
+        if client is None:
+            client = self.clients.get(normalize(address))
+        if client is not None:
+            self.stats['hits'] += 1
+            return client
+        self.stats['misses'] += 1
+        if normalize(address) is None:
+            self.stats['invalid'] += 1
+            return None
+        with self._lock:
+            self.unknown.pop(address, None)
+            self.unknown[address] = time.time()
+            while len(self.unknown) > RECENT_UNKNOWN:
+                del self.unknown[next(iter(self.unknown))]
+        return None
+
+    def summary(self):
+        return dict(self.stats, clients=len(self.clients), unknown=sorted(self.unknown),
+                    ready=self.ready.is_set())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List the NAS clients served to FreeRADIUS')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    args = parser.parse_args()
+
+    if args.dsn:
+        config = {'dsn': args.dsn}
+    else:
+        from app import DB_CONFIG
+        config = DB_CONFIG
+    conn = psycopg2.connect(**connection_params(config))
+    try:
+        index = NASClientIndex()
+        index.load(conn)
+    finally:
+        conn.close()
+    for address, (shortname, _, nas_type) in sorted(index.clients.items(),
+                                                    key=lambda item: ipaddress.ip_address(item[0])):
+        print(f"{address:40} {shortname:30} {nas_type}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - NAS Health Monitor
+Probes every NAS in nas_devices concurrently from a single asyncio loop (RFC
+5997 Status-Server over a few shared UDP sockets, or a TCP connect), records the
+round-trip times and flips nas_devices.status after consecutive failures. The
+admin app only reads the stored results, it never probes inline.
+
+Usage:
+    python nas_monitor.py                 # probe every NAS_CHECK_INTERVAL seconds
+    python nas_monitor.py --once          # single sweep (cron friendly)
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+import psycopg2.extras
+
+import radius_client
+from db_routing import connection_params
+
+CHECK_INTERVAL = int(os.environ.get('NAS_CHECK_INTERVAL', '60'))
+# 'status-server' (UDP, RFC 5997) or 'tcp' (connect to PROBE_PORT)
+PROBE_METHOD = os.environ.get('NAS_PROBE_METHOD', 'status-server')
+PROBE_PORT = int(os.environ.get('NAS_PROBE_PORT', radius_client.COA_PORT))
+PROBE_TIMEOUT = float(os.environ.get('NAS_PROBE_TIMEOUT', '2'))
+PROBE_RETRIES = 1
+MAX_IN_FLIGHT = 2000           # probes outstanding at once, bounds TCP sockets and bursts
+FAILURES_BEFORE_DOWN = 3       # consecutive failed sweeps before a NAS is marked inactive
+HISTORY_DAYS = 7
+MONITOR_LOCK_ID = 0x4e4d4f4e   # only one monitor sweeps at a time
+
+# Per nas_type overrides: nas_type -> (method, port)
+PROBE_BY_TYPE = {
+    # 'mikrotik': ('tcp', 8728),
+}
+
+NAS_HEALTH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nas_health (
+    nas_id INTEGER PRIMARY KEY REFERENCES nas_devices(id) ON DELETE CASCADE,
+    reachable BOOLEAN NOT NULL,
+    consecutive_failures INTEGER NOT NULL DEFAULT 0,
+    last_rtt_ms REAL,
+    avg_rtt_ms REAL,
+    last_error TEXT,
+    last_checked TIMESTAMP with time zone NOT NULL,
+    last_success TIMESTAMP with time zone,
+    status_changed_at TIMESTAMP with time zone
+);
+
+CREATE TABLE IF NOT EXISTS nas_health_history (
+    nas_id INTEGER NOT NULL REFERENCES nas_devices(id) ON DELETE CASCADE,
+    checked_at TIMESTAMP with time zone NOT NULL,
+    rtt_ms REAL
+);
+CREATE INDEX IF NOT EXISTS nas_health_history_nas_idx ON nas_health_history (nas_id, checked_at DESC);
+CREATE INDEX IF NOT EXISTS nas_health_history_time_idx ON nas_health_history USING BRIN (checked_at);
+"""
+
+
+def probe_settings(nas):
+    return PROBE_BY_TYPE.get((nas.get('nas_type') or '').lower(), (PROBE_METHOD, PROBE_PORT))
+
+
+async def probe(client, nas, limit, timeout=PROBE_TIMEOUT):
+    """Probe one NAS; returns (nas_id, rtt_ms or None, error or None)"""
+    method, port = probe_settings(nas)
+    async with limit:
+        started = time.monotonic()
+        try:
+            if method == 'tcp':
+                _, writer = await asyncio.wait_for(asyncio.open_connection(nas['nas_ip'], port), timeout)
+                rtt = time.monotonic() - started
+                writer.close()
+            else:
+                rtt = await radius_client.status_server(client, nas['nas_ip'], nas['shared_secret'] or '',
+                                                        port=port, timeout=timeout, retries=PROBE_RETRIES)
+            return nas['id'], round(rtt * 1000, 2), None
+        except asyncio.TimeoutError:
+            return nas['id'], None, 'timeout'
+        except (OSError, radius_client.RadiusError) as e:
+            return nas['id'], None, str(e) or type(e).__name__
+
+
+async def sweep(devices, timeout=PROBE_TIMEOUT, max_in_flight=MAX_IN_FLIGHT):
+    """Probe all devices concurrently from one event loop (no thread per device)"""
+    client = await radius_client.RadiusClient.open()
+    limit = asyncio.Semaphore(max_in_flight)
+    try:
+        return await asyncio.gather(*(probe(client, nas, limit, timeout) for nas in devices))
+    finally:
+        client.close()
+
+
+def record_results(conn, results, checked_at):
+    """Store one sweep and flip NAS status; returns [(nas_name, new status), ...]"""
+    cur = conn.cursor()
+    rows = [(nas_id, rtt, error, checked_at) for nas_id, rtt, error in results]
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO nas_health_history (nas_id, rtt_ms, checked_at)
+        SELECT nas_id, rtt, checked_at FROM (VALUES %s) AS v(nas_id, rtt, error, checked_at)
+    """, rows, template='(%s, %s::real, %s, %s::timestamptz)', page_size=1000)
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO nas_health AS h (nas_id, reachable, consecutive_failures, last_rtt_ms, avg_rtt_ms,
+                                     last_error, last_checked, last_success)
+        SELECT nas_id, rtt IS NOT NULL, CASE WHEN rtt IS NULL THEN 1 ELSE 0 END, rtt, rtt,
+               error, checked_at, CASE WHEN rtt IS NOT NULL THEN checked_at END
+        FROM (VALUES %s) AS v(nas_id, rtt, error, checked_at)
+        ON CONFLICT (nas_id) DO UPDATE SET
+            reachable = EXCLUDED.reachable,
+            consecutive_failures = CASE WHEN EXCLUDED.reachable THEN 0 ELSE h.consecutive_failures + 1 END,
+            last_rtt_ms = EXCLUDED.last_rtt_ms,
+            -- Exponentially weighted, so a single slow reply does not dominate
+            avg_rtt_ms = CASE WHEN EXCLUDED.reachable
+                              THEN COALESCE(h.avg_rtt_ms * 0.8 + EXCLUDED.last_rtt_ms * 0.2, EXCLUDED.last_rtt_ms)
+                              ELSE h.avg_rtt_ms END,
+            last_error = EXCLUDED.last_error,
+            last_checked = EXCLUDED.last_checked,
+            last_success = COALESCE(EXCLUDED.last_success, h.last_success)
+    """, rows, template='(%s, %s::real, %s, %s::timestamptz)', page_size=1000)
+    # Only 'active'/'inactive' are managed here; other statuses are set by an admin
+    cur.execute("""
+        WITH flipped AS (
+            UPDATE nas_devices d
+            SET status = CASE WHEN h.reachable THEN 'active' ELSE 'inactive' END
+            FROM nas_health h
+            WHERE h.nas_id = d.id
+              AND ((d.status = 'active' AND h.consecutive_failures >= %s)
+                   OR (d.status = 'inactive' AND h.reachable))
+            RETURNING d.id, d.nas_name, d.status
+        )
+        UPDATE nas_health h SET status_changed_at = %s
+        FROM flipped f WHERE f.id = h.nas_id
+        RETURNING f.nas_name, f.status
+    """, (FAILURES_BEFORE_DOWN, checked_at))
+    flipped = cur.fetchall()
+    cur.execute("DELETE FROM nas_health_history WHERE checked_at < %s - %s * INTERVAL '1 day'",
+                (checked_at, HISTORY_DAYS))
+    conn.commit()
+    return flipped
+
+
+def run_sweep(conn):
+    """Probe every NAS once and store the results; returns a summary or None if another monitor is sweeping"""
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (MONITOR_LOCK_ID,))
+    if not cur.fetchone()['locked']:
+        conn.rollback()
+        return None
+    cur.execute("SELECT id, nas_name, nas_ip, nas_type, shared_secret FROM nas_devices")
+    devices = cur.fetchall()
+    started = time.monotonic()
+    results = asyncio.run(sweep(devices)) if devices else []
+    flipped = record_results(conn, results, datetime.now(timezone.utc))
+    return {
+        'devices': len(devices),
+        'reachable': sum(1 for _, rtt, _ in results if rtt is not None),
+        'seconds': round(time.monotonic() - started, 2),
+        'flipped': flipped,
+    }
+
+
+def get_health(cur, nas_id=None, history_points=60):
+    """Stored probe results for the admin app (all NAS, or one NAS with its RTT history)"""
+    if nas_id is None:
+        cur.execute("""
+            SELECT d.id, d.nas_name, d.nas_ip, d.status, h.reachable, h.consecutive_failures,
+                   h.last_rtt_ms, h.avg_rtt_ms, h.last_error, h.last_checked, h.last_success,
+                   h.status_changed_at
+            FROM nas_devices d
+            LEFT JOIN nas_health h ON h.nas_id = d.id
+            ORDER BY h.reachable NULLS FIRST, d.nas_name
+        """)
+        return [dict(row) for row in cur.fetchall()]
+    cur.execute("""
+        SELECT checked_at, rtt_ms FROM nas_health_history
+        WHERE nas_id = %s ORDER BY checked_at DESC LIMIT %s
+    """, (nas_id, history_points))
+    return [dict(row) for row in cur.fetchall()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Probe NAS devices and record their health')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    parser.add_argument('--once', action='store_true', help='Run a single sweep and exit')
+    parser.add_argument('--interval', type=int, default=CHECK_INTERVAL, help='Seconds between sweeps')
+    args = parser.parse_args()
+
+    if args.dsn:
+        connect = lambda: psycopg2.connect(args.dsn)
+    else:
+        from app import DB_CONFIG
+        connect = lambda: psycopg2.connect(**connection_params(DB_CONFIG))
+
+    while True:
+        started = time.monotonic()
+        try:
+            conn = connect()
+            try:
+                summary = run_sweep(conn)
+            finally:
+                conn.close()
+            if summary is None:
+                print(f"{datetime.now().isoformat()} another monitor is sweeping, skipped")
+            else:
+                print(f"{datetime.now().isoformat()} {summary['reachable']}/{summary['devices']} NAS reachable "
+                      f"in {summary['seconds']}s")
+                for name, status in summary['flipped']:
+                    print(f"  {name} is now {status}")
+        except psycopg2.Error as e:
+            print(f"NAS monitor database error: {e}")
+        if args.once:
+            break
+        time.sleep(max(0, args.interval - (time.monotonic() - started)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Payment Reconciliation
+Matches bank and payment-gateway CSV files against the open invoices in
+billing. The open invoices are read once and indexed in memory by invoice
+number, by customer and by (customer, amount); every payment line is matched
+against those indexes, all matched invoices are marked paid with one
+UPDATE ... FROM (VALUES ...), and every line that could not be applied
+cleanly is stored as an exception for review.
+
+Usage:
+    python payments.py payments.csv               # reconcile a file
+    python payments.py payments.csv --dry-run     # match only, print the exceptions
+"""
+
+import argparse
+import csv
+import functools
+import gc
+import io
+import re
+import time
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+import psycopg2
+import psycopg2.extras
+
+import jobs
+from db_routing import connection_params
+
+OPEN_STATUSES = ('pending', 'overdue')
+
+# Accepted header names (lower case) for each field of a payment file
+COLUMN_ALIASES = {
+    'invoice_number': ('invoice_number', 'invoice', 'invoice_no', 'invoice_id', 'bill_number'),
+    'customer_id': ('customer_id', 'customer', 'account', 'account_id', 'customer_number'),
+    'amount': ('amount', 'paid_amount', 'credit', 'payment_amount', 'value'),
+    'paid_date': ('paid_date', 'date', 'payment_date', 'value_date', 'transaction_date'),
+    'reference': ('reference', 'transaction_id', 'txn_id', 'payment_id', 'description', 'narrative'),
+}
+INVOICE_PATTERN = re.compile(r'\bINV-[0-9A-Z]+-[0-9]+\b', re.IGNORECASE)
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d.%m.%Y', '%m/%d/%Y', '%Y%m%d')
+
+PAYMENTS_SCHEMA = """
+ALTER TABLE billing ADD COLUMN IF NOT EXISTS paid_date DATE;
+ALTER TABLE billing ADD COLUMN IF NOT EXISTS payment_reference VARCHAR(100);
+CREATE INDEX IF NOT EXISTS billing_open_customer_idx ON billing (customer_id)
+    WHERE status IN ('pending', 'overdue');
+
+CREATE TABLE IF NOT EXISTS payment_batches (
+    id SERIAL PRIMARY KEY,
+    filename VARCHAR(255),
+    content TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    lines INTEGER,
+    matched INTEGER,
+    invoices_paid INTEGER,
+    amount_applied DECIMAL(14,2),
+    exceptions INTEGER,
+    seconds REAL,
+    job_id BIGINT,
+    error TEXT,
+    created_at TIMESTAMP with time zone NOT NULL DEFAULT now(),
+    finished_at TIMESTAMP with time zone
+);
+ALTER TABLE payment_batches ADD COLUMN IF NOT EXISTS error TEXT;
+
+CREATE TABLE IF NOT EXISTS payment_exceptions (
+    id BIGSERIAL PRIMARY KEY,
+    batch_id INTEGER NOT NULL REFERENCES payment_batches(id) ON DELETE CASCADE,
+    line_number INTEGER NOT NULL,
+    reason VARCHAR(32) NOT NULL,
+    -- true when the payment was still applied (e.g. overpaid)
+    applied BOOLEAN NOT NULL DEFAULT false,
+    invoice_number VARCHAR(50),
+    customer_id VARCHAR(20),
+    amount DECIMAL(12,2),
+    paid_date DATE,
+    reference VARCHAR(100),
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS payment_exceptions_batch_idx ON payment_exceptions (batch_id, line_number);
+"""
+
+
+class PaymentLine:
+    __slots__ = ('number', 'invoice_number', 'customer_id', 'amount', 'paid_date', 'reference')
+
+    def __init__(self, number, invoice_number, customer_id, amount, paid_date, reference):
+        self.number = number
+        self.invoice_number = invoice_number
+        self.customer_id = customer_id
+        self.amount = amount              # cents
+        self.paid_date = paid_date
+        self.reference = reference
+
+
+def _cents(value):
+    text = (value or '').strip().replace(' ', '')
+    if ',' in text and '.' in text:
+        # Both separators: the last one is the decimal mark (1,234.56 or 1.234,56)
+        thousands = '.' if text.rfind(',') > text.rfind('.') else ','
+        text = text.replace(thousands, '').replace(',', '.')
+    elif ',' in text:
+        text = text.replace(',', '.')        # decimal comma
+    return int((Decimal(text) * 100).to_integral_value())
+
+
+@functools.lru_cache(maxsize=4096)
+def _date(value):
+    text = value[:10]
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_payments(text):
+    """CSV text -> ([PaymentLine], [(line number, reason, raw row)]) for lines that cannot be read"""
+    reader = csv.reader(io.StringIO(text.lstrip('\ufeff')))
+    header = [name.strip().lower() for name in next(reader, [])]
+    columns = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in header:
+                columns[field] = header.index(alias)
+                break
+    if 'amount' not in columns:
+        raise ValueError(f"No amount column in header {header}")
+    lines, unreadable = [], []
+    get = lambda row, field: row[columns[field]].strip() if field in columns and columns[field] < len(row) else ''
+    for number, row in enumerate(reader, start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        try:
+            amount = _cents(get(row, 'amount'))
+        except (InvalidOperation, ValueError):
+            unreadable.append((number, 'bad_amount', row))
+            continue
+        reference = get(row, 'reference')
+        invoice = get(row, 'invoice_number').upper()
+        if not invoice:
+            # Customers often put the invoice number in the transfer description
+            found = INVOICE_PATTERN.search(reference)
+            invoice = found.group(0).upper() if found else ''
+        lines.append(PaymentLine(number, invoice or None, get(row, 'customer_id').upper() or None, amount,
+                                 _date(get(row, 'paid_date')), reference[:100] or None))
+    return lines, unreadable
+
+
+class OpenInvoices:
+    """Hash indexes over the open invoices, built from one bulk read"""
+
+    def __init__(self, rows):
+        """rows: (id, invoice_number, customer_id, amount in cents, due_date) tuples, used as the entries"""
+        self.by_invoice = {}
+        self.by_customer = {}
+        self.by_customer_amount = {}
+        # Hundreds of thousands of small containers would otherwise trigger many collector passes
+        gc.disable()
+        try:
+            for entry in rows:
+                self.by_invoice[entry[1].upper()] = entry
+                self.by_customer.setdefault(entry[2], []).append(entry)
+                self.by_customer_amount.setdefault((entry[2], entry[3]), []).append(entry)
+        finally:
+            gc.enable()
+        self.paid = set()       # invoice ids taken by earlier lines of this file
+
+    def take(self, entries):
+        """Oldest unpaid invoice of the candidates, marked as taken"""
+        for entry in sorted(entries, key=lambda e: e[4] or date.max):
+            if entry[0] not in self.paid:
+                self.paid.add(entry[0])
+                return entry
+        return None
+
+    def open_for(self, customer_id):
+        return [entry for entry in self.by_customer.get(customer_id, ()) if entry[0] not in self.paid]
+
+
+def load_open_invoices(cur):
+    cur.execute("""
+        SELECT id, invoice_number, customer_id, (amount * 100)::bigint, due_date
+        FROM billing WHERE status IN %s
+    """, (OPEN_STATUSES,))
+    return OpenInvoices(cur.fetchall())
+
+
+def match_payments(lines, invoices, closed_invoices):
+    """Match lines to invoices; returns ([(invoice id, PaymentLine)], [exception rows])
+
+    closed_invoices maps invoice numbers from the file that are not open to their status.
+    """
+    applied, exceptions = [], []
+
+    def exception(line, reason, detail=None, was_applied=False):
+        exceptions.append((line.number, reason, was_applied, line.invoice_number, line.customer_id,
+                           Decimal(line.amount) / 100, line.paid_date, line.reference, detail))
+
+    for line in lines:
+        if line.amount <= 0:
+            exception(line, 'not_a_payment')
+            continue
+        if line.invoice_number:
+            entry = invoices.by_invoice.get(line.invoice_number)
+            if entry is not None:
+                if entry[0] in invoices.paid:
+                    exception(line, 'duplicate_line', 'Invoice already paid by an earlier line of this file')
+                elif line.customer_id and line.customer_id != entry[2]:
+                    exception(line, 'customer_mismatch', f'Invoice belongs to {entry[2]}')
+                elif line.amount < entry[3]:
+                    exception(line, 'underpaid', f'Invoice amount {Decimal(entry[3]) / 100}')
+                else:
+                    invoices.paid.add(entry[0])
+                    applied.append((entry[0], line))
+                    if line.amount > entry[3]:
+                        exception(line, 'overpaid', f'Invoice amount {Decimal(entry[3]) / 100}', True)
+                continue
+            if line.invoice_number in closed_invoices:
+                exception(line, 'already_paid' if closed_invoices[line.invoice_number] == 'paid' else 'invoice_closed',
+                          f'Invoice status is {closed_invoices[line.invoice_number]}')
+                continue
+            if not line.customer_id:
+                exception(line, 'unknown_invoice')
+                continue
+        if not line.customer_id:
+            exception(line, 'unidentified', 'No invoice number or customer id')
+            continue
+        # No usable invoice number: an open invoice of the same amount, or all of them if the sum matches
+        entry = invoices.take(invoices.by_customer_amount.get((line.customer_id, line.amount), ()))
+        if entry is not None:
+            applied.append((entry[0], line))
+            continue
+        open_entries = invoices.open_for(line.customer_id)
+        if not open_entries:
+            reason = 'no_open_invoice' if line.customer_id in invoices.by_customer else 'unknown_customer'
+            exception(line, reason)
+        elif sum(entry[3] for entry in open_entries) == line.amount:
+            for entry in open_entries:
+                invoices.paid.add(entry[0])
+                applied.append((entry[0], line))
+        else:
+            exception(line, 'amount_mismatch',
+                      f'{len(open_entries)} open invoice(s) totalling {Decimal(sum(e[3] for e in open_entries)) / 100}')
+    return applied, exceptions
+
+
+def apply_payments(cur, applied):
+    """Mark matched invoices paid in one statement; returns the ids actually updated"""
+    if not applied:
+        return set()
+    today = date.today()
+    rows = [(invoice_id, line.paid_date or today, line.reference) for invoice_id, line in applied]
+    updated = psycopg2.extras.execute_values(cur, """
+        UPDATE billing b SET status = 'paid', paid_date = v.paid_date, payment_reference = v.reference
+        FROM (VALUES %s) AS v(id, paid_date, reference)
+        WHERE b.id = v.id AND b.status IN ('pending', 'overdue')
+        RETURNING b.id
+    """, rows, template='(%s, %s::date, %s)', page_size=len(rows), fetch=True)
+    return {row[0] for row in updated}
+
+
+def reconcile(conn, text, batch_id=None, dry_run=False, progress=None):
+    """Reconcile one payment file; returns a summary (exceptions are stored when batch_id is set)"""
+    started = time.monotonic()
+    lines, unreadable = parse_payments(text)
+    cur = conn.cursor()
+    invoices = load_open_invoices(cur)
+    if progress:
+        progress(0.3, f'{len(lines)} lines, {len(invoices.by_invoice)} open invoices')
+    unknown = list({line.invoice_number for line in lines
+                    if line.invoice_number and line.invoice_number not in invoices.by_invoice})
+    closed = {}
+    if unknown:
+        cur.execute("SELECT invoice_number, status FROM billing WHERE invoice_number = ANY(%s)", (unknown,))
+        closed = dict(cur.fetchall())
+    applied, exceptions = match_payments(lines, invoices, closed)
+    exceptions.extend((number, reason, False, None, None, None, None, None, ','.join(row)[:200])
+                      for number, reason, row in unreadable)
+    updated = set()
+    if not dry_run:
+        updated = apply_payments(cur, applied)
+        # Invoices paid by someone else between the read and the update
+        for invoice_id, line in applied:
+            if invoice_id not in updated:
+                exceptions.append((line.number, 'already_paid', False, line.invoice_number, line.customer_id,
+                                   Decimal(line.amount) / 100, line.paid_date, line.reference,
+                                   'Paid while the file was being reconciled'))
+        if batch_id is not None and exceptions:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO payment_exceptions (batch_id, line_number, reason, applied, invoice_number,
+                                                customer_id, amount, paid_date, reference, detail)
+                VALUES %s
+            """, [(batch_id, *row) for row in exceptions], page_size=5000)
+    exceptions.sort(key=lambda row: row[0])
+    paid_lines = {line.number for invoice_id, line in applied if dry_run or invoice_id in updated}
+    summary = {
+        'lines': len(lines) + len(unreadable),
+        'matched': len(paid_lines),
+        'invoices_paid': len(applied) if dry_run else len(updated),
+        'amount_applied': str(Decimal(sum(line.amount for line in lines if line.number in paid_lines)) / 100),
+        'exceptions': len(exceptions),
+        'seconds': round(time.monotonic() - started, 2),
+    }
+    if batch_id is not None and not dry_run:
+        cur.execute("""
+            UPDATE payment_batches SET status = 'done', lines = %(lines)s, matched = %(matched)s,
+                   invoices_paid = %(invoices_paid)s, amount_applied = %(amount_applied)s,
+                   exceptions = %(exceptions)s, seconds = %(seconds)s, finished_at = now()
+            WHERE id = %(batch_id)s
+        """, dict(summary, batch_id=batch_id))
+    if dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+    summary['exception_rows'] = exceptions
+    return summary
+
+
+def create_batch(cur, filename, text):
+    """Store an uploaded file and queue its reconciliation; returns (batch id, job id)"""
+    cur.execute("INSERT INTO payment_batches (filename, content) VALUES (%s, %s) RETURNING id", (filename, text))
+    row = cur.fetchone()
+    batch_id = row['id'] if isinstance(row, dict) else row[0]
+    job_id = jobs.enqueue(cur, 'reconcile_payments', {'batch_id': batch_id})
+    cur.execute("UPDATE payment_batches SET job_id = %s WHERE id = %s", (job_id, batch_id))
+    return batch_id, job_id
+
+
+def fail_batch(conn, batch_id, error):
+    """Mark a batch failed with the error, so an unreadable file or a database error does not leave it 'running'"""
+    conn.rollback()
+    cur = conn.cursor()
+    cur.execute("UPDATE payment_batches SET status = 'failed', error = %s, finished_at = now() WHERE id = %s",
+                (str(error)[:1000], batch_id))
+    conn.commit()
+
+
+@jobs.job_handler('reconcile_payments')
+def reconcile_payments_job(ctx, payload):
+    """Background job: reconcile an uploaded payment file"""
+    conn = ctx.connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT content, status FROM payment_batches WHERE id = %s", (payload['batch_id'],))
+        row = cur.fetchone()
+        if row is None:
+            return {'missing': True}
+        if row[1] == 'done':
+            # A retried job must not apply the file twice
+            return {'skipped': True}
+        cur.execute("UPDATE payment_batches SET status = 'running', error = NULL WHERE id = %s",
+                    (payload['batch_id'],))
+        conn.commit()
+        try:
+            summary = reconcile(conn, row[0], payload['batch_id'], progress=ctx.progress)
+        except Exception as e:
+            fail_batch(conn, payload['batch_id'], e)
+            raise
+    finally:
+        conn.close()
+    summary.pop('exception_rows')
+    return summary
+
+
+def get_batch(cur, batch_id, limit=5000):
+    """A batch summary with its exceptions, for the admin app"""
+    cur.execute("""
+        SELECT id, filename, status, lines, matched, invoices_paid, amount_applied, exceptions, seconds,
+               error, job_id, created_at, finished_at
+        FROM payment_batches WHERE id = %s
+    """, (batch_id,))
+    batch = cur.fetchone()
+    if batch is None:
+        return None
+    cur.execute("""
+        SELECT line_number, reason, applied, invoice_number, customer_id, amount, paid_date, reference, detail
+        FROM payment_exceptions WHERE batch_id = %s ORDER BY line_number LIMIT %s
+    """, (batch_id, limit))
+    return dict(batch, exception_rows=[dict(row) for row in cur.fetchall()])
+
+
+def list_batches(cur, limit=50):
+    cur.execute("""
+        SELECT id, filename, status, lines, matched, invoices_paid, amount_applied, exceptions, seconds,
+               error, created_at, finished_at
+        FROM payment_batches ORDER BY created_at DESC LIMIT %s
+    """, (limit,))
+    return [dict(row) for row in cur.fetchall()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconcile a payment CSV file against billing')
+    parser.add_argument('file', help='CSV with a header row (invoice_number, customer_id, amount, date, ...)')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    parser.add_argument('--dry-run', action='store_true', help='Match and report without updating billing')
+    args = parser.parse_args()
+
+    if args.dsn:
+        conn = psycopg2.connect(args.dsn)
+    else:
+        from app import DB_CONFIG
+        conn = psycopg2.connect(**connection_params(DB_CONFIG))
+
+    with open(args.file, encoding='utf-8-sig') as f:
+        text = f.read()
+    batch_id = None
+    if not args.dry_run:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO payment_batches (filename, content, status) VALUES (%s, %s, 'running') "
+                    "RETURNING id", (args.file, text))
+        batch_id = cur.fetchone()[0]
+        conn.commit()
+    try:
+        summary = reconcile(conn, text, batch_id, dry_run=args.dry_run)
+    except Exception as e:
+        if batch_id is not None:
+            fail_batch(conn, batch_id, e)
+        raise
+    finally:
+        conn.close()
+    for number, reason, applied, invoice, customer, amount, _, _, detail in summary.pop('exception_rows'):
+        print(f"line {number}: {reason}{' (applied)' if applied else ''} invoice={invoice} "
+              f"customer={customer} amount={amount} {detail or ''}")
+    print(summary if batch_id is None else dict(summary, batch_id=batch_id))
+
+
+if __name__ == '__main__':
+    main()
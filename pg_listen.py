@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - LISTEN/NOTIFY Helper
+Keeps a dedicated connection LISTENing on PostgreSQL channels and hands the
+notifications to a callback in batches (everything that arrived together, so
+bulk changes can be applied with one query), reconnecting after failures. The on_connect hook
+runs after each (re)connect once LISTEN is active, so in-memory state can be
+reloaded without missing changes made while the connection was down.
+"""
+
+import select
+import threading
+
+import psycopg2
+
+
+def listen_forever(connect, channels, on_notify, on_connect=None, stop_event=None,
+                   poll_interval=5, reconnect_delay=5):
+    """Block and dispatch notifications until stop_event is set"""
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        conn = None
+        try:
+            conn = connect()
+            conn.autocommit = True
+            cur = conn.cursor()
+            for channel in channels:
+                cur.execute(f"LISTEN {channel}")
+            if on_connect:
+                on_connect(conn)
+            while not stop_event.is_set():
+                if select.select([conn], [], [], poll_interval) == ([], [], []):
+                    continue
+                conn.poll()
+                batch = [(notify.channel, notify.payload) for notify in conn.notifies]
+                conn.notifies.clear()
+                if not batch:
+                    continue
+                try:
+                    on_notify(conn, batch)
+                except psycopg2.Error:
+                    raise
+                except Exception as e:
+                    print(f"Notification handler error ({', '.join(channels)}): {e}")
+        except (psycopg2.Error, OSError) as e:
+            print(f"LISTEN connection error ({', '.join(channels)}): {e}")
+            stop_event.wait(reconnect_delay)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+
+
+def start_listener(connect, channels, on_notify, on_connect=None, name='pg-listener'):
+    """Run listen_forever in a daemon thread; returns (thread, stop_event)"""
+    stop_event = threading.Event()
+    thread = threading.Thread(target=listen_forever, name=name, daemon=True,
+                              args=(connect, channels, on_notify, on_connect, stop_event))
+    thread.start()
+    return thread, stop_event
+
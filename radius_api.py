@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - RADIUS REST Backend
+Small HTTP service queried by FreeRADIUS rlm_rest on the authentication path
+(authorize with Simultaneous-Use, and post-auth for Framed-IP-Address
+assignment and the radpostauth log with brute-force blocking), for dynamic
+clients (a NAS's shared secret by its address), and on the accounting path to
+write radacct to the NAS's accounting shard.
+It runs as its own process (not inside the gunicorn workers) so the in-memory
+caches exist once and stay warm, and it answers from memory without touching
+PostgreSQL per request. Keep-alive connections are supported, so rlm_rest's
+connection pool is reused between Access-Requests.
+
+Usage:
+    python radius_api.py --host 127.0.0.1 --port 5010
+"""
+
+import argparse
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import psycopg2
+
+import acct_shards
+from auth_guard import AuthGuard
+from authz_cache import AuthorizeCache
+from db_routing import connection_params
+from ip_pool import IPPoolManager
+from nas_clients import NASClientIndex
+from session_limits import ATTRIBUTE as SIMULTANEOUS_USE, SessionCounter
+
+HOST = os.environ.get('RADIUS_API_HOST', '127.0.0.1')
+PORT = int(os.environ.get('RADIUS_API_PORT', '5010'))
+# How long a request waits for the initial cache warm-up before failing
+READY_TIMEOUT = 10
+# Reply-Message of the rejects /authorize makes itself; post-auth gets it back in the URI
+BLOCKED_MESSAGE = 'Too many failed logins, try again later'
+SESSION_LIMIT_MESSAGE = 'Already logged in {} times'
+
+authz = AuthorizeCache()
+guard = AuthGuard()
+pools = IPPoolManager()
+nas_clients = NASClientIndex()
+sessions = SessionCounter()
+shards = None               # acct_shards.ShardRouter, set by serve()
+started_at = time.time()
+
+# (method, path) -> handler(attrs) returning (status, body)
+ROUTES = {}
+
+
+def route(method, path):
+    def register(func):
+        ROUTES[(method, path)] = func
+        return func
+    return register
+
+
+def parse_attributes(body, content_type):
+    """rlm_rest request body -> {attribute: first value}
+
+    Accepts the JSON format ({"User-Name": {"type": "string", "value": ["bob"]}})
+    and the form-encoded one (User-Name=bob&NAS-IP-Address=...).
+    """
+    if not body:
+        return {}
+    if 'json' in (content_type or ''):
+        data = json.loads(body)
+        attrs = {}
+        for name, item in data.items():
+            if isinstance(item, dict):
+                values = item.get('value')
+                value = values[0] if isinstance(values, list) and values else values
+            else:
+                value = item
+            if value is not None:
+                attrs[name] = str(value)
+        return attrs
+    return {name: values[0] for name, values in parse_qs(body.decode()).items()}
+
+
+def rest_attributes(prefix, items):
+    """[(attr, op, value), ...] -> rlm_rest response attributes"""
+    out = {}
+    for attribute, op, value in items:
+        key = f"{prefix}:{attribute}"
+        entry = out.get(key)
+        if entry is None:
+            out[key] = {'op': op, 'value': [value]}
+        else:
+            entry['value'].append(value)
+    return out
+
+
+def is_backend_reject(message):
+    """Whether a Reply-Message is one of the rejects /authorize makes itself"""
+    if not message:
+        return False
+    prefix, _, suffix = SESSION_LIMIT_MESSAGE.partition('{}')
+    return message == BLOCKED_MESSAGE or (message.startswith(prefix) and message.endswith(suffix))
+
+
+@route('POST', '/authorize')
+def authorize(attrs):
+    username = attrs.get('User-Name')
+    if not username:
+        return 400, {'message': 'User-Name is required'}
+    if guard.blocked(username, attrs.get('Calling-Station-Id')):
+        return 401, {'reply:Reply-Message': BLOCKED_MESSAGE}
+    if not authz.ready.wait(READY_TIMEOUT):
+        return 503, {'message': 'Authorize cache is not loaded yet'}
+    result, control, reply = authz.authorize(username, attrs)
+    if result == 'notfound':
+        # rlm_rest maps 404 to notfound, so other modules may still handle the user
+        return 404, None
+    if result == 'reject':
+        return 401, {'reply:Reply-Message': 'Access denied'}
+    if sessions.ready.is_set():
+        limit = sessions.limit(control, authz.users.get(username, ((), (), ()))[2])
+        # Reserves the slot, post-auth gives it back if the login is rejected after all
+        if not sessions.check_and_reserve(username, limit, attrs.get('Calling-Station-Id')):
+            return 401, {'reply:Reply-Message': SESSION_LIMIT_MESSAGE.format(limit)}
+    # Enforced here, so the sql module's session check must not count radacct again
+    control = [item for item in control if item[0] != SIMULTANEOUS_USE]
+    body = rest_attributes('control', control)
+    body.update(rest_attributes('reply', reply))
+    return 200, body
+
+
+@route('POST', '/post-auth')
+def post_auth(attrs):
+    username = attrs.get('User-Name')
+    if not username:
+        return 400, {'message': 'User-Name is required'}
+    # Packet-Type comes from the URI (see docs/radius-rest-backend.md), Access-Reject in Post-Auth-Type REJECT
+    accepted = attrs.get('Packet-Type', 'Access-Accept') != 'Access-Reject'
+    # A block or Simultaneous-Use reject is not a failed login, and it reserved no slot
+    refused = not accepted and is_backend_reject(attrs.get('Reply-Message'))
+    guard.record(username, attrs.get('Calling-Station-Id'), attrs.get('NAS-IP-Address'), accepted,
+                 counted=not refused)
+    if not accepted:
+        if not refused:
+            sessions.release(username, attrs.get('Calling-Station-Id'))
+        return 204, None
+    if not (pools.ready.wait(READY_TIMEOUT) and authz.ready.wait(READY_TIMEOUT)):
+        return 503, {'message': 'IP pools are not loaded yet'}
+    _, reply_items, groups = authz.users.get(username, ((), (), ()))
+    if 'Framed-IP-Address' in reply_items[0::3]:
+        # Static address from radreply
+        return 204, None
+    address = pools.allocate(username, attrs.get('NAS-IP-Address'), groups, attrs.get('Calling-Station-Id'))
+    if address is None:
+        # No pool for this NAS/profile (the NAS assigns one) or every pool is full
+        return 404, None
+    return 200, {'reply:Framed-IP-Address': {'op': ':=', 'value': [address]}}
+
+
+@route('GET', '/client')
+@route('POST', '/client')
+def client(attrs):
+    # Called from the dynamic_clients virtual server for a source address with no client yet
+    address = attrs.get('Packet-Src-IP-Address') or attrs.get('ip')
+    if not address:
+        return 400, {'message': 'Packet-Src-IP-Address is required'}
+    if not nas_clients.ready.wait(READY_TIMEOUT):
+        return 503, {'message': 'NAS clients are not loaded yet'}
+    found = nas_clients.lookup(address)
+    if found is None:
+        return 404, None
+    shortname, secret, nas_type = found
+    return 200, {
+        'control:FreeRADIUS-Client-IP-Address': {'op': ':=', 'value': [address]},
+        'control:FreeRADIUS-Client-Secret': {'op': ':=', 'value': [secret]},
+        'control:FreeRADIUS-Client-Shortname': {'op': ':=', 'value': [shortname]},
+        'control:FreeRADIUS-Client-NAS-Type': {'op': ':=', 'value': [nas_type]},
+    }
+
+
+@route('POST', '/accounting')
+def accounting(attrs):
+    # rlm_rest treats any 2xx as ok; the NAS gets its Accounting-Response only after the write
+    try:
+        acct_shards.record_accounting(shards, attrs)
+    except psycopg2.Error as e:
+        print(f"Accounting write failed: {e}")
+        return 503, {'message': 'Accounting database unavailable'}
+    return 204, None
+
+
+@route('GET', '/status')
+def status(attrs):
+    return 200, {
+        'uptime_seconds': round(time.time() - started_at),
+        'authorize': authz.summary(),
+        'ip_pools': pools.summary(),
+        'sessions': sessions.summary(),
+        'auth_guard': guard.summary(),
+        'nas_clients': nas_clients.summary(),
+        'acct_shards': {'shards': list(shards.shards) if shards else [], 'routes': shards.routes() if shards else []},
+    }
+
+
+class RadiusRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        path = urlsplit(self.path).path
+        handler = ROUTES.get((method, path))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if handler is None:
+            self._respond(404, {'message': f'No route for {method} {path}'})
+            return
+        try:
+            attrs = parse_attributes(body, self.headers.get('Content-Type'))
+            # Query parameters are extra attributes expanded by rlm_rest in the URI
+            for name, values in parse_qs(urlsplit(self.path).query).items():
+                attrs.setdefault(name, values[0])
+            status, payload = handler(attrs)
+        except ValueError as e:
+            status, payload = 400, {'message': f'Bad request: {e}'}
+        except Exception as e:
+            status, payload = 500, {'message': f'Error: {e}'}
+        self._respond(status, payload)
+
+    def _respond(self, status, payload):
+        data = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        if data:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Access-Requests are too frequent to log one line each
+        pass
+
+
+def serve(db_params, host=HOST, port=PORT, router=None):
+    global shards
+    shards = router or acct_shards.ShardRouter(db_params)
+    connect = lambda: psycopg2.connect(**db_params)
+    authz.start(connect)
+    pools.start(connect, shards)
+    sessions.start(connect, shards)
+    guard.start(connect)
+    nas_clients.start(connect)
+    server = ThreadingHTTPServer((host, port), RadiusRequestHandler)
+    server.daemon_threads = True
+    print(f"RADIUS REST backend listening on {host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the RADIUS REST backend for FreeRADIUS rlm_rest')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    args = parser.parse_args()
+
+    if args.dsn:
+        config = {'dsn': args.dsn}
+    else:
+        from app import DB_CONFIG
+        config = DB_CONFIG
+    serve(connection_params(config), args.host, args.port, acct_shards.ShardRouter(config))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - RADIUS Client
+Minimal RADIUS packet encoding (RFC 2865/2866/3576/5176/5997) and an asyncio
+client that multiplexes thousands of outstanding requests over a few UDP
+sockets. Used for Status-Server health probes and for Disconnect/CoA requests
+sent to NAS devices.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import os
+import socket
+import struct
+
+import tracing
+
+# Packet codes
+ACCESS_REQUEST = 1
+ACCESS_ACCEPT = 2
+ACCESS_REJECT = 3
+ACCOUNTING_REQUEST = 4
+ACCOUNTING_RESPONSE = 5
+STATUS_SERVER = 12
+DISCONNECT_REQUEST = 40
+DISCONNECT_ACK = 41
+DISCONNECT_NAK = 42
+COA_REQUEST = 43
+COA_ACK = 44
+COA_NAK = 45
+CODE_NAMES = {
+    ACCESS_REQUEST: 'Access-Request', ACCOUNTING_REQUEST: 'Accounting-Request', STATUS_SERVER: 'Status-Server',
+    DISCONNECT_REQUEST: 'Disconnect-Request', COA_REQUEST: 'CoA-Request',
+}
+
+AUTH_PORT = 1812
+ACCT_PORT = 1813
+COA_PORT = 3799
+
+# name -> (vendor id or None, attribute number, type)
+ATTRIBUTES = {
+    'User-Name': (None, 1, 'string'),
+    'NAS-IP-Address': (None, 4, 'ipaddr'),
+    'NAS-Port': (None, 5, 'integer'),
+    'Framed-IP-Address': (None, 8, 'ipaddr'),
+    'Filter-Id': (None, 11, 'string'),
+    'Reply-Message': (None, 18, 'string'),
+    'State': (None, 24, 'octets'),
+    'Class': (None, 25, 'octets'),
+    'Session-Timeout': (None, 27, 'integer'),
+    'Called-Station-Id': (None, 30, 'string'),
+    'Calling-Station-Id': (None, 31, 'string'),
+    'NAS-Identifier': (None, 32, 'string'),
+    'Acct-Session-Id': (None, 44, 'string'),
+    'Event-Timestamp': (None, 55, 'integer'),
+    'Message-Authenticator': (None, 80, 'octets'),
+    'Error-Cause': (None, 101, 'integer'),
+    'Mikrotik-Rate-Limit': (14988, 8, 'string'),
+    'Mikrotik-Address-List': (14988, 19, 'string'),
+    'WISPr-Bandwidth-Max-Up': (14122, 7, 'integer'),
+    'WISPr-Bandwidth-Max-Down': (14122, 8, 'integer'),
+}
+_BY_CODE = {(vendor, number): (name, kind) for name, (vendor, number, kind) in ATTRIBUTES.items()}
+VENDOR_SPECIFIC = 26
+MESSAGE_AUTHENTICATOR = 80
+
+
+class RadiusError(Exception):
+    pass
+
+
+def _encode_value(kind, value):
+    if kind == 'string':
+        return value.encode() if isinstance(value, str) else bytes(value)
+    if kind == 'integer':
+        return struct.pack('!I', int(value))
+    if kind == 'ipaddr':
+        return socket.inet_aton(value)
+    return bytes(value)
+
+
+def _decode_value(kind, data):
+    if kind == 'string':
+        return data.decode(errors='replace')
+    if kind == 'integer' and len(data) == 4:
+        return struct.unpack('!I', data)[0]
+    if kind == 'ipaddr' and len(data) == 4:
+        return socket.inet_ntoa(data)
+    return data
+
+
+def encode_attributes(attributes):
+    """[(name, value), ...] -> wire format"""
+    out = bytearray()
+    for name, value in attributes:
+        try:
+            vendor, number, kind = ATTRIBUTES[name]
+        except KeyError:
+            raise RadiusError(f"Unknown attribute: {name}")
+        data = _encode_value(kind, value)
+        if vendor is None:
+            out += struct.pack('!BB', number, len(data) + 2) + data
+        else:
+            sub = struct.pack('!BB', number, len(data) + 2) + data
+            out += struct.pack('!BBI', VENDOR_SPECIFIC, len(sub) + 6, vendor) + sub
+    return bytes(out)
+
+
+def decode_attributes(data):
+    """Wire format -> [(name, value), ...]; unknown attributes are named by number"""
+    attributes = []
+    pos = 0
+    while pos + 2 <= len(data):
+        number, length = data[pos], data[pos + 1]
+        if length < 2 or pos + length > len(data):
+            raise RadiusError('Malformed attribute')
+        value = data[pos + 2:pos + length]
+        pos += length
+        if number == VENDOR_SPECIFIC and len(value) >= 6:
+            vendor = struct.unpack('!I', value[:4])[0]
+            sub_number, sub_length = value[4], value[5]
+            key, payload = (vendor, sub_number), value[6:4 + sub_length]
+        else:
+            key, payload = (None, number), value
+        name, kind = _BY_CODE.get(key, (f"Attr-{key[0]}-{key[1]}" if key[0] else f"Attr-{key[1]}", 'octets'))
+        attributes.append((name, _decode_value(kind, payload)))
+    return attributes
+
+
+def _message_authenticator(packet, secret):
+    return hmac.new(secret, packet, hashlib.md5).digest()
+
+
+def build_request(code, identifier, secret, attributes=(), message_authenticator=False):
+    """Return (packet, request authenticator)
+
+    Access-Request and Status-Server carry a random authenticator; Accounting,
+    Disconnect and CoA requests carry the MD5 authenticator of RFC 2866/5176.
+    Status-Server always includes Message-Authenticator (RFC 5997).
+    """
+    secret = secret.encode() if isinstance(secret, str) else secret
+    body = encode_attributes(attributes)
+    if message_authenticator or code == STATUS_SERVER:
+        body += struct.pack('!BB', MESSAGE_AUTHENTICATOR, 18) + bytes(16)
+    length = 20 + len(body)
+    random_auth = code in (ACCESS_REQUEST, STATUS_SERVER)
+    authenticator = os.urandom(16) if random_auth else bytes(16)
+    packet = bytearray(struct.pack('!BBH', code, identifier, length) + authenticator + body)
+    if message_authenticator or code == STATUS_SERVER:
+        packet[-16:] = _message_authenticator(bytes(packet), secret)
+    if not random_auth:
+        authenticator = hashlib.md5(bytes(packet) + secret).digest()
+        packet[4:20] = authenticator
+    return bytes(packet), authenticator
+
+
+def parse_response(packet, request_authenticator, secret):
+    """Verify a response against its request; returns (code, identifier, attributes)"""
+    secret = secret.encode() if isinstance(secret, str) else secret
+    if len(packet) < 20:
+        raise RadiusError('Short packet')
+    code, identifier, length = struct.unpack('!BBH', packet[:4])
+    if length < 20 or length > len(packet):
+        raise RadiusError('Bad length')
+    packet = packet[:length]
+    expected = hashlib.md5(packet[:4] + request_authenticator + packet[20:] + secret).digest()
+    if not hmac.compare_digest(expected, packet[4:20]):
+        raise RadiusError('Bad response authenticator (shared secret mismatch?)')
+    attributes = decode_attributes(packet[20:])
+    pos = 20
+    while pos + 2 <= length:
+        if packet[pos] == MESSAGE_AUTHENTICATOR and packet[pos + 1] == 18:
+            value = packet[pos + 2:pos + 18]
+            zeroed = packet[:4] + request_authenticator + packet[20:pos + 2] + bytes(16) + packet[pos + 18:]
+            if not hmac.compare_digest(_message_authenticator(zeroed, secret), value):
+                raise RadiusError('Bad Message-Authenticator')
+        pos += packet[pos + 1]
+    return code, identifier, attributes
+
+
+class _ClientSocket(asyncio.DatagramProtocol):
+    def __init__(self, client, index):
+        self.client = client
+        self.index = index
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) >= 20:
+            self.client._received(self.index, data)
+
+    def error_received(self, exc):
+        # ICMP port unreachable etc.; the affected request simply times out
+        pass
+
+
+class RadiusClient:
+    """Sends RADIUS requests and matches replies by (socket, identifier)
+
+    Each UDP socket has 256 identifiers; more sockets are opened as needed, so
+    a large batch to many NAS devices runs over a handful of sockets. Replies
+    are not matched by source address (multi-homed NAS often answer from
+    another one) but are verified with the shared secret.
+    """
+
+    def __init__(self, max_sockets=32, local_addr=('0.0.0.0', 0)):
+        self.max_sockets = max_sockets
+        self.local_addr = local_addr
+        self._sockets = []
+        self._pending = {}
+        self._free = asyncio.Condition()
+
+    @classmethod
+    async def open(cls, **kwargs):
+        client = cls(**kwargs)
+        await client._add_socket()
+        return client
+
+    async def _add_socket(self):
+        loop = asyncio.get_running_loop()
+        index = len(self._sockets)
+        _, sock = await loop.create_datagram_endpoint(lambda: _ClientSocket(self, index),
+                                                      local_addr=self.local_addr)
+        self._sockets.append(sock)
+
+    def _received(self, index, data):
+        future = self._pending.get((index, data[1]))
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def close(self):
+        for sock in self._sockets:
+            if sock.transport:
+                sock.transport.close()
+
+    async def _allocate(self):
+        async with self._free:
+            while True:
+                for index in range(len(self._sockets)):
+                    for identifier in range(256):
+                        if (index, identifier) not in self._pending:
+                            self._pending[(index, identifier)] = None
+                            return index, identifier
+                if len(self._sockets) < self.max_sockets:
+                    await self._add_socket()
+                    continue
+                await self._free.wait()
+
+    async def _release(self, key):
+        async with self._free:
+            self._pending.pop(key, None)
+            self._free.notify()
+
+    async def request(self, host, port, secret, code, attributes=(), timeout=3.0, retries=2,
+                      message_authenticator=False):
+        """Send a request and wait for the verified reply; returns (code, attributes, rtt seconds)"""
+        with tracing.span(f"radius {CODE_NAMES.get(code, code)}", 'client', **{'net.peer': f'{host}:{port}'}) as span:
+            key = await self._allocate()
+            index, identifier = key
+            packet, authenticator = build_request(code, identifier, secret, attributes, message_authenticator)
+            loop = asyncio.get_running_loop()
+            try:
+                for attempt in range(retries + 1):
+                    future = loop.create_future()
+                    self._pending[key] = future
+                    sent = loop.time()
+                    self._sockets[index].transport.sendto(packet, (host, port))
+                    try:
+                        data = await asyncio.wait_for(future, timeout)
+                    except asyncio.TimeoutError:
+                        continue
+                    rtt = loop.time() - sent
+                    reply_code, _, reply_attributes = parse_response(data, authenticator, secret)
+                    if span is not None:
+                        span.set('radius.attempts', attempt + 1)
+                        span.set('radius.reply', reply_code)
+                    return reply_code, reply_attributes, rtt
+            finally:
+                await self._release(key)
+            raise asyncio.TimeoutError(f"No response from {host}:{port}")
+
+
+async def status_server(client, host, secret, port=AUTH_PORT, timeout=2.0, retries=1):
+    """RFC 5997 probe; returns the round-trip time in seconds"""
+    _, _, rtt = await client.request(host, port, secret, STATUS_SERVER, timeout=timeout, retries=retries)
+    return rtt
+
+
+async def send_paced(client, requests, rate=200, max_in_flight=500, timeout=3.0, retries=1):
+    """Send many Disconnect/CoA requests at no more than `rate` per second
+
+    requests: [(host, port, secret, code, attributes), ...]. Returns one result per
+    request in the same order: the reply code, 'timeout' or an error message.
+    """
+    limit = asyncio.Semaphore(max_in_flight)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    async def send(position, host, port, secret, code, attributes):
+        # Request n leaves no earlier than n / rate seconds after the first one
+        await asyncio.sleep(max(0.0, started + position / rate - loop.time()))
+        async with limit:
+            try:
+                reply_code, _, _ = await client.request(host, port, secret, code, attributes,
+                                                        timeout=timeout, retries=retries)
+                return reply_code
+            except asyncio.TimeoutError:
+                return 'timeout'
+            except (OSError, RadiusError) as e:
+                return str(e) or type(e).__name__
+
+    return await asyncio.gather(*(send(position, *request) for position, request in enumerate(requests)))
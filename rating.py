@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Usage Rating
+Rates metered and overage plans: each service profile with a row in
+rating_plans gets a free allowance, a peak window whose traffic counts in
+full while off-peak traffic counts at offpeak_weight, and graduated price
+bands (rating_tiers) for the billable GB above the allowance.
+
+A run pulls every session that overlaps the billing period for all rated
+subscribers with one COPY per accounting shard, keyed by subscriber index,
+and does the rest on NumPy arrays: a session's octets are pro-rated to the
+part that falls inside the period, split into peak and off-peak by how much
+of that time overlaps the daily peak window, summed per subscriber
+(bincount) and priced band by band for all subscribers of a plan at once.
+Ratings and their line items replace any earlier uninvoiced rating of the
+same period and are written in batches; --invoice turns the non-zero ones
+into pending billing invoices.
+
+Usage:
+    python rating.py                          # rate last calendar month
+    python rating.py --period 2025-03 --invoice
+    python rating.py --show CUST0001234
+"""
+
+import argparse
+import io
+import os
+import time
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import psycopg2
+import psycopg2.extras
+
+import acct_shards
+import jobs
+from db_routing import connection_params
+from dunning import USERNAME_SQL
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+RATING_TIMEZONE = os.environ.get('RATING_TIMEZONE', 'UTC')    # peak hours and periods are local time
+LOOKBACK_DAYS = int(os.environ.get('RATING_LOOKBACK_DAYS', '31'))    # oldest start of a closed session rated
+INVOICE_DUE_DAYS = 30
+WRITE_BATCH = 50000
+RATING_LOCK_ID = 0x52415445
+GB = 1000 ** 3
+
+RATING_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rating_plans (
+    service_profile VARCHAR(50) PRIMARY KEY REFERENCES service_profiles(name) ON DELETE CASCADE,
+    included_gb NUMERIC(12,3) NOT NULL DEFAULT 0,
+    peak_start TIME NOT NULL DEFAULT '18:00',
+    peak_end TIME NOT NULL DEFAULT '23:00',        -- before peak_start: the window wraps past midnight
+    offpeak_weight NUMERIC(4,3) NOT NULL DEFAULT 1,
+    count_upload BOOLEAN NOT NULL DEFAULT true
+);
+
+-- Graduated bands: GB above the allowance from from_gb up to the next band cost price_per_gb
+CREATE TABLE IF NOT EXISTS rating_tiers (
+    service_profile VARCHAR(50) NOT NULL REFERENCES rating_plans(service_profile) ON DELETE CASCADE,
+    from_gb NUMERIC(12,3) NOT NULL,
+    price_per_gb NUMERIC(10,4) NOT NULL,
+    PRIMARY KEY (service_profile, from_gb)
+);
+
+CREATE TABLE IF NOT EXISTS usage_ratings (
+    customer_id VARCHAR(20) NOT NULL REFERENCES customers(customer_id) ON DELETE CASCADE,
+    period_start DATE NOT NULL,
+    period_end DATE NOT NULL,
+    service_profile VARCHAR(50) NOT NULL,
+    peak_gb NUMERIC(14,3) NOT NULL,
+    offpeak_gb NUMERIC(14,3) NOT NULL,
+    billable_gb NUMERIC(14,3) NOT NULL,
+    amount DECIMAL(10,2) NOT NULL,
+    invoice_number VARCHAR(50),
+    rated_at TIMESTAMP with time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (customer_id, period_start)
+);
+CREATE INDEX IF NOT EXISTS usage_ratings_period_idx ON usage_ratings (period_start);
+
+CREATE TABLE IF NOT EXISTS usage_line_items (
+    customer_id VARCHAR(20) NOT NULL,
+    period_start DATE NOT NULL,
+    description VARCHAR(100) NOT NULL,
+    quantity_gb NUMERIC(14,3) NOT NULL,
+    unit_price NUMERIC(10,4) NOT NULL,
+    amount DECIMAL(10,2) NOT NULL,
+    FOREIGN KEY (customer_id, period_start) REFERENCES usage_ratings ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS usage_line_items_rating_idx ON usage_line_items (customer_id, period_start);
+
+CREATE TABLE IF NOT EXISTS rating_runs (
+    id SERIAL PRIMARY KEY,
+    period_start DATE NOT NULL,
+    period_end DATE NOT NULL,
+    started_at TIMESTAMP with time zone NOT NULL DEFAULT now(),
+    subscribers INTEGER NOT NULL DEFAULT 0,
+    sessions INTEGER NOT NULL DEFAULT 0,
+    line_items INTEGER NOT NULL DEFAULT 0,
+    amount DECIMAL(14,2) NOT NULL DEFAULT 0,
+    invoiced INTEGER NOT NULL DEFAULT 0,
+    seconds REAL
+);
+
+CREATE SEQUENCE IF NOT EXISTS usage_invoice_seq;
+"""
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError('Usage rating needs numpy: pip install numpy')
+
+
+def last_month(today=None):
+    first = (today or date.today()).replace(day=1)
+    return (first - timedelta(days=1)).replace(day=1), first
+
+
+def month_period(text):
+    start = datetime.strptime(text, '%Y-%m').date()
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+
+def _seconds(moment):
+    return moment.hour * 3600 + moment.minute * 60 + moment.second
+
+
+def load_plans(cur):
+    """{profile: plan dict with its bands as from_gb/price arrays}"""
+    cur.execute("""
+        SELECT service_profile, included_gb, peak_start, peak_end, offpeak_weight, count_upload
+        FROM rating_plans
+    """)
+    plans = {}
+    for profile, included, peak_start, peak_end, weight, upload in cur.fetchall():
+        plans[profile] = {'included_gb': float(included), 'peak_start': _seconds(peak_start),
+                          'peak_end': _seconds(peak_end), 'offpeak_weight': float(weight),
+                          'count_upload': upload, 'from_gb': [], 'price': []}
+    cur.execute("SELECT service_profile, from_gb, price_per_gb FROM rating_tiers ORDER BY service_profile, from_gb")
+    for profile, from_gb, price in cur.fetchall():
+        plans[profile]['from_gb'].append(float(from_gb))
+        plans[profile]['price'].append(float(price))
+    return plans
+
+
+def load_subscribers(cur, plans, period_start):
+    """Rated subscribers not yet invoiced for the period: [(customer_id, username, profile)]"""
+    cur.execute(f"""
+        SELECT c.customer_id, {USERNAME_SQL} AS username, c.service_profile
+        FROM customers c
+        WHERE c.service_profile = ANY(%s) AND c.status IN ('active', 'suspended')
+          AND NOT EXISTS (SELECT 1 FROM usage_ratings r
+                          WHERE r.customer_id = c.customer_id AND r.period_start = %s
+                            AND r.invoice_number IS NOT NULL)
+        ORDER BY c.customer_id
+    """, (list(plans), period_start))
+    return cur.fetchall()
+
+
+def fetch_sessions(conn, usernames, start, end):
+    """Sessions overlapping [start, end) of the given users as NumPy arrays
+
+    Returns (subscriber index, start epoch, end epoch, input octets, output
+    octets). Open sessions end at their last update (or now).
+    """
+    query = conn.cursor().mogrify("""
+        SELECT u.idx - 1,
+               EXTRACT(EPOCH FROM a.acctstarttime)::bigint,
+               EXTRACT(EPOCH FROM COALESCE(a.acctstoptime, a.acctupdatetime, now()))::bigint,
+               COALESCE(a.acctinputoctets, 0), COALESCE(a.acctoutputoctets, 0)
+        FROM radacct a
+        JOIN unnest(%(users)s::text[]) WITH ORDINALITY AS u(username, idx) ON a.username = u.username
+        WHERE a.acctstarttime < %(end)s
+          AND (a.acctstoptime IS NULL OR (a.acctstoptime >= %(start)s AND a.acctstarttime >= %(lookback)s))
+    """, {'users': usernames, 'start': start, 'end': end,
+          'lookback': start - timedelta(days=LOOKBACK_DAYS)}).decode()
+    buffer = io.BytesIO()
+    conn.cursor().copy_expert(f"COPY ({query}) TO STDOUT", buffer)
+    conn.rollback()
+    if not buffer.tell():
+        return tuple(np.empty(0, dtype=np.int64) for _ in range(5))
+    buffer.seek(0)
+    table = np.loadtxt(buffer, dtype=np.int64, delimiter='\t', ndmin=2)
+    return tuple(table[:, column] for column in range(5))
+
+
+def _peak_seconds_before(local, peak_start, peak_end):
+    """Seconds of daily peak window between the local epoch 0 and `local` (all arrays)"""
+    length = np.where(peak_end > peak_start, peak_end - peak_start, 86400 - peak_start + peak_end)
+    days, clock = np.divmod(local, 86400)
+    plain = np.clip(clock - peak_start, 0, peak_end - peak_start)
+    # Wrapping window (e.g. 20:00-02:00): peak is everything outside [peak_end, peak_start)
+    wrapped = clock - np.clip(clock - peak_end, 0, peak_start - peak_end)
+    return days * length + np.where(peak_end > peak_start, plain, wrapped)
+
+
+def rate(plans, subscribers, sessions, period_start, period_end, tz):
+    """Vectorized rating; returns (peak_bytes, offpeak_bytes, billable_gb, band_gb, band_amounts)
+
+    band_gb and band_amounts are {profile: (subscriber indexes, GB per band, amount per band)}.
+    """
+    idx, start, end, octets_in, octets_out = sessions
+    count = len(subscribers)
+    profiles = sorted(plans)
+    profile_of = np.array([profiles.index(profile) for _, _, profile in subscribers], dtype=np.int64)
+
+    def field(name):
+        return np.array([plans[profile][name] for profile in profiles], dtype=np.float64)
+
+    p0 = int(datetime.combine(period_start, datetime.min.time(), tz).timestamp())
+    p1 = int(datetime.combine(period_end, datetime.min.time(), tz).timestamp())
+    inside_start = np.maximum(start, p0)
+    inside_end = np.minimum(end, p1)
+    inside = np.maximum(inside_end - inside_start, 0)
+    duration = end - start
+    # Octets are spread evenly over the session; zero-length sessions count where they start
+    fraction = np.where(duration > 0, inside / np.maximum(duration, 1), ((start >= p0) & (start < p1)) * 1.0)
+
+    plan = profile_of[idx]
+    octets = np.where(field('count_upload').astype(bool)[plan], octets_in + octets_out, octets_out) * fraction
+
+    # Local offset per session from an hourly table of the period (follows DST changes)
+    hours = (p1 - p0) // 3600 + 1
+    offsets = np.array([datetime.fromtimestamp(p0 + h * 3600, tz).utcoffset().total_seconds()
+                        for h in range(hours)], dtype=np.int64)
+    offset = offsets[np.clip((inside_start - p0) // 3600, 0, hours - 1)]
+    peak_start = field('peak_start').astype(np.int64)[plan]
+    peak_end = field('peak_end').astype(np.int64)[plan]
+    peak_time = (_peak_seconds_before(inside_end + offset, peak_start, peak_end)
+                 - _peak_seconds_before(inside_start + offset, peak_start, peak_end))
+    peak_share = np.where(inside > 0, peak_time / np.maximum(inside, 1), 0.0)
+
+    peak_bytes = np.bincount(idx, weights=octets * peak_share, minlength=count)
+    offpeak_bytes = np.bincount(idx, weights=octets * (1 - peak_share), minlength=count)
+    weighted = (peak_bytes + offpeak_bytes * field('offpeak_weight')[profile_of]) / GB
+    billable = np.maximum(weighted - field('included_gb')[profile_of], 0)
+
+    bands = {}
+    for number, profile in enumerate(profiles):
+        members = np.flatnonzero(profile_of == number)
+        from_gb = np.array(plans[profile]['from_gb'], dtype=np.float64)
+        if not len(members) or not len(from_gb):
+            continue
+        upper = np.append(from_gb[1:], np.inf)
+        quantity = np.clip(billable[members, None] - from_gb[None, :], 0, upper - from_gb)
+        amounts = np.round(quantity * np.array(plans[profile]['price'])[None, :], 2)
+        bands[profile] = (members, quantity, amounts)
+    return peak_bytes, offpeak_bytes, billable, bands
+
+
+def _band_label(from_gb, upper):
+    if upper == float('inf'):
+        return f"Usage over {from_gb:g} GB"
+    return f"Usage {from_gb:g}-{upper:g} GB"
+
+
+def _copy_rows(cur, table, columns, rows):
+    """COPY rows into table, WRITE_BATCH rows per statement"""
+    for offset in range(0, len(rows), WRITE_BATCH):
+        buffer = io.StringIO()
+        for row in rows[offset:offset + WRITE_BATCH]:
+            buffer.write('\t'.join(str(value) for value in row) + '\n')
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def save_ratings(cur, plans, subscribers, period_start, period_end, result):
+    """Replace the period's uninvoiced ratings; returns (line items written, total amount)"""
+    peak_bytes, offpeak_bytes, billable, bands = result
+    totals = np.zeros(len(subscribers))
+    lines = []
+    for profile, (members, quantity, amounts) in bands.items():
+        totals[members] += amounts.sum(axis=1)
+        from_gb = plans[profile]['from_gb']
+        uppers = from_gb[1:] + [float('inf')]
+        for band, (low, upper, price) in enumerate(zip(from_gb, uppers, plans[profile]['price'])):
+            used = np.flatnonzero(quantity[:, band] > 0)
+            label = _band_label(low, upper)
+            lines.extend((subscribers[members[i]][0], period_start, label, round(float(quantity[i, band]), 3),
+                          price, float(amounts[i, band])) for i in used)
+
+    cur.execute("DELETE FROM usage_ratings WHERE period_start = %s AND invoice_number IS NULL", (period_start,))
+    peak_gb = np.round(peak_bytes / GB, 3).tolist()
+    offpeak_gb = np.round(offpeak_bytes / GB, 3).tolist()
+    billable_gb = np.round(billable, 3).tolist()
+    amounts = np.round(totals, 2).tolist()
+    ratings = [(customer_id, period_start, period_end, profile, peak_gb[i], offpeak_gb[i], billable_gb[i], amounts[i])
+               for i, (customer_id, _, profile) in enumerate(subscribers)]
+    _copy_rows(cur, 'usage_ratings', ('customer_id', 'period_start', 'period_end', 'service_profile', 'peak_gb',
+                                      'offpeak_gb', 'billable_gb', 'amount'), ratings)
+    _copy_rows(cur, 'usage_line_items', ('customer_id', 'period_start', 'description', 'quantity_gb', 'unit_price',
+                                         'amount'), lines)
+    return len(lines), round(float(totals.sum()), 2)
+
+
+def invoice_ratings(cur, period_start, due_days=INVOICE_DUE_DAYS):
+    """Pending billing invoices for the period's uninvoiced non-zero ratings; returns how many"""
+    cur.execute("""
+        WITH invoiced AS (
+            UPDATE usage_ratings
+            SET invoice_number = 'INV-' || to_char(period_start, 'YYYYMM') || 'U-' || nextval('usage_invoice_seq')
+            WHERE period_start = %s AND invoice_number IS NULL AND amount > 0
+            RETURNING customer_id, invoice_number, amount
+        )
+        INSERT INTO billing (customer_id, invoice_number, amount, due_date)
+        SELECT customer_id, invoice_number, amount, CURRENT_DATE + %s FROM invoiced
+    """, (period_start, due_days))
+    return cur.rowcount
+
+
+def run(conn, period_start, period_end, invoice=False, router=None, progress=None):
+    """One rating run for [period_start, period_end); returns a summary or None if another run holds the lock"""
+    _require_numpy()
+    started = time.monotonic()
+    tz = ZoneInfo(RATING_TIMEZONE)
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(%s)", (RATING_LOCK_ID,))
+    if not cur.fetchone()[0]:
+        conn.rollback()
+        return None
+    conn.commit()
+    try:
+        plans = load_plans(cur)
+        subscribers = load_subscribers(cur, plans, period_start) if plans else []
+        conn.rollback()
+        usernames = [username for _, username, _ in subscribers]
+        start = datetime.combine(period_start, datetime.min.time(), tz)
+        end = datetime.combine(period_end, datetime.min.time(), tz)
+        parts = []
+        if router is not None and router.sharded:
+            for shard in router.shards:
+                shard_conn = conn if shard == acct_shards.PRIMARY_SHARD else router.connect(shard)
+                try:
+                    parts.append(fetch_sessions(shard_conn, usernames, start, end))
+                finally:
+                    if shard_conn is not conn:
+                        shard_conn.close()
+        elif usernames:
+            parts.append(fetch_sessions(conn, usernames, start, end))
+        sessions = tuple(np.concatenate([part[column] for part in parts]) if parts else np.empty(0, np.int64)
+                         for column in range(5))
+        if progress:
+            progress(0.4, f"{len(sessions[0])} sessions of {len(subscribers)} subscribers loaded")
+
+        result = rate(plans, subscribers, sessions, period_start, period_end, tz)
+        if progress:
+            progress(0.6, 'Rated')
+        line_items, amount = save_ratings(cur, plans, subscribers, period_start, period_end, result)
+        invoiced = invoice_ratings(cur, period_start) if invoice else 0
+        summary = {'period_start': period_start.isoformat(), 'period_end': period_end.isoformat(),
+                   'subscribers': len(subscribers), 'sessions': len(sessions[0]), 'line_items': line_items,
+                   'amount': amount, 'invoiced': invoiced, 'seconds': round(time.monotonic() - started, 2)}
+        cur.execute("""
+            INSERT INTO rating_runs (period_start, period_end, subscribers, sessions, line_items, amount,
+                                     invoiced, seconds)
+            VALUES (%(period_start)s, %(period_end)s, %(subscribers)s, %(sessions)s, %(line_items)s,
+                    %(amount)s, %(invoiced)s, %(seconds)s)
+        """, summary)
+        conn.commit()
+        return summary
+    finally:
+        conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(%s)", (RATING_LOCK_ID,))
+        conn.commit()
+
+
+@jobs.job_handler('rating_run')
+def rating_job(ctx, payload):
+    """Background job: rate a period (payload: period 'YYYY-MM', invoice)"""
+    period_start, period_end = month_period(payload['period']) if payload.get('period') else last_month()
+    conn = ctx.connect()
+    try:
+        summary = run(conn, period_start, period_end, payload.get('invoice', False),
+                      acct_shards.default_router(), ctx.progress)
+    finally:
+        conn.close()
+    return {'skipped': True} if summary is None else summary
+
+
+def customer_ratings(cur, customer_id, limit=12):
+    """A customer's recent ratings with their line items"""
+    cur.execute("""
+        SELECT customer_id, period_start, period_end, service_profile, peak_gb, offpeak_gb, billable_gb,
+               amount, invoice_number, rated_at
+        FROM usage_ratings WHERE customer_id = %s ORDER BY period_start DESC LIMIT %s
+    """, (customer_id, limit))
+    ratings = [dict(row) for row in cur.fetchall()]
+    cur.execute("""
+        SELECT period_start, description, quantity_gb, unit_price, amount
+        FROM usage_line_items WHERE customer_id = %s AND period_start = ANY(%s)
+        ORDER BY period_start, quantity_gb DESC
+    """, (customer_id, [rating['period_start'] for rating in ratings]))
+    items = [dict(row) for row in cur.fetchall()]
+    for rating in ratings:
+        rating['line_items'] = [item for item in items if item['period_start'] == rating['period_start']]
+    return ratings
+
+
+def recent_runs(cur, limit=30):
+    cur.execute("""
+        SELECT id, period_start, period_end, started_at, subscribers, sessions, line_items, amount, invoiced, seconds
+        FROM rating_runs ORDER BY started_at DESC LIMIT %s
+    """, (limit,))
+    return [dict(row) for row in cur.fetchall()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rate metered usage and create usage invoices')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG, every accounting shard)')
+    parser.add_argument('--period', help='Month to rate, YYYY-MM (default: last month)')
+    parser.add_argument('--invoice', action='store_true', help='Create billing invoices for non-zero ratings')
+    parser.add_argument('--show', metavar='CUSTOMER_ID', help="Print a customer's ratings instead")
+    args = parser.parse_args()
+
+    if args.dsn:
+        conn, router = psycopg2.connect(args.dsn), None
+    else:
+        from app import DB_CONFIG
+        conn, router = psycopg2.connect(**connection_params(DB_CONFIG)), acct_shards.default_router()
+    try:
+        if args.show:
+            for rating in customer_ratings(conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor), args.show):
+                print(f"{rating['period_start']}: {rating['peak_gb']} GB peak, {rating['offpeak_gb']} GB off-peak, "
+                      f"{rating['billable_gb']} GB billable, {rating['amount']} {rating['invoice_number'] or ''}")
+                for item in rating['line_items']:
+                    print(f"    {item['description']}: {item['quantity_gb']} GB x {item['unit_price']} = "
+                          f"{item['amount']}")
+            return
+        period_start, period_end = month_period(args.period) if args.period else last_month()
+        summary = run(conn, period_start, period_end, args.invoice, router, lambda f, m: print(m))
+        print('Another rating run is in progress' if summary is None else summary)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
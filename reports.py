@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Report Snapshots
+The dashboard reports are served from materialized views that are refreshed
+concurrently in the background (on a schedule and shortly after data changes),
+so report requests only read small precomputed tables.
+
+Usage:
+    python reports.py                    # refresh once (cron friendly)
+    python reports.py --loop 300         # refresh every 5 minutes
+"""
+
+import argparse
+import os
+import threading
+import time
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extras
+
+import jobs
+from db_routing import connection_params
+
+# Seconds between scheduled refreshes in the app (0 disables the background thread)
+REFRESH_INTERVAL = int(os.environ.get('REPORT_REFRESH_INTERVAL', '300'))
+# Delay between a data change and the refresh it triggers, so bursts coalesce
+CHANGE_DEBOUNCE = int(os.environ.get('REPORT_CHANGE_DEBOUNCE', '30'))
+# How long a cached result is served before checking for a newer snapshot
+CACHE_TTL = int(os.environ.get('REPORT_CACHE_TTL', '30'))
+
+USAGE_WINDOWS = (7, 30, 90)
+USAGE_MAX_ROWS = 1000
+REFRESH_LOCK_ID = 0x5245504f  # pg advisory lock shared by every refresher
+
+REPORTS_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS report_snapshots (
+    name VARCHAR(64) PRIMARY KEY,
+    refreshed_at TIMESTAMP with time zone NOT NULL,
+    duration_ms INTEGER
+);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS report_revenue_monthly AS
+SELECT DATE_TRUNC('month', billing_date)::date AS month,
+       SUM(amount) AS total_revenue,
+       COUNT(*) AS invoice_count
+FROM billing
+GROUP BY DATE_TRUNC('month', billing_date);
+CREATE UNIQUE INDEX IF NOT EXISTS report_revenue_monthly_key ON report_revenue_monthly (month);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS report_customers_by_profile AS
+SELECT c.service_profile, COUNT(*) AS customer_count, SUM(sp.price) AS total_revenue
+FROM customers c
+JOIN service_profiles sp ON c.service_profile = sp.name
+WHERE c.status = 'active'
+GROUP BY c.service_profile;
+CREATE UNIQUE INDEX IF NOT EXISTS report_customers_by_profile_key ON report_customers_by_profile (service_profile);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS report_usage_top AS
+SELECT w.window_days, u.username, u.total_bytes, u.session_count, u.last_session
+FROM (VALUES {', '.join(f'({days})' for days in USAGE_WINDOWS)}) AS w(window_days)
+CROSS JOIN LATERAL (
+    SELECT username,
+           SUM(COALESCE(acctinputoctets, 0) + COALESCE(acctoutputoctets, 0)) AS total_bytes,
+           COUNT(*) AS session_count,
+           MAX(acctstarttime) AS last_session
+    FROM radacct
+    WHERE acctstarttime >= CURRENT_DATE - w.window_days * INTERVAL '1 day'
+    GROUP BY username
+    ORDER BY total_bytes DESC
+    LIMIT {USAGE_MAX_ROWS}
+) u;
+CREATE UNIQUE INDEX IF NOT EXISTS report_usage_top_key ON report_usage_top (window_days, username);
+
+-- The views are populated when created
+INSERT INTO report_snapshots (name, refreshed_at)
+VALUES ('report_revenue_monthly', now()), ('report_customers_by_profile', now()), ('report_usage_top', now())
+ON CONFLICT (name) DO NOTHING;
+"""
+
+# report_type -> materialized view it is served from
+SNAPSHOTS = {
+    'revenue': 'report_revenue_monthly',
+    'customers': 'report_customers_by_profile',
+    'usage': 'report_usage_top',
+}
+
+_cache = {}
+_cache_lock = threading.Lock()
+_changed = threading.Event()
+
+
+def report_params(report_type, form):
+    """Normalise request parameters into a hashable cache key"""
+    if report_type == 'revenue':
+        return (('months', max(1, min(int(form.get('months', 12)), 120))),)
+    if report_type == 'usage':
+        days = int(form.get('days', 30))
+        if days not in USAGE_WINDOWS:
+            raise ValueError(f"days must be one of {', '.join(map(str, USAGE_WINDOWS))}")
+        return (('days', days), ('limit', max(1, min(int(form.get('limit', 20)), USAGE_MAX_ROWS))))
+    if report_type == 'customers':
+        return ()
+    raise ValueError(f"Unknown report type: {report_type}")
+
+
+def query_snapshot(cur, report_type, params):
+    """Read a report from its snapshot"""
+    params = dict(params)
+    if report_type == 'revenue':
+        cur.execute("""
+            SELECT month, total_revenue, invoice_count
+            FROM report_revenue_monthly
+            WHERE month >= DATE_TRUNC('month', CURRENT_DATE) - %s * INTERVAL '1 month'
+            ORDER BY month DESC
+        """, (params['months'] - 1,))
+    elif report_type == 'customers':
+        cur.execute("""
+            SELECT service_profile, customer_count, total_revenue
+            FROM report_customers_by_profile
+            ORDER BY customer_count DESC
+        """)
+    else:
+        cur.execute("""
+            SELECT username, total_bytes, session_count, last_session
+            FROM report_usage_top
+            WHERE window_days = %s
+            ORDER BY total_bytes DESC
+            LIMIT %s
+        """, (params['days'], params['limit']))
+    return [dict(row) for row in cur.fetchall()]
+
+
+def snapshot_time(cur, report_type):
+    cur.execute("SELECT refreshed_at FROM report_snapshots WHERE name = %s", (SNAPSHOTS[report_type],))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return row['refreshed_at'] if isinstance(row, dict) else row[0]
+
+
+def get_report(cur, report_type, form, gather=None):
+    """Return (rows, data_as_of, approximate) for a report, served from cache or its snapshot
+
+    gather(report_type, params) -> (rows, data_as_of, approximate), or None to
+    use the local snapshot, serves reports kept on other databases (the
+    accounting shards); approximate is True when the rows may be off (see
+    acct_shards.ShardRouter.gather_report).
+    """
+    params = report_params(report_type, form)
+    key = (report_type, params)
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached and now - cached[0] < CACHE_TTL:
+        return cached[2], cached[1], cached[3]
+
+    gathered = gather(report_type, params) if gather else None
+    if gathered is not None:
+        rows, as_of, approximate = gathered
+        with _cache_lock:
+            _cache[key] = (now, as_of, rows, approximate)
+        return rows, as_of, approximate
+
+    as_of = snapshot_time(cur, report_type)
+    if cached and as_of is not None and as_of == cached[1]:
+        rows = cached[2]
+    else:
+        rows = query_snapshot(cur, report_type, params)
+    with _cache_lock:
+        _cache[key] = (now, as_of, rows, False)
+    return rows, as_of, False
+
+
+def refresh_snapshots(conn, names=None):
+    """Refresh snapshots concurrently (readers are never blocked); returns {view: seconds} or None if busy"""
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(%s)", (REFRESH_LOCK_ID,))
+    if not cur.fetchone()[0]:
+        return None
+    timings = {}
+    try:
+        for view in names or SNAPSHOTS.values():
+            started = time.time()
+            cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view}")
+            elapsed = time.time() - started
+            cur.execute("""
+                INSERT INTO report_snapshots (name, refreshed_at, duration_ms)
+                VALUES (%s, now(), %s)
+                ON CONFLICT (name) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at,
+                                                 duration_ms = EXCLUDED.duration_ms
+            """, (view, int(elapsed * 1000)))
+            timings[view] = round(elapsed, 3)
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (REFRESH_LOCK_ID,))
+    return timings
+
+
+@jobs.job_handler('refresh_reports')
+def refresh_reports_job(ctx, payload):
+    """Background job: refresh all (or the listed) snapshots"""
+    conn = ctx.connect()
+    try:
+        timings = refresh_snapshots(conn, payload.get('views'))
+    finally:
+        conn.close()
+    return {'skipped': True} if timings is None else {'timings': timings}
+
+
+def mark_changed():
+    """Ask the background refresher to refresh soon (called after writes that affect reports)"""
+    _changed.set()
+
+
+def start_refresher(get_connection, interval=REFRESH_INTERVAL, debounce=CHANGE_DEBOUNCE, after_refresh=None):
+    """Refresh snapshots every `interval` seconds and `debounce` seconds after a change
+
+    after_refresh() runs after each refresh, e.g. to refresh the snapshots on the accounting shards.
+    """
+    if interval <= 0:
+        return None
+
+    def run():
+        while True:
+            if _changed.wait(interval):
+                time.sleep(debounce)
+            _changed.clear()
+            conn = get_connection()
+            if not conn:
+                continue
+            try:
+                refresh_snapshots(conn)
+            except Exception as e:
+                print(f"Report refresh error: {e}")
+            finally:
+                conn.close()
+            if after_refresh:
+                try:
+                    after_refresh()
+                except Exception as e:
+                    print(f"Report refresh error: {e}")
+
+    thread = threading.Thread(target=run, name='report-refresher', daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Refresh the report snapshots')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    parser.add_argument('--loop', type=int, metavar='SECONDS', help='Keep refreshing at this interval')
+    args = parser.parse_args()
+
+    if args.dsn:
+        connect = lambda: psycopg2.connect(args.dsn)
+    else:
+        from app import DB_CONFIG
+        connect = lambda: psycopg2.connect(**connection_params(DB_CONFIG))
+
+    while True:
+        conn = connect()
+        try:
+            timings = refresh_snapshots(conn)
+            if timings is None:
+                print(f"{datetime.now().isoformat()} another refresh is running, skipped")
+            else:
+                print(f"{datetime.now().isoformat()} refreshed {timings}")
+        finally:
+            conn.close()
+        if not args.loop:
+            break
+        time.sleep(args.loop)
+
+
+if __name__ == '__main__':
+    main()
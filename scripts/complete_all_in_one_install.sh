@@ -2018,7 +2018,7 @@ User=$USER
 Group=$USER
 WorkingDirectory=/var/www/isp-admin
 Environment=PATH=/var/www/isp-admin/venv/bin
-ExecStart=/var/www/isp-admin/venv/bin/gunicorn --bind 0.0.0.0:5000 --workers 3 app:app
+ExecStart=/var/www/isp-admin/venv/bin/gunicorn --bind 0.0.0.0:5000 --workers 3 --worker-class gthread --threads 16 app:app
 Restart=always
 
 [Install]
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Subscriber Search
+Typeahead search over customer name, email, phone, customer ID, RADIUS
+username and the last seen framed IP / calling-station MAC. Backed by pg_trgm
+GiST indexes so substring and fuzzy lookups return the best matches without
+scanning the customers table. Deprovisioned customers waiting for the purge
+are not returned.
+"""
+
+import re
+
+MIN_QUERY_LENGTH = 3
+MAX_RESULTS = 20
+
+# Fragments of an IPv4 address or a MAC address (any common separator)
+ADDRESS_PATTERN = re.compile(r'^[0-9a-f.:\-]+$')
+
+SEARCH_SCHEMA = """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- One lower-cased document per customer, including the RADIUS username
+-- (first.last) and the phone number with punctuation removed
+ALTER TABLE customers ADD COLUMN IF NOT EXISTS search_text TEXT GENERATED ALWAYS AS (
+    lower(customer_id || ' ' || first_name || ' ' || last_name || ' ' ||
+          first_name || '.' || last_name || ' ' || email || ' ' ||
+          coalesce(phone, '') || ' ' || regexp_replace(coalesce(phone, ''), '[^0-9]', '', 'g'))
+) STORED;
+
+CREATE INDEX IF NOT EXISTS customers_search_trgm_idx
+    ON customers USING gist (search_text gist_trgm_ops(siglen=256));
+CREATE INDEX IF NOT EXISTS customers_username_idx
+    ON customers ((lower(first_name) || '.' || lower(last_name)));
+
+-- Latest framed IP / MAC per RADIUS username, kept current from radacct
+CREATE TABLE IF NOT EXISTS subscriber_last_seen (
+    username VARCHAR(64) PRIMARY KEY,
+    framedipaddress INET,
+    callingstationid VARCHAR(50),
+    nasipaddress INET,
+    seen_at TIMESTAMP with time zone,
+    search_text TEXT GENERATED ALWAYS AS (
+        lower(coalesce(host(framedipaddress), '') || ' ' || coalesce(callingstationid, '') || ' ' ||
+              regexp_replace(coalesce(callingstationid, ''), '[^0-9A-Fa-f]', '', 'g'))
+    ) STORED
+);
+
+CREATE INDEX IF NOT EXISTS subscriber_last_seen_trgm_idx
+    ON subscriber_last_seen USING gin (search_text gin_trgm_ops);
+
+CREATE OR REPLACE FUNCTION radacct_track_last_seen() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE'
+       AND NEW.framedipaddress IS NOT DISTINCT FROM OLD.framedipaddress
+       AND NEW.callingstationid IS NOT DISTINCT FROM OLD.callingstationid THEN
+        RETURN NULL;
+    END IF;
+    INSERT INTO subscriber_last_seen (username, framedipaddress, callingstationid, nasipaddress, seen_at)
+    VALUES (NEW.username, NEW.framedipaddress, NEW.callingstationid, NEW.nasipaddress,
+            coalesce(NEW.acctupdatetime, NEW.acctstarttime, now()))
+    ON CONFLICT (username) DO UPDATE SET
+        framedipaddress = EXCLUDED.framedipaddress,
+        callingstationid = EXCLUDED.callingstationid,
+        nasipaddress = EXCLUDED.nasipaddress,
+        seen_at = EXCLUDED.seen_at
+    WHERE subscriber_last_seen.seen_at IS NULL OR subscriber_last_seen.seen_at <= EXCLUDED.seen_at;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS radacct_last_seen_trg ON radacct;
+CREATE TRIGGER radacct_last_seen_trg
+    AFTER INSERT OR UPDATE OF framedipaddress, callingstationid ON radacct
+    FOR EACH ROW WHEN (NEW.framedipaddress IS NOT NULL OR NEW.callingstationid IS NOT NULL)
+    EXECUTE FUNCTION radacct_track_last_seen();
+
+INSERT INTO subscriber_last_seen (username, framedipaddress, callingstationid, nasipaddress, seen_at)
+SELECT DISTINCT ON (username) username, framedipaddress, callingstationid, nasipaddress,
+       coalesce(acctupdatetime, acctstarttime)
+FROM radacct
+WHERE framedipaddress IS NOT NULL OR callingstationid IS NOT NULL
+ORDER BY username, acctstarttime DESC NULLS LAST
+ON CONFLICT (username) DO NOTHING;
+"""
+
+RESULT_COLUMNS = """
+    c.customer_id, c.first_name, c.last_name,
+    c.radius_username AS username,
+    c.email, c.phone, c.service_profile, c.status,
+    host(s.framedipaddress) AS framedipaddress, s.callingstationid, s.seen_at AS last_seen
+"""
+
+
+def like_pattern(query):
+    """Substring LIKE pattern with the user's wildcard characters escaped"""
+    escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+
+def search_subscribers(cur, query, limit=MAX_RESULTS):
+    """Return up to `limit` subscribers matching `query`, best matches first"""
+    query = ' '.join(query.lower().split())
+    if len(query) < MIN_QUERY_LENGTH:
+        return []
+    limit = max(1, min(int(limit), MAX_RESULTS))
+    pattern = like_pattern(query)
+    results = []
+    seen = set()
+
+    def collect(rows, match):
+        for row in rows:
+            if row['customer_id'] not in seen and len(results) < limit:
+                seen.add(row['customer_id'])
+                row = dict(row)
+                row['match'] = match
+                results.append(row)
+
+    # Framed IP / MAC fragments are looked up in the last seen table first
+    if ADDRESS_PATTERN.match(query):
+        cur.execute(f"""
+            SELECT {RESULT_COLUMNS}
+            FROM subscriber_last_seen s
+            JOIN customers c ON c.radius_username = s.username
+            WHERE s.search_text LIKE %(pattern)s AND c.deleted_at IS NULL
+            ORDER BY s.seen_at DESC NULLS LAST
+            LIMIT %(limit)s
+        """, {'pattern': pattern, 'limit': limit})
+        collect(cur.fetchall(), 'address')
+
+    # Substring matches on the customer document, ranked by closeness to the query
+    if len(results) < limit:
+        cur.execute(f"""
+            SELECT {RESULT_COLUMNS}
+            FROM (
+                SELECT * FROM customers
+                WHERE search_text LIKE %(pattern)s AND deleted_at IS NULL
+                ORDER BY search_text <<-> %(query)s
+                LIMIT %(limit)s
+            ) c
+            LEFT JOIN subscriber_last_seen s ON s.username = c.radius_username
+            ORDER BY c.search_text <<-> %(query)s
+        """, {'pattern': pattern, 'query': query, 'limit': limit})
+        collect(cur.fetchall(), 'substring')
+
+    # Fuzzy (typo tolerant) matches fill the remaining slots
+    if len(results) < limit:
+        cur.execute(f"""
+            SELECT {RESULT_COLUMNS}
+            FROM (
+                SELECT * FROM customers
+                WHERE %(query)s <%% search_text AND deleted_at IS NULL
+                ORDER BY search_text <<-> %(query)s
+                LIMIT %(limit)s
+            ) c
+            LEFT JOIN subscriber_last_seen s ON s.username = c.radius_username
+            ORDER BY c.search_text <<-> %(query)s
+        """, {'query': query, 'limit': limit})
+        collect(cur.fetchall(), 'fuzzy')
+
+    return results
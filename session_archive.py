@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Session Archive
+Moves closed accounting sessions older than ARCHIVE_AFTER_DAYS out of radacct
+into Parquet files (partitioned by the month the session stopped, sorted by
+username, zstd-compressed) and answers the questions the old data is kept
+for: who had an IP address at a given time, a subscriber's usage and the
+traffic per NAS. Queries read only the columns they need and skip partitions
+and row groups whose min/max statistics cannot match, then filter and
+aggregate with Arrow compute and NumPy, so they stay off the live database.
+
+Each chunk is written to its files first; the files are then registered in
+session_archive_files and the rows deleted from radacct in one transaction,
+so an interrupted run leaves either both or an unregistered file, which the
+next run removes. Needs pyarrow and numpy (see requirements.txt).
+
+Usage:
+    python session_archive.py archive [--days 180]
+    python session_archive.py who-had 100.64.1.23 "2025-03-01 20:15"
+    python session_archive.py usage john.smith --start 2025-01-01 --end 2025-04-01
+    python session_archive.py nas-totals --start 2025-01-01 --end 2025-02-01
+"""
+
+import argparse
+import io
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+try:
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', '/var/lib/isp-radius/archive')
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '180'))
+CHUNK_ROWS = 100000          # sessions per file set and per delete transaction
+ROW_GROUP_ROWS = 65536
+CHUNK_PAUSE = 0.2            # seconds between chunks, lets accounting writes through
+ARCHIVE_LOCK_ID = 0x41524348
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS session_archive_files (
+    path TEXT PRIMARY KEY,
+    stop_month DATE NOT NULL,
+    sessions INTEGER NOT NULL,
+    bytes BIGINT NOT NULL,
+    min_radacctid BIGINT NOT NULL,
+    max_radacctid BIGINT NOT NULL,
+    min_stop TIMESTAMP with time zone NOT NULL,
+    max_stop TIMESTAMP with time zone NOT NULL,
+    created_at TIMESTAMP with time zone NOT NULL DEFAULT now()
+);
+"""
+
+# (column, Arrow type, SQL producing it); times travel as epoch microseconds
+COLUMNS = [
+    ('radacctid', 'int64', 'radacctid'),
+    ('username', 'string', 'username'),
+    ('acctsessionid', 'string', 'acctsessionid'),
+    ('acctuniqueid', 'string', 'acctuniqueid'),
+    ('nasipaddress', 'string', 'host(nasipaddress)'),
+    ('nasportid', 'string', 'nasportid'),
+    ('acctstarttime', 'timestamp', '(EXTRACT(EPOCH FROM acctstarttime) * 1000000)::bigint'),
+    ('acctstoptime', 'timestamp', '(EXTRACT(EPOCH FROM acctstoptime) * 1000000)::bigint'),
+    ('acctsessiontime', 'int64', 'acctsessiontime'),
+    ('acctinputoctets', 'int64', 'acctinputoctets'),
+    ('acctoutputoctets', 'int64', 'acctoutputoctets'),
+    ('callingstationid', 'string', 'callingstationid'),
+    ('calledstationid', 'string', 'calledstationid'),
+    ('framedipaddress', 'string', 'host(framedipaddress)'),
+    ('acctterminatecause', 'string', 'acctterminatecause'),
+]
+
+
+def _require_arrow():
+    if pa is None:
+        raise RuntimeError('The session archive needs pyarrow and numpy: pip install pyarrow numpy')
+
+
+def arrow_schema():
+    types = {'int64': pa.int64(), 'string': pa.string(), 'timestamp': pa.timestamp('us', tz='UTC')}
+    return pa.schema([(name, types[kind]) for name, kind, _ in COLUMNS])
+
+
+# Archiving
+
+def _fetch_chunk(conn, cutoff, after_id, upper_id, limit):
+    """Closed sessions older than cutoff with radacctid in (after_id, upper_id], as an Arrow table"""
+    select = ', '.join(sql for _, _, sql in COLUMNS)
+    query = conn.cursor().mogrify(f"""
+        SELECT {select} FROM radacct
+        WHERE radacctid > %s AND radacctid <= %s AND acctstoptime IS NOT NULL AND acctstoptime < %s
+        ORDER BY radacctid LIMIT %s
+    """, (after_id, upper_id, cutoff, limit)).decode()
+    buffer = io.BytesIO()
+    conn.cursor().copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv)", buffer)
+    buffer.seek(0)
+    read_types = {name: pa.int64() if kind == 'timestamp' else arrow_schema().field(name).type
+                  for name, kind, _ in COLUMNS}
+    table = pa_csv.read_csv(
+        buffer,
+        read_options=pa_csv.ReadOptions(column_names=[name for name, _, _ in COLUMNS]),
+        convert_options=pa_csv.ConvertOptions(column_types=read_types, strings_can_be_null=True,
+                                              quoted_strings_can_be_null=False),
+    )
+    for name, kind, _ in COLUMNS:
+        if kind == 'timestamp':
+            index = table.schema.get_field_index(name)
+            table = table.set_column(index, name, table[name].cast(pa.timestamp('us', tz='UTC')))
+    return table
+
+
+def _write_month(table, archive_dir, month, prefix):
+    """One Parquet file for a month of the chunk; returns its manifest row"""
+    table = table.sort_by([('username', 'ascending'), ('acctstoptime', 'ascending')])
+    directory = os.path.join(archive_dir, f'stop_month={month}')
+    os.makedirs(directory, exist_ok=True)
+    relative = os.path.join(f'stop_month={month}', f'{prefix}-{uuid.uuid4().hex[:12]}.parquet')
+    path = os.path.join(archive_dir, relative)
+    pq.write_table(table, path + '.tmp', row_group_size=ROW_GROUP_ROWS, compression='zstd',
+                   use_dictionary=['username', 'nasipaddress', 'acctterminatecause', 'calledstationid'])
+    with open(path + '.tmp', 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+    ids = table['radacctid']
+    stops = table['acctstoptime']
+    return (relative, f'{month}-01', table.num_rows, os.path.getsize(path), pc.min(ids).as_py(),
+            pc.max(ids).as_py(), pc.min(stops).as_py(), pc.max(stops).as_py())
+
+
+def remove_orphans(conn, archive_dir, prefix):
+    """Delete this database's files that never made it into the manifest (an interrupted run)"""
+    cur = conn.cursor()
+    cur.execute("SELECT path FROM session_archive_files")
+    known = {row[0] for row in cur.fetchall()}
+    conn.rollback()
+    removed = 0
+    if not os.path.isdir(archive_dir):
+        return removed
+    for month in os.listdir(archive_dir):
+        directory = os.path.join(archive_dir, month)
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            if not name.startswith(prefix + '-'):
+                continue
+            if name.endswith('.tmp') or os.path.join(month, name) not in known:
+                os.remove(os.path.join(directory, name))
+                removed += 1
+    return removed
+
+
+def archive(conn, archive_dir=ARCHIVE_DIR, days=ARCHIVE_AFTER_DAYS, chunk_rows=CHUNK_ROWS, prefix='main',
+            progress=print):
+    """Move closed sessions older than `days` into Parquet; returns a summary or None if locked
+
+    `prefix` names this database's files (the accounting shard).
+    """
+    _require_arrow()
+    started = time.monotonic()
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(%s)", (ARCHIVE_LOCK_ID,))
+    if not cur.fetchone()[0]:
+        conn.rollback()
+        return None
+    conn.commit()
+    summary = {'sessions': 0, 'files': 0, 'bytes': 0, 'orphans_removed': 0}
+    try:
+        summary['orphans_removed'] = remove_orphans(conn, archive_dir, prefix)
+        cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+        # Sessions stopped before the cutoff started before it too; radacct_start_time_idx finds the last id
+        cur.execute("SELECT MIN(radacctid), MAX(radacctid) FROM radacct WHERE acctstarttime < %s", (cutoff,))
+        low, upper_id = cur.fetchone()
+        conn.rollback()
+        if upper_id is None:
+            return dict(summary, seconds=round(time.monotonic() - started, 2))
+        after_id = low - 1
+        while after_id < upper_id:
+            table = _fetch_chunk(conn, cutoff, after_id, upper_id, chunk_rows)
+            conn.rollback()
+            if table.num_rows == 0:
+                break
+            after_id = pc.max(table['radacctid']).as_py()
+            months = pc.strftime(table['acctstoptime'], format='%Y-%m')
+            manifest = []
+            for month in pc.unique(months).to_pylist():
+                manifest.append(_write_month(table.filter(pc.equal(months, month)), archive_dir, month, prefix))
+            cur.executemany("""
+                INSERT INTO session_archive_files (path, stop_month, sessions, bytes, min_radacctid,
+                                                   max_radacctid, min_stop, max_stop)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, manifest)
+            cur.execute("DELETE FROM radacct WHERE radacctid = ANY(%s)", (table['radacctid'].to_pylist(),))
+            conn.commit()
+            summary['sessions'] += table.num_rows
+            summary['files'] += len(manifest)
+            summary['bytes'] += sum(row[3] for row in manifest)
+            progress(f"archived {summary['sessions']} sessions ({summary['bytes'] // 1048576} MB) "
+                     f"up to radacctid {after_id}")
+            if table.num_rows < chunk_rows:
+                break
+            time.sleep(CHUNK_PAUSE)
+    finally:
+        conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(%s)", (ARCHIVE_LOCK_ID,))
+        conn.commit()
+    summary['seconds'] = round(time.monotonic() - started, 2)
+    return summary
+
+
+# Queries
+
+def _utc(moment):
+    if isinstance(moment, str):
+        moment = datetime.fromisoformat(moment)
+    return moment if moment.tzinfo else moment.astimezone(timezone.utc)
+
+
+def _month(moment):
+    return moment.strftime('%Y-%m')
+
+
+class ArchiveQuery:
+    """Vectorized lookups over the archived sessions"""
+
+    def __init__(self, archive_dir=ARCHIVE_DIR):
+        _require_arrow()
+        self.archive_dir = archive_dir
+
+    def dataset(self):
+        """The archive as it is now (files added by later runs are picked up on the next call)"""
+        if not os.path.isdir(self.archive_dir):
+            return None
+        return ds.dataset(self.archive_dir, schema=arrow_schema().append(pa.field('stop_month', pa.string())),
+                          format='parquet', partitioning='hive', exclude_invalid_files=True)
+
+    def _scan(self, columns, condition):
+        dataset = self.dataset()
+        if dataset is None:
+            return pa.table({name: pa.array([], arrow_schema().field(name).type) for name in columns})
+        return dataset.to_table(columns=columns, filter=condition, use_threads=True)
+
+    @staticmethod
+    def _overlapping(start, end):
+        """Sessions that were running at some point in [start, end]"""
+        return ((ds.field('stop_month') >= _month(start)) & (ds.field('acctstoptime') >= pa.scalar(start))
+                & (ds.field('acctstarttime') <= pa.scalar(end)))
+
+    def who_had(self, ip, at):
+        """Sessions that had this framed IP at the moment `at` (normally one)"""
+        at = _utc(at)
+        table = self._scan(
+            ['username', 'framedipaddress', 'nasipaddress', 'acctsessionid', 'callingstationid',
+             'acctstarttime', 'acctstoptime'],
+            self._overlapping(at, at) & (ds.field('framedipaddress') == ip))
+        return table.sort_by([('acctstarttime', 'ascending')]).to_pylist()
+
+    def usage(self, username, start, end, bucket_seconds=86400):
+        """A subscriber's sessions in [start, end): totals and a per-bucket byte series
+
+        Traffic is counted in the bucket the session stopped in.
+        """
+        start, end = _utc(start), _utc(end)
+        table = self._scan(
+            ['acctstoptime', 'acctsessiontime', 'acctinputoctets', 'acctoutputoctets'],
+            self._overlapping(start, end) & (ds.field('username') == username)
+            & (ds.field('acctstoptime') < pa.scalar(end)))
+        upload = table['acctinputoctets'].fill_null(0).to_numpy()
+        download = table['acctoutputoctets'].fill_null(0).to_numpy()
+        stops = table['acctstoptime'].cast(pa.int64()).to_numpy() // 1000000
+        buckets = int((end - start).total_seconds() // bucket_seconds) + 1
+        index = np.clip((stops - int(start.timestamp())) // bucket_seconds, 0, buckets - 1)
+        series = np.bincount(index, weights=upload + download, minlength=buckets).astype(np.int64)
+        return {
+            'username': username,
+            'sessions': table.num_rows,
+            'input_octets': int(upload.sum()),
+            'output_octets': int(download.sum()),
+            'session_seconds': int(table['acctsessiontime'].fill_null(0).to_numpy().sum()),
+            'bucket_seconds': bucket_seconds,
+            'series': [(datetime.fromtimestamp(int(start.timestamp()) + i * bucket_seconds, timezone.utc), int(v))
+                       for i, v in enumerate(series) if v],
+        }
+
+    def nas_totals(self, start, end):
+        """Sessions, users and octets per NAS for sessions stopped in [start, end)"""
+        start, end = _utc(start), _utc(end)
+        table = self._scan(
+            ['nasipaddress', 'username', 'acctinputoctets', 'acctoutputoctets'],
+            (ds.field('stop_month') >= _month(start)) & (ds.field('stop_month') <= _month(end))
+            & (ds.field('acctstoptime') >= pa.scalar(start)) & (ds.field('acctstoptime') < pa.scalar(end)))
+        totals = table.group_by('nasipaddress').aggregate([
+            ('username', 'count'), ('username', 'count_distinct'),
+            ('acctinputoctets', 'sum'), ('acctoutputoctets', 'sum'),
+        ])
+        rows = [{'nasipaddress': row['nasipaddress'], 'sessions': row['username_count'],
+                 'users': row['username_count_distinct'], 'input_octets': row['acctinputoctets_sum'] or 0,
+                 'output_octets': row['acctoutputoctets_sum'] or 0} for row in totals.to_pylist()]
+        return sorted(rows, key=lambda row: row['input_octets'] + row['output_octets'], reverse=True)
+
+
+WHO_HAD_SQL = """
+    SELECT username, host(framedipaddress) AS framedipaddress, host(nasipaddress) AS nasipaddress,
+           acctsessionid, callingstationid, acctstarttime, acctstoptime
+    FROM radacct
+    WHERE framedipaddress = %(ip)s::inet AND acctstarttime <= %(at)s
+      AND (acctstoptime IS NULL OR acctstoptime >= %(at)s)
+    ORDER BY acctstarttime
+"""
+
+
+def who_had(ip, at, cur, router=None, archive_dir=ARCHIVE_DIR):
+    """Who had `ip` at `at`: radacct (every shard) plus the archive, if pyarrow is installed
+
+    Returns (sessions, archive_searched).
+    """
+    at = _utc(at)
+    params = {'ip': ip, 'at': at}
+    if router is not None and router.sharded:
+        columns, results, _ = router.scatter(WHO_HAD_SQL, params, cur.connection)
+        sessions = [dict(zip(columns, row)) for rows in results.values() for row in rows]
+    else:
+        cur.execute(WHO_HAD_SQL, params)
+        sessions = [dict(row) for row in cur.fetchall()]
+    searched = pa is not None and os.path.isdir(archive_dir)
+    if searched:
+        sessions += ArchiveQuery(archive_dir).who_had(ip, at)
+    return sorted(sessions, key=lambda row: row['acctstarttime']), searched
+
+
+def storage_stats(cur):
+    cur.execute("""
+        SELECT COUNT(*), COALESCE(SUM(sessions), 0), COALESCE(SUM(bytes), 0), MIN(min_stop), MAX(max_stop)
+        FROM session_archive_files
+    """)
+    files, sessions, size, oldest, newest = cur.fetchone()
+    return {'files': files, 'sessions': int(sessions), 'bytes': int(size), 'oldest_stop': oldest, 'newest_stop': newest}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive old accounting sessions to Parquet and query them')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG, every accounting shard)')
+    parser.add_argument('--dir', default=ARCHIVE_DIR, help='Archive directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('archive', help='Move old closed sessions out of radacct')
+    run.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS, help='Archive sessions stopped before this')
+    who = commands.add_parser('who-had', help='Who had an IP address at a given time')
+    who.add_argument('ip')
+    who.add_argument('at', help='ISO time, e.g. "2025-03-01 20:15" (local time unless an offset is given)')
+    usage = commands.add_parser('usage', help="A subscriber's archived usage")
+    usage.add_argument('username')
+    usage.add_argument('--start', required=True)
+    usage.add_argument('--end', required=True)
+    totals = commands.add_parser('nas-totals', help='Traffic per NAS')
+    totals.add_argument('--start', required=True)
+    totals.add_argument('--end', required=True)
+    args = parser.parse_args()
+
+    if args.command == 'archive':
+        if args.dsn:
+            databases = {'main': lambda: psycopg2.connect(args.dsn)}
+        else:
+            import acct_shards
+            router = acct_shards.default_router()
+            databases = {name: (lambda name=name: router.connect(name)) for name in router.shards}
+        for name, connect in databases.items():
+            conn = connect()
+            try:
+                summary = archive(conn, args.dir, args.days, prefix=name)
+            finally:
+                conn.close()
+            print(f"{name}: {'another archive run is in progress' if summary is None else summary}")
+        return
+
+    query = ArchiveQuery(args.dir)
+    if args.command == 'who-had':
+        for row in query.who_had(args.ip, args.at):
+            print(f"{row['username']} {row['framedipaddress']} via {row['nasipaddress']} "
+                  f"({row['callingstationid']}) {row['acctstarttime']} .. {row['acctstoptime']}")
+    elif args.command == 'usage':
+        result = query.usage(args.username, args.start, args.end)
+        print(f"{result['username']}: {result['sessions']} sessions, {result['input_octets']} bytes up, "
+              f"{result['output_octets']} bytes down")
+        for day, total in result['series']:
+            print(f"  {day.date()} {total}")
+    else:
+        for row in query.nas_totals(args.start, args.end):
+            print(f"{row['nasipaddress']}: {row['sessions']} sessions, {row['users']} users, "
+                  f"{row['input_octets']} up, {row['output_octets']} down")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Simultaneous-Use Limits
+Counts each user's open sessions in memory so the RADIUS REST backend can
+enforce Simultaneous-Use without counting radacct rows per Access-Request.
+The counts follow accounting starts, interim updates and stops from the
+radius_acct channel (on every accounting shard) and are reconciled against
+the open sessions in radacct every few minutes and after a reconnect. A
+session that missed STALE_MULTIPLIER interim updates no longer counts, so a
+NAS that rebooted without an Accounting-Off does not lock its users out
+until the reaper closes their sessions.
+
+The limit is the user's Simultaneous-Use check item (radcheck or
+radgroupcheck) when there is one, otherwise service_profiles.simultaneous_use
+of the user's profile; NULL means unlimited. A login that passes the check
+reserves its slot in the same step and counts as a session until its
+Accounting-Start arrives (at most PENDING_TTL seconds) or it is rejected, so
+two logins sent at once cannot both take the last free slot.
+
+Usage:
+    python db_schema.py --part acct_events --part session_limits
+    python session_limits.py                 # users over their limit, from radacct
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import psycopg2
+
+import acct_events
+import acct_shards
+from db_routing import connection_params
+from pg_listen import start_listener
+from session_reaper import DEFAULT_INTERIM, LAST_SEEN, MIN_INTERIM, STALE_MULTIPLIER
+
+LIMITS_CHANNEL = 'radius_session_limits'
+RECONCILE_INTERVAL = int(os.environ.get('SESSION_LIMITS_RECONCILE_INTERVAL', '300'))
+PENDING_TTL = float(os.environ.get('SESSION_LIMITS_PENDING_TTL', '30'))   # seconds from Access-Accept to Start
+PURGE_INTERVAL = 30
+ATTRIBUTE = 'Simultaneous-Use'
+
+SESSION_LIMITS_SCHEMA = f"""
+ALTER TABLE service_profiles ADD COLUMN IF NOT EXISTS simultaneous_use INTEGER
+    CHECK (simultaneous_use > 0);
+
+CREATE OR REPLACE FUNCTION session_limits_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{LIMITS_CHANNEL}', 'reload');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS service_profiles_limits_notify_trg ON service_profiles;
+CREATE TRIGGER service_profiles_limits_notify_trg AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON service_profiles
+    FOR EACH STATEMENT EXECUTE FUNCTION session_limits_notify();
+"""
+
+OPEN_SESSIONS_SQL = f"""
+    SELECT username, host(nasipaddress), acctsessionid, callingstationid,
+           EXTRACT(EPOCH FROM {LAST_SEEN})::float8, acctinterval
+    FROM radacct
+    WHERE acctstoptime IS NULL
+"""
+
+
+def stale_after(interval):
+    """Seconds without an update before a session stops counting (the reaper's rule)"""
+    return STALE_MULTIPLIER * max(interval or DEFAULT_INTERIM, MIN_INTERIM)
+
+
+class Session:
+    __slots__ = ('callingstationid', 'seen', 'stale_after', 'applied')
+
+    def __init__(self, callingstationid, seen, interval, applied):
+        self.callingstationid = callingstationid or ''
+        self.seen = seen
+        self.stale_after = stale_after(interval)
+        self.applied = applied
+
+
+class SessionCounter:
+    """username -> {(nas ip, session id): Session} for the open sessions, plus the profile limits"""
+
+    def __init__(self):
+        self.sessions = {}
+        # username -> {callingstationid: accepted at}, until the Start arrives; logins without a
+        # Calling-Station-Id cannot be told apart and keep a list of accepted-at times under ''
+        self.pending = {}
+        self.profile_limits = {}    # service profile -> simultaneous_use
+        self._stops = None          # sessions stopped while a reconcile query runs
+        self._lock = threading.Lock()
+        self._resync = threading.Event()
+        self.ready = threading.Event()
+        self.stats = {'checks': 0, 'rejects': 0, 'starts': 0, 'stops': 0, 'adopted': 0,
+                      'reconciled_added': 0, 'reconciled_removed': 0, 'reconciled_at': None}
+
+    # Loading and reconciliation
+
+    def load_limits(self, conn):
+        cur = conn.cursor()
+        cur.execute("SELECT name, simultaneous_use FROM service_profiles WHERE simultaneous_use IS NOT NULL")
+        self.profile_limits = dict(cur.fetchall())
+        conn.rollback()
+
+    def reconcile(self, conn, router=None):
+        """Replace the counts with the open sessions in radacct; returns what was corrected
+
+        Sessions started or stopped by events that arrived while the query
+        ran are kept as the events left them.
+        """
+        checked_at = time.time()
+        with self._lock:
+            self._stops = set()
+        try:
+            if router is not None and router.sharded:
+                _, results, errors = router.scatter(OPEN_SESSIONS_SQL, None, conn)
+                rows = [row for shard_rows in results.values() for row in shard_rows]
+            else:
+                cur = conn.cursor()
+                cur.execute(OPEN_SESSIONS_SQL)
+                rows, errors = cur.fetchall(), {}
+                conn.rollback()
+        except BaseException:
+            with self._lock:
+                self._stops = None
+            raise
+        now = time.time()
+        with self._lock:
+            sessions = {}
+            for username, nasip, sessionid, callingstationid, seen, interval in rows:
+                key = (nasip, sessionid)
+                if key not in self._stops:
+                    sessions.setdefault(username, {})[key] = Session(callingstationid, seen, interval, now)
+            added = sum(len(user_sessions.keys() - self.sessions.get(username, {}).keys())
+                        for username, user_sessions in sessions.items())
+            removed = 0
+            for username, user_sessions in self.sessions.items():
+                live = sessions.get(username, {})
+                for key, session in user_sessions.items():
+                    if key in live:
+                        if session.applied >= checked_at:
+                            live[key] = session
+                        continue
+                    # Too recent for the query, or on a shard that did not answer
+                    if session.applied >= checked_at or errors:
+                        sessions.setdefault(username, {})[key] = session
+                    else:
+                        removed += 1
+            self.sessions = sessions
+            self._stops = None
+        self.stats['reconciled_added'] += added
+        self.stats['reconciled_removed'] += removed
+        self.stats['reconciled_at'] = now
+        self.ready.set()
+        return {'sessions': len(rows), 'added': added, 'removed': removed, 'unavailable': sorted(errors)}
+
+    def apply_accounting(self, events):
+        """Add or refresh sessions on start/interim, drop them on stop"""
+        now = time.time()
+        with self._lock:
+            for event in events:
+                username = event.get('username')
+                if not username:
+                    continue
+                key = (event.get('nasip'), event.get('sessionid'))
+                user_sessions = self.sessions.get(username)
+                if event['event'] == 'stop':
+                    if self._stops is not None:
+                        self._stops.add(key)
+                    if user_sessions is not None and user_sessions.pop(key, None) is not None:
+                        self.stats['stops'] += 1
+                        if not user_sessions:
+                            del self.sessions[username]
+                    continue
+                session = user_sessions.get(key) if user_sessions is not None else None
+                if session is None:
+                    if event['event'] == 'start':
+                        self.stats['starts'] += 1
+                    else:
+                        self.stats['adopted'] += 1
+                    self.sessions.setdefault(username, {})[key] = Session(
+                        event.get('callingstationid'), event.get('ts') or now, event.get('interval'), now)
+                    self._clear_pending(username, event.get('callingstationid') or '')
+                else:
+                    session.seen = event.get('ts') or now
+                    session.applied = now
+                    if event.get('interval'):
+                        session.stale_after = stale_after(event['interval'])
+
+    def _clear_pending(self, username, callingstationid):
+        stations = self.pending.get(username)
+        if stations is None:
+            return
+        if callingstationid:
+            stations.pop(callingstationid, None)
+        elif stations.get(''):
+            # Any anonymous reservation will do, the oldest goes first
+            del stations[''][0]
+            if not stations['']:
+                del stations['']
+        if not stations:
+            del self.pending[username]
+
+    def purge_pending(self):
+        """Forget accepted logins whose Accounting-Start never came"""
+        cutoff = time.time() - PENDING_TTL
+        expired = 0
+        with self._lock:
+            for username in list(self.pending):
+                stations = self.pending[username]
+                anonymous = stations.pop('', [])
+                for station in [station for station, accepted in stations.items() if accepted < cutoff]:
+                    del stations[station]
+                    expired += 1
+                kept = [accepted for accepted in anonymous if accepted >= cutoff]
+                expired += len(anonymous) - len(kept)
+                if kept:
+                    stations[''] = kept
+                if not stations:
+                    del self.pending[username]
+        return expired
+
+    # Auth path
+
+    def limit(self, control, groups):
+        """Simultaneous-Use from the control items, else the strictest limit of the user's profiles"""
+        for attribute, _, value in control:
+            if attribute == ATTRIBUTE:
+                try:
+                    return int(value)
+                except ValueError:
+                    break
+        limits = [self.profile_limits[group] for group in groups if group in self.profile_limits]
+        return min(limits) if limits else None
+
+    def active(self, username, callingstationid='', now=None):
+        """Sessions counting against the user's limit; a device reconnecting replaces its own session"""
+        with self._lock:
+            return self._active(username, callingstationid, now)
+
+    def _active(self, username, callingstationid='', now=None):
+        # Caller holds _lock
+        now = now or time.time()
+        callingstationid = callingstationid or ''
+        count = 0
+        for session in self.sessions.get(username, {}).values():
+            if now - session.seen < session.stale_after and \
+                    not (callingstationid and session.callingstationid == callingstationid):
+                count += 1
+        for station, accepted in self.pending.get(username, {}).items():
+            if not station:
+                count += sum(1 for at in accepted if now - at < PENDING_TTL)
+            elif station != callingstationid and now - accepted < PENDING_TTL:
+                count += 1
+        return count
+
+    def check_and_reserve(self, username, limit, callingstationid=''):
+        """True and a reserved slot when another session is within the limit (None is unlimited)
+
+        The count and the reservation happen under one lock, so concurrent
+        logins cannot both take the last slot. The reservation lasts until the
+        Accounting-Start arrives, release() is called or PENDING_TTL passes.
+        """
+        self.stats['checks'] += 1
+        if limit is None:
+            return True
+        with self._lock:
+            if self._active(username, callingstationid) >= limit:
+                self.stats['rejects'] += 1
+                return False
+            stations = self.pending.setdefault(username, {})
+            if callingstationid:
+                stations[callingstationid] = time.time()
+            else:
+                stations.setdefault('', []).append(time.time())
+        return True
+
+    def release(self, username, callingstationid=''):
+        """Drop the reservation of a login that was rejected after all"""
+        with self._lock:
+            self._clear_pending(username, callingstationid or '')
+
+    # Service
+
+    def start(self, connect, router=None):
+        """Load the limits and counts and keep them current from accounting and profile changes"""
+        def on_notify(conn, batch):
+            if any(channel == LIMITS_CHANNEL for channel, _ in batch):
+                self.load_limits(conn)
+            events = acct_events.parse_events(batch)
+            if events:
+                self.apply_accounting(events)
+
+        def on_connect(conn):
+            self.load_limits(conn)
+            self.reconcile(conn, router)
+
+        # Runs after every (re)connect, so sessions missed while disconnected are reconciled
+        start_listener(connect, [acct_events.CHANNEL, LIMITS_CHANNEL], on_notify,
+                       on_connect=on_connect, name='session-limits')
+        # Other accounting shards only publish their sessions; a reconnect there asks for a reconcile
+        if router is not None and router.sharded:
+            for shard in router.shards:
+                if shard == acct_shards.PRIMARY_SHARD:
+                    continue
+                start_listener(lambda shard=shard: router.connect(shard), [acct_events.CHANNEL],
+                               lambda conn, batch: self.apply_accounting(acct_events.parse_events(batch)),
+                               on_connect=lambda conn: self._resync.set(), name=f'session-limits-{shard}')
+
+        def maintain():
+            conn = None
+            last_reconcile = time.monotonic()
+            while True:
+                resync = self._resync.wait(PURGE_INTERVAL)
+                self.purge_pending()
+                if not self.ready.is_set() or \
+                        not resync and time.monotonic() - last_reconcile < RECONCILE_INTERVAL:
+                    continue
+                self._resync.clear()
+                try:
+                    if conn is None or conn.closed:
+                        conn = connect()
+                    result = self.reconcile(conn, router)
+                    if result['added'] or result['removed']:
+                        print(f"Session count reconciliation: {result}")
+                    last_reconcile = time.monotonic()
+                except psycopg2.Error as e:
+                    print(f"Session count reconciliation failed: {e}")
+                    if conn is not None:
+                        conn.close()
+                    conn = None
+
+        threading.Thread(target=maintain, name='session-limits-reconcile', daemon=True).start()
+
+    def summary(self):
+        with self._lock:
+            now = time.time()
+            open_sessions = sum(len(user_sessions) for user_sessions in self.sessions.values())
+            stale = sum(1 for user_sessions in self.sessions.values() for session in user_sessions.values()
+                        if now - session.seen >= session.stale_after)
+            pending = sum(1 if station else len(accepted) for stations in self.pending.values()
+                          for station, accepted in stations.items())
+        return dict(self.stats, users=len(self.sessions), sessions=open_sessions, stale=stale,
+                    pending=pending, profile_limits=self.profile_limits, ready=self.ready.is_set())
+
+
+def over_limit(cur, router=None):
+    """Users with more open sessions in radacct than their Simultaneous-Use, for a one-off check"""
+    cur.execute("SELECT name, simultaneous_use FROM service_profiles WHERE simultaneous_use IS NOT NULL")
+    profile_limits = dict(cur.fetchall())
+    cur.execute(f"SELECT username, value FROM radcheck WHERE attribute = '{ATTRIBUTE}'")
+    user_limits = {username: int(value) for username, value in cur.fetchall() if value.strip().isdigit()}
+    cur.execute("SELECT username, groupname FROM radusergroup WHERE groupname = ANY(%s)", (list(profile_limits),))
+    for username, groupname in cur.fetchall():
+        limit = profile_limits[groupname]
+        user_limits.setdefault(username, limit)
+    sql = "SELECT username, COUNT(*) FROM radacct WHERE acctstoptime IS NULL GROUP BY username"
+    counts = {}
+    if router is not None and router.sharded:
+        _, results, _ = router.scatter(sql, None, cur.connection)
+        rows = [row for shard_rows in results.values() for row in shard_rows]
+    else:
+        cur.execute(sql)
+        rows = cur.fetchall()
+    for username, count in rows:
+        counts[username] = counts.get(username, 0) + count
+    return sorted(((username, count, user_limits[username]) for username, count in counts.items()
+                   if username in user_limits and count > user_limits[username]),
+                  key=lambda row: row[2] - row[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List users with more open sessions than their Simultaneous-Use')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    args = parser.parse_args()
+
+    if args.dsn:
+        config = {'dsn': args.dsn}
+    else:
+        from app import DB_CONFIG
+        config = DB_CONFIG
+    router = acct_shards.ShardRouter(config)
+    conn = psycopg2.connect(**connection_params(config))
+    try:
+        rows = over_limit(conn.cursor(), router)
+    finally:
+        conn.close()
+    for username, count, limit in rows:
+        print(f"{username:32} {count:4} open sessions, limit {limit}")
+    print(f"{len(rows)} users over their limit")
+
+
+if __name__ == '__main__':
+    main()
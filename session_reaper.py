@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Stale Session Reaper
+Closes radacct sessions left open by a NAS that died or rebooted without an
+Accounting-Off. A session is stale when no interim update arrived for
+STALE_MULTIPLIER times its interim interval. A NAS whose open sessions are
+all stale is closed with one statement; other stale sessions are closed
+in small batches through a partial index on the open sessions, so a sweep
+never holds many row locks. Every close is recorded in session_reaper_log.
+With accounting shards (acct_shards.py) every shard is swept in turn.
+
+Usage:
+    python session_reaper.py                      # sweep every REAPER_INTERVAL seconds
+    python session_reaper.py --once --dry-run     # report what would be closed
+    python session_reaper.py --reset-nas 10.0.0.1 # Accounting-On/Off for one NAS
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extras
+
+REAPER_INTERVAL = int(os.environ.get('REAPER_INTERVAL', '60'))
+# Missed interims before a session is stale; intervals for sessions without Acct-Interim-Interval
+STALE_MULTIPLIER = float(os.environ.get('REAPER_STALE_MULTIPLIER', '3'))
+DEFAULT_INTERIM = int(os.environ.get('REAPER_DEFAULT_INTERIM', '300'))
+MIN_INTERIM = 60
+BATCH_SIZE = 1000
+BATCH_PAUSE = 0.05             # seconds between batches, lets accounting writes through
+REAPER_LOCK_ID = 0x52454150    # only one reaper sweeps at a time
+
+# Last sign of life of an open session
+LAST_SEEN = "COALESCE(acctupdatetime, acctstarttime)"
+
+REAPER_SCHEMA = f"""
+CREATE INDEX IF NOT EXISTS radacct_open_seen_idx ON radacct (({LAST_SEEN}))
+    WHERE acctstoptime IS NULL;
+CREATE INDEX IF NOT EXISTS radacct_open_nas_idx ON radacct (nasipaddress, ({LAST_SEEN}))
+    WHERE acctstoptime IS NULL;
+
+CREATE TABLE IF NOT EXISTS session_reaper_log (
+    id BIGSERIAL PRIMARY KEY,
+    closed_at TIMESTAMP with time zone NOT NULL DEFAULT now(),
+    nasipaddress INET NOT NULL,
+    cause VARCHAR(32) NOT NULL,
+    -- 'nas' when every open session of the NAS was closed at once
+    scope VARCHAR(8) NOT NULL,
+    sessions INTEGER NOT NULL,
+    oldest_seen TIMESTAMP with time zone,
+    newest_seen TIMESTAMP with time zone
+);
+CREATE INDEX IF NOT EXISTS session_reaper_log_closed_idx ON session_reaper_log (closed_at DESC);
+"""
+
+# Per-session staleness; the first condition is the index range, the second the exact test
+STALE_CONDITION = f"""
+    acctstoptime IS NULL
+    AND {LAST_SEEN} < now() - make_interval(secs => %(multiplier)s * %(min_interim)s)
+    AND {LAST_SEEN} < now() - make_interval(secs => %(multiplier)s *
+        GREATEST(COALESCE(NULLIF(acctinterval, 0), %(default_interim)s), %(min_interim)s))
+"""
+
+CLOSE_SET = f"""
+    acctstoptime = {LAST_SEEN},
+    acctsessiontime = GREATEST(EXTRACT(EPOCH FROM {LAST_SEEN} - acctstarttime), 0)::bigint,
+    acctterminatecause = %(cause)s
+"""
+
+
+def _params(cause='Stale-Session'):
+    return {'multiplier': STALE_MULTIPLIER, 'min_interim': MIN_INTERIM,
+            'default_interim': DEFAULT_INTERIM, 'cause': cause}
+
+
+def _log(cur, rows, scope, cause):
+    """rows: [(nasip, sessions, oldest, newest), ...]"""
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO session_reaper_log (nasipaddress, cause, scope, sessions, oldest_seen, newest_seen)
+        VALUES %s
+    """, [(nasip, cause, scope, sessions, oldest, newest) for nasip, sessions, oldest, newest in rows],
+        template='(%s::inet, %s, %s, %s, %s, %s)')
+
+
+def dead_nas(cur):
+    """NAS with stale sessions and no open session that is still updated"""
+    cur.execute(f"""
+        SELECT host(nasipaddress), COUNT(*), MIN({LAST_SEEN}), MAX({LAST_SEEN})
+        FROM radacct
+        WHERE acctstoptime IS NULL
+          AND nasipaddress IN (SELECT DISTINCT nasipaddress FROM radacct WHERE {STALE_CONDITION})
+        GROUP BY nasipaddress
+        HAVING bool_and({LAST_SEEN} < now() - make_interval(secs => %(multiplier)s *
+            GREATEST(COALESCE(NULLIF(acctinterval, 0), %(default_interim)s), %(min_interim)s)))
+    """, _params())
+    return cur.fetchall()
+
+
+def close_nas(conn, nas_ip, cause='Stale-Session', before=None):
+    """Close the stale sessions of one NAS in one statement, or with `before` every session started by then"""
+    cur = conn.cursor()
+    params = dict(_params(cause), nas=nas_ip, before=before)
+    if before is None:
+        set_clause, condition, scope = CLOSE_SET, STALE_CONDITION, 'nas'
+    else:
+        # Accounting-On/Off: the sessions ended when the NAS restarted, not at their last update
+        set_clause = """
+            acctstoptime = %(before)s,
+            acctsessiontime = GREATEST(EXTRACT(EPOCH FROM %(before)s - acctstarttime), 0)::bigint,
+            acctterminatecause = %(cause)s
+        """
+        condition, scope = "acctstoptime IS NULL AND acctstarttime <= %(before)s", 'reset'
+    cur.execute(f"""
+        WITH closed AS (
+            UPDATE radacct SET {set_clause}
+            WHERE nasipaddress = %(nas)s::inet AND {condition}
+            RETURNING {LAST_SEEN} AS seen
+        )
+        SELECT COUNT(*), MIN(seen), MAX(seen) FROM closed
+    """, params)
+    sessions, oldest, newest = cur.fetchone()
+    if sessions:
+        _log(cur, [(nas_ip, sessions, oldest, newest)], scope, cause)
+    conn.commit()
+    return sessions
+
+
+def reset_nas(conn, nas_ip, event_time=None, cause='NAS-Reboot'):
+    """Accounting-On/Off from a NAS: close all its sessions started before the event"""
+    return close_nas(conn, nas_ip, cause, before=event_time or datetime.now().astimezone())
+
+
+def close_stale_batch(conn, batch_size=BATCH_SIZE):
+    """Close up to batch_size stale sessions, oldest first; returns [(nasip, sessions, oldest, newest)]"""
+    cur = conn.cursor()
+    cur.execute(f"""
+        WITH stale AS (
+            SELECT radacctid FROM radacct
+            WHERE {STALE_CONDITION}
+            ORDER BY {LAST_SEEN}
+            LIMIT %(batch)s
+            FOR UPDATE SKIP LOCKED
+        ), closed AS (
+            UPDATE radacct r SET {CLOSE_SET}
+            FROM stale WHERE r.radacctid = stale.radacctid
+            RETURNING r.nasipaddress, COALESCE(r.acctupdatetime, r.acctstarttime) AS seen
+        )
+        SELECT host(nasipaddress), COUNT(*), MIN(seen), MAX(seen) FROM closed GROUP BY nasipaddress
+    """, dict(_params(), batch=batch_size))
+    rows = cur.fetchall()
+    if rows:
+        _log(cur, rows, 'session', 'Stale-Session')
+    conn.commit()
+    return rows
+
+
+def preview(cur):
+    """What a sweep would close, per NAS, without changing anything"""
+    cur.execute(f"""
+        SELECT host(nasipaddress), COUNT(*), MIN({LAST_SEEN}), MAX({LAST_SEEN})
+        FROM radacct WHERE {STALE_CONDITION}
+        GROUP BY nasipaddress ORDER BY COUNT(*) DESC
+    """, _params())
+    return cur.fetchall()
+
+
+def run_sweep(conn, batch_size=BATCH_SIZE):
+    """Close dead NAS at once, then stale sessions in batches; returns a report or None if locked"""
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(%s)", (REAPER_LOCK_ID,))
+    if not cur.fetchone()[0]:
+        conn.rollback()
+        return None
+    conn.commit()
+    started = time.monotonic()
+    report = {'nas': [], 'sessions': {}, 'batches': 0}
+    try:
+        for nas_ip, sessions, _, _ in dead_nas(cur):
+            closed = close_nas(conn, nas_ip)
+            if closed:
+                report['nas'].append((nas_ip, closed))
+        conn.commit()
+        while True:
+            rows = close_stale_batch(conn, batch_size)
+            if rows:
+                report['batches'] += 1
+            for nas_ip, sessions, _, _ in rows:
+                report['sessions'][nas_ip] = report['sessions'].get(nas_ip, 0) + sessions
+            if sum(row[1] for row in rows) < batch_size:
+                break
+            time.sleep(BATCH_PAUSE)
+    finally:
+        # A failed batch leaves the transaction aborted, and the unlock would fail with it
+        conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(%s)", (REAPER_LOCK_ID,))
+        conn.commit()
+    report['closed'] = sum(n for _, n in report['nas']) + sum(report['sessions'].values())
+    report['seconds'] = round(time.monotonic() - started, 2)
+    return report
+
+
+def recent_closes(cur, limit=100):
+    """session_reaper_log for the admin app, newest first"""
+    cur.execute("""
+        SELECT closed_at, host(nasipaddress) AS nasipaddress, cause, scope, sessions, oldest_seen, newest_seen
+        FROM session_reaper_log ORDER BY closed_at DESC LIMIT %s
+    """, (limit,))
+    return [dict(row) for row in cur.fetchall()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Close accounting sessions left open by dead NAS')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    parser.add_argument('--once', action='store_true', help='Run a single sweep and exit')
+    parser.add_argument('--interval', type=int, default=REAPER_INTERVAL, help='Seconds between sweeps')
+    parser.add_argument('--dry-run', action='store_true', help='Only report stale sessions per NAS')
+    parser.add_argument('--reset-nas', metavar='IP', help='Close all open sessions of this NAS and exit')
+    args = parser.parse_args()
+
+    if args.dsn:
+        router = None
+        shards = {'main': lambda: psycopg2.connect(args.dsn)}
+    else:
+        import acct_shards
+        router = acct_shards.default_router()
+        shards = {name: (lambda name=name: router.connect(name)) for name in router.shards}
+
+    if args.reset_nas:
+        conn = router.connect(router.shard_for(args.reset_nas)) if router else shards['main']()
+        print(f"Closed {reset_nas(conn, args.reset_nas)} sessions on {args.reset_nas}")
+        conn.close()
+        return
+    if args.dry_run:
+        for connect in shards.values():
+            conn = connect()
+            dead = {row[0] for row in dead_nas(conn.cursor())}
+            for nas_ip, sessions, oldest, newest in preview(conn.cursor()):
+                note = ' (whole NAS silent)' if nas_ip in dead else ''
+                print(f"{nas_ip}: {sessions} stale, last seen {oldest} .. {newest}{note}")
+            conn.close()
+        return
+
+    while True:
+        started = time.monotonic()
+        for shard, connect in shards.items():
+            prefix = f"{datetime.now().isoformat()}{f' [{shard}]' if len(shards) > 1 else ''}"
+            try:
+                conn = connect()
+                try:
+                    report = run_sweep(conn)
+                finally:
+                    conn.close()
+                if report is None:
+                    print(f"{prefix} another reaper is sweeping, skipped")
+                elif report['closed']:
+                    print(f"{prefix} closed {report['closed']} stale sessions in {report['seconds']}s")
+                    for nas_ip, sessions in report['nas']:
+                        print(f"  {nas_ip}: all {sessions} open sessions (NAS silent)")
+                    for nas_ip, sessions in sorted(report['sessions'].items(), key=lambda item: -item[1]):
+                        print(f"  {nas_ip}: {sessions}")
+            except psycopg2.Error as e:
+                print(f"Session reaper database error{f' on {shard}' if len(shards) > 1 else ''}: {e}")
+        if args.once:
+            break
+        time.sleep(max(0, args.interval - (time.monotonic() - started)))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,7 @@ ISP RADIUS Management System - Flask Deployment Wrapper
 This Flask app serves the PHP admin interface for permanent deployment
 """
 
-from flask import Flask, render_template_string, request, jsonify, redirect
+from flask import Flask, render_template_string, request, jsonify, redirect, g, send_file, Response
 import psycopg2
 import psycopg2.extras
 import os
@@ -12,26 +12,124 @@ import json
 from datetime import datetime, timedelta
 import random
 import string
+import threading
+import time
+
+import acct_shards
+import admission
+import api_capture
+import deprovision
+import dunning
+import auth_guard
+import invoice_documents
+import bandwidth_scheduler
+import ip_pool
+import jobs
+import json_response
+import nas_monitor
+import payments
+import rating
+import reports
+import session_archive
+import session_reaper
+import tracing
+import usage_store
+from db_routing import DatabaseRouter, READ_ONLY_ACTIONS, LSN_COOKIE, LSN_COOKIE_MAX_AGE
+from search import search_subscribers
 
 app = Flask(__name__)
 
-# Database configuration
+# Database configuration (the primary). Read-only actions are spread over the
+# streaming replicas listed here or in DB_REPLICA_DSNS; replica dicts inherit
+# any keys they leave out from the primary. Accounting (radacct) may be split
+# over the shards listed in acct_shards or ACCT_SHARD_DSNS (see acct_shards.py).
 DB_CONFIG = {
     'host': 'localhost',
     'database': 'radiusdb',
     'user': 'radiususer',
-    'password': 'radius2024'
+    'password': 'radius2024',
+    'replicas': [
+        # {'host': 'replica1.example.net'},
+    ],
+    'acct_shards': {
+        # 'north': {'host': 'acct-north.example.net'},
+    },
 }
 
-def get_db_connection():
-    """Get database connection"""
+db_router = DatabaseRouter(DB_CONFIG)
+acct_router = acct_shards.ShardRouter(DB_CONFIG)
+admission_control = admission.AdmissionController()
+api_capture_log = api_capture.CaptureLog() if api_capture.enabled() else None
+
+def get_db_connection(read_only=False, min_lsn=None):
+    """Get database connection (a replica for read-only work when one is fresh enough)"""
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
+        if read_only and db_router.has_replicas:
+            conn, g.db_route = db_router.connect_for_read(min_lsn)
+        else:
+            conn = db_router.connect_primary()
         return conn
     except Exception as e:
         print(f"Database connection error: {e}")
         return None
 
+@app.before_request
+def start_request_trace():
+    """Root span of the request's trace (tracing.py); SQL and RADIUS spans attach to it"""
+    g.trace = tracing.start_trace(f"{request.method} {request.path}", request.headers.get('traceparent'),
+                                  **{'http.action': (request.view_args or {}).get('action')})
+
+@app.before_request
+def start_api_capture():
+    """Opt-in recording of API calls for replay (api_capture.py, API_CAPTURE_FILE)"""
+    if api_capture_log is not None and request.path.startswith('/api/') and api_capture_log.wanted():
+        g.capture_started = (time.time(), time.perf_counter())
+
+@app.after_request
+def record_api_capture(response):
+    if g.get('capture_started'):
+        started_at, started = g.capture_started
+        action = (request.view_args or {}).get('action', request.path.rsplit('/', 1)[-1])
+        api_capture_log.record(api_capture.build_entry(
+            action, request.form.to_dict(), request.files.keys(), action in READ_ONLY_ACTIONS,
+            started_at, time.perf_counter() - started, response))
+    return response
+
+@app.teardown_request
+def finish_request_trace(error=None):
+    tracing.finish_trace(g.pop('trace', None), error)
+
+@app.after_request
+def set_read_your_writes_cookie(response):
+    """Remember the WAL position of this client's last write so its reads wait for it"""
+    if g.get('db_lsn'):
+        response.set_cookie(LSN_COOKIE, g.db_lsn, max_age=LSN_COOKIE_MAX_AGE, httponly=True, samesite='Lax')
+    if g.get('db_route'):
+        response.headers['X-DB-Route'] = g.db_route
+    if g.get('trace') is not None:
+        g.trace.set('http.status', response.status_code)
+        response.headers['X-Trace-Id'] = g.trace.trace.trace_id
+    return response
+
+_refresher_lock = threading.Lock()
+_refresher_started = False
+
+@app.before_request
+def start_report_refresher():
+    """Keep report snapshots fresh in the background, from the first request of each worker
+
+    Not at import time: the command line tools and job workers import DB_CONFIG
+    from this module and must not start refreshing too.
+    """
+    global _refresher_started
+    if _refresher_started:
+        return
+    with _refresher_lock:
+        if not _refresher_started:
+            reports.start_refresher(get_db_connection,
+                                    after_refresh=acct_router.refresh_reports if acct_router.sharded else None)
+            _refresher_started = True
+
 def generate_customer_id():
     """Generate unique customer ID"""
     return f"CUST{random.randint(1000, 9999)}"
@@ -45,10 +143,17 @@ def index():
     """Main admin dashboard"""
     return render_template_string(ADMIN_TEMPLATE)
 
+@app.route('/api/admission_stats')
+def admission_stats():
+    """Queue depth, running and shed counts of every worker, for tuning the admission limits"""
+    return jsonify({'success': True, **admission.all_stats(admission_control)})
+
 @app.route('/api/<action>', methods=['POST'])
+@admission_control.admit
 def api_handler(action):
     """Handle API requests"""
-    conn = get_db_connection()
+    read_only = action in READ_ONLY_ACTIONS
+    conn = get_db_connection(read_only, request.cookies.get(LSN_COOKIE))
     if not conn:
         return jsonify({'success': False, 'message': 'Database connection failed'})
     
@@ -62,11 +167,12 @@ def api_handler(action):
             
             # Insert customer
             cur.execute("""
-                INSERT INTO customers (customer_id, first_name, last_name, email, phone, address, service_profile, status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, 'active')
+                INSERT INTO customers (customer_id, first_name, last_name, email, phone, address, service_profile, status,
+                                       radius_username)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, 'active', %s)
             """, (customer_id, request.form['first_name'], request.form['last_name'], 
                   request.form['email'], request.form['phone'], request.form['address'], 
-                  request.form['service_profile']))
+                  request.form['service_profile'], username))
             
             # Insert RADIUS user
             cur.execute("""
@@ -92,35 +198,65 @@ def api_handler(action):
             """, (customer_id, invoice_number, price, due_date.date()))
             
             conn.commit()
+            reports.mark_changed()
             return jsonify({'success': True, 'message': 'Customer added successfully!', 'username': username})
             
         elif action == 'get_users':
-            cur.execute("""
-                SELECT c.*, sp.price 
+            # Large lists are encoded straight from tuples (see json_response)
+            rows = json_response.tuple_cursor(conn)
+            rows.execute("""
+                SELECT c.customer_id, c.first_name, c.last_name, c.email, c.phone, c.address,
+                       c.service_profile, c.status, c.created_at, c.updated_at, sp.price
                 FROM customers c 
                 LEFT JOIN service_profiles sp ON c.service_profile = sp.name 
+                WHERE c.deleted_at IS NULL
                 ORDER BY c.created_at DESC
             """)
-            users = cur.fetchall()
-            return jsonify({'success': True, 'users': [dict(user) for user in users]})
-            
-        elif action == 'delete_user':
-            customer_id = request.form['customer_id']
+            return json_response.rows_response(rows, 'users', json_response.wants_columnar())
             
-            # Get username
-            cur.execute("SELECT first_name, last_name FROM customers WHERE customer_id = %s", (customer_id,))
-            customer = cur.fetchone()
-            username = f"{customer['first_name'].lower()}.{customer['last_name'].lower()}"
+        elif action == 'get_online_users':
+            # Open accounting sessions, newest first
+            limit = int(request.form.get('limit', 100000))
+            if acct_router.sharded:
+                columns, rows, unavailable = acct_router.online_users(conn, limit)
+                return json_response.list_response(columns, rows, 'online_users', json_response.wants_columnar(),
+                                                   {'unavailable_shards': unavailable})
+            rows = json_response.tuple_cursor(conn)
+            rows.execute("""
+                SELECT radacctid, username, host(nasipaddress) AS nasipaddress, acctsessionid, acctstarttime,
+                       host(framedipaddress) AS framedipaddress, callingstationid,
+                       acctinputoctets, acctoutputoctets
+                FROM radacct 
+                WHERE acctstoptime IS NULL 
+                ORDER BY acctstarttime DESC
+                LIMIT %s
+            """, (limit,))
+            return json_response.rows_response(rows, 'online_users', json_response.wants_columnar())
             
-            # Delete from all tables
-            cur.execute("DELETE FROM customers WHERE customer_id = %s", (customer_id,))
-            cur.execute("DELETE FROM radcheck WHERE username = %s", (username,))
-            cur.execute("DELETE FROM radusergroup WHERE username = %s", (username,))
-            cur.execute("DELETE FROM billing WHERE customer_id = %s", (customer_id,))
+        elif action == 'search_users':
+            # Typeahead search across name, email, phone, IDs and last seen IP/MAC
+            results = search_subscribers(cur, request.form.get('q', ''), request.form.get('limit', 20))
+            return jsonify({'success': True, 'users': results})
             
-            conn.commit()
+        elif action == 'delete_user':
+            # Logins are rejected at once; the rows are purged by a background job
+            summary = deprovision.deprovision_customers(conn, [request.form['customer_id']])
+            if not summary['deleted']:
+                return jsonify({'success': False, 'message': 'Customer not found'})
+            reports.mark_changed()
             return jsonify({'success': True, 'message': 'Customer deleted successfully!'})
             
+        elif action == 'deprovision_users':
+            # Many customers at once: customer_ids repeated, or separated by commas/whitespace
+            customer_ids = [customer_id for value in request.form.getlist('customer_ids')
+                            for customer_id in value.replace(',', ' ').split()]
+            if not customer_ids:
+                return jsonify({'success': False, 'message': 'customer_ids is required'})
+            summary = deprovision.deprovision_customers(conn, customer_ids)
+            reports.mark_changed()
+            return jsonify({'success': True, 'message': f"{summary['deleted']} customers deprovisioned",
+                            **summary})
+            
         elif action == 'add_nas':
             cur.execute("""
                 INSERT INTO nas_devices (nas_name, nas_ip, nas_type, shared_secret, location)
@@ -132,17 +268,111 @@ def api_handler(action):
             return jsonify({'success': True, 'message': 'NAS device added successfully!'})
             
         elif action == 'get_nas':
-            cur.execute("SELECT * FROM nas_devices ORDER BY created_at DESC")
+            cur.execute("""
+                SELECT n.*, h.last_rtt_ms, h.last_checked
+                FROM nas_devices n
+                LEFT JOIN nas_health h ON h.nas_id = n.id
+                ORDER BY n.created_at DESC
+            """)
             nas_devices = cur.fetchall()
             return jsonify({'success': True, 'nas_devices': [dict(nas) for nas in nas_devices]})
             
+        elif action == 'get_ip_pools':
+            return jsonify({'success': True, 'pools': ip_pool.pool_usage(cur)})
+            
+        elif action == 'add_ip_pool':
+            # An address may belong to one pool only (ip_pools_no_overlap enforces it too)
+            first_address = request.form.get('first_address') or None
+            last_address = request.form.get('last_address') or None
+            problem = ip_pool.network_problem(request.form['network'], first_address, last_address)
+            if problem:
+                return jsonify({'success': False, 'message': problem})
+            overlapping = ip_pool.overlapping_pools(cur, request.form['network'], first_address, last_address)
+            if overlapping:
+                return jsonify({'success': False,
+                                'message': f"Addresses overlap IP pool {', '.join(overlapping)}"})
+            # The RADIUS REST backend reloads its pools on the change notification
+            cur.execute("""
+                INSERT INTO ip_pools (name, network, first_address, last_address, service_profile, nas_ip, lease_time)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, (request.form['name'], request.form['network'], first_address, last_address,
+                  request.form.get('service_profile') or None, request.form.get('nas_ip') or None,
+                  int(request.form.get('lease_time') or 3600)))
+            conn.commit()
+            return jsonify({'success': True, 'message': 'IP pool added successfully!'})
+            
+        elif action == 'get_nas_health':
+            # Results of the last probes stored by nas_monitor.py
+            nas_id = request.form.get('nas_id')
+            if nas_id:
+                history = nas_monitor.get_health(cur, int(nas_id), int(request.form.get('points', 60)))
+                return jsonify({'success': True, 'history': history})
+            return jsonify({'success': True, 'nas_health': nas_monitor.get_health(cur)})
+            
+        elif action == 'get_auth_blocks':
+            # Brute-force flags and blocks detected by the RADIUS REST backend
+            include_expired = request.form.get('include_expired') == '1'
+            return jsonify({'success': True, 'blocks': auth_guard.list_blocks(cur, include_expired)})
+            
+        elif action == 'delete_auth_block':
+            # The backend lifts the block on the change notification
+            cur.execute("DELETE FROM auth_blocks WHERE kind = %s AND value = %s",
+                        (request.form['kind'], request.form['value']))
+            conn.commit()
+            return jsonify({'success': True, 'message': 'Block removed'})
+            
+        elif action == 'get_usage_history':
+            # Per-interim traffic recorded by usage_store.py, summed into at most `points` buckets
+            end = datetime.fromisoformat(request.form['end']) if request.form.get('end') else datetime.now()
+            if request.form.get('start'):
+                start = datetime.fromisoformat(request.form['start'])
+            else:
+                start = end - timedelta(hours=int(request.form.get('hours', 24)))
+            bucket_seconds, series = usage_store.usage_history(
+                cur, request.form['username'], start, end, request.form.get('points', 300))
+            return jsonify({
+                'success': True,
+                'bucket_seconds': bucket_seconds,
+                'columns': ['time', 'input_octets', 'output_octets'],
+                'series': [[moment.isoformat(), rx, tx] for moment, rx, tx in series],
+            })
+            
+        elif action == 'get_reaper_log':
+            # Sessions closed by session_reaper.py (stale, silent NAS and manual resets)
+            if acct_router.sharded:
+                return jsonify({'success': True, 'closed': acct_router.reaper_log(conn)})
+            return jsonify({'success': True, 'closed': session_reaper.recent_closes(cur)})
+            
+        elif action == 'lookup_ip':
+            # Who had a framed IP at a given time, in radacct and the Parquet archive (session_archive.py)
+            sessions, archive_searched = session_archive.who_had(
+                request.form['ip'], request.form['at'], cur, acct_router)
+            return jsonify({
+                'success': True,
+                'sessions': [dict(row, acctstarttime=row['acctstarttime'].isoformat(),
+                                  acctstoptime=row['acctstoptime'] and row['acctstoptime'].isoformat())
+                             for row in sessions],
+                'archive_searched': archive_searched,
+            })
+            
+        elif action == 'reset_nas_sessions':
+            # Same as an Accounting-On from the NAS: close every session it has open
+            nas_ip = request.form['nas_ip']
+            with acct_router.nas_connection(nas_ip, conn) as shard_conn:
+                closed = session_reaper.reset_nas(shard_conn, nas_ip)
+            return jsonify({'success': True, 'message': f'Closed {closed} sessions'})
+            
+        elif action == 'get_acct_shards':
+            # Accounting shards: sessions on each and the NAS routing map
+            return jsonify({'success': True, **acct_router.status()})
+            
         elif action == 'get_stats':
             # Get total users
             cur.execute("SELECT COUNT(*) as count FROM customers WHERE status = 'active'")
             total_users = cur.fetchone()['count']
             
-            # Get online users (simulated)
-            online_users = random.randint(0, total_users)
+            # Open sessions, summed over the accounting shards
+            online_users, unavailable_shards = acct_router.online_count(conn)
             
             # Get NAS count
             cur.execute("SELECT COUNT(*) as count FROM nas_devices WHERE status = 'active'")
@@ -165,29 +395,158 @@ def api_handler(action):
                     'online_users': online_users,
                     'nas_count': nas_count,
                     'monthly_revenue': f"{monthly_revenue:.2f}"
-                }
+                },
+                'unavailable_shards': unavailable_shards
             })
             
         elif action == 'get_billing':
-            cur.execute("""
+            rows = json_response.tuple_cursor(conn)
+            rows.execute("""
                 SELECT b.*, c.first_name, c.last_name 
                 FROM billing b 
                 JOIN customers c ON b.customer_id = c.customer_id 
                 ORDER BY b.created_at DESC LIMIT 50
             """)
-            billing = cur.fetchall()
-            return jsonify({'success': True, 'billing': [dict(bill) for bill in billing]})
+            return json_response.rows_response(rows, 'billing', json_response.wants_columnar())
+            
+        elif action == 'render_invoices':
+            # Invoice documents of a billing month (default: last month), rendered in a process pool
+            job_id = jobs.enqueue(cur, 'render_invoices', {'period': request.form.get('period'),
+                                                           'formats': request.form.getlist('formats')})
+            conn.commit()
+            return jsonify({'success': True, 'message': 'Invoice rendering queued', 'job_id': job_id})
+            
+        elif action == 'upload_payments':
+            # Bank/gateway CSV (file upload or pasted text), reconciled by a background job
+            upload = request.files.get('file')
+            if upload:
+                filename, text = upload.filename, upload.read().decode('utf-8-sig')
+            else:
+                filename, text = request.form.get('filename', 'pasted.csv'), request.form['csv']
+            batch_id, job_id = payments.create_batch(cur, filename, text)
+            conn.commit()
+            return jsonify({'success': True, 'message': 'Payment file queued for reconciliation',
+                            'batch_id': batch_id, 'job_id': job_id})
+            
+        elif action == 'get_payment_batch':
+            batch = payments.get_batch(cur, int(request.form['batch_id']))
+            if not batch:
+                return jsonify({'success': False, 'message': 'Payment batch not found'})
+            return jsonify({'success': True, 'batch': batch})
+            
+        elif action == 'list_payment_batches':
+            return jsonify({'success': True, 'batches': payments.list_batches(cur)})
+            
+        elif action == 'run_dunning':
+            # Suspend overdue customers and restore paid ones in the background
+            job_id = jobs.enqueue(cur, 'dunning_run', {'dry_run': request.form.get('dry_run') == '1'})
+            conn.commit()
+            return jsonify({'success': True, 'message': 'Dunning run queued', 'job_id': job_id})
+            
+        elif action == 'get_dunning_runs':
+            return jsonify({'success': True, 'runs': dunning.recent_runs(cur)})
+            
+        elif action == 'run_rating':
+            # Rate metered usage for a month (default: last month) in the background
+            job_id = jobs.enqueue(cur, 'rating_run', {'period': request.form.get('period'),
+                                                      'invoice': request.form.get('invoice') == '1'})
+            conn.commit()
+            return jsonify({'success': True, 'message': 'Rating run queued', 'job_id': job_id})
+            
+        elif action == 'get_usage_ratings':
+            # A customer's rated usage per period with line items, or the recent rating runs
+            if request.form.get('customer_id'):
+                return jsonify({'success': True,
+                                'ratings': rating.customer_ratings(cur, request.form['customer_id'])})
+            return jsonify({'success': True, 'runs': rating.recent_runs(cur)})
+            
+        elif action == 'set_session_limit':
+            # Simultaneous-Use for a profile, enforced by radius_api.py; empty means unlimited
+            limit = request.form.get('simultaneous_use') or None
+            if limit is not None and int(limit) < 1:
+                return jsonify({'success': False, 'message': 'simultaneous_use must be at least 1'})
+            cur.execute("UPDATE service_profiles SET simultaneous_use = %s WHERE name = %s",
+                        (limit, request.form['service_profile']))
+            if cur.rowcount == 0:
+                return jsonify({'success': False, 'message': 'Service profile not found'})
+            conn.commit()
+            return jsonify({'success': True, 'message': 'Session limit updated'})
+            
+        elif action == 'get_bandwidth_schedules':
+            # Time-of-day speeds per profile, applied by bandwidth_scheduler.py
+            return jsonify({
+                'success': True,
+                'schedules': bandwidth_scheduler.list_schedules(cur),
+                'runs': bandwidth_scheduler.recent_runs(cur, 20)
+            })
+            
+        elif action == 'add_bandwidth_schedule':
+            try:
+                schedule_id = bandwidth_scheduler.add_schedule(
+                    cur, request.form['service_profile'], request.form.getlist('days') or range(7),
+                    request.form['start_time'], request.form['end_time'],
+                    request.form['download_speed'], request.form['upload_speed'])
+            except ValueError as e:
+                return jsonify({'success': False, 'message': str(e)})
+            conn.commit()
+            return jsonify({'success': True, 'message': 'Schedule added', 'id': schedule_id})
+            
+        elif action == 'delete_bandwidth_schedule':
+            cur.execute("DELETE FROM bandwidth_schedules WHERE id = %s", (int(request.form['id']),))
+            conn.commit()
+            return jsonify({'success': True, 'message': 'Schedule deleted'})
+            
+        elif action == 'get_reports':
+            # Served from precomputed snapshots, never from the raw tables
+            report_type = request.form.get('report_type', 'revenue')
+            gather = acct_router.gather_report if acct_router.sharded else None
+            rows, data_as_of, approximate = reports.get_report(cur, report_type, request.form, gather)
+            return jsonify({
+                'success': True,
+                'reports': rows,
+                'data_as_of': data_as_of.isoformat() if data_as_of else None,
+                # Usage merged from accounting shards whose top lists may hide part of a total
+                'approximate': approximate
+            })
+            
+        elif action == 'refresh_reports':
+            job_id = jobs.enqueue(cur, 'refresh_reports')
+            conn.commit()
+            return jsonify({'success': True, 'message': 'Report refresh queued', 'job_id': job_id})
+            
+        elif action == 'get_job':
+            job = jobs.get_job(cur, int(request.form['job_id']))
+            if not job:
+                return jsonify({'success': False, 'message': 'Job not found'})
+            return jsonify({'success': True, 'job': job})
+            
+        elif action == 'list_jobs':
+            job_list = jobs.list_jobs(cur, request.form.get('status') or None, request.form.get('kind') or None)
+            return jsonify({'success': True, 'jobs': job_list})
+            
+        elif action == 'cancel_job':
+            status = jobs.cancel_job(cur, int(request.form['job_id']))
+            conn.commit()
+            if not status:
+                return jsonify({'success': False, 'message': 'Job not found or already finished'})
+            return jsonify({'success': True, 'status': status,
+                            'message': 'Job cancelled' if status == 'cancelled' else 'Cancellation requested'})
             
     except Exception as e:
         conn.rollback()
         return jsonify({'success': False, 'message': f'Error: {str(e)}'})
     finally:
+        if not read_only and db_router.has_replicas:
+            try:
+                g.db_lsn = db_router.current_lsn(conn)
+            except psycopg2.Error:
+                pass
         conn.close()
 
 @app.route('/service_profiles')
 def get_service_profiles():
     """Get service profiles for the interface"""
-    conn = get_db_connection()
+    conn = get_db_connection(True, request.cookies.get(LSN_COOKIE))
     if not conn:
         return jsonify([])
     
@@ -201,6 +560,46 @@ def get_service_profiles():
     finally:
         conn.close()
 
+@app.route('/invoices/<invoice_number>.<fmt>')
+def get_invoice_document(invoice_number, fmt):
+    """One invoice as PDF or HTML, from the document cache (rendered now when it is not there)"""
+    if fmt not in invoice_documents.FORMATS:
+        return jsonify({'success': False, 'message': f'Unknown format {fmt}'}), 404
+    conn = get_db_connection(True, request.cookies.get(LSN_COOKIE))
+    if not conn:
+        return jsonify({'success': False, 'message': 'Database connection failed'}), 503
+    try:
+        invoices = list(invoice_documents.fetch_invoices(conn, invoice_numbers=[invoice_number]))
+    finally:
+        conn.close()
+    if not invoices:
+        return jsonify({'success': False, 'message': 'Invoice not found'}), 404
+    path, digest = invoice_documents.ensure_document(invoices[0], fmt)
+    # The content hash is the ETag, so a client asking again gets a 304
+    return send_file(path, mimetype=invoice_documents.FORMATS[fmt], download_name=f"{invoice_number}.{fmt}",
+                     etag=digest, conditional=True, max_age=0)
+
+@app.route('/invoices/cycle/<month>.zip')
+def get_invoice_cycle(month):
+    """Every invoice document of a billing month ('YYYY-MM') as a zip, streamed as it is built"""
+    fmt = request.args.get('format', 'pdf')
+    if fmt not in invoice_documents.FORMATS:
+        return jsonify({'success': False, 'message': f'Unknown format {fmt}'}), 404
+    conn = get_db_connection(True, request.cookies.get(LSN_COOKIE))
+    if not conn:
+        return jsonify({'success': False, 'message': 'Database connection failed'}), 503
+    try:
+        documents, missing = invoice_documents.cycle_documents(conn, month, fmt)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'month must be YYYY-MM'}), 400
+    finally:
+        conn.close()
+    if documents is None:
+        return jsonify({'success': False, 'message': f'{missing} invoices are not rendered yet, '
+                                                     f'run render_invoices for {month} first'}), 409
+    return Response(invoice_documents.zip_stream(documents), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename=invoices-{month}-{fmt}.zip'})
+
 # HTML Template for the admin interface
 ADMIN_TEMPLATE = '''
 <!DOCTYPE html>
@@ -240,6 +639,7 @@ ADMIN_TEMPLATE = '''
         .form-group { margin-bottom: 15px; }
         .form-group label { display: block; margin-bottom: 5px; font-weight: 500; }
         .form-group input, .form-group select { width: 100%; padding: 10px; border: 1px solid #ddd; border-radius: 5px; font-size: 14px; }
+        .search-input { width: 320px; padding: 10px; border: 1px solid #ddd; border-radius: 8px; font-size: 14px; margin-right: 10px; }
         .form-row { display: grid; grid-template-columns: 1fr 1fr; gap: 15px; }
         .table { width: 100%; border-collapse: collapse; margin-top: 20px; }
         .table th, .table td { padding: 12px; text-align: left; border-bottom: 1px solid #e0e0e0; }
@@ -271,9 +671,11 @@ ADMIN_TEMPLATE = '''
             <ul class="nav-menu">
                 <li class="nav-item"><a class="nav-link active" data-section="dashboard"><i class="fas fa-tachometer-alt"></i> Dashboard</a></li>
                 <li class="nav-item"><a class="nav-link" data-section="users"><i class="fas fa-users"></i> Users</a></li>
+                <li class="nav-item"><a class="nav-link" data-section="online"><i class="fas fa-signal"></i> Online Users</a></li>
                 <li class="nav-item"><a class="nav-link" data-section="nas"><i class="fas fa-server"></i> NAS Management</a></li>
                 <li class="nav-item"><a class="nav-link" data-section="billing"><i class="fas fa-file-invoice-dollar"></i> Billing</a></li>
                 <li class="nav-item"><a class="nav-link" data-section="profiles"><i class="fas fa-layer-group"></i> Service Profiles</a></li>
+                <li class="nav-item"><a class="nav-link" data-section="reports"><i class="fas fa-chart-bar"></i> Reports</a></li>
             </ul>
         </nav>
         
@@ -313,11 +715,23 @@ ADMIN_TEMPLATE = '''
             <section id="users" class="content-section">
                 <div class="section-header">
                     <h2 class="section-title">User Management</h2>
-                    <button class="btn" onclick="showAddUserModal()"><i class="fas fa-plus"></i> Add New User</button>
+                    <div>
+                        <input type="search" id="user-search" class="search-input" placeholder="Search name, email, phone, ID, IP or MAC..." autocomplete="off">
+                        <button class="btn" onclick="showAddUserModal()"><i class="fas fa-plus"></i> Add New User</button>
+                    </div>
                 </div>
                 <div id="users-table-container"><p>Loading users...</p></div>
             </section>
             
+            <!-- Online Users Section -->
+            <section id="online" class="content-section">
+                <div class="section-header">
+                    <h2 class="section-title">Online Users</h2>
+                    <button class="btn" onclick="loadOnlineUsers()"><i class="fas fa-sync"></i> Refresh</button>
+                </div>
+                <div id="online-table-container"><p>Loading online users...</p></div>
+            </section>
+            
             <!-- NAS Management Section -->
             <section id="nas" class="content-section">
                 <div class="section-header">
@@ -345,6 +759,23 @@ ADMIN_TEMPLATE = '''
                     <p>Loading service profiles...</p>
                 </div>
             </section>
+            
+            <!-- Reports Section -->
+            <section id="reports" class="content-section">
+                <div class="section-header">
+                    <h2 class="section-title">Reports</h2>
+                    <div>
+                        <select id="report-type" class="search-input" onchange="loadReports()">
+                            <option value="revenue">Revenue by Month</option>
+                            <option value="customers">Customers by Profile</option>
+                            <option value="usage">Top Usage (30 days)</option>
+                        </select>
+                        <button class="btn" onclick="loadReports()"><i class="fas fa-sync"></i> Refresh</button>
+                    </div>
+                </div>
+                <p id="report-as-of" style="color: #666; font-size: 0.9em;"></p>
+                <div id="reports-table-container"><p>Loading report...</p></div>
+            </section>
         </main>
     </div>
     
@@ -453,9 +884,11 @@ ADMIN_TEMPLATE = '''
             switch(section) {
                 case 'dashboard': loadStats(); break;
                 case 'users': loadUsers(); break;
+                case 'online': loadOnlineUsers(); break;
                 case 'nas': loadNAS(); break;
                 case 'billing': loadBilling(); break;
                 case 'profiles': loadProfiles(); break;
+                case 'reports': loadReports(); break;
             }
         }
         
@@ -472,19 +905,92 @@ ADMIN_TEMPLATE = '''
             });
         }
         
+        function renderUsers(users) {
+            let html = '<table class="table"><thead><tr><th>Customer ID</th><th>Name</th><th>Email</th><th>Service Plan</th><th>Price</th><th>Status</th><th>Actions</th></tr></thead><tbody>';
+            users.forEach(user => {
+                const seen = user.framedipaddress ? `<br><small>${user.framedipaddress} ${user.callingstationid || ''}</small>` : '';
+                const price = user.price !== undefined ? `$${parseFloat(user.price || 0).toFixed(2)}` : '';
+                html += `<tr><td>${user.customer_id}</td><td>${user.first_name} ${user.last_name}${seen}</td><td>${user.email}</td><td>${user.service_profile}</td><td>${price}</td><td><span class="status-badge status-${user.status}">${user.status}</span></td><td><button class="btn btn-danger" onclick="deleteUser('${user.customer_id}')">Delete</button></td></tr>`;
+            });
+            html += '</tbody></table>';
+            document.getElementById('users-table-container').innerHTML = html;
+        }
+        
         function loadUsers() {
             fetch('/api/get_users', {method: 'POST'})
             .then(response => response.json())
             .then(data => {
                 if (data.success) {
-                    let html = '<table class="table"><thead><tr><th>Customer ID</th><th>Name</th><th>Email</th><th>Service Plan</th><th>Price</th><th>Status</th><th>Actions</th></tr></thead><tbody>';
-                    data.users.forEach(user => {
-                        html += `<tr><td>${user.customer_id}</td><td>${user.first_name} ${user.last_name}</td><td>${user.email}</td><td>${user.service_profile}</td><td>$${parseFloat(user.price || 0).toFixed(2)}</td><td><span class="status-badge status-${user.status}">${user.status}</span></td><td><button class="btn btn-danger" onclick="deleteUser('${user.customer_id}')">Delete</button></td></tr>`;
+                    renderUsers(data.users);
+                } else {
+                    document.getElementById('users-table-container').innerHTML = '<p>Error loading users: ' + data.message + '</p>';
+                }
+            });
+        }
+        
+        // Typeahead search: debounce keystrokes, drop stale responses and
+        // narrow a complete previous result set locally while the user keeps typing
+        const SEARCH_LIMIT = 20;
+        let searchTimer = null;
+        let searchSeq = 0;
+        let lastSearch = {query: null, users: []};
+        
+        function matchesLocally(user, query) {
+            const text = [user.customer_id, user.first_name, user.last_name, user.username, user.email,
+                          user.phone, user.framedipaddress, user.callingstationid].join(' ').toLowerCase();
+            return text.includes(query);
+        }
+        
+        function searchUsers(query) {
+            if (lastSearch.query && query.startsWith(lastSearch.query) && lastSearch.users.length < SEARCH_LIMIT) {
+                renderUsers(lastSearch.users.filter(user => matchesLocally(user, query)));
+                return;
+            }
+            const seq = ++searchSeq;
+            const formData = new FormData();
+            formData.append('q', query);
+            formData.append('limit', SEARCH_LIMIT);
+            fetch('/api/search_users', {method: 'POST', body: formData})
+            .then(response => response.json())
+            .then(data => {
+                if (seq !== searchSeq || !data.success) return;
+                lastSearch = {query: query, users: data.users};
+                renderUsers(data.users);
+            });
+        }
+        
+        document.getElementById('user-search').addEventListener('input', function() {
+            const query = this.value.trim().toLowerCase().split(/ +/).join(' ');
+            clearTimeout(searchTimer);
+            if (query.length < 3) {
+                searchSeq++;
+                lastSearch = {query: null, users: []};
+                if (query.length === 0) loadUsers();
+                return;
+            }
+            searchTimer = setTimeout(() => searchUsers(query), 200);
+        });
+        
+        function loadOnlineUsers() {
+            const formData = new FormData();
+            formData.append('format', 'columnar');
+            fetch('/api/get_online_users', {method: 'POST', body: formData})
+            .then(response => response.json())
+            .then(data => {
+                if (data.success) {
+                    const col = {};
+                    data.columns.forEach((name, i) => col[name] = i);
+                    const shown = data.online_users.slice(0, 500);
+                    let html = `<p>${data.online_users.length} sessions online${data.online_users.length > shown.length ? ', showing the newest ' + shown.length : ''}</p>`;
+                    html += '<table class="table"><thead><tr><th>Username</th><th>NAS IP</th><th>User IP</th><th>Start Time</th><th>Data Usage</th></tr></thead><tbody>';
+                    shown.forEach(row => {
+                        const usage = ((row[col.acctinputoctets] || 0) + (row[col.acctoutputoctets] || 0)) / (1024 * 1024);
+                        html += `<tr><td>${row[col.username]}</td><td>${row[col.nasipaddress]}</td><td>${row[col.framedipaddress] || 'N/A'}</td><td>${new Date(row[col.acctstarttime]).toLocaleString()}</td><td>${usage.toFixed(2)} MB</td></tr>`;
                     });
                     html += '</tbody></table>';
-                    document.getElementById('users-table-container').innerHTML = html;
+                    document.getElementById('online-table-container').innerHTML = html;
                 } else {
-                    document.getElementById('users-table-container').innerHTML = '<p>Error loading users: ' + data.message + '</p>';
+                    document.getElementById('online-table-container').innerHTML = '<p>Error loading online users: ' + data.message + '</p>';
                 }
             });
         }
@@ -494,9 +1000,10 @@ ADMIN_TEMPLATE = '''
             .then(response => response.json())
             .then(data => {
                 if (data.success) {
-                    let html = '<table class="table"><thead><tr><th>Name</th><th>IP Address</th><th>Type</th><th>Location</th><th>Status</th></tr></thead><tbody>';
+                    let html = '<table class="table"><thead><tr><th>Name</th><th>IP Address</th><th>Type</th><th>Location</th><th>Status</th><th>RTT</th></tr></thead><tbody>';
                     data.nas_devices.forEach(nas => {
-                        html += `<tr><td>${nas.nas_name}</td><td>${nas.nas_ip}</td><td>${nas.nas_type}</td><td>${nas.location || 'N/A'}</td><td><span class="status-badge status-${nas.status}">${nas.status}</span></td></tr>`;
+                        const rtt = nas.last_rtt_ms !== null ? nas.last_rtt_ms + ' ms' : (nas.last_checked ? 'no reply' : 'N/A');
+                        html += `<tr><td>${nas.nas_name}</td><td>${nas.nas_ip}</td><td>${nas.nas_type}</td><td>${nas.location || 'N/A'}</td><td><span class="status-badge status-${nas.status}">${nas.status}</span></td><td>${rtt}</td></tr>`;
                     });
                     html += '</tbody></table>';
                     document.getElementById('nas-table-container').innerHTML = html;
@@ -523,6 +1030,33 @@ ADMIN_TEMPLATE = '''
             });
         }
         
+        function loadReports() {
+            const formData = new FormData();
+            formData.append('report_type', document.getElementById('report-type').value);
+            fetch('/api/get_reports', {method: 'POST', body: formData})
+            .then(response => response.json())
+            .then(data => {
+                if (data.success) {
+                    const asOf = data.data_as_of ? new Date(data.data_as_of).toLocaleString() : 'unknown';
+                    document.getElementById('report-as-of').textContent = 'Data as of ' + asOf +
+                        (data.approximate ? ' (approximate: some totals span accounting shards)' : '');
+                    if (data.reports.length === 0) {
+                        document.getElementById('reports-table-container').innerHTML = '<p>No data</p>';
+                        return;
+                    }
+                    const columns = Object.keys(data.reports[0]);
+                    let html = '<table class="table"><thead><tr>' + columns.map(c => `<th>${c.replace(/_/g, ' ')}</th>`).join('') + '</tr></thead><tbody>';
+                    data.reports.forEach(row => {
+                        html += '<tr>' + columns.map(c => `<td>${row[c] === null ? '' : row[c]}</td>`).join('') + '</tr>';
+                    });
+                    html += '</tbody></table>';
+                    document.getElementById('reports-table-container').innerHTML = html;
+                } else {
+                    document.getElementById('reports-table-container').innerHTML = '<p>Error loading report: ' + data.message + '</p>';
+                }
+            });
+        }
+        
         function loadProfiles() {
             fetch('/service_profiles')
             .then(response => response.json())
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Request Tracing
+Records a span for every admin API request, every SQL statement, commit and
+rollback (the connections are created with TracingConnection, which wraps
+whatever cursor class the caller asks for), every RADIUS/CoA packet exchange
+and every background job. Trace context is W3C traceparent: it is read from
+the incoming request header, stored with jobs enqueued inside a trace and
+restored by the worker that runs them, so a job shows up under the request
+that queued it.
+
+Spans are kept in memory until the trace's root ends. The trace is exported
+if it was sampled (TRACE_SAMPLE_RATE, or the sampled flag of the incoming
+traceparent) or if the root took longer than TRACE_SLOW_MS, so slow requests
+are always kept even at a low sample rate. With both at 0 (the default)
+nothing is recorded and connections are plain psycopg2 connections.
+
+Spans go, one JSON object per line, to a file (TRACE_EXPORT=file:PATH) or as
+UDP datagrams to a collector (TRACE_EXPORT=udp://HOST:PORT); `collect` below
+is a stand-in collector, `show` prints the slowest traces as span trees with
+the critical path marked.
+
+Usage:
+    TRACE_SAMPLE_RATE=0.01 TRACE_SLOW_MS=500 gunicorn ... app:app
+    python tracing.py collect --listen 127.0.0.1:4319 --out /var/log/isp-radius/traces.jsonl
+    python tracing.py show /var/log/isp-radius/traces.jsonl --slowest 5
+"""
+
+import argparse
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '0'))     # keep traces slower than this (0: off)
+TRACE_EXPORT = os.environ.get('TRACE_EXPORT', 'file:/tmp/isp-traces.jsonl')
+TRACE_SERVICE = os.environ.get('TRACE_SERVICE', 'isp-radius')
+MAX_SPANS = 2000             # per trace; bulk CoA runs would otherwise hold every packet
+MAX_STATEMENT = 1000         # characters of SQL kept per span (the query text, never its parameters)
+EXPORT_QUEUE = 1000          # traces waiting for the exporter; more are dropped
+UDP_DATAGRAM = 60000
+
+_current = contextvars.ContextVar('trace_span', default=None)
+_TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+
+def enabled():
+    return TRACE_SAMPLE_RATE > 0 or TRACE_SLOW_MS > 0
+
+
+class Trace:
+    __slots__ = ('trace_id', 'sampled', 'spans', 'started', 'dropped')
+
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = []             # finished spans, root excluded
+        self.started = 0            # counted at start: concurrent spans (CoA bursts) end late
+        self.dropped = 0
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'kind', 'start', '_t0', 'duration',
+                 'attributes', 'error', '_token')
+
+    def __init__(self, trace, parent_id, name, kind, attributes):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self.duration = None
+        self.attributes = attributes
+        self.error = None
+        self._token = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, error=None):
+        self.duration = time.perf_counter() - self._t0
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def traceparent(self):
+        return f"00-{self.trace.trace_id}-{self.span_id}-{'01' if self.trace.sampled else '00'}"
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id,
+            'service': TRACE_SERVICE, 'name': self.name, 'kind': self.kind, 'start': self.start,
+            'duration_ms': round((self.duration or 0) * 1000, 3), 'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+def start_trace(name, traceparent=None, kind='server', **attributes):
+    """Begin a trace in the current context and return its root span (None when not recording)
+
+    An incoming traceparent continues that trace and keeps its sampling
+    decision. End it with finish_trace().
+    """
+    if not enabled():
+        return None
+    match = _TRACEPARENT.match(traceparent or '')
+    if match:
+        trace = Trace(match.group(1), bool(int(match.group(3), 16) & 1))
+        parent_id = match.group(2)
+    else:
+        trace = Trace(os.urandom(16).hex(), random.random() < TRACE_SAMPLE_RATE)
+        parent_id = None
+    root = Span(trace, parent_id, name, kind, attributes)
+    root._token = _current.set(root)
+    return root
+
+
+def finish_trace(root, error=None):
+    """End the root span and hand the trace to the exporter if it is sampled or slow"""
+    if root is None:
+        return
+    root.end(error)
+    _current.reset(root._token)
+    trace = root.trace
+    if trace.sampled or (TRACE_SLOW_MS > 0 and root.duration * 1000 >= TRACE_SLOW_MS):
+        if trace.dropped:
+            root.set('spans_dropped', trace.dropped)
+        _exporter().submit([span.as_dict() for span in trace.spans + [root]])
+
+
+@contextmanager
+def trace(name, traceparent=None, kind='server', **attributes):
+    """start_trace()/finish_trace() around a block (jobs, CLI runs)"""
+    root = start_trace(name, traceparent, kind, **attributes)
+    try:
+        yield root
+    except BaseException as e:
+        finish_trace(root, e)
+        raise
+    finish_trace(root)
+
+
+@contextmanager
+def span(name, kind='internal', **attributes):
+    """A child of the current span; yields None (and costs nothing) outside a trace"""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    trace = parent.trace
+    if trace.started >= MAX_SPANS:
+        trace.dropped += 1
+        yield None
+        return
+    trace.started += 1
+    current = Span(trace, parent.span_id, name, kind, attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.end(e)
+        raise
+    else:
+        current.end()
+    finally:
+        _current.reset(token)
+        trace.spans.append(current)
+
+
+def current_traceparent():
+    """traceparent of the current span, for handing the trace to another process (None outside a trace)"""
+    current = _current.get()
+    return current.traceparent() if current is not None else None
+
+
+def current_trace_id():
+    current = _current.get()
+    return current.trace.trace_id if current is not None else None
+
+
+# SQL: a connection class that traces every statement of every cursor it creates
+
+def _statement(cursor, query):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    elif not isinstance(query, str):
+        query = query.as_string(cursor)
+    return ' '.join(query.split())[:MAX_STATEMENT]
+
+
+class _TracedCursor:
+    def _traced(self, method, query, *args):
+        if _current.get() is None:
+            return method(query, *args)
+        statement = _statement(self, query)
+        with span(statement.split(' ', 1)[0].upper() or 'SQL', 'client', **{
+            'db.statement': statement, 'db.server': self.connection.info.host,
+        }) as current:
+            result = method(query, *args)
+            if current is not None:
+                current.set('db.rows', self.rowcount)
+            return result
+
+    def execute(self, query, vars=None):
+        return self._traced(super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._traced(super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._traced(super().copy_expert, sql, file, size)
+
+
+_traced_cursors = {}
+
+
+def _traced_cursor(factory):
+    traced = _traced_cursors.get(factory)
+    if traced is None:
+        traced = _traced_cursors.setdefault(factory, type(f'Traced{factory.__name__}', (_TracedCursor, factory), {}))
+    return traced
+
+
+class TracingConnection(psycopg2.extensions.connection):
+    """psycopg2 connection whose cursors, commits and rollbacks are recorded as spans"""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _traced_cursor(factory)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        with span('COMMIT', 'client', **{'db.server': self.info.host}):
+            return super().commit()
+
+    def rollback(self):
+        with span('ROLLBACK', 'client', **{'db.server': self.info.host}):
+            return super().rollback()
+
+
+def connection_factory():
+    """connection_factory argument for psycopg2.connect: TracingConnection when tracing is on"""
+    return TracingConnection if enabled() else None
+
+
+# Export
+
+class Exporter:
+    """Writes finished traces from a background thread so requests never wait on I/O"""
+
+    def __init__(self, target=TRACE_EXPORT):
+        self.target = target
+        self.queue = queue.Queue(maxsize=EXPORT_QUEUE)
+        self.dropped = 0
+        self._socket = None
+        if target.startswith('udp://'):
+            host, port = target[len('udp://'):].rsplit(':', 1)
+            self._address = (host, int(port))
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        threading.Thread(target=self._run, name='trace-export', daemon=True).start()
+
+    def submit(self, spans):
+        try:
+            self.queue.put_nowait(spans)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write([span for spans in batch for span in spans])
+            except OSError as e:
+                print(f"Trace export failed: {e}")
+
+    def _write(self, spans):
+        lines = [json.dumps(span, default=str) for span in spans]
+        if self._socket is None:
+            # One append per batch; O_APPEND keeps lines from several workers whole
+            with open(self.target[len('file:'):] if self.target.startswith('file:') else self.target, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+            return
+        datagram = []
+        size = 0
+        for line in lines + [None]:
+            if datagram and (line is None or size + len(line) + 1 > UDP_DATAGRAM):
+                self._socket.sendto('\n'.join(datagram).encode(), self._address)
+                datagram, size = [], 0
+            if line is not None:
+                datagram.append(line)
+                size += len(line) + 1
+
+
+_exporter_instance = None
+_exporter_lock = threading.Lock()
+
+
+def _exporter():
+    global _exporter_instance
+    if _exporter_instance is None:
+        with _exporter_lock:
+            if _exporter_instance is None:
+                _exporter_instance = Exporter()
+    return _exporter_instance
+
+
+# Collector stand-in and trace viewer
+
+def collect(host, port, out):
+    """Receive span datagrams and append them to `out` until interrupted"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Room for a burst from a large trace (capped by net.core.rmem_max)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    sock.bind((host, port))
+    print(f"Collecting spans on udp://{host}:{port} into {out}")
+    with open(out, 'a') as f:
+        while True:
+            data, _ = sock.recvfrom(65535)
+            f.write(data.decode('utf-8', 'replace').rstrip('\n') + '\n')
+            f.flush()
+
+
+def load_traces(path):
+    traces = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                span_row = json.loads(line)
+                traces[span_row['trace_id']].append(span_row)
+    return traces
+
+
+def critical_path(spans):
+    """span_ids on the critical path: from each root, follow the child that finished last"""
+    children = defaultdict(list)
+    ids = {span_row['span_id'] for span_row in spans}
+    for span_row in spans:
+        children[span_row['parent_id'] if span_row['parent_id'] in ids else None].append(span_row)
+    path = set()
+    for root in children[None]:
+        node = root
+        while node is not None:
+            path.add(node['span_id'])
+            kids = children.get(node['span_id'])
+            node = max(kids, key=lambda s: s['start'] + s['duration_ms'] / 1000) if kids else None
+    return children, path
+
+
+def print_trace(spans, out=print):
+    children, path = critical_path(spans)
+    started = min(span_row['start'] for span_row in spans)
+
+    def walk(span_row, depth):
+        marker = '*' if span_row['span_id'] in path else ' '
+        detail = span_row['attributes'].get('db.statement') or span_row['attributes'].get('net.peer') or ''
+        error = f" !! {span_row['error'].splitlines()[0]}" if span_row.get('error') else ''
+        out(f"{marker} {(span_row['start'] - started) * 1000:9.1f}ms {span_row['duration_ms']:9.1f}ms "
+            f"{'  ' * depth}{span_row['name']} [{span_row['service']}] {detail[:100]}{error}")
+        for child in sorted(children.get(span_row['span_id'], []), key=lambda s: s['start']):
+            walk(child, depth + 1)
+
+    for root in sorted(children[None], key=lambda s: s['start']):
+        walk(root, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collect and inspect request traces')
+    commands = parser.add_subparsers(dest='command', required=True)
+    collector = commands.add_parser('collect', help='Receive spans over UDP and append them to a file')
+    collector.add_argument('--listen', default='127.0.0.1:4319', help='host:port')
+    collector.add_argument('--out', required=True, help='File to append spans to')
+    show = commands.add_parser('show', help='Print traces as span trees, critical path marked with *')
+    show.add_argument('file')
+    show.add_argument('--slowest', type=int, default=5, help='How many of the slowest traces')
+    show.add_argument('--trace', help='Only this trace id')
+    args = parser.parse_args()
+
+    if args.command == 'collect':
+        host, port = args.listen.rsplit(':', 1)
+        try:
+            collect(host, int(port), args.out)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    traces = load_traces(args.file)
+    if args.trace:
+        selected = [args.trace] if args.trace in traces else []
+    else:
+        def total(trace_id):
+            spans = traces[trace_id]
+            return max(s['start'] + s['duration_ms'] / 1000 for s in spans) - min(s['start'] for s in spans)
+        selected = sorted(traces, key=total, reverse=True)[:args.slowest]
+    for trace_id in selected:
+        print(f"trace {trace_id}")
+        print_trace(traces[trace_id])
+        print()
+
+
+if __name__ == '__main__':
+    main()
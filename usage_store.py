@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+ISP RADIUS Management System - Usage History
+radacct keeps only cumulative octets per session, so every Interim-Update
+overwrites when the traffic happened. This collector follows the accounting
+events (see acct_events), turns each interim into a per-sample delta and
+stores the samples per subscriber and day in one compact chunk: a bytea of
+varints (seconds since the previous sample, input octets, output octets), so
+a 5-minute sample costs about a dozen bytes instead of a table row.
+Chunks are appended in batches; the per-session counters are saved in the
+same transaction, so a crash only makes the next sample coarser.
+
+Usage:
+    python usage_store.py                 # run the collector
+    python usage_store.py --stats         # storage used per sample
+"""
+
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+import psycopg2.extras
+
+import acct_events
+import acct_shards
+from db_routing import connection_params
+from pg_listen import listen_forever
+
+FLUSH_INTERVAL = int(os.environ.get('USAGE_FLUSH_INTERVAL', '900'))   # seconds between chunk appends
+RETENTION_DAYS = int(os.environ.get('USAGE_RETENTION_DAYS', '400'))
+MAX_POINTS = 2000
+
+USAGE_SCHEMA = """
+-- One row per subscriber and day (UTC); data holds the delta-encoded samples
+CREATE TABLE IF NOT EXISTS usage_chunks (
+    username VARCHAR(64) NOT NULL,
+    day DATE NOT NULL,
+    data BYTEA NOT NULL,
+    samples INTEGER NOT NULL,
+    input_octets BIGINT NOT NULL,
+    output_octets BIGINT NOT NULL,
+    -- Seconds since midnight of the last sample, the base for the next append
+    last_offset INTEGER NOT NULL,
+    PRIMARY KEY (username, day)
+) WITH (fillfactor = 50);
+CREATE INDEX IF NOT EXISTS usage_chunks_day_idx ON usage_chunks (day);
+
+-- Counters of the open sessions as of the last append
+CREATE TABLE IF NOT EXISTS usage_sessions (
+    nasipaddress INET NOT NULL,
+    acctsessionid VARCHAR(64) NOT NULL,
+    username VARCHAR(64) NOT NULL,
+    input_octets BIGINT NOT NULL,
+    output_octets BIGINT NOT NULL,
+    updated_at TIMESTAMP with time zone NOT NULL,
+    PRIMARY KEY (nasipaddress, acctsessionid)
+);
+"""
+
+
+def _put_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_samples(samples, last_offset):
+    """[(offset, input, output), ...] -> (bytes, new last offset); offsets are seconds since midnight"""
+    out = bytearray()
+    for offset, input_octets, output_octets in samples:
+        # Out-of-order samples are recorded at the previous sample's time
+        offset = max(offset, last_offset)
+        _put_varint(out, offset - last_offset)
+        _put_varint(out, input_octets)
+        _put_varint(out, output_octets)
+        last_offset = offset
+    return bytes(out), last_offset
+
+
+def decode_samples(data):
+    """Chunk bytes -> [(offset, input, output), ...]"""
+    samples = []
+    values = []
+    value = shift = 0
+    offset = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(value)
+        value = shift = 0
+        if len(values) == 3:
+            offset += values[0]
+            samples.append((offset, values[1], values[2]))
+            values = []
+    return samples
+
+
+def _day_offset(ts):
+    moment = datetime.fromtimestamp(ts, timezone.utc)
+    return moment.date(), moment.hour * 3600 + moment.minute * 60 + moment.second
+
+
+class UsageCollector:
+    """Turns accounting events into per-subscriber samples and appends them in batches"""
+
+    def __init__(self):
+        self.sessions = {}      # (nasip, sessionid) -> [username, input, output]
+        self.pending = {}       # (username, day) -> [(offset, input, output), ...]
+        self.chunk_last = {}    # (username, day) -> offset of the last stored sample
+        self._touched = set()
+        self._stopped = set()
+        self.router = None      # acct_shards.ShardRouter when radacct is sharded
+        self._resync = threading.Event()
+        self._lock = threading.Lock()
+        self.stats = {'events': 0, 'samples': 0, 'flushes': 0, 'chunks_written': 0}
+
+    def load(self, conn):
+        """Restore session counters, closing sessions that stopped while we were not listening"""
+        cur = conn.cursor()
+        with self._lock:
+            self._flush_locked(conn)
+            cur.execute("""
+                SELECT host(nasipaddress), acctsessionid, username, input_octets, output_octets
+                FROM usage_sessions
+            """)
+            sessions = {(nasip, sessionid): [username, input_octets, output_octets]
+                        for nasip, sessionid, username, input_octets, output_octets in cur.fetchall()}
+            # Sessions we were tracking that have stopped since: record their final delta
+            keys = list(sessions)
+            for nasip, sessionid, input_octets, output_octets, stopped in self._radacct(conn, """
+                SELECT host(nasipaddress), acctsessionid, COALESCE(acctinputoctets, 0),
+                       COALESCE(acctoutputoctets, 0), EXTRACT(EPOCH FROM acctstoptime)
+                FROM radacct
+                WHERE acctstoptime IS NOT NULL
+                  AND (nasipaddress, acctsessionid) IN (SELECT * FROM unnest(%s::inet[], %s::varchar[]))
+            """, ([key[0] for key in keys], [key[1] for key in keys])):
+                session = sessions.pop((nasip, sessionid), None)
+                if session is None:
+                    continue
+                self._add_sample(session[0], float(stopped), max(input_octets - session[1], 0),
+                                 max(output_octets - session[2], 0))
+                self._stopped.add((nasip, sessionid))
+            # Open sessions we have no counters for start from their current totals
+            for nasip, sessionid, username, input_octets, output_octets in self._radacct(conn, """
+                SELECT host(nasipaddress), acctsessionid, username,
+                       COALESCE(acctinputoctets, 0), COALESCE(acctoutputoctets, 0)
+                FROM radacct WHERE acctstoptime IS NULL
+            """):
+                if (nasip, sessionid) not in sessions:
+                    sessions[(nasip, sessionid)] = [username, input_octets, output_octets]
+                    self._touched.add((nasip, sessionid))
+            self.sessions = sessions
+            cur.execute("SELECT username, day, last_offset FROM usage_chunks WHERE day >= %s",
+                        (datetime.now(timezone.utc).date() - timedelta(days=1),))
+            self.chunk_last = {(username, day): last for username, day, last in cur.fetchall()}
+            conn.commit()
+        print(f"Usage collector tracking {len(sessions)} open sessions")
+
+    def _radacct(self, conn, sql, params=None):
+        """Rows of a radacct query, from every accounting shard when radacct is sharded"""
+        if self.router is None or not self.router.sharded:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            return cur.fetchall()
+        # A shard that does not answer only makes its sessions' next samples coarser
+        _, results, _ = self.router.scatter(sql, params, conn)
+        return [row for rows in results.values() for row in rows]
+
+    def apply_events(self, events):
+        with self._lock:
+            for event in events:
+                self.stats['events'] += 1
+                key = (event.get('nasip'), event.get('sessionid'))
+                input_octets = event.get('input_octets') or 0
+                output_octets = event.get('output_octets') or 0
+                session = self.sessions.get(key)
+                if session is None:
+                    # A start, or a session that began before we were listening
+                    session = self.sessions[key] = [event['username'], 0, 0]
+                    if event['event'] != 'start':
+                        session[1:] = [input_octets, output_octets]
+                        input_octets = output_octets = None
+                if input_octets is not None:
+                    # A counter that went backwards was reset by the NAS
+                    delta_in = input_octets - session[1] if input_octets >= session[1] else input_octets
+                    delta_out = output_octets - session[2] if output_octets >= session[2] else output_octets
+                    if delta_in or delta_out:
+                        self._add_sample(session[0], float(event['ts']), delta_in, delta_out)
+                    session[1], session[2] = input_octets, output_octets
+                if event['event'] == 'stop':
+                    del self.sessions[key]
+                    self._stopped.add(key)
+                    self._touched.discard(key)
+                else:
+                    self._touched.add(key)
+
+    def _add_sample(self, username, ts, input_octets, output_octets):
+        day, offset = _day_offset(ts)
+        self.pending.setdefault((username, day), []).append((offset, input_octets, output_octets))
+        self.stats['samples'] += 1
+
+    def flush(self, conn):
+        with self._lock:
+            return self._flush_locked(conn)
+
+    def _flush_locked(self, conn):
+        """Append pending samples and save session counters in one transaction"""
+        if not (self.pending or self._touched or self._stopped):
+            return 0
+        chunks, new_last = [], {}
+        for key, samples in self.pending.items():
+            samples.sort()
+            last = self.chunk_last.get(key, 0)
+            data, new_last[key] = encode_samples(samples, last)
+            chunks.append((key[0], key[1], psycopg2.Binary(data), len(samples),
+                           sum(sample[1] for sample in samples), sum(sample[2] for sample in samples),
+                           new_last[key]))
+        now = datetime.now(timezone.utc)
+        sessions = [(nasip, sessionid, *self.sessions[(nasip, sessionid)], now)
+                    for nasip, sessionid in self._touched if (nasip, sessionid) in self.sessions]
+        cur = conn.cursor()
+        try:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO usage_chunks AS c (username, day, data, samples, input_octets, output_octets, last_offset)
+                VALUES %s
+                ON CONFLICT (username, day) DO UPDATE SET
+                    data = c.data || EXCLUDED.data,
+                    samples = c.samples + EXCLUDED.samples,
+                    input_octets = c.input_octets + EXCLUDED.input_octets,
+                    output_octets = c.output_octets + EXCLUDED.output_octets,
+                    last_offset = EXCLUDED.last_offset
+            """, chunks, page_size=1000)
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO usage_sessions (nasipaddress, acctsessionid, username, input_octets, output_octets,
+                                            updated_at)
+                VALUES %s
+                ON CONFLICT (nasipaddress, acctsessionid) DO UPDATE SET
+                    input_octets = EXCLUDED.input_octets,
+                    output_octets = EXCLUDED.output_octets,
+                    updated_at = EXCLUDED.updated_at
+            """, sessions, template='(%s::inet, %s, %s, %s, %s, %s)', page_size=1000)
+            psycopg2.extras.execute_values(cur, """
+                DELETE FROM usage_sessions u USING (VALUES %s) AS s(nasip, sessionid)
+                WHERE u.nasipaddress = s.nasip::inet AND u.acctsessionid = s.sessionid
+            """, list(self._stopped), page_size=1000)
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        self.chunk_last.update(new_last)
+        self.pending.clear()
+        self._touched.clear()
+        self._stopped.clear()
+        self.stats['flushes'] += 1
+        self.stats['chunks_written'] += len(chunks)
+        return len(chunks)
+
+    def run(self, connect, flush_interval=FLUSH_INTERVAL, router=None):
+        """Listen for accounting events (on every accounting shard) and append chunks every flush_interval seconds"""
+        self.router = router
+
+        def on_notify(conn, batch):
+            events = acct_events.parse_events(batch)
+            if events:
+                self.apply_events(events)
+
+        listener = threading.Thread(target=listen_forever, name='usage-events', daemon=True,
+                                    args=(connect, [acct_events.CHANNEL], on_notify, self.load))
+        listener.start()
+        # Other accounting shards only publish their sessions; a reconnect there asks for a reload
+        if router is not None and router.sharded:
+            for shard in router.shards:
+                if shard == acct_shards.PRIMARY_SHARD:
+                    continue
+                threading.Thread(target=listen_forever, name=f'usage-events-{shard}', daemon=True,
+                                 args=(lambda shard=shard: router.connect(shard), [acct_events.CHANNEL],
+                                       on_notify, lambda conn: self._resync.set())).start()
+        conn = None
+        last_purge = 0
+        while True:
+            resync = self._resync.wait(flush_interval)
+            try:
+                if conn is None or conn.closed:
+                    conn = connect()
+                if resync:
+                    self._resync.clear()
+                    self.load(conn)
+                    continue
+                written = self.flush(conn)
+                print(f"{datetime.now().isoformat()} appended {written} chunks, "
+                      f"{len(self.sessions)} open sessions")
+                if time.time() - last_purge > 86400:
+                    cur = conn.cursor()
+                    cur.execute("DELETE FROM usage_chunks WHERE day < CURRENT_DATE - %s", (RETENTION_DAYS,))
+                    conn.commit()
+                    # Keep the same window as load(): older days get no new samples
+                    yesterday = datetime.now(timezone.utc).date() - timedelta(days=1)
+                    with self._lock:
+                        self.chunk_last = {key: last for key, last in self.chunk_last.items()
+                                           if key[1] >= yesterday}
+                    last_purge = time.time()
+            except psycopg2.Error as e:
+                print(f"Usage flush error: {e}")
+                if conn is not None:
+                    conn.close()
+                conn = None
+
+
+def usage_history(cur, username, start, end, points=300):
+    """Traffic of one subscriber between two datetimes, summed into at most `points` buckets
+
+    Returns (bucket_seconds, [(bucket_start, input_octets, output_octets), ...]).
+    Buckets of a day or more are served from the per-day totals without decoding.
+    """
+    points = max(1, min(int(points), MAX_POINTS))
+    start_ts, end_ts = start.timestamp(), end.timestamp()
+    bucket = max(300, int((end_ts - start_ts) / points))
+    daily = bucket >= 86400
+    if daily:
+        bucket = bucket // 86400 * 86400
+    columns = "day, input_octets, output_octets" if daily else "day, data"
+    cur.execute(f"""
+        SELECT {columns} FROM usage_chunks
+        WHERE username = %s AND day BETWEEN %s AND %s
+        ORDER BY day
+    """, (username, start.astimezone(timezone.utc).date(), end.astimezone(timezone.utc).date()))
+    buckets = {}
+    for row in cur.fetchall():
+        row = list(row.values()) if isinstance(row, dict) else row
+        midnight = datetime(row[0].year, row[0].month, row[0].day, tzinfo=timezone.utc).timestamp()
+        samples = [(0, row[1], row[2])] if daily else decode_samples(bytes(row[1]))
+        for offset, input_octets, output_octets in samples:
+            ts = midnight + offset
+            if not daily and not start_ts <= ts < end_ts:
+                continue
+            slot = int((ts - start_ts) // bucket) if ts >= start_ts else 0
+            totals = buckets.setdefault(slot, [0, 0])
+            totals[0] += input_octets
+            totals[1] += output_octets
+    series = [(datetime.fromtimestamp(start_ts + slot * bucket, timezone.utc), totals[0], totals[1])
+              for slot, totals in sorted(buckets.items())]
+    return bucket, series
+
+
+def storage_stats(cur):
+    cur.execute("""
+        SELECT COUNT(*), COALESCE(SUM(samples), 0), COALESCE(SUM(octet_length(data)), 0),
+               pg_total_relation_size('usage_chunks')
+        FROM usage_chunks
+    """)
+    chunks, samples, data_bytes, table_bytes = cur.fetchone()
+    return {
+        'chunks': chunks,
+        'samples': samples,
+        'data_bytes_per_sample': round(data_bytes / samples, 2) if samples else None,
+        'table_bytes_per_sample': round(table_bytes / samples, 2) if samples else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collect per-interim usage history')
+    parser.add_argument('--dsn', help='PostgreSQL DSN (defaults to the app DB_CONFIG)')
+    parser.add_argument('--flush-interval', type=int, default=FLUSH_INTERVAL,
+                        help='Seconds between chunk appends')
+    parser.add_argument('--stats', action='store_true', help='Print storage per sample and exit')
+    args = parser.parse_args()
+
+    if args.dsn:
+        config = {'dsn': args.dsn}
+    else:
+        from app import DB_CONFIG
+        config = DB_CONFIG
+    connect = lambda: psycopg2.connect(**connection_params(config))
+
+    if args.stats:
+        conn = connect()
+        print(storage_stats(conn.cursor()))
+        conn.close()
+        return
+    UsageCollector().run(connect, args.flush_interval, acct_shards.ShardRouter(config))
+
+
+if __name__ == '__main__':
+    main()